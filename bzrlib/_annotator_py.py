@@ -36,9 +36,19 @@ from bzrlib import (
 class Annotator(object):
     """Class that drives performing annotations."""
 
-    def __init__(self, vf):
-        """Create a new Annotator from a VersionedFile."""
+    def __init__(self, vf, cache=None):
+        """Create a new Annotator from a VersionedFile.
+
+        :param cache: An optional annotation_cache.AnnotationCache. The
+            ancestry of texts found in it is not annotated again, and the
+            texts annotated are added to it.
+        """
         self._vf = vf
+        self._cache = cache
+        # Keys whose annotations were read from the cache, their ancestry is
+        # left out of self._parent_map.
+        self._cached_keys = set()
+        self._special_keys = set()
         self._parent_map = {}
         self._text_cache = {}
         # Map from key => number of nexts that will be built from this key
@@ -85,8 +95,16 @@ class Annotator(object):
                         ann_keys_needed.add(key)
                         next_parent_map[key] = self._parent_map[key]
                 else:
-                    parent_lookup.append(key)
                     vf_keys_needed.add(key)
+                    if self._cache is not None:
+                        annotations = self._cache.get(key)
+                        if annotations is not None:
+                            # Only the text is needed, to annotate children
+                            self._cached_keys.add(key)
+                            self._annotations_cache[key] = annotations
+                            next_parent_map[key] = ()
+                            continue
+                    parent_lookup.append(key)
             needed_keys = set()
             next_parent_map.update(self._vf.get_parent_map(parent_lookup))
             for key, parent_keys in next_parent_map.iteritems():
@@ -213,7 +231,7 @@ class Annotator(object):
         for parent_key in parent_keys:
             num = self._num_needed_children[parent_key]
             num -= 1
-            if num == 0:
+            if num == 0 and parent_key not in self._cached_keys:
                 del self._text_cache[parent_key]
                 del self._annotations_cache[parent_key]
                 # Do we want to clean up _num_needed_children at this point as
@@ -246,6 +264,7 @@ class Annotator(object):
         """
         self._parent_map[key] = parent_keys
         self._text_cache[key] = osutils.split_lines(text)
+        self._special_keys.add(key)
         self._heads_provider = None
 
     def annotate(self, key):
@@ -260,6 +279,8 @@ class Annotator(object):
         pb = ui.ui_factory.nested_progress_bar()
         try:
             for text_key, text, num_lines in self._get_needed_texts(key, pb=pb):
+                if text_key in self._cached_keys:
+                    continue
                 self._annotate_one(text_key, text, num_lines)
         finally:
             pb.finished()
@@ -267,11 +288,25 @@ class Annotator(object):
             annotations = self._annotations_cache[key]
         except KeyError:
             raise errors.RevisionNotPresent(key, self._vf)
+        if (self._cache is not None and key not in self._cached_keys
+            and key not in self._special_keys):
+            self._cache.put(key, annotations)
         return annotations, self._text_cache[key]
 
     def _get_heads_provider(self):
         if self._heads_provider is None:
-            self._heads_provider = _mod_graph.KnownGraph(self._parent_map)
+            if self._cached_keys:
+                # The annotations read from the cache refer to texts whose
+                # ancestry is not in self._parent_map.
+                parent_map = dict((key, parents) for key, parents
+                                  in self._parent_map.iteritems()
+                                  if key not in self._cached_keys)
+                self._heads_provider = _mod_graph.Graph(
+                    _mod_graph.StackedParentsProvider([
+                        _mod_graph.DictParentsProvider(parent_map),
+                        self._vf]))
+            else:
+                self._heads_provider = _mod_graph.KnownGraph(self._parent_map)
         return self._heads_provider
 
     def _resolve_annotation_tie(self, the_heads, line, tiebreaker):
@@ -0,0 +1,155 @@
+# Copyright (C) 2017 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Persistent cache of the annotations of file texts.
+
+Annotating a text requires extracting and diffing every text in its
+ancestry. As texts never change once committed, the annotations computed for
+a (file_id, revision_id) key stay valid forever and are stored in the
+repository. An Annotator given a cache stops walking the ancestry at the
+texts it finds there, so only the versions added since are extracted and
+diffed.
+"""
+
+from __future__ import absolute_import
+
+import zlib
+
+from bzrlib import (
+    bencode,
+    errors,
+    osutils,
+    )
+from bzrlib.trace import mutter
+
+
+_FORMAT_STRING = 'Bazaar annotation cache v1\n'
+
+
+class AnnotationCache(object):
+    """The annotations of texts, stored one file per text key on a transport.
+
+    Files are spread in subdirectories named after the first two hex digits
+    of the sha1 of their key.
+    """
+
+    def __init__(self, transport, file_mode=None, dir_mode=None):
+        """Create an AnnotationCache.
+
+        :param transport: The transport holding the cache files, usually
+            the 'annotation-cache' directory of a repository.
+        :param file_mode: The mode to create the cache files with.
+        :param dir_mode: The mode to create the cache directories with.
+        """
+        self._transport = transport
+        self._file_mode = file_mode
+        self._dir_mode = dir_mode
+
+    def _path_for_key(self, key):
+        name = osutils.sha_string('\x00'.join(key))
+        return name[:2] + '/' + name[2:]
+
+    def _ensure_directory(self, dirname):
+        try:
+            self._transport.mkdir(dirname, mode=self._dir_mode)
+        except errors.NoSuchFile:
+            # The cache itself is only created when first written to
+            self._transport.mkdir('.', mode=self._dir_mode)
+            self._transport.mkdir(dirname, mode=self._dir_mode)
+
+    def get(self, key):
+        """Read the annotations of a text.
+
+        :param key: The key of the text.
+        :return: A list with a tuple of origin keys for each line of the text,
+            as returned by Annotator.annotate, or None if the text is not in
+            the cache.
+        """
+        try:
+            bytes = self._transport.get_bytes(self._path_for_key(key))
+        except errors.NoSuchFile:
+            return None
+        if not bytes.startswith(_FORMAT_STRING):
+            mutter('ignoring annotation cache entry with unknown format'
+                   ' for %r', key)
+            return None
+        try:
+            cached_key, origins, lines = bencode.bdecode_as_tuple(
+                zlib.decompress(bytes[len(_FORMAT_STRING):]))
+            if cached_key != tuple(key):
+                raise ValueError('entry is for %r' % (cached_key,))
+            # Lines with the same origins share the same tuple, as they do
+            # when the annotations are computed.
+            annotations = {}
+            result = []
+            for indexes in lines:
+                annotation = annotations.get(indexes)
+                if annotation is None:
+                    annotation = tuple([origins[i] for i in indexes])
+                    annotations[indexes] = annotation
+                result.append(annotation)
+        except (ValueError, TypeError, IndexError, zlib.error), e:
+            mutter('ignoring corrupt annotation cache entry for %r: %s',
+                   key, e)
+            return None
+        return result
+
+    def put(self, key, annotations):
+        """Store the annotations of a text.
+
+        Failing to write the cache is not an error, the text is simply not
+        cached.
+
+        :param key: The key of the text.
+        :param annotations: A list with a tuple of origin keys for each line
+            of the text.
+        """
+        origins = []
+        origin_indexes = {}
+        lines = []
+        for annotation in annotations:
+            indexes = []
+            for origin in annotation:
+                index = origin_indexes.get(origin)
+                if index is None:
+                    index = origin_indexes[origin] = len(origins)
+                    origins.append(tuple(origin))
+                indexes.append(index)
+            lines.append(indexes)
+        bytes = _FORMAT_STRING + zlib.compress(
+            bencode.bencode((tuple(key), origins, lines)))
+        path = self._path_for_key(key)
+        try:
+            try:
+                self._transport.put_bytes(path, bytes, mode=self._file_mode)
+            except errors.NoSuchFile:
+                self._ensure_directory(path[:2])
+                self._transport.put_bytes(path, bytes, mode=self._file_mode)
+        except (errors.TransportNotPossible, errors.PathError), e:
+            mutter('unable to write annotation cache entry for %r: %s',
+                   key, e)
+
+
+def cache_for_repository(repository):
+    """Return the annotation cache of a repository.
+
+    :param repository: A repository stored on a transport.
+    :return: An AnnotationCache using the 'annotation-cache' directory of the
+        repository, which is only created when the first entry is stored.
+    """
+    return AnnotationCache(repository._transport.clone('annotation-cache'),
+                           file_mode=repository.bzrdir._get_file_mode(),
+                           dir_mode=repository.bzrdir._get_dir_mode())
@@ -38,6 +38,7 @@ from bzrlib import (
     remote,
     repository,
     revision as _mod_revision,
+    revno_cache,
     rio,
     shelf,
     tag as _mod_tag,
@@ -521,11 +522,8 @@ class Branch(controldir.ControlComponent):
         # we need the full graph to get stable numbers, regardless of the
         # start_revision_id.
         if self._merge_sorted_revisions_cache is None:
-            last_revision = self.last_revision()
-            known_graph = self.repository.get_known_graph_ancestry(
-                [last_revision])
-            self._merge_sorted_revisions_cache = known_graph.merge_sort(
-                last_revision)
+            self._merge_sorted_revisions_cache = (
+                self._gen_merge_sorted_revisions())
         filtered = self._filter_merge_sorted_revisions(
             self._merge_sorted_revisions_cache, start_revision_id,
             stop_revision_id, stop_rule)
@@ -539,6 +537,19 @@ class Branch(controldir.ControlComponent):
         else:
             raise ValueError('invalid direction %r' % direction)
 
+    def _gen_merge_sorted_revisions(self):
+        """Merge sort the ancestry of the branch tip.
+
+        This is the worker function for iter_merge_sorted_revisions, which
+        caches the return value.
+
+        :return: A list of nodes as returned by KnownGraph.merge_sort.
+        """
+        last_revision = self.last_revision()
+        known_graph = self.repository.get_known_graph_ancestry(
+            [last_revision])
+        return known_graph.merge_sort(last_revision)
+
     def _filter_merge_sorted_revisions(self, merge_sorted_revisions,
         start_revision_id, stop_revision_id, stop_rule):
         """Iterate over an inclusive range of sorted revisions."""
@@ -2532,6 +2543,21 @@ class BzrBranch(Branch, _RelockDebugMixin):
         """See Branch.basis_tree."""
         return self.repository.revision_tree(self.last_revision())
 
+    def _gen_merge_sorted_revisions(self):
+        """See Branch._gen_merge_sorted_revisions.
+
+        When the branch.revno_cache option is set, the result is kept in the
+        revno-cache file of the branch and only the revisions added since the
+        cached tip are merge sorted.
+        """
+        revno, last_revision = self.last_revision_info()
+        if (_mod_revision.is_null(last_revision)
+            or not self.get_config_stack().get('branch.revno_cache')):
+            return super(BzrBranch, self)._gen_merge_sorted_revisions()
+        cache = revno_cache.RevnoCache(self._transport,
+            file_mode=self.bzrdir._get_file_mode())
+        return cache.merge_sort(self.repository, revno, last_revision)
+
     def _get_parent_location(self):
         _locs = ['parent', 'pull', 'x-pull']
         for l in _locs:
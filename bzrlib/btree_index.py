@@ -23,8 +23,11 @@ import cStringIO
 
 from bzrlib.lazy_import import lazy_import
 lazy_import(globals(), """
+import array
 import bisect
 import math
+import mmap
+import struct
 import tempfile
 import zlib
 """)
@@ -56,6 +59,90 @@ _PAGE_SIZE = 4096
 # 4K per page: 4MB - 1000 entries
 _NODE_CACHE_SIZE = 1000
 
+_BLOOM_SIGNATURE = "B+Tree Graph Index Bloom Filter 1\n"
+_OPTION_HASHES = "hashes="
+_OPTION_BITS = "bits="
+# 10 bits per key with 7 hashes gives about 1% false positives
+_BLOOM_BITS_PER_KEY = 10
+
+
+class BloomFilter(object):
+    """A bloom filter over the keys of an index.
+
+    Keys are hashed in their serialised form. The bit positions are derived
+    from the sha1 of the key by double hashing.
+    """
+
+    def __init__(self, num_bits, num_hashes, bits=None):
+        """Create a BloomFilter.
+
+        :param num_bits: The size of the filter in bits, a multiple of 8.
+        :param num_hashes: How many bits are set for each key.
+        :param bits: The content of an existing filter, as a bytearray.
+        """
+        if num_bits <= 0 or num_bits % 8:
+            raise ValueError('num_bits must be a positive multiple of 8: %r'
+                             % (num_bits,))
+        if bits is None:
+            bits = bytearray(num_bits // 8)
+        elif len(bits) * 8 != num_bits:
+            raise ValueError('expected %d bits, got %d'
+                             % (num_bits, len(bits) * 8))
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self._bits = bits
+
+    @classmethod
+    def for_key_count(cls, key_count, bits_per_key=_BLOOM_BITS_PER_KEY):
+        """Create an empty filter sized for key_count keys."""
+        num_bits = max(64, (key_count * bits_per_key + 7) // 8 * 8)
+        num_hashes = max(1, int(round(bits_per_key * math.log(2))))
+        return cls(num_bits, num_hashes)
+
+    @classmethod
+    def from_bytes(cls, bytes):
+        """Parse a filter serialised by to_bytes."""
+        if not bytes.startswith(_BLOOM_SIGNATURE):
+            raise errors.BadIndexFormatSignature('bloom filter', BloomFilter)
+        header = bytes[len(_BLOOM_SIGNATURE):].split('\n', 2)
+        if (len(header) != 3 or not header[0].startswith(_OPTION_HASHES)
+            or not header[1].startswith(_OPTION_BITS)):
+            raise errors.BadIndexOptions('bloom filter')
+        try:
+            num_hashes = int(header[0][len(_OPTION_HASHES):])
+            num_bits = int(header[1][len(_OPTION_BITS):])
+            return cls(num_bits, num_hashes, bytearray(header[2]))
+        except ValueError:
+            raise errors.BadIndexOptions('bloom filter')
+
+    def to_bytes(self):
+        """Serialise the filter."""
+        return '%s%s%d\n%s%d\n%s' % (_BLOOM_SIGNATURE, _OPTION_HASHES,
+            self.num_hashes, _OPTION_BITS, self.num_bits, str(self._bits))
+
+    def _positions(self, key):
+        h1, h2 = struct.unpack('>LL',
+                               osutils.sha('\x00'.join(key)).digest()[:8])
+        num_bits = self.num_bits
+        return [(h1 + i * h2) % num_bits for i in xrange(self.num_hashes)]
+
+    def add(self, key):
+        """Add key to the filter."""
+        bits = self._bits
+        for pos in self._positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        """Is key possibly in the filter?
+
+        :return: False if key was never added, True if it may have been.
+        """
+        bits = self._bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
 
 class _BuilderRow(object):
     """The stored state accumulated while writing out a row in the index.
@@ -151,6 +238,20 @@ class BTreeBuilder(index.GraphIndexBuilder):
         # Indicate it hasn't been built yet
         self._nodes_by_key = None
         self._optimize_for_size = False
+        self._bloom_bits_per_key = None
+        # The BloomFilter of the keys written by finish(), if requested
+        self.bloom_filter = None
+
+    def set_bloom_filter(self, bits_per_key=_BLOOM_BITS_PER_KEY):
+        """Build a BloomFilter of the keys when finishing the index.
+
+        The filter is available as the bloom_filter attribute once finish()
+        has been called, for the caller to store next to the index.
+
+        :param bits_per_key: The size of the filter per key, or None to not
+            build a filter.
+        """
+        self._bloom_bits_per_key = bits_per_key
 
     def add_node(self, key, value, references=()):
         """Add a node to the index.
@@ -363,7 +464,8 @@ class BTreeBuilder(index.GraphIndexBuilder):
                 new_row.writer.write(key_line)
             self._add_key(string_key, line, rows, allow_optimize=allow_optimize)
 
-    def _write_nodes(self, node_iterator, allow_optimize=True):
+    def _write_nodes(self, node_iterator, allow_optimize=True,
+                     bloom_filter=None):
         """Write node_iterator out as a B+Tree.
 
         :param node_iterator: An iterator of sorted nodes. Each node should
@@ -371,6 +473,7 @@ class BTreeBuilder(index.GraphIndexBuilder):
         :param allow_optimize: If set to False, prevent setting the optimize
             flag when writing out. This is used by the _spill_mem_keys_to_disk
             functionality.
+        :param bloom_filter: If not None, a BloomFilter to add the keys to.
         :return: A file handle for a temporary file containing a B+Tree for
             the nodes.
         """
@@ -393,6 +496,8 @@ class BTreeBuilder(index.GraphIndexBuilder):
                 # First key triggers the first row
                 rows.append(_LeafBuilderRow())
             key_count += 1
+            if bloom_filter is not None:
+                bloom_filter.add(node[1])
             string_key, line = _btree_serializer._flatten_node(node,
                                     self.reference_lists)
             self._add_key(string_key, line, rows, allow_optimize=allow_optimize)
@@ -446,7 +551,14 @@ class BTreeBuilder(index.GraphIndexBuilder):
         :return: A file handle for a temporary file containing the nodes added
             to the index.
         """
-        return self._write_nodes(self.iter_all_entries())[0]
+        bloom_filter = None
+        if self._bloom_bits_per_key:
+            bloom_filter = BloomFilter.for_key_count(self.key_count(),
+                                                     self._bloom_bits_per_key)
+        result = self._write_nodes(self.iter_all_entries(),
+                                   bloom_filter=bloom_filter)[0]
+        self.bloom_filter = bloom_filter
+        return result
 
     def iter_all_entries(self):
         """Iterate over all keys within the index
@@ -646,6 +758,97 @@ class _LeafNode(dict):
         return keys
 
 
+class _LazyLeafNode(object):
+    """A leaf node for a serialised B+Tree index, parsed on demand.
+
+    Only the page text and the offsets of its lines are kept. Lookups bisect
+    the serialised keys and parse the matching line, so a cached page costs
+    little more than its uncompressed size.
+    """
+
+    __slots__ = ('min_key', 'max_key', '_bytes', '_offsets', '_key_length',
+                 '_ref_list_length')
+
+    def __init__(self, bytes, key_length, ref_list_length):
+        """Index the lines of bytes to create a leaf node object."""
+        self._bytes = bytes
+        self._key_length = key_length
+        self._ref_list_length = ref_list_length
+        offsets = array.array('L')
+        # Skip the leaf flag, the page then ends with an empty line or the
+        # end of the data.
+        pos = bytes.find('\n') + 1
+        end = len(bytes)
+        while 0 < pos < end and bytes[pos] != '\n':
+            offsets.append(pos)
+            pos = bytes.find('\n', pos) + 1
+        self._offsets = offsets
+        if offsets:
+            self.min_key = self._key_at(0)
+            self.max_key = self._key_at(len(offsets) - 1)
+        else:
+            self.min_key = self.max_key = None
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, key):
+        return self._find(key) != -1
+
+    def __getitem__(self, key):
+        pos = self._find(key)
+        if pos == -1:
+            raise KeyError(key)
+        return self._parse_line(pos)[0][1]
+
+    def _key_string_at(self, pos):
+        """Return the serialised key of line pos."""
+        bytes = self._bytes
+        start = end = self._offsets[pos]
+        for _ in xrange(self._key_length):
+            end = bytes.index('\x00', end) + 1
+        return bytes[start:end - 1]
+
+    def _key_at(self, pos):
+        return static_tuple.StaticTuple.from_sequence(
+            self._key_string_at(pos).split('\x00')).intern()
+
+    def _find(self, key):
+        """Return the line number holding key, or -1 if it is not present.
+
+        Key elements never contain a NULL, which sorts before every other
+        byte, so serialised keys sort in the same order as the key tuples.
+        """
+        key_string = '\x00'.join(key)
+        lo = 0
+        hi = len(self._offsets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_string_at(mid) < key_string:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self._offsets) and self._key_string_at(lo) == key_string:
+            return lo
+        return -1
+
+    def _parse_line(self, pos):
+        start = self._offsets[pos]
+        end = self._bytes.index('\n', start) + 1
+        return _btree_serializer._parse_leaf_lines(
+            _LEAF_FLAG + self._bytes[start:end], self._key_length,
+            self._ref_list_length)
+
+    def all_items(self):
+        """Return a sorted list of (key, (value, refs)) items"""
+        return _btree_serializer._parse_leaf_lines(self._bytes,
+            self._key_length, self._ref_list_length)
+
+    def all_keys(self):
+        """Return a sorted list of all keys."""
+        return [self._key_at(pos) for pos in xrange(len(self._offsets))]
+
+
 class _InternalNode(object):
     """An internal node for a serialised B+Tree index."""
 
@@ -713,6 +916,8 @@ class BTreeGraphIndex(object):
         self._key_count = None
         self._row_lengths = None
         self._row_offsets = None # Start of each row, [-1] is the end
+        self._bloom_name = None
+        self._bloom_filter = None
 
     def __eq__(self, other):
         """Equal when self and other were created with the same parameters."""
@@ -725,6 +930,29 @@ class BTreeGraphIndex(object):
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def set_bloom_filter_name(self, name):
+        """Skip lookups of keys rejected by the BloomFilter stored as name.
+
+        The filter is read from the index transport on the first lookup. If
+        it is missing or corrupt all keys are looked up in the index.
+        """
+        self._bloom_name = name
+        self._bloom_filter = None
+
+    def _get_bloom_filter(self):
+        if self._bloom_name is not None:
+            name = self._bloom_name
+            self._bloom_name = None
+            try:
+                self._bloom_filter = BloomFilter.from_bytes(
+                    self._transport.get_bytes(name))
+            except errors.NoSuchFile:
+                pass
+            except (errors.BadIndexFormatSignature,
+                    errors.BadIndexOptions), e:
+                trace.mutter('ignoring bloom filter %s: %s', name, e)
+        return self._bloom_filter
+
     def _get_and_cache_nodes(self, nodes):
         """Read nodes and cache them in the lru.
 
@@ -1167,6 +1395,11 @@ class BTreeGraphIndex(object):
         keys = frozenset(keys)
         if not keys:
             return
+        bloom_filter = self._get_bloom_filter()
+        if bloom_filter is not None:
+            keys = [key for key in keys if key in bloom_filter]
+            if not keys:
+                return
 
         if not self.key_count():
             return
@@ -1228,6 +1461,17 @@ class BTreeGraphIndex(object):
             if they are missing or present. Callers can re-query this index for
             those keys, and they will be placed into parent_map or missing_keys
         """
+        bloom_filter = self._get_bloom_filter()
+        if bloom_filter is not None:
+            maybe_present = []
+            for key in keys:
+                if key in bloom_filter:
+                    maybe_present.append(key)
+                else:
+                    missing_keys.add(key)
+            keys = maybe_present
+            if not keys:
+                return set()
         if not self.key_count():
             # We use key_count() to trigger reading the root node and
             # determining info about this BTreeGraphIndex
@@ -1598,6 +1842,55 @@ class BTreeGraphIndex(object):
             pass
 
 
+class MMapBTreeGraphIndex(BTreeGraphIndex):
+    """A BTreeGraphIndex that reads pages from a memory map of the index.
+
+    When the transport gives access to a local file, pages are read from a
+    read-only memory map rather than through readv, and leaf pages are kept
+    as _LazyLeafNode objects rather than dicts. Other transports are read as
+    for a plain BTreeGraphIndex.
+
+    The mapping is held until the index object is released, which prevents
+    renaming or deleting the file on some platforms.
+    """
+
+    def __init__(self, transport, name, size, unlimited_cache=False,
+                 offset=0):
+        super(MMapBTreeGraphIndex, self).__init__(transport, name, size,
+            unlimited_cache=unlimited_cache, offset=offset)
+        self._leaf_factory = _LazyLeafNode
+        self._mapped = False
+
+    def _compute_recommended_pages(self):
+        # Mapped pages cost no round trip, don't decompress pages that may
+        # never be used.
+        return 1
+
+    def _map_file(self):
+        """Map the index file, if it is local, as self._file."""
+        self._mapped = True
+        try:
+            path = self._transport.local_abspath(self._name)
+        except errors.NotLocalUrl:
+            return
+        try:
+            f = open(path, 'rb')
+            try:
+                self._file = mmap.mmap(f.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+        except (EnvironmentError, ValueError), e:
+            # ValueError is raised for empty files
+            trace.mutter('not mapping index %s: %s', path, e)
+            self._file = None
+
+    def _read_nodes(self, nodes):
+        if not self._mapped and self._size:
+            self._map_file()
+        return super(MMapBTreeGraphIndex, self)._read_nodes(nodes)
+
+
 _gcchk_factory = _LeafNode
 
 try:
@@ -3259,6 +3259,30 @@ class cmd_ignored(Command):
             self.outf.write('%-50s %s\n' % (path, pat))
 
 
+class cmd_watch_tree(Command):
+    __doc__ = """Watch a working tree to speed up status.
+
+    While this command runs, the modifications made in the working tree are
+    recorded so that status, diff and commit only look at the files
+    modified since the previous status instead of the whole tree.
+
+    This requires inotify and is only available on Linux.
+    """
+
+    _see_also = ['status']
+    takes_options = ['directory']
+
+    def run(self, directory=u'.'):
+        from bzrlib import tree_watch
+        tree = WorkingTree.open_containing(directory)[0]
+        watcher = tree_watch.TreeWatcher(tree.basedir)
+        note(gettext('Watching %s, interrupt to stop.') % (tree.basedir,))
+        try:
+            tree_watch.watch_tree(tree, watcher)
+        except KeyboardInterrupt:
+            pass
+
+
 class cmd_lookup_revision(Command):
     __doc__ = """Lookup the revision-id from a revision-number
 
@@ -1044,6 +1044,9 @@ class BzrDirMeta1(BzrDir):
             self._format.get_format_string() != format.get_format_string()):
             # it is not a meta dir format, conversion is needed.
             return True
+        if self.transport.has('repository.backup'):
+            # the conversion of the repository was interrupted.
+            return True
         # we might want to push this down to the repository?
         try:
             if not isinstance(self.open_repository()._format,
@@ -1795,6 +1798,12 @@ class ConvertMetaToMeta(controldir.Converter):
         self.count = 0
         self.total = 1
         self.step('checking repository format')
+        if self.bzrdir.transport.has('repository.backup'):
+            # A previous conversion of the repository was interrupted
+            from bzrlib.repository import CopyConverter
+            ui.ui_factory.note(gettext('resuming repository conversion'))
+            converter = CopyConverter(self.target_format.repository_format)
+            converter.resume(self.bzrdir, pb)
         try:
             repo = self.bzrdir.open_repository()
         except errors.NoRepositoryPresent:
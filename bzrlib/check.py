@@ -50,6 +50,8 @@ check_refs are tuples (kind, value). Currently defined kinds are:
 from __future__ import absolute_import
 
 from bzrlib import (
+    btree_index,
+    config,
     errors,
     ui,
     )
@@ -70,6 +72,101 @@ class Check(object):
         raise NotImplementedError(self.report_results)
 
 
+# An estimate of the memory used by each text key waiting to be checked.
+_PENDING_TEXT_SIZE = 512
+
+
+class _PendingKeys(object):
+    """The keys to cross check, mapped to (kind, sha1, first-referer).
+
+    Most of the keys referenced in a repository are text keys. When spill_at
+    is given, they are held in a BTreeBuilder which writes them to temporary
+    files whenever it holds that many keys in memory.
+    """
+
+    def __init__(self, spill_at=None):
+        self._keys = {}
+        if spill_at:
+            self._texts = btree_index.BTreeBuilder(key_elements=2,
+                                                   spill_at=spill_at)
+        else:
+            self._texts = None
+        self._text_items = {}
+
+    def __len__(self):
+        length = len(self._keys) + len(self._text_items)
+        if self._texts is not None:
+            length += self._texts.key_count()
+        return length
+
+    def __iter__(self):
+        for key in self._keys:
+            yield key
+        for text_key, item_data in self.iter_texts():
+            yield ('texts',) + text_key
+
+    def get(self, key, default=None):
+        if key[0] != 'texts' or len(key) != 3:
+            return self._keys.get(key, default)
+        item_data = self._text_items.get(key[1:])
+        if item_data is not None or self._texts is None:
+            return item_data or default
+        for node in self._texts.iter_entries([key[1:]]):
+            return self._parse_value(node[2])
+        return default
+
+    def __getitem__(self, key):
+        item_data = self.get(key)
+        if item_data is None:
+            raise KeyError(key)
+        return item_data
+
+    def __setitem__(self, key, item_data):
+        """Add a key, which must not be in the map already."""
+        if key[0] != 'texts' or len(key) != 3:
+            self._keys[key] = item_data
+            return
+        if self._texts is not None:
+            kind, sha1, referer = item_data
+            try:
+                self._texts.add_node(key[1:],
+                    '%s %s %s' % (kind, sha1 or '', referer))
+            except (errors.BadIndexKey, errors.BadIndexValue):
+                # Damaged ids are kept in memory and reported by the checks
+                pass
+            else:
+                return
+        self._text_items[key[1:]] = item_data
+
+    def _parse_value(self, value):
+        kind, sha1, referer = value.split(' ')
+        return kind, sha1 or None, referer
+
+    def other_items(self):
+        """Return a dict of the keys which are not text keys."""
+        return self._keys
+
+    def iter_texts(self):
+        """Iterate over the (text_key, item_data) of the text keys."""
+        for item in self._text_items.iteritems():
+            yield item
+        if self._texts is None:
+            return
+        for node in self._texts.iter_all_entries():
+            yield node[1], self._parse_value(node[2])
+
+    def iter_text_batches(self, batch_size):
+        """Iterate over lists of at most batch_size (text_key, item_data)."""
+        batch = []
+        for item in self.iter_texts():
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
 class VersionedFileCheck(Check):
     """Check a versioned file repository"""
 
@@ -91,9 +188,17 @@ class VersionedFileCheck(Check):
         self.other_results = []
         # Plain text lines to include in the report
         self._report_items = []
+        stack = config.LocationStack(repository.user_url)
+        # The number of processes verifying texts
+        self.workers = stack.get('check.workers')
+        memory_budget = stack.get('check.memory_budget')
+        if memory_budget:
+            self._spill_at = max(memory_budget // _PENDING_TEXT_SIZE, 1)
+        else:
+            self._spill_at = None
         # Keys we are looking for; may be large and need spilling to disk.
         # key->(type(revision/inventory/text/signature/map), sha1, first-referer)
-        self.pending_keys = {}
+        self.pending_keys = self._new_pending_keys()
         # Ancestors map for all of revisions being checked; while large helper
         # functions we call would create it anyway, so better to have once and
         # keep.
@@ -282,6 +387,9 @@ class VersionedFileCheck(Check):
             rev.inventory_sha1)
         self.checked_rev_cnt += 1
 
+    def _new_pending_keys(self):
+        return _PendingKeys(self._spill_at)
+
     def add_pending_item(self, referer, key, kind, sha1):
         """Add a reference to a sha1 to be cross checked against a key.
 
@@ -338,6 +446,10 @@ class VersionedFileCheck(Check):
     def _add_entry_to_text_key_references(self, inv, entry):
         if not self.rich_roots and entry.name == '':
             return
+        if self.repository._format.fast_deltas:
+            # Not used by _check_weaves, the references are found again
+            # from the inventories.
+            return
         key = (entry.file_id, entry.revision)
         self.text_key_references.setdefault(key, False)
         if entry.revision == inv.revision_id:
@@ -39,13 +39,17 @@ Densely packed upper nodes.
 
 from __future__ import absolute_import
 
+import collections
 import heapq
+import Queue
+import sys
 import threading
 
 from bzrlib import lazy_import
 lazy_import.lazy_import(globals(), """
 from bzrlib import (
     errors,
+    versionedfile,
     )
 """)
 from bzrlib import (
@@ -62,6 +66,9 @@ from bzrlib.static_tuple import StaticTuple
 # If each line is 50 bytes, and you have 255 internal pages, with 255-way fan
 # out, it takes 3.1MB to cache the layer.
 _PAGE_CACHE_SIZE = 4*1024*1024
+# The maximum number of pages read by a single get_record_stream call when
+# prefetching.
+_PREFETCH_BATCH_SIZE = 1000
 # Per thread caches for 2 reasons:
 # - in the server we may be serving very different content, so we get less
 #   cache thrashing.
@@ -70,16 +77,101 @@ _thread_caches = threading.local()
 # The page cache.
 _thread_caches.page_cache = None
 
-def _get_cache():
-    """Get the per-thread page cache.
+
+class PageCache(lru_cache.LRUSizeCache):
+    """A cache of the bytes of CHK pages, counting hits, misses and evictions.
+
+    When cache_nodes is True, the nodes deserialised from the cached pages are
+    kept too, so that hot pages are not parsed again. Their size is not
+    accounted for.
+
+    :ivar hits: The number of lookups that found their page.
+    :ivar misses: The number of lookups that did not find their page.
+    :ivar evictions: The number of pages removed to make room for others.
+    """
+
+    def __init__(self, max_size=_PAGE_CACHE_SIZE, cache_nodes=False):
+        # We are caching bytes so len(value) is perfectly accurate
+        lru_cache.LRUSizeCache.__init__(self, max_size)
+        self.cache_nodes = cache_nodes
+        self._nodes = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getitem__(self, key):
+        try:
+            value = lru_cache.LRUSizeCache.__getitem__(self, key)
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        return value
+
+    def get_node(self, key, search_key_func):
+        """Return a node for a cached page.
+
+        :raise KeyError: If the page is not cached.
+        """
+        bytes = self[key]
+        if not self.cache_nodes:
+            return _deserialise(bytes, key, search_key_func=search_key_func)
+        node = self._nodes.get(key)
+        if node is None or node._search_key_func is not search_key_func:
+            node = _deserialise(bytes, key, search_key_func=search_key_func)
+            self._nodes[key] = node
+        # The cached node must not be modified, callers get their own copy.
+        return _copy_node(node)
+
+    def _remove_node(self, node):
+        self._nodes.pop(node.key, None)
+        lru_cache.LRUSizeCache._remove_node(self, node)
+
+    def _remove_lru(self):
+        self.evictions += 1
+        lru_cache.LRUSizeCache._remove_lru(self)
+
+    def clear(self):
+        evictions = self.evictions
+        lru_cache.LRUSizeCache.clear(self)
+        self.evictions = evictions
+
+
+class _StorePageCache(threading.local):
+    """The page caches of a store, one per thread."""
+
+    def __init__(self, max_size, cache_nodes):
+        self.page_cache = PageCache(max_size, cache_nodes)
+
+
+def set_page_cache(store, max_size, cache_nodes=False):
+    """Give a store its own page caches, instead of the per-thread ones.
+
+    Each thread still gets its own cache, as caches are not locked.
+
+    :param store: A VersionedFiles holding CHK pages.
+    :param max_size: The size of the caches in bytes.
+    :param cache_nodes: Whether the deserialised nodes are cached too.
+    """
+    store._chk_page_cache = _StorePageCache(max_size, cache_nodes)
+
+
+def _get_cache(store=None):
+    """Get the page cache for store in this thread.
 
     We need a function to do this because in a new thread the _thread_caches
     threading.local object does not have the cache initialized yet.
+
+    :param store: The store pages are read from, if it has no cache of its
+        own (see set_page_cache) or is None, the per-thread cache shared by
+        all the stores is used.
     """
+    store_cache = getattr(store, '_chk_page_cache', None)
+    if store_cache is not None:
+        return store_cache.page_cache
     page_cache = getattr(_thread_caches, 'page_cache', None)
     if page_cache is None:
-        # We are caching bytes so len(value) is perfectly accurate
-        page_cache = lru_cache.LRUSizeCache(_PAGE_CACHE_SIZE)
+        page_cache = PageCache(_PAGE_CACHE_SIZE)
         _thread_caches.page_cache = page_cache
     return page_cache
 
@@ -173,6 +265,11 @@ class CHKMap(object):
         :return: A node object.
         """
         if type(node) is StaticTuple:
+            page_cache = _get_cache(self._store)
+            try:
+                return page_cache.get_node(node, self._search_key_func)
+            except KeyError:
+                pass
             bytes = self._read_bytes(node)
             return _deserialise(bytes, node,
                 search_key_func=self._search_key_func)
@@ -180,13 +277,10 @@ class CHKMap(object):
             return node
 
     def _read_bytes(self, key):
-        try:
-            return _get_cache()[key]
-        except KeyError:
-            stream = self._store.get_record_stream([key], 'unordered', True)
-            bytes = stream.next().get_bytes_as('fulltext')
-            _get_cache()[key] = bytes
-            return bytes
+        stream = self._store.get_record_stream([key], 'unordered', True)
+        bytes = stream.next().get_bytes_as('fulltext')
+        _get_cache(self._store)[key] = bytes
+        return bytes
 
     def _dump_tree(self, include_keys=False):
         """Return the tree in a string representation."""
@@ -922,7 +1016,7 @@ class LeafNode(Node):
         bytes = ''.join(lines)
         if len(bytes) != self._current_size():
             raise AssertionError('Invalid _current_size')
-        _get_cache()[self._key] = bytes
+        _get_cache(store)[self._key] = bytes
         return [self._key]
 
     def refs(self):
@@ -1162,14 +1256,13 @@ class InternalNode(Node):
         if keys:
             # Look in the page cache for some more bytes
             found_keys = set()
+            page_cache = _get_cache(store)
             for key in keys:
                 try:
-                    bytes = _get_cache()[key]
+                    node = page_cache.get_node(key, self._search_key_func)
                 except KeyError:
                     continue
                 else:
-                    node = _deserialise(bytes, key,
-                        search_key_func=self._search_key_func)
                     prefix, node_key_filter = keys[key]
                     self._items[prefix] = node
                     found_keys.add(key)
@@ -1195,7 +1288,7 @@ class InternalNode(Node):
                     prefix, node_key_filter = keys[record.key]
                     node_and_filters.append((node, node_key_filter))
                     self._items[prefix] = node
-                    _get_cache()[record.key] = bytes
+                    page_cache[record.key] = bytes
                 for info in node_and_filters:
                     yield info
 
@@ -1321,7 +1414,7 @@ class InternalNode(Node):
             lines.append(serialised[prefix_len:])
         sha1, _, _ = store.add_lines((None,), (), lines)
         self._key = StaticTuple("sha1:" + sha1,).intern()
-        _get_cache()[self._key] = ''.join(lines)
+        _get_cache(store)[self._key] = ''.join(lines)
         yield self._key
 
     def _search_key(self, key):
@@ -1462,6 +1555,16 @@ def _deserialise(bytes, key, search_key_func):
     return node
 
 
+def _copy_node(node):
+    """Copy a node freshly deserialised, so that it can be modified."""
+    node_class = node.__class__
+    copy = node_class.__new__(node_class)
+    for slot in Node.__slots__ + node_class.__slots__:
+        setattr(copy, slot, getattr(node, slot))
+    copy._items = dict(node._items)
+    return copy
+
+
 class CHKMapDifference(object):
     """Iterate the stored pages and key,value pairs for (new - old).
 
@@ -1474,7 +1577,7 @@ class CHKMapDifference(object):
     """
 
     def __init__(self, store, new_root_keys, old_root_keys,
-                 search_key_func, pb=None):
+                 search_key_func, pb=None, prefetch=0):
         # TODO: Should we add a StaticTuple barrier here? It would be nice to
         #       force callers to use StaticTuple, because there will often be
         #       lots of keys passed in here. And even if we cast it locally,
@@ -1508,6 +1611,13 @@ class CHKMapDifference(object):
         # waiting for the uninteresting nodes to be walked
         self._new_item_queue = []
         self._state = None
+        # The number of batches of pages read ahead by a thread while the
+        # pages below the roots are processed, 0 to read them level by level.
+        self._prefetch = prefetch
+        # Every page is read once: pages_read - new_pages is the number of
+        # pages only read to filter out the old items.
+        self.pages_read = 0
+        self.new_pages = 0
 
     def _read_nodes_from_store(self, keys):
         # We chose not to use _get_cache(), because we think in
@@ -1515,33 +1625,63 @@ class CHKMapDifference(object):
         # only 1 time during this code. (We may want to evaluate saving the
         # raw bytes into the page cache, which would allow a working tree
         # update after the fetch to not have to read the bytes again.)
-        as_st = StaticTuple.from_sequence
         stream = self._store.get_record_stream(keys, 'unordered', True)
         for record in stream:
-            if self._pb is not None:
-                self._pb.tick()
             if record.storage_kind == 'absent':
-                raise errors.NoSuchRevision(self._store, record.key)
-            bytes = record.get_bytes_as('fulltext')
-            node = _deserialise(bytes, record.key,
-                                search_key_func=self._search_key_func)
-            if type(node) is InternalNode:
-                # Note we don't have to do node.refs() because we know that
-                # there are no children that have been pushed into this node
-                # Note: Using as_st() here seemed to save 1.2MB, which would
-                #       indicate that we keep 100k prefix_refs around while
-                #       processing. They *should* be shorter lived than that...
-                #       It does cost us ~10s of processing time
-                #prefix_refs = [as_st(item) for item in node._items.iteritems()]
-                prefix_refs = node._items.items()
-                items = []
+                bytes = None
             else:
-                prefix_refs = []
-                # Note: We don't use a StaticTuple here. Profiling showed a
-                #       minor memory improvement (0.8MB out of 335MB peak 0.2%)
-                #       But a significant slowdown (15s / 145s, or 10%)
-                items = node._items.items()
-            yield record, node, prefix_refs, items
+                bytes = record.get_bytes_as('fulltext')
+            yield self._deserialise_record(record, bytes)
+
+    def _deserialise_record(self, record, bytes):
+        if self._pb is not None:
+            self._pb.tick()
+        if record.storage_kind == 'absent':
+            raise errors.NoSuchRevision(self._store, record.key)
+        self.pages_read += 1
+        node = _deserialise(bytes, record.key,
+                            search_key_func=self._search_key_func)
+        if type(node) is InternalNode:
+            # Note we don't have to do node.refs() because we know that
+            # there are no children that have been pushed into this node
+            # Note: Using as_st() here seemed to save 1.2MB, which would
+            #       indicate that we keep 100k prefix_refs around while
+            #       processing. They *should* be shorter lived than that...
+            #       It does cost us ~10s of processing time
+            #prefix_refs = [as_st(item) for item in node._items.iteritems()]
+            prefix_refs = node._items.items()
+            items = []
+        else:
+            prefix_refs = []
+            # Note: We don't use a StaticTuple here. Profiling showed a
+            #       minor memory improvement (0.8MB out of 335MB peak 0.2%)
+            #       But a significant slowdown (15s / 145s, or 10%)
+            items = node._items.items()
+        return record, node, prefix_refs, items
+
+    def _iter_prefetched(self, keys, select_refs):
+        """Read pages and the pages they reference, reading ahead.
+
+        The children of a page are requested as soon as it is read, so the
+        next level is read while the current one is processed.
+
+        :param keys: The keys of the first pages to read.
+        :param select_refs: Called with the prefix_refs of every page read,
+            returns the keys of the children to read. It is responsible for
+            not returning keys already requested.
+        :return: An iterator of (record, items).
+        """
+        prefetcher = _PagePrefetcher(self._store, self._prefetch)
+        try:
+            prefetcher.request(keys)
+            while prefetcher.pending:
+                for record, bytes in prefetcher.next_batch():
+                    record, _, prefix_refs, items = self._deserialise_record(
+                        record, bytes)
+                    prefetcher.request(select_refs(prefix_refs))
+                    yield record, items
+        finally:
+            prefetcher.stop()
 
     def _read_old_roots(self):
         old_chks_to_enqueue = []
@@ -1649,6 +1789,10 @@ class CHKMapDifference(object):
             yield None, new_items
         refs = refs.difference(all_old_chks)
         processed_new_refs.update(refs)
+        if self._prefetch:
+            for record, items in self._flush_new_prefetched(refs):
+                yield record, items
+            return
         while refs:
             # TODO: Using a SimpleSet for self._processed_new_refs and
             #       saved as much as 10MB of peak memory. However, it requires
@@ -1678,6 +1822,32 @@ class CHKMapDifference(object):
             processed_new_refs.update(next_refs)
             refs = next_refs
 
+    def _flush_new_prefetched(self, refs):
+        all_old_chks = self._all_old_chks
+        processed_new_refs = self._processed_new_refs
+        all_old_items = self._all_old_items
+        def select_refs(prefix_refs):
+            refs = [ref for _, ref in prefix_refs
+                    if ref not in all_old_chks
+                       and ref not in processed_new_refs]
+            processed_new_refs.update(refs)
+            return refs
+        for record, items in self._iter_prefetched(refs, select_refs):
+            if all_old_items:
+                items = [item for item in items if item not in all_old_items]
+            yield record, items
+
+    def _process_old_prefetched(self):
+        refs = self._old_queue
+        self._old_queue = []
+        all_old_chks = self._all_old_chks
+        def select_refs(prefix_refs):
+            refs = [ref for _, ref in prefix_refs if ref not in all_old_chks]
+            all_old_chks.update(refs)
+            return refs
+        for record, items in self._iter_prefetched(refs, select_refs):
+            self._all_old_items.update(items)
+
     def _process_next_old(self):
         # Since we don't filter uninteresting any further than during
         # _read_all_roots, process the whole queue in a single pass.
@@ -1692,19 +1862,126 @@ class CHKMapDifference(object):
             all_old_chks.update(refs)
 
     def _process_queues(self):
+        if self._prefetch and self._old_queue:
+            self._process_old_prefetched()
         while self._old_queue:
             self._process_next_old()
         return self._flush_new_queue()
 
     def process(self):
         for record in self._read_all_roots():
+            self.new_pages += 1
             yield record, []
         for record, items in self._process_queues():
+            if record is not None:
+                self.new_pages += 1
             yield record, items
+        trace.mutter('CHK difference read %d pages for %d new pages',
+                     self.pages_read, self.new_pages)
+
+
+class _PagePrefetcher(object):
+    """Read CHK pages in a thread, ahead of their processing.
+
+    Pages are read in batches of at most batch_size pages, up to max_batches
+    batches are kept waiting for their processing. The records returned hold
+    the bytes of their page: the records of the store may share state, like
+    groupcompress blocks, which must not be used from two threads.
+
+    :ivar pending: The number of pages requested and not returned yet.
+    """
+
+    def __init__(self, store, max_batches, batch_size=None):
+        self._store = store
+        if batch_size is None:
+            batch_size = _PREFETCH_BATCH_SIZE
+        self._batch_size = batch_size
+        self._keys = collections.deque()
+        self._keys_available = threading.Condition(threading.Lock())
+        self._batches = Queue.Queue(max_batches)
+        self._stopped = False
+        self.pending = 0
+        self._thread = threading.Thread(target=self._read_batches)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def request(self, keys):
+        """Queue keys to be read."""
+        if not keys:
+            return
+        self.pending += len(keys)
+        self._keys_available.acquire()
+        try:
+            self._keys.extend(keys)
+            self._keys_available.notify()
+        finally:
+            self._keys_available.release()
+
+    def next_batch(self):
+        """Wait for the next batch of pages.
+
+        :return: A list of (record, bytes).
+        """
+        batch, exc_info = self._batches.get()
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.pending -= len(batch)
+        return batch
+
+    def _next_keys(self):
+        self._keys_available.acquire()
+        try:
+            while not self._keys and not self._stopped:
+                self._keys_available.wait()
+            if self._stopped:
+                return None
+            count = min(len(self._keys), self._batch_size)
+            return [self._keys.popleft() for i in xrange(count)]
+        finally:
+            self._keys_available.release()
+
+    def _read_batches(self):
+        try:
+            while True:
+                keys = self._next_keys()
+                if keys is None:
+                    return
+                batch = []
+                for record in self._store.get_record_stream(keys, 'unordered',
+                                                            True):
+                    if record.storage_kind == 'absent':
+                        bytes = None
+                        record = versionedfile.AbsentContentFactory(
+                            record.key)
+                    else:
+                        bytes = record.get_bytes_as('fulltext')
+                        record = versionedfile.FulltextContentFactory(
+                            record.key, None, record.sha1, bytes)
+                    batch.append((record, bytes))
+                self._put((batch, None))
+        except Exception:
+            self._put((None, sys.exc_info()))
+
+    def _put(self, item):
+        while not self._stopped:
+            try:
+                self._batches.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def stop(self):
+        self._keys_available.acquire()
+        try:
+            self._stopped = True
+            self._keys_available.notify()
+        finally:
+            self._keys_available.release()
+        self._thread.join()
 
 
 def iter_interesting_nodes(store, interesting_root_keys,
-                           uninteresting_root_keys, pb=None):
+                           uninteresting_root_keys, pb=None, prefetch=None):
     """Given root keys, find interesting nodes.
 
     Evaluate nodes referenced by interesting_root_keys. Ones that are also
@@ -1714,13 +1991,18 @@ def iter_interesting_nodes(store, interesting_root_keys,
         "interesting" nodes (which will be yielded)
     :param uninteresting_root_keys: keys which should be filtered out of the
         result set.
+    :param prefetch: The number of batches of pages to read ahead in a
+        thread, 0 to read the pages level by level. Defaults to the
+        _chk_prefetch attribute of store if it has one, 0 otherwise.
     :return: Yield
         (interesting record, {interesting key:values})
     """
+    if prefetch is None:
+        prefetch = getattr(store, '_chk_prefetch', 0)
     iterator = CHKMapDifference(store, interesting_root_keys,
                                 uninteresting_root_keys,
                                 search_key_func=store._search_key_func,
-                                pb=pb)
+                                pb=pb, prefetch=prefetch)
     return iterator.process()
 
 
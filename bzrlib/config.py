@@ -2672,6 +2672,15 @@ option_registry.register(
            help="""\
 Whether revisions associated with tags should be fetched.
 """))
+option_registry.register(
+    Option('branch.revno_cache', default=False, from_unicode=bool_from_store,
+           help="""\
+Whether to keep the dotted revnos of the branch tip on disk.
+
+When set, the merge sorted ancestry of the branch tip is stored in the
+``revno-cache`` file of the branch control directory. Later commands that
+need dotted revnos only have to merge sort the revisions added since then.
+"""))
 option_registry.register_lazy(
     'bzr.transform.orphan_policy', 'bzrlib.transform', 'opt_transform_orphan')
 option_registry.register(
@@ -2695,6 +2704,26 @@ This bug tracker will be used for example when marking bugs
 as fixed using ``bzr commit --fixes``, if no explicit
 bug tracker was specified.
 '''))
+option_registry.register(
+    Option('check.memory_budget',
+           default=0, from_unicode=int_SI_from_store,
+           help='''\
+The memory used to hold the texts ``bzr check`` has to verify.
+
+When set, the keys and expected sha1s of the texts referenced by the
+inventories are written to temporary files once they would use more than
+about this many bytes. Suffixes like 'MB' are accepted. 0 keeps them all in
+memory.
+'''))
+option_registry.register(
+    Option('check.workers',
+           default=1, from_unicode=int_from_store,
+           help='''\
+The number of processes verifying texts when checking a repository.
+
+When greater than 1, ``bzr check`` extracts the texts and computes their
+sha1 in batches spread over this many worker processes.
+'''))
 option_registry.register(
     Option('check_signatures', default=CHECK_IF_POSSIBLE,
            from_unicode=signature_policy_from_unicode,
@@ -2734,6 +2763,43 @@ If true (default), working tree metadata changes are flushed through the
 OS buffers to physical disk.  This is somewhat slower, but means data
 should not be lost if the machine crashes.  See also repository.fdatasync.
 '''))
+option_registry.register(
+    Option('dirstate.journal', default=False,
+           from_unicode=bool_from_store,
+           help='''\
+Append hash cache updates to a journal rather than rewriting the dirstate.
+
+When ``bzr status`` or ``bzr diff`` only refresh the recorded sha1 of some
+files, these entries are appended to a ``dirstate.journal`` file next to the
+dirstate. The dirstate is rewritten, and the journal removed, when the tree
+itself changes or once the journal is larger than a quarter of the dirstate.
+'''))
+option_registry.register(
+    Option('dirstate.lazy_read', default=False,
+           from_unicode=bool_from_store,
+           help='''\
+Only read the parts of the dirstate needed by commands given some paths.
+
+If true, ``bzr status`` or ``bzr diff`` given some paths only read the
+entries for these paths, their parents and their children, by bisecting
+through the dirstate. This makes them faster and use less memory in large
+working trees.
+'''))
+option_registry.register(
+    Option('dirstate.sha1_workers', default=1,
+           from_unicode=int_from_store,
+           help='''\
+The number of threads hashing files when looking for changes.
+
+Files whose stat changed since their sha1 was recorded are hashed again by
+``bzr status``, ``bzr diff`` or ``bzr commit``. With more than one thread,
+the files of each directory are hashed concurrently.
+
+Only the pure python comparison of the tree with its basis hashes files in
+threads, so setting this uses it instead of the compiled one. This is
+faster when many files need hashing, for example after a whole tree has
+been touched, and slower otherwise.
+'''))
 option_registry.register(
     ListOption('debug_flags', default=[],
            help='Debug flags to activate.'))
@@ -2756,6 +2822,16 @@ option_registry.register(
 option_registry.register(
     Option('email', override_from_env=['BZR_EMAIL'], default=default_email,
            help='The users identity'))
+option_registry.register(
+    Option('export.compress_workers', default=1,
+           from_unicode=int_from_store,
+           help='''\
+The number of threads compressing tarballs written by ``bzr export``.
+
+With more than one thread, ``.tar.gz`` exports are compressed in blocks
+concurrently, like pigz does. The result is a regular gzip file, slightly
+larger than a tarball compressed in a single stream.
+'''))
 option_registry.register(
     Option('gpg_signing_command',
            default='gpg',
@@ -2772,6 +2848,37 @@ GPG key to use for signing.
 
 This defaults to the first key associated with the users email.
 """))
+option_registry.register(
+    Option('http.idle_timeout',
+           default=30, from_unicode=int_from_store,
+           help='''\
+The number of seconds an idle http connection is kept for reuse.
+
+See http.max_idle_connections.
+'''))
+option_registry.register(
+    Option('http.max_idle_connections',
+           default=0, from_unicode=int_from_store,
+           help='''\
+The number of idle http connections kept for reuse per host.
+
+When a transport is done with its connection, the connection is kept
+open so that the next transport to the same scheme, host and port can use
+it without a new TCP or TLS handshake. Beyond this number, the oldest idle
+connections to a host are closed. 0 disables the reuse.
+'''))
+option_registry.register(
+    Option('http.readv_window',
+           default=1, from_unicode=int_from_store,
+           help='''\
+The number of range requests a readv can have in flight over http.
+
+Above 1, the ranges read from a file are spread over at least that many
+GET requests, issued at once on their own connections. This keeps the
+link busy when the server is far away, at the cost of extra connections.
+How much data is read between two ranges to save a request is then
+adjusted from the measured latency.
+'''))
 option_registry.register(
     Option('ignore_missing_extensions', default=False,
            from_unicode=bool_from_store,
@@ -2795,6 +2902,16 @@ will automatically break the stale lock, and create a new lock for
 this process.
 Otherwise, bzr will prompt as normal to break the lock.
 '''))
+option_registry.register(
+    Option('log.file_index', default=False,
+           from_unicode=bool_from_store,
+           help='''\
+Use an index of the files touched by each revision when logging files?
+
+If true, ``bzr log FILE`` and ``bzr log DIR`` maintain an index in the
+repository of the file ids changed by each revision and only look at the
+revisions it lists.
+'''))
 option_registry.register(
     Option('log_format', default='long',
            help= '''\
@@ -2805,6 +2922,16 @@ may be provided by plugins.
 '''))
 option_registry.register_lazy('mail_client', 'bzrlib.mail_client',
     'opt_mail_client')
+option_registry.register(
+    Option('merge.workers',
+           default=1, from_unicode=int_from_store,
+           help='''\
+The number of processes merging the texts of files during a merge.
+
+When greater than 1, the texts of the files changed on both sides are
+extracted in batches and merged in this many worker processes, ahead of the
+files being merged into the tree.
+'''))
 option_registry.register(
     Option('output_encoding',
            help= 'Unicode encoding for output'
@@ -2846,6 +2973,16 @@ The location of the default branch for push.
 
 This option is normally set by the first ``push`` or ``push --remember``.
 """))
+option_registry.register(
+    Option('pack.workers',
+           default=1, from_unicode=int_from_store,
+           help='''\
+The number of processes compressing texts when packing a repository.
+
+When greater than 1, ``bzr pack`` and autopacking cut the file texts into
+chunks of whole files that are compressed in parallel by this many worker
+processes. The result does not depend on the number of workers.
+'''))
 option_registry.register(
     Option('push_strict', default=None,
            from_unicode=bool_from_store,
@@ -2855,6 +2992,79 @@ The default value for ``push --strict``.
 If present, defines the ``--strict`` option default value for checking
 uncommitted changes before sending a merge directive.
 '''))
+option_registry.register(
+    Option('repository.annotation_cache', default=False,
+           from_unicode=bool_from_store,
+           help='''\
+Keep the annotations of file texts in 2a repositories?
+
+If true, the annotations computed by ``bzr annotate`` are stored in the
+repository, and annotating a later version of a file only processes the
+versions committed since.
+'''))
+option_registry.register(
+    Option('repository.bloom_filters', default=False,
+           from_unicode=bool_from_store,
+           help='''\
+Write and use bloom filters for the btree indices of new packs?
+
+If true, a ``.bloom`` file is written next to each index of new packs, and
+lookups skip the packs whose filter does not contain the key. This makes
+missing keys cheap in repositories holding many packs.
+'''))
+option_registry.register(
+    Option('repository.chk_cache_nodes', default=False,
+           from_unicode=bool_from_store,
+           help='''\
+Keep the parsed inventory pages in the cache of 2a repositories?
+
+If true, the pages kept by the cache set with ``repository.chk_cache_size``
+are also kept parsed, so that the pages used often are not parsed again.
+This uses more memory than the size of the cache.
+'''))
+option_registry.register(
+    Option('repository.chk_cache_size', default=None,
+           from_unicode=int_SI_from_store,
+           help='''\
+The size of the cache of inventory pages of 2a repositories.
+
+When set, each repository caches its own inventory (CHK) pages, up to this
+many bytes per thread, instead of sharing a 4MB cache with all the other
+repositories used by the process. Suffixes like 'MB' are accepted.
+'''))
+option_registry.register(
+    Option('repository.chk_prefetch',
+           default=0, from_unicode=int_from_store,
+           help='''\
+The number of batches of CHK pages read ahead when comparing inventories.
+
+When greater than 0, fetching from 2a repositories reads the inventory pages
+of the next level in a thread while the current ones are processed, keeping
+up to this many batches of pages in memory. 0 reads the pages level by
+level.
+'''))
+option_registry.register(
+    Option('repository.convert_workers',
+           default=0, from_unicode=int_from_store,
+           help='''\
+The number of processes preparing revisions when converting repositories.
+
+When greater than 1, copying revisions between repositories whose formats
+serialise inventories differently (like ``bzr upgrade`` from pack-0.92 to
+2a) computes the inventory deltas and compresses the texts of the next
+batches of revisions in this many processes, while the current batch is
+inserted. 0 converts the batches one after the other.
+'''))
+option_registry.register(
+    Option('repository.extract_workers',
+           default=0, from_unicode=int_from_store,
+           help='''\
+The number of threads extracting file texts from 2a repositories.
+
+When greater than 1, operations reading many file texts (like ``export``,
+``checkout`` or ``pack``) decompress the next blocks in this many threads
+while the current texts are used. 0 extracts texts as they are used.
+'''))
 option_registry.register(
     Option('repository.fdatasync', default=True,
            from_unicode=bool_from_store,
@@ -2865,6 +3075,29 @@ If true (default), repository changes are flushed through the OS buffers
 to physical disk.  This is somewhat slower, but means data should not be
 lost if the machine crashes.  See also dirstate.fdatasync.
 '''))
+option_registry.register(
+    Option('repository.generation_index', default=False,
+           from_unicode=bool_from_store,
+           help='''\
+Keep an index of the generation numbers of revisions in pack repositories?
+
+If true, the repository records the generation number and first-parent
+chain of each revision added to it. ``bzr merge``, ``bzr missing`` or
+``bzr push`` then decide whether a revision is an ancestor of another
+without searching through the ancestry of both. The first update indexes the
+whole ancestry of the new revisions.
+'''))
+option_registry.register(
+    Option('repository.mmap_indices', default=False,
+           from_unicode=bool_from_store,
+           help='''\
+Memory map the btree indices of local repositories?
+
+If true, index pages are read from a memory map of the index files and
+leaf pages are only parsed as far as lookups need. This keeps memory use low
+for repositories with large indices, but prevents packing on platforms that
+cannot rename or delete mapped files.
+'''))
 option_registry.register_lazy('smtp_server',
     'bzrlib.smtp_connection', 'smtp_server')
 option_registry.register_lazy('smtp_password',
@@ -2893,6 +3126,48 @@ option_registry.register(
            default=300.0, from_unicode=float_from_store,
            help="If we wait for a new request from a client for more than"
                 " X seconds, consider the client idle, and hangup."))
+option_registry.register(
+    Option('serve.max_connections',
+           default=None, from_unicode=int_from_store,
+           help='''\
+The maximum number of clients served at the same time, 0 means no limit.
+
+With serve.workers, this limit applies to each worker process. Further
+clients wait until a connection is available.
+'''))
+option_registry.register(
+    Option('serve.repository_cache_size',
+           default=0, from_unicode=int_from_store,
+           help='''\
+How many idle repositories the server keeps open.
+
+Repositories kept open by ``bzr serve`` are reused by later read-only
+requests from any client, along with their index and block caches. A
+repository is reopened when its pack-names file changes. 0 opens the
+repository again for each request.
+'''))
+option_registry.register(
+    Option('serve.workers',
+           default=0, from_unicode=int_from_store,
+           help='''\
+The number of processes serving TCP connections.
+
+When set, ``bzr serve`` forks this many worker processes sharing the
+listening socket, so that concurrent requests can use several CPUs.
+Sending SIGHUP to the server stops it gracefully, SIGUSR1 restarts its
+workers gracefully. 0 serves all connections from a single process.
+'''))
+option_registry.register(
+    Option('sftp.readv_window',
+           default=0, from_unicode=int_from_store,
+           help='''\
+The number of read requests a readv can have in flight over sftp.
+
+The data is requested in 32kB chunks. The next chunks are requested when
+half of the ones in flight have been received, so that the link stays
+busy without queuing a whole file on the server. 0 sends all requests at
+once.
+'''))
 option_registry.register(
     Option('stacked_on_location',
            default=None,
@@ -2913,6 +3188,17 @@ option_registry.register(
     ListOption('suppress_warnings',
            default=[],
            help="List of warning classes to suppress."))
+option_registry.register(
+    Option('transform.write_workers', default=1,
+           from_unicode=int_from_store,
+           help='''\
+The number of threads writing files when building a tree.
+
+With more than one thread, ``bzr checkout`` and ``bzr branch`` write the new
+files of the working tree concurrently while their texts are extracted, which
+helps on file systems with a high latency. The files are still moved into
+place one at a time.
+'''))
 option_registry.register(
     Option('validate_signatures_in_log', default=False,
            from_unicode=bool_from_store, invalid='warning',
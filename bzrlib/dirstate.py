@@ -48,6 +48,20 @@ are not - this is done for clarity of reading. All string data is in utf8.
     size = WHOLE_NUMBER;
     fingerprint = a nonempty utf8 sequence with meaning defined by minikind.
 
+When the dirstate.journal option is set, changes which only refresh the
+cached details of the current tree (like a new sha1 for a file whose stat
+changed) are appended to a journal file next to the state file rather than
+rewriting it. The journal is only used while the state file has the checksum
+and row count recorded in the journal header::
+
+    journal format = journal header line, full checksum, row count,
+     {journal chunk};
+    journal header line = "#bazaar dirstate journal 1", NL;
+    journal chunk = WHOLE_NUMBER, " ", ["-"], WHOLE_NUMBER, NL,
+     {entry_key, current_entry_details};
+
+where the numbers of a chunk are the length and crc32 of its records.
+
 Given this definition, the following is useful to know::
 
     entry (aka row) - all the data for a given key.
@@ -222,6 +236,7 @@ from __future__ import absolute_import
 
 import bisect
 import errno
+import mmap
 import operator
 import os
 from stat import S_IEXEC
@@ -292,6 +307,63 @@ class DefaultSHA1Provider(SHA1Provider):
         return statvalue, sha1
 
 
+class _PrefetchingSHA1Provider(SHA1Provider):
+    """A SHA1Provider hashing files in a thread pool ahead of their use.
+
+    Files are queued with prefetch() and hashed by the threads of a pool
+    (hashlib releases the GIL while hashing), the results are then handed
+    out when the dirstate asks for them. Files which have not been prefetched
+    or could not be read are hashed by the wrapped provider as usual, so
+    errors are reported where they would have been.
+    """
+
+    def __init__(self, provider, sha1_file, pool):
+        """Create a _PrefetchingSHA1Provider.
+
+        :param provider: The SHA1Provider of the dirstate.
+        :param sha1_file: The function the dirstate uses to hash files.
+        :param pool: A multiprocessing.pool.ThreadPool.
+        """
+        self._provider = provider
+        self._sha1_file = sha1_file
+        self._pool = pool
+        self._pending = {}
+
+    def prefetch(self, abspaths):
+        """Start hashing some files."""
+        for abspath in abspaths:
+            if abspath not in self._pending:
+                self._pending[abspath] = self._pool.apply_async(
+                    self._provider.stat_and_sha1, (abspath,))
+
+    def discard(self):
+        """Forget about the files prefetched but not asked for."""
+        self._pending.clear()
+
+    def _get_prefetched(self, abspath):
+        result = self._pending.pop(abspath, None)
+        if result is None:
+            return None
+        try:
+            return result.get()
+        except (IOError, OSError):
+            return None
+
+    def sha1(self, abspath):
+        """See SHA1Provider.sha1()."""
+        result = self._get_prefetched(abspath)
+        if result is None:
+            return self._sha1_file(abspath)
+        return result[1]
+
+    def stat_and_sha1(self, abspath):
+        """See SHA1Provider.stat_and_sha1()."""
+        result = self._get_prefetched(abspath)
+        if result is None:
+            return self._provider.stat_and_sha1(abspath)
+        return result
+
+
 class DirState(object):
     """Record directory and metadata state for fast access.
 
@@ -350,6 +422,11 @@ class DirState(object):
 
     HEADER_FORMAT_2 = '#bazaar dirstate flat format 2\n'
     HEADER_FORMAT_3 = '#bazaar dirstate flat format 3\n'
+    JOURNAL_HEADER_1 = '#bazaar dirstate journal 1\n'
+
+    # The journal is folded into the state file by the first save after it
+    # grows larger than this fraction of the state file.
+    MAX_JOURNAL_FRACTION = 0.25
 
     def __init__(self, path, sha1_provider, worth_saving_limit=0):
         """Create a  DirState object.
@@ -382,6 +459,19 @@ class DirState(object):
         self._parents = []
         self._state_file = None
         self._filename = path
+        self._journal_filename = path + '.journal'
+        # The checksum and row count lines of the state file, identifying the
+        # content the journal applies to
+        self._state_identity = None
+        # The size of the valid part of the journal if it applies to the
+        # state file, None otherwise
+        self._journal_size = None
+        # A read only map of the state file to bisect through, see
+        # _read_dirblocks_for_paths
+        self._state_map = None
+        # The directories whose blocks are in memory when only some of them
+        # have been read, None otherwise
+        self._loaded_dirnames = None
         self._lock_token = None
         self._lock_state = None
         self._id_index = None
@@ -600,8 +690,7 @@ class DirState(object):
         # The disk representation is generally info + '\0\n\0' at the end. But
         # for bisecting, it is easier to treat this as '\0' + info + '\0\n'
         # Because it means we can sync on the '\n'
-        state_file = self._state_file
-        file_size = os.fstat(state_file.fileno()).st_size
+        state_file, file_size = self._get_bisect_file()
         # We end up with 2 extra fields, we should have a trailing '\n' to
         # ensure that we read the whole record, and we should have a precursur
         # '' which ensures that we start after the previous '\n'
@@ -774,7 +863,7 @@ class DirState(object):
         _bisect_dirblocks is meant to find the contents of directories, which
         differs from _bisect, which only finds individual entries.
 
-        :param dir_list: A sorted list of directory names ['', 'dir', 'foo'].
+        :param dir_list: A list of directory names ['', 'dir', 'foo'].
         :return: A map from dir => entries_for_dir
         """
         # TODO: jam 20070223 A lot of the bisecting logic could be shared
@@ -792,8 +881,7 @@ class DirState(object):
         # The disk representation is generally info + '\0\n\0' at the end. But
         # for bisecting, it is easier to treat this as '\0' + info + '\0\n'
         # Because it means we can sync on the '\n'
-        state_file = self._state_file
-        file_size = os.fstat(state_file.fileno()).st_size
+        state_file, file_size = self._get_bisect_file()
         # We end up with 2 extra fields, we should have a trailing '\n' to
         # ensure that we read the whole record, and we should have a precursur
         # '' which ensures that we start after the previous '\n'
@@ -812,8 +900,9 @@ class DirState(object):
         #   low -> the first byte offset to read (inclusive)
         #   high -> the last byte offset (inclusive)
         #   dirs -> The list of directories that should be found in
-        #                the [low, high] range
-        pending = [(low, high, dir_list)]
+        #                the [low, high] range, split into their components
+        #                to be compared in the order of the file
+        pending = [(low, high, sorted(d.split('/') for d in dir_list))]
 
         page_size = self._bisect_page_size
 
@@ -872,7 +961,7 @@ class DirState(object):
                 # Find what entries we are looking for, which occur before and
                 # after this first record.
                 after = start
-                first_dir = first_fields[1]
+                first_dir = first_fields[1].split('/')
                 first_loc = bisect.bisect_left(cur_dirs, first_dir)
 
                 # These exist before the current location
@@ -896,7 +985,7 @@ class DirState(object):
                 else:
                     after = mid + len(block)
 
-                last_dir = last_fields[1]
+                last_dir = last_fields[1].split('/')
                 last_loc = bisect.bisect_right(post, last_dir)
 
                 middle_files = post[:last_loc]
@@ -915,11 +1004,12 @@ class DirState(object):
                         post.insert(0, last_dir)
 
                     # Find out what paths we have
-                    paths = {first_dir:[first_fields]}
+                    paths = {first_fields[1]:[first_fields]}
                     # last_dir might == first_dir so we need to be
                     # careful if we should append rather than overwrite
                     if last_entry_num != first_entry_num:
-                        paths.setdefault(last_dir, []).append(last_fields)
+                        paths.setdefault(last_fields[1], []).append(
+                            last_fields)
                     for num in xrange(first_entry_num+1, last_entry_num):
                         # TODO: jam 20070223 We are already splitting here, so
                         #       shouldn't we just split the whole thing rather
@@ -928,6 +1018,7 @@ class DirState(object):
                         paths.setdefault(fields[1], []).append(fields)
 
                     for cur_dir in middle_files:
+                        cur_dir = '/'.join(cur_dir)
                         for fields in paths.get(cur_dir, []):
                             # offset by 1 because of the opening '\0'
                             # consider changing fields_to_entry to avoid the
@@ -2074,7 +2165,9 @@ class DirState(object):
             rather it indicates that there are at least some files in some
             tree present there.
         """
-        self._read_dirblocks_if_needed()
+        if (self._loaded_dirnames is None
+            or dirname not in self._loaded_dirnames):
+            self._read_dirblocks_if_needed()
         key = dirname, basename, ''
         block_index, present = self._find_block_index_from_key(key)
         if not present:
@@ -2111,7 +2204,9 @@ class DirState(object):
             (absent) paths.
         :return: The dirstate entry tuple for path, or (None, None)
         """
-        self._read_dirblocks_if_needed()
+        if path_utf8 is None or self._loaded_dirnames is None:
+            # Otherwise _get_block_entry_index reads the block if needed
+            self._read_dirblocks_if_needed()
         if path_utf8 is not None:
             if type(path_utf8) is not str:
                 raise errors.BzrError('path_utf8 is not a str: %s %r'
@@ -2390,6 +2485,187 @@ class DirState(object):
         self._read_header_if_needed()
         if self._dirblock_state == DirState.NOT_IN_MEMORY:
             _read_dirblocks(self)
+            self._read_journal()
+        elif self._loaded_dirnames is not None:
+            self._read_remaining_dirblocks()
+
+    def _read_dirblocks_for_paths(self, paths):
+        """Read in the dirblocks needed to look at some paths.
+
+        With the dirstate.lazy_read option, only the blocks of the paths, of
+        their parent directories and of their children are read, by bisecting
+        through a map of the state file. The other entries stay on disk until
+        something needs the whole dirstate and calls
+        _read_dirblocks_if_needed. All the dirblocks are read otherwise, or
+        when the paths have been renamed in a tree.
+
+        :param paths: A set of utf8 paths, with their children.
+        """
+        self._read_header_if_needed()
+        if (self._dirblock_state != DirState.NOT_IN_MEMORY or '' in paths
+            or not self._config_stack.get('dirstate.lazy_read')):
+            self._read_dirblocks_if_needed()
+            return
+        blocks = self._bisect_blocks_for_paths(paths)
+        if blocks is None:
+            self._read_dirblocks_if_needed()
+            return
+        # Entries are found in the order they were read
+        for entries in blocks.itervalues():
+            entries.sort(key=operator.itemgetter(0))
+        root_entries = blocks.get('', [])
+        dirblocks = [('', [e for e in root_entries if e[0][1] == '']),
+                     ('', [e for e in root_entries if e[0][1] != ''])]
+        for dirname in sorted(blocks, key=lambda d: d.split('/')):
+            if dirname != '':
+                dirblocks.append((dirname, blocks[dirname]))
+        self._dirblocks = dirblocks
+        self._loaded_dirnames = set(blocks)
+        self._loaded_dirnames.add('')
+        self._dirblock_state = DirState.IN_MEMORY_UNMODIFIED
+        self._read_journal()
+
+    def _bisect_blocks_for_paths(self, paths):
+        """Find the dirblocks needed to look at some paths.
+
+        :return: A dict mapping the directories to their entries, or None if
+            one of the entries for the paths or their children is relocated.
+        """
+        to_read = set([''])
+        for path in paths:
+            to_read.add(path)
+            while path:
+                path = osutils.split(path)[0]
+                to_read.add(path)
+        blocks = {}
+        while to_read:
+            found = self._bisect_dirblocks(to_read)
+            to_read = set()
+            for dirname, entries in found.iteritems():
+                blocks[dirname] = entries
+                for entry in entries:
+                    if not entry[0][1]:
+                        # The root entry
+                        continue
+                    path = osutils.pathjoin(dirname, entry[0][1])
+                    if not osutils.is_inside_any(paths, path):
+                        continue
+                    for details in entry[1]:
+                        if details[0] == 'r':
+                            return None
+                        if details[0] == 'd' and path not in blocks:
+                            to_read.add(path)
+        return blocks
+
+    def _read_remaining_dirblocks(self):
+        """Read the dirblocks not read by _read_dirblocks_for_paths.
+
+        The blocks already in memory are kept, as their entries may have
+        been updated or be referenced by callers.
+        """
+        loaded = self._dirblocks
+        dirblock_state = self._dirblock_state
+        self._loaded_dirnames = None
+        self._close_state_map()
+        _read_dirblocks(self)
+        self._read_journal()
+        dirblocks = self._dirblocks
+        dirblocks[0] = loaded[0]
+        loaded_blocks = dict(loaded[1:])
+        for index in xrange(1, len(dirblocks)):
+            block = loaded_blocks.pop(dirblocks[index][0], None)
+            if block is not None:
+                dirblocks[index] = (dirblocks[index][0], block)
+        # Blocks added since, by update_entry
+        for dirname, block in loaded_blocks.iteritems():
+            index = bisect_dirblock(dirblocks, dirname, 1,
+                                    cache=self._split_path_cache)
+            dirblocks.insert(index, (dirname, block))
+        self._dirblock_state = dirblock_state
+
+    def _get_bisect_file(self):
+        """Return the file to bisect through and its size.
+
+        This is the map of the state file when some blocks have been read by
+        _read_dirblocks_for_paths, or the state file.
+        """
+        if (self._state_map is None
+            and self._dirblock_state == DirState.NOT_IN_MEMORY
+            and self._config_stack.get('dirstate.lazy_read')):
+            self._state_map = mmap.mmap(self._state_file.fileno(), 0,
+                                        access=mmap.ACCESS_READ)
+        if self._state_map is not None:
+            return self._state_map, self._state_map.size()
+        state_file = self._state_file
+        return state_file, os.fstat(state_file.fileno()).st_size
+
+    def _close_state_map(self):
+        if self._state_map is not None:
+            self._state_map.close()
+            self._state_map = None
+
+    def _read_journal(self):
+        """Apply the changes recorded in the journal to the dirblocks.
+
+        The journal is ignored if it was written for another content of the
+        state file. Its chunks are applied up to the first incomplete or
+        corrupt one, as left by an interrupted save.
+        """
+        self._journal_size = None
+        try:
+            f = open(self._journal_filename, 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        try:
+            text = f.read()
+        finally:
+            f.close()
+        header = DirState.JOURNAL_HEADER_1 + self._state_identity
+        if not text.startswith(header):
+            return
+        pos = len(header)
+        while True:
+            end_of_line = text.find('\n', pos)
+            if end_of_line == -1:
+                break
+            try:
+                length, crc = [int(value) for value
+                               in text[pos:end_of_line].split(' ')]
+            except ValueError:
+                break
+            records = text[end_of_line + 1:end_of_line + 1 + length]
+            if len(records) != length or zlib.crc32(records) != crc:
+                break
+            self._apply_journal_records(records)
+            pos = end_of_line + 1 + length
+        self._journal_size = pos
+
+    def _apply_journal_records(self, records):
+        """Update the current tree details of entries from journal records."""
+        fields = records.split('\0')
+        for pos in xrange(0, len(fields) - 1, 8):
+            (dirname, basename, file_id, minikind, fingerprint, size,
+             executable, packed_stat) = fields[pos:pos + 8]
+            if (self._loaded_dirnames is not None
+                and dirname not in self._loaded_dirnames):
+                # Applied when the block is read
+                continue
+            block_index, entry_index, dir_present, file_present = \
+                self._get_block_entry_index(dirname, basename, 0)
+            if not file_present:
+                continue
+            entry = self._dirblocks[block_index][1][entry_index]
+            if entry[0][2] != file_id:
+                continue
+            saved_minikind = entry[1][0][0]
+            entry[1][0] = (minikind, fingerprint, int(size),
+                           executable == 'y', packed_stat)
+            if minikind == 'd' and saved_minikind != 'd':
+                # As done by update_entry
+                self._ensure_block(block_index, entry_index,
+                                   osutils.pathjoin(dirname, basename))
 
     def _read_header(self):
         """This reads in the metadata header, and the parent ids.
@@ -2440,6 +2716,7 @@ class DirState(object):
         if not num_entries_line.startswith('num_entries: '):
             raise errors.BzrError('missing num_entries line')
         self._num_entries = int(num_entries_line[len('num_entries: '):-1])
+        self._state_identity = crc_line + num_entries_line
 
     def sha1_from_stat(self, path, stat_result):
         """Find a sha1 given a stat lookup."""
@@ -2481,6 +2758,8 @@ class DirState(object):
         #       fail to save IN_MEMORY_MODIFIED
         if not self._worth_saving():
             return
+        # The state file is about to change
+        self._close_state_map()
 
         grabbed_write_lock = False
         if self._lock_state != 'w':
@@ -2495,12 +2774,16 @@ class DirState(object):
                 # We couldn't grab a write lock, so we switch back to a read one
                 return
         try:
-            lines = self.get_lines()
-            self._state_file.seek(0)
-            self._state_file.writelines(lines)
-            self._state_file.truncate()
-            self._state_file.flush()
-            self._maybe_fdatasync()
+            if self._should_append_to_journal():
+                self._append_to_journal()
+            else:
+                lines = self.get_lines()
+                self._state_file.seek(0)
+                self._state_file.writelines(lines)
+                self._state_file.truncate()
+                self._state_file.flush()
+                self._maybe_fdatasync()
+                self._discard_journal(lines)
             self._mark_unmodified()
         finally:
             if grabbed_write_lock:
@@ -2510,10 +2793,80 @@ class DirState(object):
                 #       not changed contents. Since restore_read_lock may
                 #       not be an atomic operation.                
 
-    def _maybe_fdatasync(self):
-        """Flush to disk if possible and if not configured off."""
+    def _maybe_fdatasync(self, f=None):
+        """Flush to disk if possible and if not configured off.
+
+        :param f: The file to flush, the state file if None.
+        """
+        if f is None:
+            f = self._state_file
         if self._config_stack.get('dirstate.fdatasync'):
-            osutils.fdatasync(self._state_file.fileno())
+            osutils.fdatasync(f.fileno())
+
+    def _should_append_to_journal(self):
+        """Can the pending changes be saved by appending to the journal?"""
+        if (self._header_state == DirState.IN_MEMORY_MODIFIED
+            or self._dirblock_state != DirState.IN_MEMORY_HASH_MODIFIED
+            or self._state_identity is None):
+            return False
+        if not self._config_stack.get('dirstate.journal'):
+            return False
+        if self._journal_size is None:
+            return True
+        state_size = os.fstat(self._state_file.fileno()).st_size
+        return self._journal_size <= state_size * self.MAX_JOURNAL_FRACTION
+
+    def _append_to_journal(self):
+        """Append the entries whose hash changed to the journal."""
+        fields = []
+        for key in self._known_hash_changes:
+            block_index, entry_index, dir_present, file_present = \
+                self._get_block_entry_index(key[0], key[1], 0)
+            if not file_present:
+                continue
+            entry = self._dirblocks[block_index][1][entry_index]
+            if entry[0] != key:
+                continue
+            minikind, fingerprint, size, executable, packed_stat = entry[1][0]
+            fields.extend(key)
+            fields.extend([minikind, fingerprint, str(size),
+                           executable and 'y' or 'n', packed_stat])
+        if not fields:
+            return
+        fields.append('')
+        records = '\0'.join(fields)
+        chunk = '%d %d\n%s' % (len(records), zlib.crc32(records), records)
+        if self._journal_size is None:
+            f = open(self._journal_filename, 'wb')
+            header = DirState.JOURNAL_HEADER_1 + self._state_identity
+            chunk = header + chunk
+            size = 0
+        else:
+            f = open(self._journal_filename, 'r+b')
+            # Drop any incomplete chunk left by an interrupted save
+            f.seek(self._journal_size)
+            size = self._journal_size
+        try:
+            f.write(chunk)
+            f.truncate()
+            f.flush()
+            self._maybe_fdatasync(f)
+        finally:
+            f.close()
+        self._journal_size = size + len(chunk)
+
+    def _discard_journal(self, lines):
+        """Remove the journal after the state file has been rewritten.
+
+        :param lines: The lines written to the state file.
+        """
+        self._state_identity = lines[1] + lines[2]
+        self._journal_size = None
+        try:
+            os.unlink(self._journal_filename)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
 
     def _worth_saving(self):
         """Is it worth saving the dirstate or not?"""
@@ -3319,6 +3672,10 @@ class DirState(object):
         self._end_of_header = None
         self._cutoff_time = None
         self._split_path_cache = {}
+        self._state_identity = None
+        self._journal_size = None
+        self._close_state_map()
+        self._loaded_dirnames = None
 
     def lock_read(self):
         """Acquire a read lock on the dirstate."""
@@ -3354,6 +3711,7 @@ class DirState(object):
         #       already in memory, we could read just the header and check for
         #       any modification. If not modified, we can just leave things
         #       alone
+        self._close_state_map()
         self._state_file = None
         self._lock_state = None
         self._lock_token.unlock()
@@ -3797,6 +4155,74 @@ class ProcessEntryPython(object):
 
     def iter_changes(self):
         """Iterate over the changes."""
+        prefetcher = self._start_sha1_prefetch()
+        if prefetcher is None:
+            for result in self._iter_changes(None):
+                yield result
+            return
+        state = self.state
+        try:
+            for result in self._iter_changes(prefetcher):
+                yield result
+        finally:
+            state._sha1_provider = prefetcher._provider
+            state._sha1_file = prefetcher._sha1_file
+            prefetcher._pool.terminate()
+            prefetcher._pool.join()
+
+    def _start_sha1_prefetch(self):
+        """Hash the files which need it in threads, if configured.
+
+        :return: The _PrefetchingSHA1Provider installed on the dirstate, or
+            None if files are hashed one at a time.
+        """
+        if self.source_index is None:
+            # Everything is added, the files do not need to be compared
+            return None
+        if isinstance(self.state._sha1_provider, _PrefetchingSHA1Provider):
+            return None
+        workers = self.tree.get_config_stack().get('dirstate.sha1_workers')
+        if workers is None or workers <= 1:
+            return None
+        from multiprocessing.pool import ThreadPool
+        prefetcher = _PrefetchingSHA1Provider(self.state._sha1_provider,
+            self.state._sha1_file, ThreadPool(workers))
+        self.state._sha1_provider = prefetcher
+        self.state._sha1_file = prefetcher.sha1
+        return prefetcher
+
+    def _prefetch_sha1s(self, prefetcher, block, dir_info):
+        """Prefetch the sha1s comparing the files of a directory will need.
+
+        These are the files versioned in the source and the target whose stat
+        does not match the one recorded in the dirstate.
+
+        :param block: The dirblock of the directory.
+        :param dir_info: The walkdirs listing of the same directory.
+        """
+        files = {}
+        for path_info in dir_info[1]:
+            if path_info[2] == 'file':
+                files[path_info[1]] = path_info
+        abspaths = []
+        source_index = self.source_index
+        for entry in block[1]:
+            details = entry[1][0]
+            if details[0] != 'f' or entry[1][source_index][0] != 'f':
+                continue
+            path_info = files.get(entry[0][1])
+            if path_info is None:
+                continue
+            stat_value = path_info[3]
+            if (details[2] == stat_value.st_size
+                and details[4] == pack_stat(stat_value)):
+                # The recorded sha1 will be used
+                continue
+            abspaths.append(path_info[4])
+        prefetcher.discard()
+        prefetcher.prefetch(abspaths)
+
+    def _iter_changes(self, prefetcher):
         utf8_decode = cache_utf8._utf8_decode
         _cmp_by_dirs = cmp_by_dirs
         _process_entry = self._process_entry
@@ -4010,6 +4436,10 @@ class ProcessEntryPython(object):
                         else:
                             current_block = None
                     continue
+                if (prefetcher is not None and current_dir_info is not None
+                    and current_block is not None):
+                    self._prefetch_sha1s(prefetcher, current_block,
+                                         current_dir_info)
                 entry_index = 0
                 if current_block and entry_index < len(current_block[1]):
                     current_entry = current_block[1][entry_index]
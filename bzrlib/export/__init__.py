@@ -31,6 +31,11 @@ from bzrlib import (
 
 # Maps format name => export function
 _exporters = {}
+# The most file texts to read ahead of an exporter, and the most bytes of
+# them when their size is known.
+EXPORT_BATCH_FILES = 1000
+EXPORT_BATCH_BYTES = 2**24
+
 # Maps filename extensions => export format name
 _exporter_extensions = {}
 
@@ -228,6 +233,53 @@ def _export_iter_entries(tree, subdir, skip_special=True):
         yield final_path, path, entry
 
 
+def _export_iter_entries_and_chunks(tree, subdir, skip_special=True,
+                                    batch_files=EXPORT_BATCH_FILES,
+                                    batch_bytes=EXPORT_BATCH_BYTES):
+    """Iter the entries for tree suitable for exporting, with their texts.
+
+    The texts of the files are read with tree.iter_files_bytes for batches of
+    entries, which lets the repository read them in its own order and
+    several at a time, and are then handed out in the order of
+    _export_iter_entries. Only the texts of the current batch are kept in
+    memory.
+
+    :param batch_files: The most file texts to read at once.
+    :param batch_bytes: The most bytes of file texts to read at once, for the
+        entries whose text size is known.
+    :return: iterator over tuples with final path, tree path, inventory entry
+        and the list of chunks of the text for files, None for other kinds.
+    """
+    pending = []
+    desired_files = []
+    pending_bytes = 0
+    for final_path, path, entry in _export_iter_entries(tree, subdir,
+                                                        skip_special):
+        pending.append((final_path, path, entry))
+        if entry.kind != 'file':
+            continue
+        desired_files.append((entry.file_id, len(pending) - 1))
+        pending_bytes += entry.text_size or 0
+        if len(desired_files) >= batch_files or pending_bytes >= batch_bytes:
+            for item in _export_batch(tree, pending, desired_files):
+                yield item
+            pending = []
+            desired_files = []
+            pending_bytes = 0
+    for item in _export_batch(tree, pending, desired_files):
+        yield item
+
+
+def _export_batch(tree, pending, desired_files):
+    """Read the texts of a batch of entries and yield them in order."""
+    texts = {}
+    for index, chunks in tree.iter_files_bytes(desired_files):
+        # The chunks may only be valid until the next text is read
+        texts[index] = list(chunks)
+    for index, (final_path, path, entry) in enumerate(pending):
+        yield final_path, path, entry, texts.pop(index, None)
+
+
 register_lazy_exporter(None, [], 'bzrlib.export.dir_exporter',
                        'dir_exporter_generator')
 register_lazy_exporter('dir', [], 'bzrlib.export.dir_exporter',
@@ -18,19 +18,160 @@
 
 from __future__ import absolute_import
 
+import collections
+import gzip
 import os
 import StringIO
+import struct
 import sys
 import tarfile
+import time
+import zlib
 
 from bzrlib import (
+    config,
     errors,
     osutils,
     )
-from bzrlib.export import _export_iter_entries
+from bzrlib.export import _export_iter_entries_and_chunks
+
+
+# Uncompressed bytes of each block compressed by a worker thread, when
+# compressing a tarball in parallel.
+PARALLEL_GZIP_BLOCK_SIZE = 2**20
+
+
+class _ChunksFile(object):
+    """A file-like object reading a list of chunks without joining them."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = ''
+        self._offset = 0
+
+    def read(self, size=-1):
+        result = []
+        while size != 0:
+            if self._offset >= len(self._chunk):
+                try:
+                    self._chunk = self._chunks.next()
+                except StopIteration:
+                    self._chunk = ''
+                    break
+                self._offset = 0
+                continue
+            if size < 0:
+                piece = self._chunk[self._offset:]
+            else:
+                piece = self._chunk[self._offset:self._offset + size]
+                size -= len(piece)
+            self._offset += len(piece)
+            result.append(piece)
+        return ''.join(result)
+
+
+def _compress_block(data, level):
+    """Compress a block of a gzip stream on its own.
+
+    The block ends on a byte boundary and is not marked as the last one, so
+    the compressed blocks can be concatenated, like pigz does.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
 
+class _ParallelGzipFile(object):
+    """A write-only gzip file compressing blocks in a pool of threads.
 
-def prepare_tarball_item(tree, root, final_path, tree_path, entry, force_mtime=None):
+    The output is a single gzip member whose deflate stream is made of
+    independently compressed blocks, like the one written by pigz, so any
+    gzip reader can decompress it. zlib releases the GIL while compressing.
+    """
+
+    def __init__(self, filename, fileobj, mtime, pool, workers,
+                 compresslevel=9, block_size=PARALLEL_GZIP_BLOCK_SIZE):
+        """Create a _ParallelGzipFile.
+
+        :param filename: The name stored in the gzip header, or None.
+        :param fileobj: The file object to write the gzip stream to. It is
+            not closed with the gzip file.
+        :param mtime: The mtime stored in the gzip header, or None for now.
+        :param pool: A multiprocessing.pool.ThreadPool compressing the blocks.
+        :param workers: The number of threads of pool.
+        """
+        self._fileobj = fileobj
+        self._pool = pool
+        self._compresslevel = compresslevel
+        self._block_size = block_size
+        # The blocks being compressed are kept in memory
+        self._max_pending = workers * 2
+        self._pending = collections.deque()
+        self._buffer = []
+        self._buffered = 0
+        self._crc = zlib.crc32('') & 0xffffffffL
+        self._size = 0
+        self._write_header(filename, mtime)
+
+    def _write_header(self, filename, mtime):
+        # The same header as gzip.GzipFile
+        if mtime is None:
+            mtime = time.time()
+        if filename is None:
+            filename = getattr(self._fileobj, 'name', '')
+            if not isinstance(filename, basestring):
+                filename = ''
+        try:
+            filename = os.path.basename(filename)
+            if not isinstance(filename, str):
+                filename = filename.encode('latin-1')
+            if filename.endswith('.gz'):
+                filename = filename[:-3]
+        except UnicodeEncodeError:
+            filename = ''
+        flags = 0
+        if filename:
+            flags = gzip.FNAME
+        self._fileobj.write('\037\213\010' + chr(flags)
+            + struct.pack('<L', long(mtime)) + '\002\377')
+        if flags:
+            self._fileobj.write(filename + '\000')
+
+    def write(self, data):
+        self._crc = zlib.crc32(data, self._crc) & 0xffffffffL
+        self._size += len(data)
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self._block_size:
+            data = ''.join(self._buffer)
+            end = len(data) - len(data) % self._block_size
+            for start in range(0, end, self._block_size):
+                self._compress(data[start:start + self._block_size])
+            self._buffer = [data[end:]]
+            self._buffered = len(data) - end
+
+    def _compress(self, block):
+        self._pending.append(self._pool.apply_async(_compress_block,
+            (block, self._compresslevel)))
+        while len(self._pending) > self._max_pending:
+            self._fileobj.write(self._pending.popleft().get())
+
+    def close(self):
+        """Write the remaining blocks and the gzip trailer."""
+        if self._buffered:
+            self._compress(''.join(self._buffer))
+        self._buffer = []
+        self._buffered = 0
+        while self._pending:
+            self._fileobj.write(self._pending.popleft().get())
+        # An empty final block ends the deflate stream
+        self._fileobj.write(zlib.compressobj(self._compresslevel,
+            zlib.DEFLATED, -zlib.MAX_WBITS).flush())
+        self._fileobj.write(struct.pack('<LL', self._crc,
+                                        self._size & 0xffffffffL))
+
+
+def prepare_tarball_item(tree, root, final_path, tree_path, entry, force_mtime=None,
+                         chunks=None):
     """Prepare a tarball item for exporting
 
     :param tree: Tree to export
@@ -39,6 +180,8 @@ def prepare_tarball_item(tree, root, final_path, tree_path, entry, force_mtime=N
     :param entry: Entry to export
     :param force_mtime: Option mtime to force, instead of using tree
         timestamps.
+    :param chunks: The list of chunks of the text of a file, if already
+        read. The tarball item then reads them without joining them.
 
     Returns a (tarinfo, fileobj) tuple
     """
@@ -54,13 +197,17 @@ def prepare_tarball_item(tree, root, final_path, tree_path, entry, force_mtime=N
             item.mode = 0755
         else:
             item.mode = 0644
-        # This brings the whole file into memory, but that's almost needed for
-        # the tarfile contract, which wants the size of the file up front.  We
-        # want to make sure it doesn't change, and we need to read it in one
-        # go for content filtering.
-        content = tree.get_file_text(entry.file_id, tree_path)
-        item.size = len(content)
-        fileobj = StringIO.StringIO(content)
+        if chunks is not None:
+            item.size = sum(map(len, chunks))
+            fileobj = _ChunksFile(chunks)
+        else:
+            # This brings the whole file into memory, but that's almost
+            # needed for the tarfile contract, which wants the size of the
+            # file up front.  We want to make sure it doesn't change, and we
+            # need to read it in one go for content filtering.
+            content = tree.get_file_text(entry.file_id, tree_path)
+            item.size = len(content)
+            fileobj = StringIO.StringIO(content)
     elif entry.kind == "directory":
         item.type = tarfile.DIRTYPE
         item.name += '/'
@@ -97,9 +244,11 @@ def export_tarball_generator(tree, ball, root, subdir=None, force_mtime=None):
         timestamps.
     """
     try:
-        for final_path, tree_path, entry in _export_iter_entries(tree, subdir):
+        for final_path, tree_path, entry, chunks in (
+            _export_iter_entries_and_chunks(tree, subdir)):
             (item, fileobj) = prepare_tarball_item(
-                tree, root, final_path, tree_path, entry, force_mtime)
+                tree, root, final_path, tree_path, entry, force_mtime,
+                chunks)
             ball.addfile(item, fileobj)
             yield
     finally:
@@ -112,8 +261,10 @@ def tgz_exporter_generator(tree, dest, root, subdir, force_mtime=None,
 
     `dest` will be created holding the contents of this tree; if it
     already exists, it will be clobbered, like with "tar -c".
+
+    The tarball is compressed in several threads when the
+    export.compress_workers option is set.
     """
-    import gzip
     if force_mtime is not None:
         root_mtime = force_mtime
     elif (getattr(tree, "repository", None) and
@@ -139,18 +290,31 @@ def tgz_exporter_generator(tree, dest, root, subdir, force_mtime=None,
         # the basename can be stored in the gzip file rather than
         # dest. (bug 102234)
         basename = os.path.basename(dest)
+    workers = config.GlobalStack().get('export.compress_workers')
+    pool = None
+    if workers is not None and workers > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        zipstream = _ParallelGzipFile(basename, stream, root_mtime, pool,
+                                      workers)
+    else:
+        try:
+            zipstream = gzip.GzipFile(basename, 'w', fileobj=stream,
+                                      mtime=root_mtime)
+        except TypeError:
+            # Python < 2.7 doesn't support the mtime argument
+            zipstream = gzip.GzipFile(basename, 'w', fileobj=stream)
     try:
-        zipstream = gzip.GzipFile(basename, 'w', fileobj=stream,
-                                  mtime=root_mtime)
-    except TypeError:
-        # Python < 2.7 doesn't support the mtime argument
-        zipstream = gzip.GzipFile(basename, 'w', fileobj=stream)
-    ball = tarfile.open(None, 'w|', fileobj=zipstream)
-    for _ in export_tarball_generator(
-        tree, ball, root, subdir, force_mtime):
-        yield
-    # Closing zipstream may trigger writes to stream
-    zipstream.close()
+        ball = tarfile.open(None, 'w|', fileobj=zipstream)
+        for _ in export_tarball_generator(
+            tree, ball, root, subdir, force_mtime):
+            yield
+        # Closing zipstream may trigger writes to stream
+        zipstream.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
     if not is_stdout:
         # Now we can safely close the stream
         stream.close()
@@ -28,7 +28,7 @@ import zipfile
 from bzrlib import (
     osutils,
     )
-from bzrlib.export import _export_iter_entries
+from bzrlib.export import _export_iter_entries_and_chunks
 from bzrlib.trace import mutter
 
 
@@ -57,7 +57,8 @@ def zip_exporter_generator(tree, dest, root, subdir=None,
         dest = sys.stdout
     zipf = zipfile.ZipFile(dest, "w", compression)
     try:
-        for dp, tp, ie in _export_iter_entries(tree, subdir):
+        for dp, tp, ie, chunks in _export_iter_entries_and_chunks(tree,
+                                                                  subdir):
             file_id = ie.file_id
             mutter("  export {%s} kind %s to %s", file_id, ie.kind, dest)
 
@@ -75,8 +76,7 @@ def zip_exporter_generator(tree, dest, root, subdir=None,
                             date_time=date_time)
                 zinfo.compress_type = compression
                 zinfo.external_attr = _FILE_ATTR
-                content = tree.get_file_text(file_id, tp)
-                zipf.writestr(zinfo, content)
+                zipf.writestr(zinfo, ''.join(chunks))
             elif ie.kind == "directory":
                 # Directories must contain a trailing slash, to indicate
                 # to the zip routine that they are really directories and
@@ -0,0 +1,324 @@
+# Copyright (C) 2017 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Persistent index of the generation numbers of revisions.
+
+Deciding whether a revision is an ancestor of another, or which revisions
+are heads, means walking the ancestry of the revisions until they meet, which
+can go through most of the history of a repository. This index records for
+each revision:
+
+ * its generation number, or gdfo (greatest distance from origin): 1 for a
+   revision without parents, one more than the largest one of its parents
+   otherwise. An ancestor of a revision always has a smaller generation
+   number, so a search for the ancestors of a revision can stop at the
+   revisions whose generation number is not greater than that of the
+   revision.
+
+ * its left-hand parent, from which the revision's first-parent chain is
+   worked out when the index is read. A revision is on the chain of its
+   left-hand parent when that parent is the last revision of its chain,
+   and starts a new chain otherwise. The revisions of a chain are each the
+   left-hand parent of the next one, so of two revisions on the same chain,
+   the one with the smaller generation number is an ancestor of the other.
+
+The generation number of a revision depends on its whole ancestry, so the
+revisions with a ghost in their ancestry are not given one: the ghost may
+be filled in later with any history.
+
+The index is stored in the repository as an append-only file with one
+record per revision, and is extended by the repository when new revisions
+are added to it. Chains are not stored, so records appended in any order
+can't put two revisions on the same chain unless one is the left-hand
+parent of the other.
+"""
+
+from __future__ import absolute_import
+
+from bzrlib import (
+    errors,
+    revision as _mod_revision,
+    )
+from bzrlib.trace import mutter
+
+
+_FORMAT_STRING = 'Bazaar generation index v1\n'
+
+# The generation recorded for the revisions with ghost ancestors
+_NO_GENERATION = '-'
+
+
+class GenerationIndex(object):
+    """The generation numbers and chains of revisions, stored on a transport.
+
+    :ivar revisions: A dict mapping the revisions with a generation number to
+        their (generation, chain).
+    :ivar ghosted: The set of revisions with a ghost in their ancestry.
+    """
+
+    def __init__(self, transport, filename='generation-index',
+                 file_mode=None):
+        """Create a GenerationIndex.
+
+        :param transport: The transport holding the index file, usually the
+            repository control transport.
+        :param filename: The name of the index file.
+        :param file_mode: The mode to create the index file with.
+        """
+        self._transport = transport
+        self._filename = filename
+        self._file_mode = file_mode
+        self.revisions = {}
+        self.ghosted = set()
+        # The last revision of each chain
+        self._chain_tips = {}
+        self._next_chain = 0
+        # The offset of the end of the last complete record read
+        self._size = 0
+        # Whether the index file ends with a partial record
+        self._partial = False
+
+    def _add_record(self, revision_id, generation, left_parent_id):
+        """Add a revision to the index in memory.
+
+        The revision joins the chain of its left-hand parent if that parent
+        is the last revision of its chain, and starts a new chain otherwise.
+
+        :return: The (generation, chain) of the revision, or None.
+        """
+        if revision_id in self.revisions or revision_id in self.ghosted:
+            # Recorded twice, by another process or by this one
+            return self.revisions.get(revision_id)
+        if generation is None:
+            self.ghosted.add(revision_id)
+            return None
+        left = self.revisions.get(left_parent_id)
+        if (left is not None
+            and self._chain_tips.get(left[1]) == left_parent_id):
+            chain = left[1]
+        else:
+            chain = self._next_chain
+            self._next_chain += 1
+        self.revisions[revision_id] = (generation, chain)
+        self._chain_tips[chain] = revision_id
+        return generation, chain
+
+    def _read_new_bytes(self):
+        """Read the index file from the end of the last record read."""
+        if not self._size:
+            bytes = self._transport.get_bytes(self._filename)
+            if not bytes.startswith(_FORMAT_STRING):
+                mutter('ignoring generation index with unknown format in %s',
+                       self._transport.base)
+                return ''
+            self._size = len(_FORMAT_STRING)
+            return bytes[self._size:]
+        try:
+            size = self._transport.stat(self._filename).st_size
+        except (errors.TransportNotPossible, NotImplementedError):
+            return self._transport.get_bytes(self._filename)[self._size:]
+        if size <= self._size:
+            return ''
+        for offset, bytes in self._transport.readv(self._filename,
+                [(self._size, size - self._size)]):
+            return bytes
+
+    def load(self):
+        """Read the records added to the file since it was last read.
+
+        Records which can't be parsed are ignored, their revisions will be
+        recorded again by the next update.
+        """
+        try:
+            bytes = self._read_new_bytes()
+        except errors.NoSuchFile:
+            return
+        end = bytes.rfind('\n') + 1
+        self._size += end
+        # The last record is only complete if the file ends with a newline
+        self._partial = (end != len(bytes))
+        for record in bytes[:end].split('\n')[:-1]:
+            fields = record.split('\x00')
+            if len(fields) != 4 or fields[3] != '':
+                mutter('ignoring corrupt generation index record in %s: %r',
+                       self._transport.base, record)
+                continue
+            revision_id, generation, left_parent_id = fields[:3]
+            if generation == _NO_GENERATION:
+                self._add_record(revision_id, None, None)
+                continue
+            try:
+                generation = int(generation)
+            except ValueError:
+                mutter('ignoring corrupt generation index record in %s: %r',
+                       self._transport.base, record)
+                continue
+            self._add_record(revision_id, generation, left_parent_id)
+
+    def get_generations(self, revision_ids):
+        """Get the generations and chains of some revisions.
+
+        :return: A dict mapping the revisions which have a generation number
+            to their (generation, chain).
+        """
+        revisions = self.revisions
+        result = {}
+        for revision_id in revision_ids:
+            value = revisions.get(revision_id)
+            if value is not None:
+                result[revision_id] = value
+        return result
+
+    def update(self, parents_provider, revision_ids):
+        """Record the revisions which are not in the index yet.
+
+        Their ancestors are recorded first if needed. This must be done
+        while holding the physical lock of the repository, so that the
+        records appended by other processes are read first and no revision
+        is recorded twice.
+
+        :param parents_provider: An object providing get_parent_map, usually
+            the repository holding the revisions.
+        :param revision_ids: The revisions which must be in the index.
+        """
+        self.load()
+        known = self.revisions
+        pending = set(revision_id for revision_id in revision_ids
+                      if revision_id not in known
+                      and revision_id not in self.ghosted)
+        pending.discard(_mod_revision.NULL_REVISION)
+        if not pending:
+            return
+        # The parents of the revisions to record, None for ghosts
+        parent_map = {}
+        while pending:
+            found = parents_provider.get_parent_map(pending)
+            next_pending = set()
+            for revision_id in pending:
+                parent_ids = found.get(revision_id)
+                parent_map[revision_id] = parent_ids
+                if parent_ids is None:
+                    continue
+                for parent_id in parent_ids:
+                    if (parent_id not in known
+                        and parent_id not in self.ghosted
+                        and parent_id not in parent_map
+                        and parent_id != _mod_revision.NULL_REVISION):
+                        next_pending.add(parent_id)
+            pending = next_pending
+        present = dict((revision_id, [p for p in parent_ids
+                                      if parent_map.get(p) is not None])
+                       for revision_id, parent_ids in parent_map.iteritems()
+                       if parent_ids is not None)
+        records = []
+        for revision_id in _left_first_order(present):
+            records.append(self._make_record(revision_id,
+                                             parent_map[revision_id]))
+        self._append_records(records)
+
+    def _make_record(self, revision_id, parent_ids):
+        generation = 0
+        for parent_id in parent_ids:
+            if parent_id == _mod_revision.NULL_REVISION:
+                continue
+            value = self.revisions.get(parent_id)
+            if value is None:
+                # A ghost, or a revision with ghost ancestors
+                self._add_record(revision_id, None, None)
+                return revision_id, None, ''
+            generation = max(generation, value[0])
+        left_parent_id = ''
+        if parent_ids and parent_ids[0] != _mod_revision.NULL_REVISION:
+            left_parent_id = parent_ids[0]
+        self._add_record(revision_id, generation + 1, left_parent_id)
+        return revision_id, generation + 1, left_parent_id
+
+    def _append_records(self, records):
+        if not records:
+            return
+        lines = []
+        for revision_id, generation, left_parent_id in records:
+            if generation is None:
+                generation = _NO_GENERATION
+            lines.append('%s\x00%s\x00%s\x00\n'
+                         % (revision_id, generation, left_parent_id))
+        bytes = ''.join(lines)
+        if self._partial:
+            # Terminate the partial record, it is then ignored as corrupt
+            bytes = '\n' + bytes
+        try:
+            if not self._transport.has(self._filename):
+                self._transport.put_bytes(self._filename, _FORMAT_STRING,
+                                          mode=self._file_mode)
+            # The records are read back by the next load, which skips them
+            # as already known, rather than assuming nothing else was
+            # appended since the last load.
+            self._transport.append_bytes(self._filename, bytes,
+                                         mode=self._file_mode)
+        except (errors.TransportNotPossible, errors.PathError), e:
+            mutter('unable to write generation index in %s: %s',
+                   self._transport.base, e)
+
+
+def _left_first_order(parent_map):
+    """Sort revisions so that left-hand parents keep their chain.
+
+    The revisions are sorted topologically by a depth first search from the
+    revisions which are not the parent of another, going through left-hand
+    parents first. The revisions on the left-hand ancestry of a revision are
+    then recorded before the other children of their parents.
+
+    :param parent_map: A dict mapping each revision to its parents, which
+        must all be in the dict.
+    :return: A list of the revisions.
+    """
+    children = set()
+    for parent_ids in parent_map.itervalues():
+        children.update(parent_ids)
+    tips = sorted(set(parent_map).difference(children))
+    order = []
+    visited = set()
+    for tip in tips:
+        visited.add(tip)
+        stack = [(tip, iter(parent_map[tip]))]
+        while stack:
+            revision_id, parent_ids = stack[-1]
+            for parent_id in parent_ids:
+                if parent_id not in visited:
+                    visited.add(parent_id)
+                    stack.append((parent_id, iter(parent_map[parent_id])))
+                    break
+            else:
+                stack.pop()
+                order.append(revision_id)
+    return order
+
+
+def index_for_repository(repository):
+    """Return the generation index of a repository, loaded and ready to use.
+
+    :param repository: A repository stored on a transport.
+    :return: A GenerationIndex, or None if the repository has no control
+        transport.
+    """
+    try:
+        transport = repository.control_transport
+    except (AttributeError, errors.TransportNotPossible):
+        return None
+    index = GenerationIndex(transport,
+                            file_mode=repository.bzrdir._get_file_mode())
+    index.load()
+    return index
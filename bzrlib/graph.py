@@ -237,7 +237,7 @@ class Graph(object):
     specialize it for other repository types.
     """
 
-    def __init__(self, parents_provider):
+    def __init__(self, parents_provider, generation_index=None):
         """Construct a Graph that uses several graphs as its input
 
         This should not normally be invoked directly, because there may be
@@ -247,12 +247,17 @@ class Graph(object):
         :param parents_provider: An object providing a get_parent_map call
             conforming to the behavior of
             StackedParentsProvider.get_parent_map.
+        :param generation_index: An optional object providing a
+            get_generations call, like generation_index.GenerationIndex,
+            used to answer ancestry queries without searching through the
+            ancestry of the revisions it knows about.
         """
         if getattr(parents_provider, 'get_parents', None) is not None:
             self.get_parents = parents_provider.get_parents
         if getattr(parents_provider, 'get_parent_map', None) is not None:
             self.get_parent_map = parents_provider.get_parent_map
         self._parents_provider = parents_provider
+        self._generation_index = generation_index
 
     def __repr__(self):
         return 'Graph(%r)' % self._parents_provider
@@ -430,6 +435,10 @@ class Graph(object):
         """
         if unique_revision in common_revisions:
             return set()
+        for common_revision in common_revisions:
+            if self._is_ancestor_by_generation(unique_revision,
+                                               common_revision):
+                return set()
 
         # Algorithm description
         # 1) Walk backwards from the unique node and all common nodes.
@@ -831,6 +840,11 @@ class Graph(object):
                 return set([revision.NULL_REVISION])
         if len(candidate_heads) < 2:
             return candidate_heads
+        if self._generation_index is not None:
+            generations = self._generation_index.get_generations(
+                candidate_heads)
+            if len(generations) == len(candidate_heads):
+                return self._heads_by_generation(candidate_heads, generations)
         searchers = dict((c, self._make_breadth_first_searcher([c]))
                           for c in candidate_heads)
         active_searchers = dict(searchers)
@@ -897,6 +911,84 @@ class Graph(object):
             common_walker.start_searching(new_common)
         return candidate_heads
 
+    def _heads_by_generation(self, candidate_heads, generations):
+        """Return the heads from amongst keys with known generations.
+
+        A candidate on the same first-parent chain as another candidate with
+        a greater generation number is an ancestor of it. The ancestry of
+        the other candidates is then searched, without going past the
+        smallest generation number of the candidates still possibly heads,
+        as no candidate can be an ancestor of a revision with a smaller or
+        equal generation number.
+
+        :param candidate_heads: A set of at least two revisions.
+        :param generations: A dict mapping each of candidate_heads to its
+            (generation, chain).
+        """
+        heads = set(candidate_heads)
+        chain_tips = {}
+        for candidate, (generation, chain) in generations.iteritems():
+            tip = chain_tips.get(chain)
+            if tip is None:
+                chain_tips[chain] = candidate
+            elif generations[tip][0] < generation:
+                heads.discard(tip)
+                chain_tips[chain] = candidate
+            else:
+                heads.discard(candidate)
+        if len(heads) < 2:
+            return heads
+        min_generation = min(generations[c][0] for c in heads)
+        # The ancestors of the candidates on a chain are the ancestors of its
+        # tip, so only the heads are searched
+        pending = set(c for c in heads if generations[c][0] > min_generation)
+        seen = set(pending)
+        get_generations = self._generation_index.get_generations
+        while pending and len(heads) > 1:
+            parent_map = self.get_parent_map(pending)
+            parents = set()
+            for parent_ids in parent_map.itervalues():
+                parents.update(parent_ids)
+            reached = heads.intersection(parents)
+            parents.difference_update(seen)
+            seen.update(parents)
+            if reached:
+                heads.difference_update(reached)
+                if len(heads) < 2:
+                    break
+                min_generation = min(generations[c][0] for c in heads)
+            parent_generations = get_generations(parents)
+            pending = set()
+            for parent in parents:
+                value = parent_generations.get(parent)
+                # Revisions without a generation are searched anyway
+                if value is None or value[0] > min_generation:
+                    pending.add(parent)
+            pending.discard(revision.NULL_REVISION)
+        return heads
+
+    def _is_ancestor_by_generation(self, candidate_ancestor,
+                                   candidate_descendant):
+        """Tell if a revision is an ancestor of another from their generations.
+
+        :return: True or False, or None if the generation index can't tell.
+        """
+        if (self._generation_index is None
+            or candidate_ancestor == candidate_descendant):
+            return None
+        generations = self._generation_index.get_generations(
+            [candidate_ancestor, candidate_descendant])
+        if len(generations) != 2:
+            return None
+        ancestor_generation, ancestor_chain = generations[candidate_ancestor]
+        descendant_generation, descendant_chain = generations[
+            candidate_descendant]
+        if ancestor_generation >= descendant_generation:
+            return False
+        if ancestor_chain == descendant_chain:
+            return True
+        return None
+
     def find_merge_order(self, tip_revision_id, lca_revision_ids):
         """Find the order that each revision was merged into tip.
 
@@ -1058,6 +1150,10 @@ class Graph(object):
         smallest number of parent lookups to determine the ancestral
         relationship between N revisions.
         """
+        result = self._is_ancestor_by_generation(candidate_ancestor,
+                                                 candidate_descendant)
+        if result is not None:
+            return result
         return set([candidate_descendant]) == self.heads(
             [candidate_ancestor, candidate_descendant])
 
@@ -18,6 +18,7 @@
 
 from __future__ import absolute_import
 
+import collections
 import time
 import zlib
 
@@ -55,6 +56,14 @@ from bzrlib.versionedfile import (
 # groupcompress blocks.
 BATCH_SIZE = 2**16
 
+# Uncompressed block content to extract ahead of the consumer of a record
+# stream, when extracting in worker threads.
+EXTRACT_AHEAD_BYTES = 2**26
+
+# Uncompressed bytes of whole files to put in each chunk compressed by a
+# worker process, see GroupCompressVersionedFiles._insert_record_stream_in_pool
+PARALLEL_CHUNK_SIZE = 2**24
+
 # osutils.sha_string('')
 _null_sha1 = 'da39a3ee5e6b4b0d3255bfef95601890afd80709'
 
@@ -1043,6 +1052,73 @@ class PyrexGroupCompressor(_CommonGroupCompressor):
         self.endpoint = endpoint
 
 
+def _start_new_block(prefix, last_prefix, max_fulltext_prefix,
+                     max_fulltext_len, end_point):
+    """Should the text that ended at end_point go into a new block?"""
+    if (prefix == max_fulltext_prefix
+        and end_point < 2 * max_fulltext_len):
+        # As long as we are on the same file_id, we will fill at least
+        # 2 * max_fulltext_len
+        return False
+    elif end_point > 4*1024*1024:
+        return True
+    elif (prefix is not None and prefix != last_prefix
+          and end_point > 2*1024*1024):
+        return True
+    return False
+
+
+def _compress_texts(texts, compressor_settings):
+    """Compress texts into groupcompress blocks.
+
+    The texts are grouped into blocks as by
+    GroupCompressVersionedFiles._insert_record_stream. This is a function so
+    that it can run in a worker process.
+
+    :param texts: A list of (key, parents, sha1, bytes) tuples, in the order
+        to compress them.
+    :param compressor_settings: The settings for the GroupCompressor.
+    :return: A list of (block_bytes, [(key, parents, reads)]) tuples, one per
+        block, where reads is the 'start end' of the text in the block.
+    """
+    blocks = []
+    keys_to_add = []
+    compressor = GroupCompressor(compressor_settings)
+    last_prefix = None
+    max_fulltext_len = 0
+    max_fulltext_prefix = None
+    for key, parents, sha1, bytes in texts:
+        if len(key) > 1:
+            prefix = key[0]
+            soft = (prefix == last_prefix)
+        else:
+            prefix = None
+            soft = False
+        if max_fulltext_len < len(bytes):
+            max_fulltext_len = len(bytes)
+            max_fulltext_prefix = prefix
+        (found_sha1, start_point, end_point,
+         type) = compressor.compress(key, bytes, sha1, soft=soft)
+        if _start_new_block(prefix, last_prefix, max_fulltext_prefix,
+                            max_fulltext_len, end_point):
+            compressor.pop_last()
+            blocks.append((''.join(compressor.flush().to_chunks()[1]),
+                           keys_to_add))
+            keys_to_add = []
+            compressor = GroupCompressor(compressor_settings)
+            max_fulltext_len = len(bytes)
+            (found_sha1, start_point, end_point,
+             type) = compressor.compress(key, bytes, sha1)
+        last_prefix = prefix
+        if key[-1] is None:
+            key = key[:-1] + ('sha1:' + found_sha1,)
+        keys_to_add.append((key, parents, '%d %d' % (start_point, end_point)))
+    if keys_to_add:
+        blocks.append((''.join(compressor.flush().to_chunks()[1]),
+                       keys_to_add))
+    return blocks
+
+
 def make_pack_factory(graph, delta, keylength, inconsistency_fatal=True):
     """Create a factory for creating a pack based groupcompress.
 
@@ -1080,6 +1156,16 @@ def cleanup_pack_group(versioned_files):
     versioned_files.stream.close()
 
 
+def _extract_factories(manager):
+    """Extract the texts of the factories of manager ahead of their use."""
+    for factory in manager._factories:
+        try:
+            factory.get_bytes_as('fulltext')
+        except Exception:
+            # The error is raised again when the consumer asks for the text
+            return
+
+
 class _BatchingBlockFetcher(object):
     """Fetch group compress blocks in batches.
 
@@ -1087,7 +1173,16 @@ class _BatchingBlockFetcher(object):
         currently pending batch.
     """
 
-    def __init__(self, gcvf, locations, get_compressor_settings=None):
+    def __init__(self, gcvf, locations, get_compressor_settings=None,
+                 extract_pool=None, extract_ahead_bytes=EXTRACT_AHEAD_BYTES):
+        """Create a _BatchingBlockFetcher.
+
+        :param extract_pool: If not None, a ThreadPool extracting the texts
+            of blocks before their factories are yielded.
+        :param extract_ahead_bytes: The uncompressed size of the blocks to
+            extract ahead of the consumer at most. A block is always
+            extracted ahead, however large.
+        """
         self.gcvf = gcvf
         self.locations = locations
         self.keys = []
@@ -1097,6 +1192,12 @@ class _BatchingBlockFetcher(object):
         self.last_read_memo = None
         self.manager = None
         self._get_compressor_settings = get_compressor_settings
+        self._extract_pool = extract_pool
+        self._extract_ahead_bytes = extract_ahead_bytes
+        # (manager, async_result) for the managers being extracted, in the
+        # order to yield them
+        self._extracting = collections.deque()
+        self._extracting_bytes = 0
 
     def add_key(self, key):
         """Add another to key to fetch.
@@ -1134,11 +1235,38 @@ class _BatchingBlockFetcher(object):
 
     def _flush_manager(self):
         if self.manager is not None:
-            for factory in self.manager.get_record_stream():
-                yield factory
+            if self._extract_pool is None:
+                for factory in self.manager.get_record_stream():
+                    yield factory
+            else:
+                for factory in self._extract_ahead(self.manager):
+                    yield factory
             self.manager = None
             self.last_read_memo = None
 
+    def _extract_ahead(self, manager):
+        """Start extracting manager, yielding the factories now due."""
+        block = manager._block
+        # Blocks are shared through the group cache, but only one thread at
+        # a time may expand one.
+        while [m for m, _ in self._extracting if m._block is block]:
+            for factory in self._yield_extracted():
+                yield factory
+        self._extracting.append((manager,
+            self._extract_pool.apply_async(_extract_factories, (manager,))))
+        self._extracting_bytes += manager._last_byte
+        while self._extracting_bytes > self._extract_ahead_bytes:
+            for factory in self._yield_extracted():
+                yield factory
+
+    def _yield_extracted(self):
+        """Yield the factories of the first manager being extracted."""
+        manager, result = self._extracting.popleft()
+        result.wait()
+        self._extracting_bytes -= manager._last_byte
+        for factory in manager.get_record_stream():
+            yield factory
+
     def yield_factories(self, full_flush=False):
         """Yield factories for keys added since the last yield.  They will be
         returned in the order they were added via add_key.
@@ -1184,6 +1312,9 @@ class _BatchingBlockFetcher(object):
         if full_flush:
             for factory in self._flush_manager():
                 yield factory
+            while self._extracting:
+                for factory in self._yield_extracted():
+                    yield factory
         del self.keys[:]
         self.batch_memos.clear()
         del self.memos_to_get[:]
@@ -1226,12 +1357,33 @@ class GroupCompressVersionedFiles(VersionedFilesWithFallbacks):
         self._group_cache = _group_cache
         self._immediate_fallback_vfs = []
         self._max_bytes_to_index = None
+        self._extract_workers = 0
+        self._annotation_cache = None
+
+    def set_annotation_cache(self, cache):
+        """Use a persistent cache when annotating texts.
+
+        :param cache: An annotation_cache.AnnotationCache, or None.
+        """
+        self._annotation_cache = cache
+
+    def set_extract_workers(self, workers):
+        """Extract texts in worker threads when streaming fulltexts.
+
+        :param workers: The number of threads extracting the blocks streamed
+            by get_record_stream(..., include_delta_closure=True) ahead of
+            the consumer. With 0 or 1 texts are extracted when asked for.
+        """
+        self._extract_workers = workers
 
     def without_fallbacks(self):
         """Return a clone of this object without any fallbacks configured."""
-        return GroupCompressVersionedFiles(self._index, self._access,
+        vf = GroupCompressVersionedFiles(self._index, self._access,
             self._delta, _unadded_refs=dict(self._unadded_refs),
             _group_cache=self._group_cache)
+        vf._extract_workers = self._extract_workers
+        vf._annotation_cache = self._annotation_cache
+        return vf
 
     def add_lines(self, key, parents, lines, parent_texts=None,
         left_matching_blocks=None, nostore_sha=None, random_id=False,
@@ -1310,11 +1462,11 @@ class GroupCompressVersionedFiles(VersionedFilesWithFallbacks):
 
     def annotate(self, key):
         """See VersionedFiles.annotate."""
-        ann = annotate.Annotator(self)
+        ann = self.get_annotator()
         return ann.annotate_flat(key)
 
     def get_annotator(self):
-        return annotate.Annotator(self)
+        return annotate.Annotator(self, cache=self._annotation_cache)
 
     def check(self, progress_bar=None, keys=None):
         """See VersionedFiles.check()."""
@@ -1590,8 +1742,25 @@ class GroupCompressVersionedFiles(VersionedFilesWithFallbacks):
         #  - we encounter an unadded ref, or
         #  - we run out of keys, or
         #  - the total bytes to retrieve for this batch > BATCH_SIZE
+        extract_pool = None
+        if (include_delta_closure and self._extract_workers > 1
+            and len(locations) > 1):
+            from multiprocessing.pool import ThreadPool
+            extract_pool = ThreadPool(self._extract_workers)
+        try:
+            for factory in self._get_batched_record_stream(source_keys,
+                    locations, ordering, include_delta_closure,
+                    extract_pool):
+                yield factory
+        finally:
+            if extract_pool is not None:
+                extract_pool.terminate()
+
+    def _get_batched_record_stream(self, source_keys, locations, ordering,
+                                   include_delta_closure, extract_pool):
         batcher = _BatchingBlockFetcher(self, locations,
-            get_compressor_settings=self._get_compressor_settings)
+            get_compressor_settings=self._get_compressor_settings,
+            extract_pool=extract_pool)
         for source, keys in source_keys:
             if source is self:
                 for key in keys:
@@ -1667,6 +1836,88 @@ class GroupCompressVersionedFiles(VersionedFilesWithFallbacks):
     def _make_group_compressor(self):
         return GroupCompressor(self._get_compressor_settings())
 
+    def _add_block(self, bytes, keys_to_add, random_id=False):
+        """Write a compressed block and index the texts it holds.
+
+        :param bytes: The serialised GroupCompressBlock.
+        :param keys_to_add: A list of (key, reads, refs) for the texts in the
+            block, reads being the 'start end' of each text in the block.
+        """
+        index, start, length = self._access.add_raw_records(
+            [(None, len(bytes))], bytes)[0]
+        nodes = []
+        for key, reads, refs in keys_to_add:
+            nodes.append((key, "%d %d %s" % (start, length, reads), refs))
+        self._index.add_records(nodes, random_id=random_id)
+
+    def _add_compressed_blocks(self, blocks, random_id=False):
+        """Write the blocks compressed by _compress_texts.
+
+        :param blocks: A list of (block_bytes, [(key, parents, reads)]) as
+            returned by _compress_texts.
+        """
+        as_st = static_tuple.StaticTuple.from_sequence
+        for bytes, texts in blocks:
+            keys_to_add = []
+            for key, parents, reads in texts:
+                if parents is not None:
+                    parents = as_st([as_st(p) for p in parents])
+                keys_to_add.append(
+                    (key, reads, static_tuple.StaticTuple(parents)))
+            self._add_block(bytes, keys_to_add, random_id=random_id)
+
+    def _insert_record_stream_in_pool(self, stream, pool, max_pending,
+                                      random_id=False,
+                                      chunk_size=PARALLEL_CHUNK_SIZE):
+        """Insert a record stream, compressing it in a process pool.
+
+        The stream is cut into chunks holding the texts of whole files, about
+        chunk_size bytes each. Every chunk is compressed into its own blocks
+        by a worker of pool, and the blocks are written in stream order, so
+        the result does not depend on the number of workers.
+
+        :param stream: A stream of records to insert, all of which can be
+            returned as fulltexts.
+        :param pool: A multiprocessing.Pool to compress chunks in.
+        :param max_pending: The number of chunks to have in flight at most,
+            which bounds memory use.
+        :return: An iterator over the keys of the inserted records.
+        """
+        settings = self._get_compressor_settings()
+        pending = collections.deque()
+        def add_blocks(result):
+            self._add_compressed_blocks(result.get(), random_id=random_id)
+        chunk = []
+        chunk_bytes = 0
+        last_prefix = None
+        for record in stream:
+            if record.storage_kind == 'absent':
+                raise errors.RevisionNotPresent(record.key, self)
+            bytes = record.get_bytes_as('fulltext')
+            if len(record.key) > 1:
+                prefix = record.key[0]
+            else:
+                prefix = None
+            # Only split the texts of a single file if it is very large
+            if chunk and ((prefix is None or prefix != last_prefix)
+                          and chunk_bytes >= chunk_size
+                          or chunk_bytes >= 4 * chunk_size):
+                pending.append(pool.apply_async(_compress_texts,
+                                                (chunk, settings)))
+                chunk = []
+                chunk_bytes = 0
+                while len(pending) > max_pending:
+                    add_blocks(pending.popleft())
+            chunk.append((record.key, record.parents, record.sha1, bytes))
+            chunk_bytes += len(bytes)
+            last_prefix = prefix
+            yield record.key
+        if chunk:
+            pending.append(pool.apply_async(_compress_texts,
+                                            (chunk, settings)))
+        while pending:
+            add_blocks(pending.popleft())
+
     def _insert_record_stream(self, stream, random_id=False, nostore_sha=None,
                               reuse_blocks=True):
         """Internal core to insert a record stream into this container.
@@ -1712,12 +1963,7 @@ class GroupCompressVersionedFiles(VersionedFilesWithFallbacks):
             #       time we won't (everything else)
             bytes = ''.join(chunks)
             del chunks
-            index, start, length = self._access.add_raw_records(
-                [(None, len(bytes))], bytes)[0]
-            nodes = []
-            for key, reads, refs in keys_to_add:
-                nodes.append((key, "%d %d %s" % (start, length, reads), refs))
-            self._index.add_records(nodes, random_id=random_id)
+            self._add_block(bytes, keys_to_add, random_id=random_id)
             self._unadded_refs = {}
             del keys_to_add[:]
 
@@ -1801,18 +2047,8 @@ class GroupCompressVersionedFiles(VersionedFilesWithFallbacks):
                                                nostore_sha=nostore_sha)
             # delta_ratio = float(len(bytes)) / (end_point - start_point)
             # Check if we want to continue to include that text
-            if (prefix == max_fulltext_prefix
-                and end_point < 2 * max_fulltext_len):
-                # As long as we are on the same file_id, we will fill at least
-                # 2 * max_fulltext_len
-                start_new_block = False
-            elif end_point > 4*1024*1024:
-                start_new_block = True
-            elif (prefix is not None and prefix != last_prefix
-                  and end_point > 2*1024*1024):
-                start_new_block = True
-            else:
-                start_new_block = False
+            start_new_block = _start_new_block(prefix, last_prefix,
+                max_fulltext_prefix, max_fulltext_len, end_point)
             last_prefix = prefix
             if start_new_block:
                 self._compressor.pop_last()
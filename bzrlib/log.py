@@ -70,6 +70,7 @@ from bzrlib import (
     diff,
     errors,
     foreign,
+    log_index,
     repository as _mod_repository,
     revision as _mod_revision,
     revisionspec,
@@ -523,6 +524,14 @@ class _DefaultLogGenerator(LogGenerator):
             generate_merge_revisions=generate_merge_revisions,
             delayed_graph_generation=delayed_graph_generation,
             exclude_common_ancestry=rqst.get('exclude_common_ancestry'))
+        if rqst.get('specific_fileids'):
+            view_revisions = list(view_revisions)
+            touching_revisions = _find_touching_revisions(self.branch,
+                rqst.get('specific_fileids'), view_revisions,
+                include_moved_directories=True)
+            if touching_revisions is not None:
+                view_revisions = [view for view in view_revisions
+                                  if view[0] in touching_revisions]
 
         # Apply the other filters
         return make_log_rev_iterator(self.branch, view_revisions,
@@ -541,9 +550,12 @@ class _DefaultLogGenerator(LogGenerator):
             exclude_common_ancestry=rqst.get('exclude_common_ancestry'))
         if not isinstance(view_revisions, list):
             view_revisions = list(view_revisions)
+        touching_revisions = _find_touching_revisions(self.branch,
+            rqst.get('specific_fileids'), view_revisions)
         view_revisions = _filter_revisions_touching_file_id(self.branch,
             rqst.get('specific_fileids')[0], view_revisions,
-            include_merges=rqst.get('levels') != 1)
+            include_merges=rqst.get('levels') != 1,
+            touching_revisions=touching_revisions)
         return make_log_rev_iterator(self.branch, view_revisions,
             rqst.get('delta_type'), rqst.get('match'))
 
@@ -1158,8 +1170,37 @@ def _get_mainline_revs(branch, start_revision, end_revision):
     return mainline_revs, rev_nos, start_rev_id, end_rev_id
 
 
+def _find_touching_revisions(branch, file_ids, view_revisions,
+                             include_moved_directories=False):
+    """Narrow down the revisions touching file ids with the log index.
+
+    The log index of the repository is used when the log.file_index option
+    is set, and updated with the revisions it is missing.
+
+    :param branch: The branch being logged.
+    :param file_ids: The file ids of interest.
+    :param view_revisions: A list of (revision_id, dotted_revno, merge_depth)
+        tuples.
+    :param include_moved_directories: Also keep the revisions which moved a
+        directory.
+    :return: None if the log index is not used, otherwise the set of the
+        revisions from view_revisions which may touch file_ids. Revisions that
+        can't be indexed are part of it.
+    """
+    if not branch.get_config_stack().get('log.file_index'):
+        return None
+    index = log_index.index_for_repository(branch.repository)
+    if index is None:
+        return None
+    revision_ids = [rev_id for rev_id, revno, depth in view_revisions]
+    index.update(branch.repository, revision_ids)
+    touching = index.revisions_touching(file_ids, include_moved_directories)
+    return set(rev_id for rev_id in revision_ids
+               if rev_id in touching or rev_id not in index.revisions)
+
+
 def _filter_revisions_touching_file_id(branch, file_id, view_revisions,
-    include_merges=True):
+    include_merges=True, touching_revisions=None):
     r"""Return the list of revision ids which touch a given file id.
 
     The function filters view_revisions and returns a subset.
@@ -1195,13 +1236,17 @@ def _filter_revisions_touching_file_id(branch, file_id, view_revisions,
 
     :param include_merges: include merge revisions in the result or not
 
+    :param touching_revisions: If not None, only these revisions may modify
+        file_id, as found by _find_touching_revisions.
+
     :return: A list of (revision_id, dotted_revno, merge_depth) tuples.
     """
     # Lookup all possible text keys to determine which ones actually modified
     # the file.
     graph = branch.repository.get_file_graph()
     get_parent_map = graph.get_parent_map
-    text_keys = [(file_id, rev_id) for rev_id, revno, depth in view_revisions]
+    text_keys = [(file_id, rev_id) for rev_id, revno, depth in view_revisions
+                 if touching_revisions is None or rev_id in touching_revisions]
     next_keys = None
     # Looking up keys in batches of 1000 can cut the time in half, as well as
     # memory consumption. GraphIndex *does* like to look for a few keys in
@@ -0,0 +1,283 @@
+# Copyright (C) 2017 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Persistent index of the file ids touched by each revision.
+
+Logging a file or a directory needs to find the revisions which changed it,
+which means looking up a text key or computing a delta for every revision
+logged. This index records, for each revision, the file ids of the entries
+which differ from its left-hand parent along with the file ids of all their
+parent directories. The revisions which touched a file or anything below a
+directory are then known without looking at any inventory.
+
+The index only narrows down the revisions to look at: the revisions it
+returns are still checked the usual way, so it gives the same log.
+
+The index is stored in the repository as an append-only file with one
+record per revision, and is extended with the revisions missing from it
+whenever it is used. That happens under a read lock, so two processes may
+append at the same time: each record line starts with the length and crc32
+of the record, and the lines torn or mixed up by concurrent appends are
+ignored.
+"""
+
+from __future__ import absolute_import
+
+import zlib
+
+from bzrlib import (
+    errors,
+    revision as _mod_revision,
+    ui,
+    )
+from bzrlib.i18n import gettext
+from bzrlib.trace import mutter
+
+
+_FORMAT_STRING = 'Bazaar log index v1\n'
+
+
+class LogIndex(object):
+    """The file ids touched by revisions, stored on a transport.
+
+    :ivar touched: A dict mapping each file id to the set of revisions which
+        touched it, or a file below it for directories.
+    :ivar moved_directories: The revisions which renamed or moved a
+        directory, these change the path of everything below it.
+    :ivar revisions: The set of revisions recorded in the index.
+    """
+
+    # The number of revisions whose trees are read at once
+    _batch_size = 100
+
+    def __init__(self, transport, filename='log-index', file_mode=None):
+        """Create a LogIndex.
+
+        :param transport: The transport holding the index file, usually the
+            repository control transport.
+        :param filename: The name of the index file.
+        :param file_mode: The mode to create the index file with.
+        """
+        self._transport = transport
+        self._filename = filename
+        self._file_mode = file_mode
+        self.touched = {}
+        self.moved_directories = set()
+        self.revisions = set()
+
+    def _add_record(self, revision_id, moved_directory, file_ids):
+        self.revisions.add(revision_id)
+        if moved_directory:
+            self.moved_directories.add(revision_id)
+        for file_id in file_ids:
+            revisions = self.touched.get(file_id)
+            if revisions is None:
+                revisions = self.touched[file_id] = set()
+            revisions.add(revision_id)
+
+    def load(self):
+        """Read the records stored on the transport.
+
+        Records which can't be parsed are ignored, they will be recomputed
+        by the next update.
+        """
+        try:
+            bytes = self._transport.get_bytes(self._filename)
+        except errors.NoSuchFile:
+            return
+        if not bytes.startswith(_FORMAT_STRING):
+            mutter('ignoring log index with unknown format in %s',
+                   self._transport.base)
+            return
+        lines = bytes[len(_FORMAT_STRING):].split('\n')
+        # The last record is only complete if the file ends with a newline
+        for line in lines[:-1]:
+            fields = _parse_record(line)
+            if fields is None:
+                mutter('ignoring corrupt log index record in %s: %r',
+                       self._transport.base, line)
+                continue
+            self._add_record(fields[0], fields[1] == '1', fields[2:])
+
+    def update(self, repository, revision_ids):
+        """Record the revisions which are not in the index yet.
+
+        Revisions absent from the repository are not recorded.
+
+        :param repository: The repository holding the revisions.
+        :param revision_ids: The revisions which must be in the index.
+        """
+        missing = [revision_id for revision_id in revision_ids
+                   if revision_id not in self.revisions]
+        if not missing:
+            return
+        parent_map = repository.get_parent_map(missing)
+        missing = [revision_id for revision_id in missing
+                   if revision_id in parent_map]
+        pb = ui.ui_factory.nested_progress_bar()
+        try:
+            for start in xrange(0, len(missing), self._batch_size):
+                pb.update(gettext('Indexing revisions'), start, len(missing))
+                batch = missing[start:start + self._batch_size]
+                records = self._compute_records(repository, batch,
+                                                parent_map)
+                self._append_records(records)
+        finally:
+            pb.finished()
+
+    def _compute_records(self, repository, revision_ids, parent_map):
+        needed = set(revision_ids)
+        for revision_id in revision_ids:
+            needed.update(parent_map[revision_id][:1])
+        needed.discard(_mod_revision.NULL_REVISION)
+        try:
+            inventories = dict((tree.get_revision_id(), tree.root_inventory)
+                for tree in repository.revision_trees(needed))
+        except errors.NoSuchRevision:
+            # A ghost left-hand parent, get the inventories one by one
+            inventories = {}
+            for revision_id in needed:
+                try:
+                    inventories[revision_id] = repository.revision_tree(
+                        revision_id).root_inventory
+                except errors.NoSuchRevision:
+                    pass
+        records = []
+        for revision_id in revision_ids:
+            new_inv = inventories.get(revision_id)
+            if new_inv is None:
+                continue
+            parent_ids = parent_map[revision_id]
+            if parent_ids and parent_ids[0] != _mod_revision.NULL_REVISION:
+                old_inv = inventories.get(parent_ids[0])
+            else:
+                old_inv = None
+            records.append((revision_id,)
+                           + touched_file_ids(old_inv, new_inv))
+        return records
+
+    def _append_records(self, records):
+        lines = []
+        for revision_id, moved_directory, file_ids in records:
+            self._add_record(revision_id, moved_directory, file_ids)
+            record = '\x00'.join([revision_id, moved_directory and '1'
+                                  or '0'] + sorted(file_ids))
+            lines.append('%d %d %s\n'
+                         % (len(record), zlib.crc32(record), record))
+        if not lines:
+            return
+        try:
+            if not self._transport.has(self._filename):
+                self._transport.put_bytes(self._filename, _FORMAT_STRING,
+                                          mode=self._file_mode)
+            self._transport.append_bytes(self._filename, ''.join(lines),
+                                         mode=self._file_mode)
+        except (errors.TransportNotPossible, errors.PathError), e:
+            mutter('unable to write log index in %s: %s',
+                   self._transport.base, e)
+
+    def revisions_touching(self, file_ids, include_moved_directories=False):
+        """Return the recorded revisions which touched some file ids.
+
+        :param file_ids: The file ids of interest, a revision touches a
+            directory when it touches anything below it.
+        :param include_moved_directories: Also return the revisions which
+            moved or renamed a directory, as those may change the parents of
+            the file ids.
+        :return: A set of revision ids.
+        """
+        result = set()
+        for file_id in file_ids:
+            result.update(self.touched.get(file_id, ()))
+        if include_moved_directories:
+            result.update(self.moved_directories)
+        return result
+
+
+def _parse_record(line):
+    """Parse a record line of the index file.
+
+    :return: The list of the fields of the record, or None if the line is not
+        a complete record.
+    """
+    header = line.split(' ', 2)
+    if len(header) != 3:
+        return None
+    length, crc, record = header
+    try:
+        if int(length) != len(record) or int(crc) != zlib.crc32(record):
+            return None
+    except ValueError:
+        return None
+    fields = record.split('\x00')
+    if len(fields) < 2 or fields[1] not in ('0', '1'):
+        return None
+    return fields
+
+
+def touched_file_ids(old_inv, new_inv):
+    """Find the file ids touched by going from one inventory to another.
+
+    :param old_inv: The inventory of the left-hand parent, or None.
+    :param new_inv: The inventory of the revision.
+    :return: A (moved_directory, file_ids) tuple. moved_directory tells if a
+        directory other than the root has been changed, file_ids is the set of
+        the file ids of the entries which changed and of their parents in
+        both inventories.
+    """
+    if old_inv is None:
+        return False, set(entry.file_id for path, entry
+                          in new_inv.iter_entries())
+    touched = set()
+    old_seen = set()
+    new_seen = set()
+    moved_directory = False
+    for old_path, new_path, file_id, entry in new_inv._make_delta(old_inv):
+        touched.add(file_id)
+        old_kind = None
+        if old_path is not None:
+            old_entry = old_inv[file_id]
+            old_kind = old_entry.kind
+            _add_parents(old_inv, old_entry.parent_id, old_seen)
+        if new_path is not None:
+            _add_parents(new_inv, entry.parent_id, new_seen)
+            if (old_path is not None and entry.parent_id is not None
+                and 'directory' in (old_kind, entry.kind)):
+                moved_directory = True
+    touched.update(old_seen)
+    touched.update(new_seen)
+    return moved_directory, touched
+
+
+def _add_parents(inventory, file_id, seen):
+    while file_id is not None and file_id not in seen:
+        seen.add(file_id)
+        file_id = inventory[file_id].parent_id
+
+
+def index_for_repository(repository):
+    """Return the log index of a repository, loaded and ready to use.
+
+    :param repository: A repository stored on a transport.
+    :return: A LogIndex, or None if the repository has no control transport.
+    """
+    try:
+        transport = repository.control_transport
+    except (AttributeError, errors.TransportNotPossible):
+        return None
+    index = LogIndex(transport, file_mode=repository.bzrdir._get_file_mode())
+    index.load()
+    return index
@@ -16,6 +16,7 @@
 
 from __future__ import absolute_import
 
+import collections
 import warnings
 
 from bzrlib.lazy_import import lazy_import
@@ -721,6 +722,10 @@ class Merge3Merger(object):
     supports_reverse_cherrypick = True
     winner_idx = {"this": 2, "other": 1, "conflict": 1}
     supports_lca_trees = True
+    # Whether text_merge can use texts merged in worker processes
+    supports_parallel_text_merge = True
+    # The _ParallelTextMerger used while computing the transform
+    _text_merger = None
 
     def __init__(self, working_tree, this_tree, base_tree, other_tree,
                  interesting_ids=None, reprocess=False, show_base=False,
@@ -837,6 +842,7 @@ class Merge3Merger(object):
         # One hook for each registered one plus our default merger
         hooks = [factory(self) for factory in factories] + [self]
         self.active_hooks = [hook for hook in hooks if hook is not None]
+        self._text_merger = self._make_parallel_text_merger(entries)
         child_pb = ui.ui_factory.nested_progress_bar()
         try:
             for num, (file_id, changed, parents3, names3,
@@ -853,9 +859,50 @@ class Merge3Merger(object):
                     executable3, file_status, resolver=resolver)
         finally:
             child_pb.finished()
+            if self._text_merger is not None:
+                self._text_merger.close()
+                self._text_merger = None
         self.tt.fixup_new_roots()
         self._finish_computing_transform()
 
+    def _make_parallel_text_merger(self, entries):
+        """Start merging texts in worker processes if merge.workers is set.
+
+        The texts of the changed files which are files with a different
+        content in all of base, this and other are merged ahead of
+        _do_merge_contents, which uses the result if the merge hooks leave the
+        text merge to text_merge.
+
+        :return: A _ParallelTextMerger or None.
+        """
+        if not self.supports_parallel_text_merge:
+            return None
+        workers = self.this_branch.get_config_stack().get('merge.workers')
+        if workers <= 1:
+            return None
+        file_ids = [entry[0] for entry in entries
+                    if entry[1] and self._may_need_text_merge(entry[0])]
+        if len(file_ids) < 2:
+            return None
+        return _ParallelTextMerger(self, file_ids, workers)
+
+    def _may_need_text_merge(self, file_id):
+        """Whether text_merge may be called for file_id.
+
+        This is the case when the file is a file in this and other, and was
+        changed in both.
+        """
+        for tree in (self.this_tree, self.other_tree):
+            if not tree.has_id(file_id) or tree.kind(file_id) != 'file':
+                return False
+        other_sha1 = self.other_tree.get_file_sha1(file_id)
+        if self._lca_trees is None and self.base_tree.has_id(file_id):
+            if (self.base_tree.kind(file_id) == 'file'
+                and self.base_tree.get_file_sha1(file_id) == other_sha1):
+                return False
+        this_sha1 = self.this_tree.get_file_sha1(file_id)
+        return this_sha1 != other_sha1
+
     def _finish_computing_transform(self):
         """Finalize the transform and report the changes.
 
@@ -1430,39 +1477,30 @@ class Merge3Merger(object):
 
     def text_merge(self, file_id, trans_id):
         """Perform a three-way text merge on a file_id"""
-        # it's possible that we got here with base as a different type.
-        # if so, we just want two-way text conflicts.
-        if self.base_tree.has_id(file_id) and \
-            self.base_tree.kind(file_id) == "file":
-            base_lines = self.get_lines(self.base_tree, file_id)
-        else:
-            base_lines = []
-        other_lines = self.get_lines(self.other_tree, file_id)
-        this_lines = self.get_lines(self.this_tree, file_id)
-        m3 = merge3.Merge3(base_lines, this_lines, other_lines,
-                           is_cherrypick=self.cherrypick)
-        start_marker = "!START OF MERGE CONFLICT!" + "I HOPE THIS IS UNIQUE"
-        if self.show_base is True:
-            base_marker = '|' * 7
+        merged = None
+        if self._text_merger is not None:
+            merged = self._text_merger.get(file_id)
+        if merged is not None:
+            base_lines, this_lines, other_lines, result = merged
+            if result == _BINARY_TEXT:
+                raise errors.BinaryFile()
+            lines, text_conflicts = result
+            self.tt.create_file(lines, trans_id)
+            retval = {"text_conflicts": text_conflicts}
         else:
-            base_marker = None
-
-        def iter_merge3(retval):
-            retval["text_conflicts"] = False
-            for line in m3.merge_lines(name_a = "TREE",
-                                       name_b = "MERGE-SOURCE",
-                                       name_base = "BASE-REVISION",
-                                       start_marker=start_marker,
-                                       base_marker=base_marker,
-                                       reprocess=self.reprocess):
-                if line.startswith(start_marker):
-                    retval["text_conflicts"] = True
-                    yield line.replace(start_marker, '<' * 7)
-                else:
-                    yield line
-        retval = {}
-        merge3_iterator = iter_merge3(retval)
-        self.tt.create_file(merge3_iterator, trans_id)
+            # it's possible that we got here with base as a different type.
+            # if so, we just want two-way text conflicts.
+            if self.base_tree.has_id(file_id) and \
+                self.base_tree.kind(file_id) == "file":
+                base_lines = self.get_lines(self.base_tree, file_id)
+            else:
+                base_lines = []
+            other_lines = self.get_lines(self.other_tree, file_id)
+            this_lines = self.get_lines(self.this_tree, file_id)
+            retval = {}
+            merge3_iterator = _iter_merge3_lines(base_lines, this_lines,
+                other_lines, retval, **self._text_merge_options())
+            self.tt.create_file(merge3_iterator, trans_id)
         if retval["text_conflicts"] is True:
             self._raw_conflicts.append(('text conflict', trans_id))
             name = self.tt.final_name(trans_id)
@@ -1473,6 +1511,11 @@ class Merge3Merger(object):
             file_group.append(trans_id)
 
 
+    def _text_merge_options(self):
+        """The options of _iter_merge3_lines used by text_merge."""
+        return dict(is_cherrypick=self.cherrypick,
+                    show_base=self.show_base, reprocess=self.reprocess)
+
     def _get_filter_tree_path(self, file_id):
         if self.this_tree.supports_content_filtering():
             # We get the path from the working tree if it exists.
@@ -1643,11 +1686,174 @@ class Merge3Merger(object):
         self.cooked_conflicts.sort(key=_mod_conflicts.Conflict.sort_key)
 
 
+# The start marker of the conflicts produced by merge3, replaced to find out
+# whether the merged text has conflicts
+_MERGE3_START_MARKER = "!START OF MERGE CONFLICT!" + "I HOPE THIS IS UNIQUE"
+
+# The result of a text merge in a worker for texts which are not text
+_BINARY_TEXT = 'binary'
+
+# The number of files whose texts are merged at once by a worker
+_TEXT_MERGE_BATCH_SIZE = 50
+
+
+def _iter_merge3_lines(base_lines, this_lines, other_lines, retval,
+                       is_cherrypick=False, show_base=False, reprocess=False):
+    """Merge texts with merge3, as done by Merge3Merger.text_merge.
+
+    :param retval: A dict in which "text_conflicts" is set to whether the
+        merged text has conflicts, once the lines have been consumed.
+    :return: An iterator over the lines of the merged text.
+    """
+    m3 = merge3.Merge3(base_lines, this_lines, other_lines,
+                       is_cherrypick=is_cherrypick)
+    if show_base is True:
+        base_marker = '|' * 7
+    else:
+        base_marker = None
+    def iter_merge3():
+        retval["text_conflicts"] = False
+        for line in m3.merge_lines(name_a = "TREE",
+                                   name_b = "MERGE-SOURCE",
+                                   name_base = "BASE-REVISION",
+                                   start_marker=_MERGE3_START_MARKER,
+                                   base_marker=base_marker,
+                                   reprocess=reprocess):
+            if line.startswith(_MERGE3_START_MARKER):
+                retval["text_conflicts"] = True
+                yield line.replace(_MERGE3_START_MARKER, '<' * 7)
+            else:
+                yield line
+    return iter_merge3()
+
+
+def _merge_texts(texts, options):
+    """Merge texts with merge3 in a worker process.
+
+    :param texts: A list of (base_lines, this_lines, other_lines).
+    :param options: The keyword arguments of _iter_merge3_lines.
+    :return: A list with the (lines, text_conflicts) of each merged text, or
+        _BINARY_TEXT if one of its texts is not text, or None if the texts
+        could not be merged.
+    """
+    results = []
+    try:
+        for base_lines, this_lines, other_lines in texts:
+            retval = {}
+            try:
+                lines = list(_iter_merge3_lines(base_lines, this_lines,
+                    other_lines, retval, **options))
+            except errors.BinaryFile:
+                results.append(_BINARY_TEXT)
+            else:
+                results.append((lines, retval["text_conflicts"]))
+    except Exception, e:
+        # Errors are not always picklable, the texts are merged again by
+        # the parent process which reports them.
+        trace.mutter('unable to merge texts in a worker: %s', e)
+        return None
+    return results
+
+
+class _ParallelTextMerger(object):
+    """Merge the texts of files in worker processes ahead of a merger.
+
+    The texts of the files are extracted in batches, in the order the merger
+    processes them, and merged in a process pool, at most 2 * workers batches
+    being pending at once.
+    """
+
+    def __init__(self, merger, file_ids, workers,
+                 batch_size=_TEXT_MERGE_BATCH_SIZE):
+        """Create a _ParallelTextMerger.
+
+        :param merger: The Merge3Merger the texts are merged for.
+        :param file_ids: The ids of the files to merge, in the order the
+            merger will ask for them.
+        :param workers: The number of worker processes.
+        :param batch_size: The number of files merged by a worker at once.
+        """
+        import multiprocessing
+        self._merger = merger
+        self._options = merger._text_merge_options()
+        self._batches = [file_ids[i:i + batch_size]
+                         for i in xrange(0, len(file_ids), batch_size)]
+        self._batches.reverse()
+        self._remaining = set(file_ids)
+        self._workers = workers
+        # (file_ids, texts, result) of the batches sent to the pool
+        self._pending = collections.deque()
+        trace.mutter('merging texts with %d workers', workers)
+        self._pool = multiprocessing.Pool(workers)
+        self._fill()
+
+    def _extract_lines(self, tree, file_ids):
+        """Extract the lines of some files of a tree, in one request."""
+        lines = dict((file_id, []) for file_id in file_ids)
+        desired = [(file_id, file_id) for file_id in file_ids]
+        for file_id, chunks in tree.iter_files_bytes(desired):
+            lines[file_id] = osutils.split_lines(''.join(chunks))
+        return lines
+
+    def _extract_texts(self, file_ids):
+        """Return the (base_lines, this_lines, other_lines) of files."""
+        merger = self._merger
+        base_ids = [file_id for file_id in file_ids
+                    if merger.base_tree.has_id(file_id)
+                    and merger.base_tree.kind(file_id) == 'file']
+        base = self._extract_lines(merger.base_tree, base_ids)
+        this = self._extract_lines(merger.this_tree, file_ids)
+        other = self._extract_lines(merger.other_tree, file_ids)
+        return [(base.get(file_id, []), this[file_id], other[file_id])
+                for file_id in file_ids]
+
+    def _fill(self):
+        while self._batches and len(self._pending) < 2 * self._workers:
+            file_ids = self._batches.pop()
+            texts = self._extract_texts(file_ids)
+            result = self._pool.apply_async(_merge_texts,
+                                            (texts, self._options))
+            self._pending.append((file_ids, texts, result))
+
+    def get(self, file_id):
+        """Get the merged text of a file.
+
+        The texts of the files before file_id which have not been asked for,
+        because a merge hook merged them, are dropped.
+
+        :return: (base_lines, this_lines, other_lines, result) where result
+            is (lines, text_conflicts) or _BINARY_TEXT, or None if the text
+            of file_id has not been merged in a worker.
+        """
+        if file_id not in self._remaining:
+            return None
+        while file_id not in self._pending[0][0]:
+            file_ids = self._pending.popleft()[0]
+            self._remaining.difference_update(file_ids)
+            self._fill()
+        file_ids, texts, result = self._pending[0]
+        self._remaining.discard(file_id)
+        merged = result.get()
+        if merged is None:
+            # The worker failed, the text is merged by the merger
+            return None
+        index = file_ids.index(file_id)
+        return texts[index] + (merged[index],)
+
+    def close(self):
+        try:
+            self._pool.close()
+        finally:
+            self._pool.terminate()
+            self._pool.join()
+
+
 class WeaveMerger(Merge3Merger):
     """Three-way tree merger, text weave merger."""
     supports_reprocess = True
     supports_show_base = False
     supports_reverse_cherrypick = False
+    supports_parallel_text_merge = False
     history_based = True
 
     def _generate_merge_plan(self, file_id, base):
@@ -1709,6 +1915,7 @@ class LCAMerger(WeaveMerger):
 
 class Diff3Merger(Merge3Merger):
     """Three-way merger using external diff3 for text merging"""
+    supports_parallel_text_merge = False
 
     def dump_file(self, temp_dir, name, tree, file_id):
         out_path = osutils.pathjoin(temp_dir, name)
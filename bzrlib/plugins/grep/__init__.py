@@ -18,10 +18,15 @@
 
 from __future__ import absolute_import
 
-from bzrlib import version_info
+from bzrlib import (
+    config,
+    version_info,
+    )
 from bzrlib.commands import plugin_cmds
 
 plugin_cmds.register_lazy("cmd_grep", [], "bzrlib.plugins.grep.cmds")
+config.option_registry.register_lazy('grep.content_index',
+    'bzrlib.plugins.grep.content_index', 'content_index_option')
 
 def test_suite():
     from bzrlib.tests import TestUtil
@@ -29,6 +34,7 @@ def test_suite():
     suite = TestUtil.TestSuite()
     loader = TestUtil.TestLoader()
     testmod_names = [
+        'test_content_index',
         'test_grep',
         ]
 
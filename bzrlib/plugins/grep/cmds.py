@@ -61,6 +61,7 @@ class GrepOptions(object):
     files_without_match = False
     color = None
     diff = False
+    workers = 1
 
     # derived options
     recursive = None
@@ -71,6 +72,8 @@ class GrepOptions(object):
     fixed_string = None
     outf = None
     show_color = False
+    grepper = None
+    content_filter = None
 
 
 class cmd_grep(Command):
@@ -138,6 +141,8 @@ class cmd_grep(Command):
         Option('null', short_name='Z',
                help='Write an ASCII NUL (\\0) separator '
                'between output lines rather than a newline.'),
+        Option('workers', type=int, argname='N',
+               help='Search the texts of revisions in N processes.'),
         ]
 
 
@@ -146,7 +151,7 @@ class cmd_grep(Command):
             from_root=False, null=False, levels=None, line_number=False,
             path_list=None, revision=None, pattern=None, include=None,
             exclude=None, fixed_string=False, files_with_matches=False,
-            files_without_match=False, color=None, diff=False):
+            files_without_match=False, color=None, diff=False, workers=None):
         from bzrlib import _termcolor
         from bzrlib.plugins.grep import (
             grep,
@@ -177,6 +182,11 @@ class cmd_grep(Command):
         if levels==None:
             levels=1
 
+        if workers is None:
+            workers = 1
+        elif workers < 1:
+            raise errors.BzrCommandError('--workers must be at least 1.')
+
         print_revno = False
         if revision != None or levels == 0:
             # print revision numbers as we may be showing multiple revisions
@@ -227,6 +237,7 @@ class cmd_grep(Command):
         GrepOptions.files_without_match = files_without_match
         GrepOptions.color = color
         GrepOptions.diff = False
+        GrepOptions.workers = workers
 
         GrepOptions.eol_marker = eol_marker
         GrepOptions.print_revno = print_revno
@@ -0,0 +1,380 @@
+# Copyright (C) 2017 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Trigram index of the file texts of a repository.
+
+Searching the history of a branch needs to extract every version of the
+files searched. For each text in the repository, this index records the
+trigrams (sequences of three bytes, lower cased) it contains. The texts
+which contain all the trigrams of a string that any match must contain are
+the only ones that need to be searched.
+
+The index is stored in the 'grep-index' directory of pack repositories, as
+segments each covering the texts of the packs added since the previous one.
+"""
+
+from __future__ import absolute_import
+
+import array
+import sre_constants
+import sre_parse
+import zlib
+
+from bzrlib import (
+    bencode,
+    config,
+    errors,
+    osutils,
+    ui,
+    )
+from bzrlib.i18n import gettext
+from bzrlib.trace import mutter
+
+
+content_index_option = config.Option('grep.content_index', default=False,
+    from_unicode=config.bool_from_store,
+    help='''\
+Use a trigram index of the file texts when searching revisions?
+
+If true, ``bzr grep -r`` maintains an index of the trigrams of each text in
+pack repositories, and only searches the texts which contain the trigrams of
+the strings the pattern requires.
+''')
+
+
+_MANIFEST_FORMAT = 'Bazaar grep index manifest v1\n'
+_SEGMENT_FORMAT = 'Bazaar grep index segment v1\n'
+
+# Case insensitive searches only fold ASCII letters, str.lower() depends on
+# the locale.
+_ascii_lower = ''.join(chr(c).lower() if c < 128 else chr(c)
+                       for c in range(256))
+
+
+def text_trigrams(text):
+    """Return the set of the trigrams of a text, with ASCII lower cased."""
+    text = text.translate(_ascii_lower)
+    return set([text[i:i + 3] for i in xrange(len(text) - 2)])
+
+
+def _is_binary(text):
+    # Like grep, which skips these texts
+    return '\x00' in text[:1024]
+
+
+def required_literals(pattern, fixed_string):
+    """Find the strings that any match of a pattern must contain.
+
+    :param pattern: The pattern given to grep, as unicode.
+    :param fixed_string: Whether pattern is a string rather than a regular
+        expression.
+    :return: A list of byte strings.
+    """
+    if fixed_string:
+        # Searched for as encoded
+        return [pattern.encode(osutils.get_user_encoding(), 'replace')]
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (sre_constants.error, ValueError, OverflowError):
+        return []
+    literals = []
+    current = []
+    # Only the top-level sequence is looked at, any other construct ends the
+    # current run of literals. Regular expressions are unicode and match
+    # bytes as latin-1, which only agrees with the user encoding on ASCII.
+    for op, value in parsed:
+        if op == sre_constants.LITERAL and value < 128:
+            current.append(chr(value))
+        else:
+            if current:
+                literals.append(''.join(current))
+            current = []
+    if current:
+        literals.append(''.join(current))
+    return literals
+
+
+class _Segment(object):
+    """The trigrams of some texts."""
+
+    def __init__(self, keys, binary, postings):
+        """Create a _Segment.
+
+        :param keys: The list of the text keys in the segment.
+        :param binary: The list of the indexes in keys of binary texts.
+        :param postings: A dict mapping trigrams to the indexes of the texts
+            containing them, packed as an array of unsigned ints.
+        """
+        self.keys = keys
+        self.binary = binary
+        self.postings = postings
+
+    @classmethod
+    def from_texts(klass, texts):
+        """Build a segment from an iterable of (key, text) pairs."""
+        keys = []
+        binary = []
+        postings = {}
+        for key, text in texts:
+            index = len(keys)
+            keys.append(tuple(key))
+            if _is_binary(text):
+                binary.append(index)
+                continue
+            for trigram in text_trigrams(text):
+                posting = postings.get(trigram)
+                if posting is None:
+                    posting = postings[trigram] = array.array('I')
+                posting.append(index)
+        return klass(keys, binary,
+            dict((trigram, posting.tostring())
+                 for trigram, posting in postings.iteritems()))
+
+    @classmethod
+    def from_bytes(klass, bytes):
+        if not bytes.startswith(_SEGMENT_FORMAT):
+            raise ValueError('unknown segment format')
+        keys, binary, postings = bencode.bdecode_as_tuple(
+            zlib.decompress(bytes[len(_SEGMENT_FORMAT):]))
+        return klass(list(keys), list(binary), postings)
+
+    def to_bytes(self):
+        return _SEGMENT_FORMAT + zlib.compress(bencode.bencode(
+            (self.keys, self.binary, self.postings)))
+
+    def candidates(self, trigrams):
+        """Return the keys of the texts which may contain all trigrams."""
+        result = None
+        for trigram in trigrams:
+            posting = array.array('I')
+            posting.fromstring(self.postings.get(trigram, ''))
+            if result is None:
+                result = set(posting)
+            else:
+                result.intersection_update(posting)
+            if not result:
+                break
+        if result is None:
+            result = xrange(len(self.keys))
+        result = set(result)
+        result.update(self.binary)
+        return set([self.keys[index] for index in result])
+
+    @classmethod
+    def combine(klass, segments):
+        keys = []
+        binary = []
+        postings = {}
+        for segment in segments:
+            offset = len(keys)
+            keys.extend(segment.keys)
+            binary.extend([index + offset for index in segment.binary])
+            for trigram, packed in segment.postings.iteritems():
+                posting = array.array('I')
+                posting.fromstring(packed)
+                combined = postings.get(trigram)
+                if combined is None:
+                    combined = postings[trigram] = array.array('I')
+                combined.extend([index + offset for index in posting])
+        return klass(keys, binary,
+            dict((trigram, posting.tostring())
+                 for trigram, posting in postings.iteritems()))
+
+
+class ContentIndex(object):
+    """The trigram index of the texts of a pack repository."""
+
+    # The segments are combined when there are more than this
+    _max_segments = 8
+    # The number of texts extracted at once when indexing
+    _batch_size = 1000
+
+    def __init__(self, transport, file_mode=None, dir_mode=None):
+        """Create a ContentIndex.
+
+        :param transport: The transport of the index directory.
+        :param file_mode: The mode to create the index files with.
+        :param dir_mode: The mode to create the index directory with.
+        """
+        self._transport = transport
+        self._file_mode = file_mode
+        self._dir_mode = dir_mode
+
+    def _read_manifest(self):
+        """Return the names of the packs indexed and of the segments."""
+        try:
+            bytes = self._transport.get_bytes('manifest')
+        except errors.NoSuchFile:
+            return [], []
+        if not bytes.startswith(_MANIFEST_FORMAT):
+            mutter('ignoring grep index with unknown format in %s',
+                   self._transport.base)
+            return [], []
+        try:
+            pack_names, segment_names = bencode.bdecode_as_tuple(
+                bytes[len(_MANIFEST_FORMAT):])
+        except (ValueError, TypeError), e:
+            mutter('ignoring corrupt grep index manifest in %s: %s',
+                   self._transport.base, e)
+            return [], []
+        return list(pack_names), list(segment_names)
+
+    def _write_manifest(self, pack_names, segment_names):
+        self._transport.put_bytes('manifest', _MANIFEST_FORMAT +
+            bencode.bencode((sorted(pack_names), segment_names)),
+            mode=self._file_mode)
+
+    def _read_segments(self, segment_names):
+        segments = []
+        for name in segment_names:
+            try:
+                segments.append(_Segment.from_bytes(
+                    self._transport.get_bytes(name)))
+            except (errors.NoSuchFile, ValueError, TypeError, zlib.error), e:
+                # The texts of the segment are simply searched
+                mutter('ignoring grep index segment %s in %s: %s', name,
+                       self._transport.base, e)
+        return segments
+
+    def _write_segment(self, segment):
+        bytes = segment.to_bytes()
+        name = osutils.sha_string(bytes) + '.tix'
+        self._transport.put_bytes(name, bytes, mode=self._file_mode)
+        return name
+
+    def update(self, repository):
+        """Index the texts of the packs added since the last update.
+
+        :param repository: A locked pack repository.
+        """
+        pack_collection = repository._pack_collection
+        pack_collection.ensure_loaded()
+        pack_names, segment_names = self._read_manifest()
+        indexed_packs = set(pack_names)
+        new_packs = [pack for pack in pack_collection.all_packs()
+                     if pack.name not in indexed_packs]
+        if not new_packs:
+            return
+        segments = self._read_segments(segment_names)
+        indexed_keys = set()
+        for segment in segments:
+            indexed_keys.update(segment.keys)
+        new_keys = set()
+        for pack in new_packs:
+            for entry in pack.text_index.iter_all_entries():
+                key = tuple(entry[1])
+                if key not in indexed_keys:
+                    new_keys.add(key)
+        try:
+            if not self._transport.has('.'):
+                self._transport.mkdir('.', mode=self._dir_mode)
+            if new_keys:
+                segment = _Segment.from_texts(
+                    self._iter_texts(repository, sorted(new_keys)))
+                segment_names.append(self._write_segment(segment))
+                segments.append(segment)
+            obsolete_names = []
+            if len(segment_names) > self._max_segments:
+                obsolete_names = segment_names
+                segment_names = [self._write_segment(
+                    _Segment.combine(segments))]
+            self._write_manifest(
+                [pack.name for pack in pack_collection.all_packs()],
+                segment_names)
+            for name in obsolete_names:
+                self._transport.delete(name)
+        except (errors.TransportNotPossible, errors.PathError), e:
+            mutter('unable to update grep index in %s: %s',
+                   self._transport.base, e)
+
+    def _iter_texts(self, repository, keys):
+        pb = ui.ui_factory.nested_progress_bar()
+        try:
+            for start in xrange(0, len(keys), self._batch_size):
+                pb.update(gettext('Indexing texts'), start, len(keys))
+                stream = repository.texts.get_record_stream(
+                    keys[start:start + self._batch_size], 'unordered', True)
+                for record in stream:
+                    if record.storage_kind == 'absent':
+                        continue
+                    yield record.key, record.get_bytes_as('fulltext')
+        finally:
+            pb.finished()
+
+    def get_filter(self, literals):
+        """Return a filter for the texts which may contain some strings.
+
+        :param literals: Strings which must all be in a matching text.
+        :return: A ContentFilter.
+        """
+        trigrams = set()
+        for literal in literals:
+            trigrams.update(text_trigrams(literal))
+        pack_names, segment_names = self._read_manifest()
+        indexed = set()
+        candidates = set()
+        for segment in self._read_segments(segment_names):
+            indexed.update(segment.keys)
+            candidates.update(segment.candidates(trigrams))
+        return ContentFilter(indexed, candidates)
+
+
+class ContentFilter(object):
+    """Tell which texts may match a pattern."""
+
+    def __init__(self, indexed, candidates):
+        self._indexed = indexed
+        self._candidates = candidates
+
+    def may_match(self, key):
+        """Return False if the text with key can't match the pattern."""
+        return key not in self._indexed or key in self._candidates
+
+
+def index_for_repository(repository):
+    """Return the content index of a repository, or None if not supported.
+
+    :param repository: A locked repository.
+    """
+    if getattr(repository, '_pack_collection', None) is None:
+        return None
+    return ContentIndex(repository._transport.clone('grep-index'),
+                        file_mode=repository.bzrdir._get_file_mode(),
+                        dir_mode=repository.bzrdir._get_dir_mode())
+
+
+def filter_for_branch(branch, opts):
+    """Return the ContentFilter to use for a search, if any.
+
+    :param branch: The locked branch being searched.
+    :param opts: The GrepOptions of the search.
+    :return: A ContentFilter, or None if all texts must be searched.
+    """
+    if opts.files_without_match:
+        # Texts which do not match are what is looked for
+        return None
+    if not branch.get_config_stack().get('grep.content_index'):
+        return None
+    literals = [literal for literal in
+                required_literals(opts.pattern, opts.fixed_string)
+                if len(literal) >= 3]
+    if not literals:
+        return None
+    index = index_for_repository(branch.repository)
+    if index is None:
+        return None
+    index.update(branch.repository)
+    return index.get_filter(literals)
@@ -20,11 +20,14 @@ import sys
 
 from bzrlib.lazy_import import lazy_import
 lazy_import(globals(), """
+import collections
 from fnmatch import fnmatch
+import multiprocessing
 import re
 from cStringIO import StringIO
 
 from bzrlib._termcolor import color_string, re_color_string, FG
+from bzrlib.plugins.grep import content_index
 
 from bzrlib.revisionspec import (
     RevisionSpec,
@@ -347,28 +350,46 @@ def versioned_grep(opts):
 
         # GZ 2010-06-02: Shouldn't be smuggling this on opts, but easy for now
         opts.outputter = _Outputter(opts, use_cache=True)
+        opts.content_filter = content_index.filter_for_branch(branch, opts)
+        if opts.workers > 1:
+            pool = multiprocessing.Pool(opts.workers)
+            opts.grepper = _ParallelGrepper(opts, pool, 16 * opts.workers)
+        else:
+            pool = opts.grepper = None
+        try:
+            _grep_revisions(branch, given_revs, relpath, opts)
+            if pool is not None:
+                opts.grepper.flush()
+                pool.close()
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+    finally:
+        branch.unlock()
 
-        for revid, revno, merge_depth in given_revs:
-            if opts.levels == 1 and merge_depth != 0:
-                # with level=1 show only top level
-                continue
 
-            rev = RevisionSpec_revid.from_string("revid:"+revid)
-            tree = rev.as_tree(branch)
-            for path in opts.path_list:
-                path_for_id = osutils.pathjoin(relpath, path)
-                id = tree.path2id(path_for_id)
-                if not id:
-                    trace.warning("Skipped unknown file '%s'." % path)
-                    continue
+def _grep_revisions(branch, given_revs, relpath, opts):
+    """Search the trees of given_revs, as found by versioned_grep."""
+    for revid, revno, merge_depth in given_revs:
+        if opts.levels == 1 and merge_depth != 0:
+            # with level=1 show only top level
+            continue
 
-                if osutils.isdir(path):
-                    path_prefix = path
-                    dir_grep(tree, path, relpath, opts, revno, path_prefix)
-                else:
-                    versioned_file_grep(tree, id, '.', path, opts, revno)
-    finally:
-        branch.unlock()
+        rev = RevisionSpec_revid.from_string("revid:"+revid)
+        tree = rev.as_tree(branch)
+        for path in opts.path_list:
+            path_for_id = osutils.pathjoin(relpath, path)
+            id = tree.path2id(path_for_id)
+            if not id:
+                trace.warning("Skipped unknown file '%s'." % path)
+                continue
+
+            if osutils.isdir(path):
+                path_prefix = path
+                dir_grep(tree, path, relpath, opts, revno, path_prefix)
+            else:
+                versioned_file_grep(tree, id, '.', path, opts, revno)
 
 
 def workingtree_grep(opts):
@@ -383,6 +404,8 @@ def workingtree_grep(opts):
 
     # GZ 2010-06-02: Shouldn't be smuggling this on opts, but easy for now
     opts.outputter = _Outputter(opts)
+    opts.grepper = None
+    opts.content_filter = None
 
     tree.lock_read()
     try:
@@ -422,6 +445,7 @@ def dir_grep(tree, path, relpath, opts, revno, path_prefix):
     #                and hits manually refilled. Could do this again if it was
     #                for a good reason, otherwise cache might want purging.
     outputter = opts.outputter
+    grepper = opts.grepper
     for fp, fc, fkind, fid, entry in tree.list_files(include_root=False,
         from_dir=from_dir, recursive=opts.recursive):
 
@@ -433,8 +457,21 @@ def dir_grep(tree, path, relpath, opts, revno, path_prefix):
                 # If old result is valid, print results immediately.
                 # Otherwise, add file info to to_grep so that the
                 # loop later will get chunks and grep them
-                cache_id = tree.get_file_revision(fid)
-                if cache_id in outputter.cache:
+                cache_id = (fid, tree.get_file_revision(fid))
+                if (opts.content_filter is not None
+                    and not opts.content_filter.may_match(cache_id)):
+                    # The text does not contain the pattern
+                    continue
+                if grepper is not None:
+                    # The result may not be known yet, it is written once
+                    # the texts grepped before have been.
+                    if grepper.is_scheduled(cache_id):
+                        grepper.add_cached(cache_id,
+                            _make_display_path(relpath, fp), revno,
+                            path_prefix)
+                    else:
+                        to_grep_append((fid, (fp, fid)))
+                elif cache_id in outputter.cache:
                     # GZ 2010-06-05: Not really sure caching and re-outputting
                     #                the old path is really the right thing,
                     #                but it's what the old code seemed to do
@@ -459,8 +496,13 @@ def dir_grep(tree, path, relpath, opts, revno, path_prefix):
     if revno != None: # grep versioned files
         for (path, fid), chunks in tree.iter_files_bytes(to_grep):
             path = _make_display_path(relpath, path)
-            _file_grep(chunks[0], path, opts, revno, path_prefix,
-                tree.get_file_revision(fid, path))
+            cache_id = (fid, tree.get_file_revision(fid))
+            if grepper is not None:
+                grepper.add_text(chunks[0], path, revno, path_prefix,
+                                 cache_id, tree.get_file_sha1(fid))
+            else:
+                _file_grep(chunks[0], path, opts, revno, path_prefix,
+                           cache_id)
 
 
 def _make_display_path(relpath, path):
@@ -483,8 +525,16 @@ def versioned_file_grep(tree, id, relpath, path, opts, revno, path_prefix = None
     """
 
     path = _make_display_path(relpath, path)
+    if (opts.content_filter is not None and not
+        opts.content_filter.may_match((id, tree.get_file_revision(id)))):
+        # The text does not contain the pattern
+        return
     file_text = tree.get_file_text(id)
-    _file_grep(file_text, path, opts, revno, path_prefix)
+    if opts.grepper is not None:
+        opts.grepper.add_text(file_text, path, revno, path_prefix,
+                              sha1=tree.get_file_sha1(id))
+    else:
+        _file_grep(file_text, path, opts, revno, path_prefix)
 
 
 def _path_in_glob_list(path, glob_list):
@@ -629,26 +679,37 @@ class _Outputter(object):
 
 
 def _file_grep(file_text, path, opts, revno, path_prefix=None, cache_id=None):
-    # test and skip binary files
-    if '\x00' in file_text[:1024]:
-        if opts.verbose:
-            trace.warning("Binary file '%s' skipped." % path)
-        return
+    result = _grep_text(file_text, _grep_settings(opts))
+    _write_grep_result(result, path, opts, revno, path_prefix, cache_id)
 
-    if path_prefix and path_prefix != '.':
-        # user has passed a dir arg, show that as result prefix
-        path = osutils.pathjoin(path_prefix, path)
 
-    # GZ 2010-06-07: There's no actual guarentee the file contents will be in
-    #                the user encoding, but we have to guess something and it
-    #                is a reasonable default without a better mechanism.
-    file_encoding = _user_encoding
-    pattern = opts.pattern.encode(_user_encoding, 'replace')
+def _grep_settings(opts):
+    """Return the options needed by _grep_text, in a picklable form."""
+    return (opts.pattern.encode(_user_encoding, 'replace'), opts.patternc,
+            opts.fixed_string,
+            opts.files_with_matches or opts.files_without_match,
+            opts.line_number)
 
-    writeline = opts.outputter.get_writer(path, revno, cache_id)
 
-    if opts.files_with_matches or opts.files_without_match:
-        if opts.fixed_string:
+def _grep_text(file_text, settings):
+    """Find the lines of a text matching a pattern.
+
+    This only depends on its arguments so that it can run in a worker
+    process.
+
+    :param file_text: The text to search.
+    :param settings: The tuple returned by _grep_settings.
+    :return: None for binary texts. When only listing files, whether the
+        pattern was found, otherwise a list of (lineno, line) tuples, where
+        lineno is None when line numbers are not shown.
+    """
+    pattern, patternc, fixed_string, list_only, line_number = settings
+    # test and skip binary files
+    if '\x00' in file_text[:1024]:
+        return None
+
+    if list_only:
+        if fixed_string:
             if sys.platform > (2, 5):
                 found = pattern in file_text
             else:
@@ -659,7 +720,7 @@ def _file_grep(file_text, path, opts, revno, path_prefix=None, cache_id=None):
                 else:
                     found = False
         else:
-            search = opts.patternc.search
+            search = patternc.search
             if "$" not in pattern:
                 found = search(file_text) is not None
             else:
@@ -669,10 +730,9 @@ def _file_grep(file_text, path, opts, revno, path_prefix=None, cache_id=None):
                         break
                 else:
                     found = False
-        if (opts.files_with_matches and found) or \
-                (opts.files_without_match and not found):
-            writeline()
-    elif opts.fixed_string:
+        return found
+    matches = []
+    if fixed_string:
         # Fast path for no match, search through the entire file at once rather
         # than a line at a time. However, we don't want this without Python 2.5
         # as the quick string search algorithm wasn't implemented till then:
@@ -680,49 +740,150 @@ def _file_grep(file_text, path, opts, revno, path_prefix=None, cache_id=None):
         if sys.version_info > (2, 5):
             i = file_text.find(pattern)
             if i == -1:
-                return
+                return matches
             b = file_text.rfind("\n", 0, i) + 1
-            if opts.line_number:
+            if line_number:
                 start = file_text.count("\n", 0, b) + 1
             file_text = file_text[b:]
         else:
             start = 1
-        if opts.line_number:
+        if line_number:
             for index, line in enumerate(file_text.splitlines()):
                 if pattern in line:
-                    line = line.decode(file_encoding, 'replace')
-                    writeline(lineno=index+start, line=line)
+                    matches.append((index+start, line))
         else:
             for line in file_text.splitlines():
                 if pattern in line:
-                    line = line.decode(file_encoding, 'replace')
-                    writeline(line=line)
+                    matches.append((None, line))
     else:
         # Fast path on no match, the re module avoids bad behaviour in most
         # standard cases, but perhaps could try and detect backtracking
         # patterns here and avoid whole text search in those cases
-        search = opts.patternc.search
+        search = patternc.search
         if "$" not in pattern:
             # GZ 2010-06-05: Grr, re.MULTILINE can't save us when searching
             #                through revisions as bazaar returns binary mode
             #                and trailing \r breaks $ as line ending match
             m = search(file_text)
             if m is None:
-                return
+                return matches
             b = file_text.rfind("\n", 0, m.start()) + 1
-            if opts.line_number:
+            if line_number:
                 start = file_text.count("\n", 0, b) + 1
             file_text = file_text[b:]
         else:
             start = 1
-        if opts.line_number:
+        if line_number:
             for index, line in enumerate(file_text.splitlines()):
                 if search(line):
-                    line = line.decode(file_encoding, 'replace')
-                    writeline(lineno=index+start, line=line)
+                    matches.append((index+start, line))
         else:
             for line in file_text.splitlines():
                 if search(line):
-                    line = line.decode(file_encoding, 'replace')
-                    writeline(line=line)
+                    matches.append((None, line))
+    return matches
+
+
+def _write_grep_result(result, path, opts, revno, path_prefix=None,
+                       cache_id=None):
+    """Write the result of _grep_text for a file."""
+    if result is None:
+        if opts.verbose:
+            trace.warning("Binary file '%s' skipped." % path)
+        return
+
+    if path_prefix and path_prefix != '.':
+        # user has passed a dir arg, show that as result prefix
+        path = osutils.pathjoin(path_prefix, path)
+
+    # GZ 2010-06-07: There's no actual guarentee the file contents will be in
+    #                the user encoding, but we have to guess something and it
+    #                is a reasonable default without a better mechanism.
+    file_encoding = _user_encoding
+
+    writeline = opts.outputter.get_writer(path, revno, cache_id)
+
+    if opts.files_with_matches or opts.files_without_match:
+        if (opts.files_with_matches and result) or \
+                (opts.files_without_match and not result):
+            writeline()
+    elif opts.line_number:
+        for lineno, line in result:
+            line = line.decode(file_encoding, 'replace')
+            writeline(lineno=lineno, line=line)
+    else:
+        for lineno, line in result:
+            line = line.decode(file_encoding, 'replace')
+            writeline(line=line)
+
+
+class _ParallelGrepper(object):
+    """Grep texts in a pool of worker processes.
+
+    Results are written in the order the texts are added, so the output is
+    the same as when grepping them one after the other. Texts with the same
+    sha1 are only grepped once.
+    """
+
+    def __init__(self, opts, pool, max_pending):
+        """Create a _ParallelGrepper.
+
+        :param opts: The GrepOptions, with the outputter to write with.
+        :param pool: The multiprocessing.Pool to grep texts in.
+        :param max_pending: The number of results waiting to be written
+            above which adding a text waits for the oldest result.
+        """
+        self.opts = opts
+        self._pool = pool
+        self._max_pending = max_pending
+        self._settings = _grep_settings(opts)
+        self._pending = collections.deque()
+        self._results_by_cache_id = {}
+        self._results_by_sha1 = {}
+
+    def is_scheduled(self, cache_id):
+        """Has a text with this cache_id already been added?"""
+        return cache_id in self._results_by_cache_id
+
+    def add_text(self, file_text, path, revno, path_prefix=None,
+                 cache_id=None, sha1=None):
+        """Grep a text, like _file_grep."""
+        result = None
+        if sha1 is not None:
+            result = self._results_by_sha1.get(sha1)
+        if result is None:
+            result = self._pool.apply_async(_grep_text,
+                                            (file_text, self._settings))
+            if sha1 is not None:
+                self._results_by_sha1[sha1] = result
+        if cache_id is not None:
+            self._results_by_cache_id[cache_id] = result
+        self._add_pending(result, path, revno, path_prefix, cache_id)
+
+    def add_cached(self, cache_id, path, revno, path_prefix=None):
+        """Write the result of the text added with cache_id again.
+
+        Like with _Outputter.write_cached_lines, the path of the text first
+        added is shown, path is only used for binary files.
+        """
+        self._add_pending(self._results_by_cache_id[cache_id], path, revno,
+                          path_prefix, cache_id)
+
+    def _add_pending(self, result, path, revno, path_prefix, cache_id):
+        self._pending.append((result, path, revno, path_prefix, cache_id))
+        while len(self._pending) > self._max_pending:
+            self._write_oldest()
+
+    def _write_oldest(self):
+        result, path, revno, path_prefix, cache_id = self._pending.popleft()
+        outputter = self.opts.outputter
+        if cache_id is not None and cache_id in outputter.cache:
+            outputter.write_cached_lines(cache_id, revno)
+        else:
+            _write_grep_result(result.get(), path, self.opts, revno,
+                               path_prefix, cache_id)
 
+    def flush(self):
+        """Write all the pending results."""
+        while self._pending:
+            self._write_oldest()
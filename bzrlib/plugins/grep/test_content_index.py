@@ -0,0 +1,157 @@
+# Copyright (C) 2017 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the trigram index of repository texts."""
+
+from __future__ import absolute_import
+
+from bzrlib import tests
+from bzrlib.plugins.grep import content_index
+
+
+class TestRequiredLiterals(tests.TestCase):
+
+    def test_fixed_string(self):
+        self.assertEqual(['foo(bar'],
+                         content_index.required_literals(u'foo(bar', True))
+
+    def test_regexp(self):
+        self.assertEqual(['foo', 'bar', 'baz'],
+            content_index.required_literals(u'foo.*bar[0-9]+baz', False))
+        self.assertEqual(['def foo('],
+            content_index.required_literals(u'^def foo\\(', False))
+
+    def test_alternation(self):
+        self.assertEqual([], content_index.required_literals(u'foo|bar',
+                                                             False))
+        self.assertEqual(['x', 'y'],
+            content_index.required_literals(u'x(foo|bar)y', False))
+
+    def test_non_ascii(self):
+        self.assertEqual(['ab', 'cd'],
+            content_index.required_literals(u'ab\xe9cd', False))
+
+    def test_invalid(self):
+        self.assertEqual([], content_index.required_literals(u'foo(', False))
+
+
+class TestSegment(tests.TestCase):
+
+    def make_segment(self):
+        return content_index._Segment.from_texts([
+            (('f', 'a'), 'Hello World\n'),
+            (('f', 'b'), 'hello there\n'),
+            (('g', 'a'), 'binary\x00hello\n'),
+            (('g', 'b'), 'nothing\n'),
+            ])
+
+    def test_candidates(self):
+        segment = self.make_segment()
+        self.assertEqual(set([('f', 'a'), ('f', 'b'), ('g', 'a')]),
+            segment.candidates(content_index.text_trigrams('hello')))
+        self.assertEqual(set([('f', 'a'), ('g', 'a')]),
+            segment.candidates(content_index.text_trigrams('WORLD')))
+        self.assertEqual(set([('g', 'a')]),
+            segment.candidates(content_index.text_trigrams('absent')))
+
+    def test_roundtrip(self):
+        segment = content_index._Segment.from_bytes(
+            self.make_segment().to_bytes())
+        self.assertEqual(set([('f', 'b'), ('g', 'a')]),
+            segment.candidates(content_index.text_trigrams('there')))
+
+    def test_combine(self):
+        other = content_index._Segment.from_texts([
+            (('h', 'a'), 'over there\n')])
+        segment = content_index._Segment.combine([self.make_segment(), other])
+        self.assertEqual(set([('f', 'b'), ('g', 'a'), ('h', 'a')]),
+            segment.candidates(content_index.text_trigrams('there')))
+
+
+class TestContentIndex(tests.TestCaseWithTransport):
+
+    def make_tree(self):
+        tree = self.make_branch_and_tree('.', format='2a')
+        self.build_tree_contents([('a', 'first text\n'),
+                                  ('b', 'second text\n')])
+        tree.add(['a', 'b'], ['a-id', 'b-id'])
+        tree.commit('one', rev_id='rev-1')
+        return tree
+
+    def get_filter(self, repo, literals):
+        repo.lock_read()
+        try:
+            index = content_index.index_for_repository(repo)
+            index.update(repo)
+            return index.get_filter(literals)
+        finally:
+            repo.unlock()
+
+    def test_filter(self):
+        tree = self.make_tree()
+        content_filter = self.get_filter(tree.branch.repository, ['first'])
+        self.assertTrue(content_filter.may_match(('a-id', 'rev-1')))
+        self.assertFalse(content_filter.may_match(('b-id', 'rev-1')))
+        # Texts which are not indexed may match
+        self.assertTrue(content_filter.may_match(('c-id', 'rev-1')))
+
+    def test_incremental_update(self):
+        tree = self.make_tree()
+        repo = tree.branch.repository
+        self.get_filter(repo, ['first'])
+        self.build_tree_contents([('a', 'first text, again\n')])
+        tree.commit('two', rev_id='rev-2')
+        content_filter = self.get_filter(repo, ['again'])
+        self.assertTrue(content_filter.may_match(('a-id', 'rev-2')))
+        self.assertFalse(content_filter.may_match(('a-id', 'rev-1')))
+        index = content_index.index_for_repository(repo)
+        pack_names, segment_names = index._read_manifest()
+        self.assertLength(2, segment_names)
+        # Packing does not index the texts again
+        repo.pack()
+        self.get_filter(repo, ['again'])
+        self.assertEqual(segment_names, index._read_manifest()[1])
+
+    def test_segments_combined(self):
+        tree = self.make_tree()
+        repo = tree.branch.repository
+        self.overrideAttr(content_index.ContentIndex, '_max_segments', 1)
+        self.get_filter(repo, ['first'])
+        self.build_tree_contents([('a', 'first text, again\n')])
+        tree.commit('two', rev_id='rev-2')
+        content_filter = self.get_filter(repo, ['first'])
+        self.assertTrue(content_filter.may_match(('a-id', 'rev-1')))
+        self.assertTrue(content_filter.may_match(('a-id', 'rev-2')))
+        self.assertFalse(content_filter.may_match(('b-id', 'rev-1')))
+        index = content_index.index_for_repository(repo)
+        self.assertLength(1, index._read_manifest()[1])
+
+    def test_grep_uses_index(self):
+        tree = self.make_tree()
+        self.build_tree_contents([('a', 'first text, again\n')])
+        tree.commit('two', rev_id='rev-2')
+        expected = self.run_bzr(['grep', '-r', '1..2', 'text'])[0]
+        tree.branch.get_config_stack().set('grep.content_index', True)
+        self.assertEqualDiff(
+            ''.join(sorted(expected.splitlines(True))),
+            ''.join(sorted(self.run_bzr(['grep', '-r', '1..2',
+                                         'text'])[0].splitlines(True))))
+        self.assertEqual('a~2:first text, again\n',
+                         self.run_bzr(['grep', '-r', '1..2', 'again'])[0])
+        self.assertEqual('a~2:first text, again\n',
+                         self.run_bzr(['grep', '-r', '1..2', 'ag.in'])[0])
+        self.assertTrue(tree.branch.repository._transport.has(
+            'grep-index/manifest'))
@@ -2252,3 +2252,68 @@ class TestGrepDiff(tests.TestCaseWithTransport):
         self.assertEqual(out, '')
         self.assertContainsRe(err, "ERROR:.*revision.* does not exist in branch")
 
+
+
+class TestGrepWorkers(GrepTestBase):
+    """Tests for grepping revisions in worker processes."""
+
+    def make_history(self):
+        self.make_branch_and_tree('.')
+        self._mk_versioned_dir('dir0')
+        self._mk_versioned_file('dir0/file0.txt')
+        self._mk_versioned_file('file1.txt', line_prefix='other')
+        self.build_tree_contents([('dir0/copy.txt', 'line1\nline2\n'),
+                                  ('binary.bin', 'line1\x00\n')])
+        self.run_bzr(['add', 'dir0/copy.txt', 'binary.bin'])
+        self.run_bzr(['ci', '-m', 'copy'])
+        self._update_file('dir0/file0.txt', 'line1 again\n')
+        self._update_file('file1.txt', 'line1 too\n')
+        self.build_tree_contents([('dir0/copy.txt', 'line1\n')])
+        self.run_bzr(['ci', '-m', 'revert copy'])
+
+    def assertSameOutput(self, args):
+        serial = self.run_bzr(['grep'] + args)
+        parallel = self.run_bzr(['grep', '--workers', '3'] + args)
+        # The texts of a revision are grepped in the order they are read
+        # from the repository, which is not stable.
+        self.assertEqualDiff(''.join(sorted(serial[0].splitlines(True))),
+                             ''.join(sorted(parallel[0].splitlines(True))))
+        self.assertEqual(self.revnos(serial[0]), self.revnos(parallel[0]))
+        self.assertEqual(serial[1], parallel[1])
+        return parallel[0]
+
+    def revnos(self, output):
+        revnos = []
+        for line in output.splitlines():
+            revno = re.search('~([0-9.]+)', line).group(1)
+            if not revnos or revnos[-1] != revno:
+                revnos.append(revno)
+        return revnos
+
+    def test_same_output_as_serial(self):
+        self.make_history()
+        for args in (['-r', '1..-1', 'line1'],
+                     ['-r', '1..-1', '-n', 'line[12]'],
+                     ['-r', '1..-1', '-l', 'line1'],
+                     ['-r', '1..-1', '-L', 'line1'],
+                     ['-r', '1..-1', '--verbose', 'line1'],
+                     ['-r', '1..-1', '--include', '*.txt', 'line1', 'dir0'],
+                     ['-r', '-2..-1', '-n', 'line1', 'file1.txt'],
+                     ):
+            self.assertSameOutput(args)
+
+    def test_files_changed_in_the_same_revision(self):
+        self.make_branch_and_tree('.')
+        self.build_tree_contents([('a', 'foo a\n'), ('b', 'foo b\n')])
+        self.run_bzr(['add', 'a', 'b'])
+        self.run_bzr(['ci', '-m', 'one'])
+        self._mk_versioned_file('c')
+        out = self.assertSameOutput(['-r', '1..2', 'foo'])
+        self.assertEqual(['a~1:foo a', 'a~2:foo a', 'b~1:foo b', 'b~2:foo b'],
+                         sorted(out.splitlines()))
+
+    def test_workers_must_be_positive(self):
+        self.make_branch_and_tree('.')
+        out, err = self.run_bzr(['grep', '--workers', '0', '-r', '-1',
+                                 'foo'], retcode=3)
+        self.assertContainsRe(err, '--workers must be at least 1')
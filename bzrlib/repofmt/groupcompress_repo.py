@@ -21,6 +21,7 @@ from __future__ import absolute_import
 import time
 
 from bzrlib import (
+    annotation_cache,
     controldir,
     chk_map,
     chk_serializer,
@@ -59,6 +60,10 @@ from bzrlib.vf_repository import (
     StreamSource,
     )
 from bzrlib.static_tuple import StaticTuple
+from bzrlib.lazy_import import lazy_import
+lazy_import(globals(), """
+import multiprocessing
+""")
 
 
 class GCPack(NewPack):
@@ -407,6 +412,25 @@ class GCCHKPacker(Packer):
         finally:
             child_pb.finished()
 
+    def _copy_stream_in_pool(self, source_vf, target_vf, keys, message,
+                             vf_to_stream, pb_offset, workers):
+        """Like _copy_stream, compressing in a pool of worker processes."""
+        trace.mutter('repacking %d %s with %d workers', len(keys), message,
+                     workers)
+        self.pb.update('repacking %s' % (message,), pb_offset)
+        child_pb = ui.ui_factory.nested_progress_bar()
+        pool = multiprocessing.Pool(workers)
+        try:
+            stream = vf_to_stream(source_vf, keys, message, child_pb)
+            for _ in target_vf._insert_record_stream_in_pool(stream, pool,
+                    2 * workers, random_id=True):
+                pass
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            child_pb.finished()
+
     def _copy_revision_texts(self):
         source_vf, target_vf = self._build_vfs('revision', True, False)
         if not self.revision_keys:
@@ -472,8 +496,13 @@ class GCCHKPacker(Packer):
         #      rev just before the ones you are copying, otherwise the filter
         #      is grabbing too many keys...
         text_keys = source_vf.keys()
-        self._copy_stream(source_vf, target_vf, text_keys,
-                          'texts', self._get_progress_stream, 4)
+        workers = self._pack_collection.config_stack.get('pack.workers')
+        if workers > 1:
+            self._copy_stream_in_pool(source_vf, target_vf, text_keys,
+                'texts', self._get_progress_stream, 4, workers)
+        else:
+            self._copy_stream(source_vf, target_vf, text_keys,
+                              'texts', self._get_progress_stream, 4)
 
     def _copy_signature_texts(self):
         source_vf, target_vf = self._build_vfs('signature', False, False)
@@ -770,6 +799,10 @@ class GCRepositoryPackCollection(RepositoryPackCollection):
         chk_bytes_no_fallbacks = self.repo.chk_bytes.without_fallbacks()
         chk_bytes_no_fallbacks._search_key_func = \
             self.repo.chk_bytes._search_key_func
+        chk_bytes_no_fallbacks._chk_prefetch = \
+            self.repo.chk_bytes._chk_prefetch
+        chk_bytes_no_fallbacks._chk_page_cache = getattr(
+            self.repo.chk_bytes, '_chk_page_cache', None)
         chk_diff = chk_map.iter_interesting_nodes(
             chk_bytes_no_fallbacks, root_key_info.interesting_root_keys,
             root_key_info.uninteresting_root_keys)
@@ -841,6 +874,13 @@ class CHKInventoryRepository(PackRepository):
                 parents=True, is_locked=self.is_locked,
                 inconsistency_fatal=False),
             access=self._pack_collection.text_index.data_access)
+        self.texts.set_extract_workers(
+            self._pack_collection.config_stack.get(
+                'repository.extract_workers'))
+        if self._pack_collection.config_stack.get(
+            'repository.annotation_cache'):
+            self.texts.set_annotation_cache(
+                annotation_cache.cache_for_repository(self))
         # No parents, individual CHK pages don't have specific ancestry
         self.chk_bytes = GroupCompressVersionedFiles(
             _GCGraphIndex(self._pack_collection.chk_index.combined_index,
@@ -851,6 +891,14 @@ class CHKInventoryRepository(PackRepository):
         search_key_name = self._format._serializer.search_key_name
         search_key_func = chk_map.search_key_registry.get(search_key_name)
         self.chk_bytes._search_key_func = search_key_func
+        self.chk_bytes._chk_prefetch = \
+            self._pack_collection.config_stack.get('repository.chk_prefetch')
+        chk_cache_size = self._pack_collection.config_stack.get(
+            'repository.chk_cache_size')
+        if chk_cache_size:
+            chk_map.set_page_cache(self.chk_bytes, chk_cache_size,
+                self._pack_collection.config_stack.get(
+                    'repository.chk_cache_nodes'))
         # True when the repository object is 'write locked' (as opposed to the
         # physical lock only taken out around changes to the pack-names list.)
         # Another way to represent this would be a decorator around the control
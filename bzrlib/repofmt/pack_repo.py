@@ -29,6 +29,7 @@ from bzrlib import (
     cleanup,
     config,
     debug,
+    generation_index,
     graph,
     osutils,
     pack,
@@ -542,13 +543,26 @@ class NewPack(Pack):
             transport = self.upload_transport
         else:
             transport = self.index_transport
+        config_stack = self._pack_collection.config_stack
+        # Suspended packs are resumed by moving their indices only, so they
+        # don't get a bloom filter.
+        use_bloom_filter = (not suspend
+            and getattr(index, 'set_bloom_filter', None) is not None
+            and config_stack.get('repository.bloom_filters'))
+        if use_bloom_filter:
+            index.set_bloom_filter()
         index_tempfile = index.finish()
         index_bytes = index_tempfile.read()
+        if use_bloom_filter:
+            # Written first, so that readers finding the index find the
+            # filter too.
+            transport.put_bytes(index_name + '.bloom',
+                index.bloom_filter.to_bytes(), mode=self._file_mode)
         write_stream = transport.open_write_stream(index_name,
             mode=self._file_mode)
         write_stream.write(index_bytes)
         write_stream.close(
-            want_fdatasync=self._pack_collection.config_stack.get('repository.fdatasync'))
+            want_fdatasync=config_stack.get('repository.fdatasync'))
         self.index_sizes[self.index_offset(index_type)] = len(index_bytes)
         if 'pack' in debug.debug_flags:
             # XXX: size might be interesting?
@@ -560,6 +574,9 @@ class NewPack(Pack):
         # the index layer to make its finish() error if add_node is
         # subsequently used. RBC
         self._replace_index_with_readonly(index_type)
+        if use_bloom_filter:
+            getattr(self, index_type + '_index').set_bloom_filter_name(
+                index_name + '.bloom')
 
 
 class AggregateIndex(object):
@@ -1184,8 +1201,15 @@ class RepositoryPackCollection(object):
         else:
             transport = self._index_transport
             index_size = self._names[name][size_offset]
-        index = self._index_class(transport, index_name, index_size,
-                                  unlimited_cache=is_chk)
+        index_class = self._index_class
+        if (index_class is btree_index.BTreeGraphIndex and not resume
+            and self.config_stack.get('repository.mmap_indices')):
+            index_class = btree_index.MMapBTreeGraphIndex
+        index = index_class(transport, index_name, index_size,
+                            unlimited_cache=is_chk)
+        if (not resume and isinstance(index, btree_index.BTreeGraphIndex)
+            and self.config_stack.get('repository.bloom_filters')):
+            index.set_bloom_filter_name(index_name + '.bloom')
         if is_chk and self._index_class is btree_index.BTreeGraphIndex: 
             index._leaf_factory = btree_index._gcchk_factory
         return index
@@ -1252,6 +1276,19 @@ class RepositoryPackCollection(object):
                 except (errors.PathError, errors.TransportError), e:
                     mutter("couldn't rename obsolete index, skipping it:\n%s"
                            % (e,))
+            # The filters are moved even if repository.bloom_filters is no
+            # longer set, or they would be left behind in indices/.
+            for suffix in suffixes:
+                try:
+                    self._index_transport.move(
+                        pack.name + suffix + '.bloom',
+                        '../obsolete_packs/' + pack.name + suffix + '.bloom')
+                except errors.NoSuchFile:
+                    # Packs written without bloom filters
+                    pass
+                except (errors.PathError, errors.TransportError), e:
+                    mutter("couldn't rename obsolete bloom filter,"
+                           " skipping it:\n%s" % (e,))
 
     def pack_distribution(self, total_revisions):
         """Generate a list of the number of revisions to put in each pack.
@@ -1512,6 +1549,9 @@ class RepositoryPackCollection(object):
             return found
         for filename in obsolete_pack_files:
             name, ext = osutils.splitext(filename)
+            if ext == '.bloom':
+                # The bloom filter of an index, e.g. name.rix.bloom
+                name = osutils.splitext(name)[0]
             if ext == '.pack':
                 found.append(name)
             if name in preserve:
@@ -1586,6 +1626,16 @@ class RepositoryPackCollection(object):
         # overrides this.
         return []
         
+    def _new_revision_ids(self):
+        """Return the ids of the revisions inserted by this write group."""
+        revision_ids = []
+        for pack in [self._new_pack] + self._resumed_packs:
+            if pack is None:
+                continue
+            for node in pack.revision_index.iter_all_entries():
+                revision_ids.append(node[1][0])
+        return revision_ids
+
     def _commit_write_group(self):
         all_missing = set()
         for prefix, versioned_file in (
@@ -1691,6 +1741,7 @@ class PackRepository(MetaDirVersionedFileRepository):
         self._commit_builder_class = _commit_builder_class
         self._serializer = _serializer
         self._reconcile_fixes_text_parents = True
+        self._generation_index = None
         if self._format.supports_external_lookups:
             self._unstacked_provider = graph.CachingParentsProvider(
                 self._make_parents_provider_unstacked())
@@ -1724,14 +1775,43 @@ class PackRepository(MetaDirVersionedFileRepository):
         self._pack_collection._start_write_group()
 
     def _commit_write_group(self):
+        index = self._get_generation_index()
+        if index is not None:
+            revision_ids = self._pack_collection._new_revision_ids()
         hint = self._pack_collection._commit_write_group()
         self.revisions._index._key_dependencies.clear()
         # The commit may have added keys that were previously cached as
         # missing, so reset the cache.
         self._unstacked_provider.disable_cache()
         self._unstacked_provider.enable_cache()
+        if index is not None and revision_ids:
+            # The repository write lock is only logical: take the physical
+            # lock so that concurrent commits append to the index in turn.
+            self._pack_collection.lock_names()
+            try:
+                index.update(self, revision_ids)
+            finally:
+                self._pack_collection._unlock_names()
         return hint
 
+    def _get_generation_index(self):
+        """See Repository._get_generation_index.
+
+        Pack repositories have one when the repository.generation_index
+        option is set. It is extended with the revisions inserted by each
+        write group.
+        """
+        if not self._pack_collection.config_stack.get(
+            'repository.generation_index'):
+            return None
+        if self._generation_index is None:
+            self._generation_index = generation_index.index_for_repository(
+                self)
+        else:
+            # Pick up the revisions recorded by other processes
+            self._generation_index.load()
+        return self._generation_index
+
     def suspend_write_group(self):
         # XXX check self._write_group is self.get_transaction()?
         tokens = self._pack_collection._suspend_write_group()
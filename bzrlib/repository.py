@@ -1102,7 +1102,16 @@ class Repository(_RelockDebugMixin, controldir.ControlComponent):
             not self.has_same_location(other_repository)):
             parents_provider = graph.StackedParentsProvider(
                 [parents_provider, other_repository._make_parents_provider()])
-        return graph.Graph(parents_provider)
+        return graph.Graph(parents_provider,
+                           generation_index=self._get_generation_index())
+
+    def _get_generation_index(self):
+        """Return the generation index of this repository, if any.
+
+        :return: A generation_index.GenerationIndex holding the revisions of
+            this repository, or None.
+        """
+        return None
 
     @needs_write_lock
     def set_make_working_trees(self, new_value):
@@ -1745,6 +1754,44 @@ class CopyConverter(object):
         pb.update(gettext('Creating new repository'))
         converted = self.target_format.initialize(self.repo_dir,
                                                   self.source_repo.is_shared())
+        self._copy_content(converted, pb)
+
+    def resume(self, a_bzrdir, pb):
+        """Complete a conversion which has been interrupted.
+
+        The content copied before the interruption is kept, only the revisions
+        still missing are copied from repository.backup.
+
+        :param a_bzrdir: The control directory holding the repositories.
+        :param pb: a progress bar to use for progress information.
+        """
+        pb = ui.ui_factory.nested_progress_bar()
+        self.count = 0
+        self.total = 4
+        self.repo_dir = a_bzrdir
+        backup_transport = self.repo_dir.transport.clone('repository.backup')
+        source_format = RepositoryFormatMetaDir._find_format(format_registry,
+            'repository', backup_transport.get_bytes('format'))
+        self.source_repo = source_format.open(self.repo_dir,
+            _found=True,
+            _override_transport=backup_transport)
+        try:
+            converted = self.repo_dir.open_repository()
+        except errors.NoRepositoryPresent:
+            converted = None
+        if (converted is not None and converted._format.network_name()
+            != self.target_format.network_name()):
+            # Not the format we are converting to this time
+            converted = None
+        if converted is None:
+            if self.repo_dir.transport.has('repository'):
+                self.repo_dir.transport.delete_tree('repository')
+            pb.update(gettext('Creating new repository'))
+            converted = self.target_format.initialize(self.repo_dir,
+                self.source_repo.is_shared())
+        self._copy_content(converted, pb)
+
+    def _copy_content(self, converted, pb):
         converted.lock_write()
         try:
             pb.update(gettext('Copying content'))
@@ -0,0 +1,179 @@
+# Copyright (C) 2017 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Persistent cache of the merge sorted ancestry of a branch tip.
+
+Merge sorting the whole ancestry of a branch is needed to know the dotted
+revno of any revision, which is expensive for long histories. The result is
+stored next to the branch control files, keyed by the tip it was computed
+for. When the tip moves forward along its left-hand history, only the
+revisions that are not ancestors of the cached tip are merge sorted.
+"""
+
+from __future__ import absolute_import
+
+import itertools
+
+from bzrlib import (
+    bencode,
+    errors,
+    tsort,
+    )
+from bzrlib._known_graph_py import _MergeSortNode
+from bzrlib.trace import mutter
+
+
+_FORMAT_STRING = 'Bazaar revno cache v1\n'
+
+
+class RevnoCache(object):
+    """The merge sorted revisions of a branch tip, stored on a transport.
+
+    The cache holds a single tip: storing a new one replaces the old one.
+    """
+
+    def __init__(self, transport, filename='revno-cache', file_mode=None):
+        """Create a RevnoCache.
+
+        :param transport: The transport holding the cache file, usually the
+            branch control transport.
+        :param filename: The name of the cache file.
+        :param file_mode: The mode to create the cache file with.
+        """
+        self._transport = transport
+        self._filename = filename
+        self._file_mode = file_mode
+
+    def load(self):
+        """Read the cached tip and its merge sorted revisions.
+
+        :return: A (tip, nodes) tuple where nodes is the merge sorted
+            ancestry of tip, or None if there is no usable cache.
+        """
+        try:
+            bytes = self._transport.get_bytes(self._filename)
+        except errors.NoSuchFile:
+            return None
+        if not bytes.startswith(_FORMAT_STRING):
+            mutter('ignoring revno cache with unknown format in %s',
+                   self._transport.base)
+            return None
+        try:
+            tip, raw_nodes = bencode.bdecode_as_tuple(
+                bytes[len(_FORMAT_STRING):])
+            nodes = [_MergeSortNode(key, merge_depth, revno,
+                                    bool(end_of_merge))
+                     for key, merge_depth, revno, end_of_merge in raw_nodes]
+        except (ValueError, TypeError), e:
+            mutter('ignoring corrupt revno cache in %s: %s',
+                   self._transport.base, e)
+            return None
+        return tip, nodes
+
+    def save(self, tip, nodes):
+        """Replace the cache content.
+
+        Failing to write the cache is not an error, the cache is simply not
+        updated.
+
+        :param tip: The revision nodes were computed for.
+        :param nodes: The merge sorted ancestry of tip, as returned by
+            KnownGraph.merge_sort.
+        """
+        raw_nodes = [(node.key, node.merge_depth, node.revno,
+                      int(node.end_of_merge)) for node in nodes]
+        bytes = _FORMAT_STRING + bencode.bencode((tip, raw_nodes))
+        try:
+            self._transport.put_bytes(self._filename, bytes,
+                                      mode=self._file_mode)
+        except (errors.TransportNotPossible, errors.PathError), e:
+            mutter('unable to write revno cache in %s: %s',
+                   self._transport.base, e)
+
+    def merge_sort(self, repository, tip_revno, tip):
+        """Return the merge sorted ancestry of tip, updating the cache.
+
+        :param repository: The repository holding the ancestry of tip.
+        :param tip_revno: The revno of tip.
+        :param tip: The revision to merge sort the ancestry of.
+        :return: A list of nodes like KnownGraph.merge_sort.
+        """
+        cached = self.load()
+        nodes = None
+        if cached is not None:
+            cached_tip, cached_nodes = cached
+            if cached_tip == tip:
+                return cached_nodes
+            nodes = extend_merge_sorted(repository, tip_revno, tip,
+                                        cached_nodes)
+        if nodes is None:
+            known_graph = repository.get_known_graph_ancestry([tip])
+            nodes = known_graph.merge_sort(tip)
+        self.save(tip, nodes)
+        return nodes
+
+
+def extend_merge_sorted(repository, tip_revno, tip, base_nodes):
+    """Merge sort tip by extending the merge sort of one of its ancestors.
+
+    :param repository: The repository holding the ancestry of tip.
+    :param tip_revno: The revno of tip.
+    :param tip: The revision to merge sort the ancestry of.
+    :param base_nodes: The merge sorted ancestry of a previous tip.
+    :return: The merge sorted ancestry of tip, or None if the previous tip is
+        not a left-hand ancestor of tip.
+    """
+    if not base_nodes:
+        return None
+    base_tip = base_nodes[0].key
+    base_revno = base_nodes[0].revno
+    if len(base_revno) != 1 or tip_revno <= base_revno[0]:
+        return None
+    graph = repository.get_graph()
+    distance = tip_revno - base_revno[0]
+    try:
+        lefthand = list(itertools.islice(graph.iter_lefthand_ancestry(tip),
+                                         distance + 1))
+    except errors.RevisionNotPresent:
+        return None
+    if len(lefthand) != distance + 1 or lefthand[-1] != base_tip:
+        return None
+    parent_map = graph.get_parent_map(
+        graph.find_unique_ancestors(tip, [base_tip]))
+    referenced = set([base_tip])
+    for parents in parent_map.itervalues():
+        referenced.update(parents)
+    # Rebuild the state the sort of base_tip finished with. A node has been
+    # claimed as a left-hand parent exactly when the revno following its own
+    # one exists, and branch counts only ever grow by one.
+    all_revnos = set(node.revno for node in base_nodes)
+    base_revnos = {}
+    revno_to_branch_count = {}
+    for node in base_nodes:
+        revno = node.revno
+        if len(revno) == 3:
+            if revno[1] > revno_to_branch_count.get(revno[0], 0):
+                revno_to_branch_count[revno[0]] = revno[1]
+        elif revno == (1,):
+            revno_to_branch_count.setdefault(0, 0)
+        if node.key in referenced:
+            first_child = revno[:-1] + (revno[-1] + 1,) not in all_revnos
+            base_revnos[node.key] = (revno, first_child)
+    new_nodes = [_MergeSortNode(key, merge_depth, revno, end_of_merge)
+                 for _, key, merge_depth, revno, end_of_merge
+                 in tsort.extend_merge_sort(parent_map, tip, base_tip,
+                     base_revnos, revno_to_branch_count)]
+    return new_nodes + base_nodes
@@ -53,8 +53,135 @@ from bzrlib.versionedfile import (
     )
 
 
+class RepositoryCache(object):
+    """Opened repositories shared by the requests of all server connections.
+
+    Keeping a repository open keeps its index caches (such as the
+    BTreeGraphIndex leaf nodes) and its groupcompress block cache warm for
+    later requests, possibly from other clients.
+
+    A repository is used by a single request at a time: get() hands out an
+    idle repository or opens a new one, and release() makes it available
+    again. Only pack based repositories are cached, and a cached repository
+    is discarded as soon as its pack-names file has changed.
+    """
+
+    def __init__(self, max_size):
+        """Create a RepositoryCache.
+
+        :param max_size: The maximum number of idle repositories kept open.
+        """
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        # (url, pack_names_bytes, repository) tuples, least recently released
+        # first.
+        self._idle = []
+        # Maps id(repository) => (url, pack_names_bytes) for the repositories
+        # handed out by get() and not released yet.
+        self._in_use = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _read_pack_names(self, repository):
+        pack_collection = getattr(repository, '_pack_collection', None)
+        if pack_collection is None:
+            return None
+        try:
+            return pack_collection.transport.get_bytes('pack-names')
+        except errors.NoSuchFile:
+            return None
+
+    def _pop_idle(self, url):
+        self._lock.acquire()
+        try:
+            for index in range(len(self._idle) - 1, -1, -1):
+                if self._idle[index][0] == url:
+                    return self._idle.pop(index)
+            return None
+        finally:
+            self._lock.release()
+
+    def get(self, transport):
+        """Get a repository opened at transport.
+
+        :param transport: The transport the repository is at. No searching
+            is done.
+        :return: A repository that must be passed to release() once the
+            request is done with it.
+        """
+        url = transport.base
+        while True:
+            entry = self._pop_idle(url)
+            if entry is None:
+                break
+            _, pack_names, repository = entry
+            if self._read_pack_names(repository) == pack_names:
+                self.hits += 1
+                self._in_use[id(repository)] = (url, pack_names)
+                return repository
+            self.invalidations += 1
+        self.misses += 1
+        repository = BzrDir.open_from_transport(transport).open_repository()
+        pack_names = self._read_pack_names(repository)
+        if pack_names is not None:
+            self._in_use[id(repository)] = (url, pack_names)
+        return repository
+
+    def release(self, repository):
+        """Make a repository returned by get() available to other requests.
+
+        Repositories that are still locked are not reused.
+        """
+        try:
+            url, pack_names = self._in_use.pop(id(repository))
+        except KeyError:
+            # Not cacheable.
+            return
+        if repository.is_locked() or not self._max_size:
+            return
+        self._lock.acquire()
+        try:
+            self._idle.append((url, pack_names, repository))
+            del self._idle[:-self._max_size]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Forget about all the idle repositories."""
+        self._lock.acquire()
+        try:
+            del self._idle[:]
+        finally:
+            self._lock.release()
+
+
+# The RepositoryCache used by all requests, None means repositories are opened
+# for each request.
+_repository_cache = None
+
+
+def set_repository_cache(cache):
+    """Set the RepositoryCache used by the server requests.
+
+    :param cache: A RepositoryCache or None to stop caching.
+    :return: The previous RepositoryCache.
+    """
+    global _repository_cache
+    old_cache = _repository_cache
+    _repository_cache = cache
+    return old_cache
+
+
 class SmartServerRepositoryRequest(SmartServerRequest):
-    """Common base class for Repository requests."""
+    """Common base class for Repository requests.
+
+    :cvar uses_repository_cache: True if the request only reads from the
+        repository and calls self._release_repository() once it is done with
+        it, so that the repository can come from the server RepositoryCache.
+    """
+
+    uses_repository_cache = False
 
     def do(self, path, *args):
         """Execute a repository request.
@@ -70,11 +197,23 @@ class SmartServerRepositoryRequest(SmartServerRequest):
         :return: A SmartServerResponse from self.do_repository_request().
         """
         transport = self.transport_from_client_path(path)
-        bzrdir = BzrDir.open_from_transport(transport)
         # Save the repository for use with do_body.
-        self._repository = bzrdir.open_repository()
+        self._repository_cache = None
+        if self.uses_repository_cache and _repository_cache is not None:
+            self._repository_cache = _repository_cache
+            self._repository = _repository_cache.get(transport)
+        else:
+            bzrdir = BzrDir.open_from_transport(transport)
+            self._repository = bzrdir.open_repository()
         return self.do_repository_request(self._repository, *args)
 
+    def _release_repository(self):
+        """Tell the repository cache this request is done with the repository.
+        """
+        if self._repository_cache is not None:
+            self._repository_cache.release(self._repository)
+            self._repository_cache = None
+
     def do_repository_request(self, repository, *args):
         """Override to provide an implementation for a verb."""
         # No-op for verbs that take bodies (None as a result indicates a body
@@ -142,6 +281,8 @@ class SmartServerRepositoryRequest(SmartServerRequest):
 class SmartServerRepositoryReadLocked(SmartServerRepositoryRequest):
     """Calls self.do_readlocked_repository_request."""
 
+    uses_repository_cache = True
+
     def do_repository_request(self, repository, *args):
         """Read lock a repository for do_readlocked_repository_request."""
         repository.lock_read()
@@ -149,6 +290,7 @@ class SmartServerRepositoryReadLocked(SmartServerRepositoryRequest):
             return self.do_readlocked_repository_request(repository, *args)
         finally:
             repository.unlock()
+            self._release_repository()
 
 
 class SmartServerRepositoryBreakLock(SmartServerRepositoryRequest):
@@ -166,6 +308,8 @@ class SmartServerRepositoryGetParentMap(SmartServerRepositoryRequest):
 
     no_extra_results = False
 
+    uses_repository_cache = True
+
     def do_repository_request(self, repository, *revision_ids):
         """Get parent details for some revisions.
 
@@ -198,6 +342,7 @@ class SmartServerRepositoryGetParentMap(SmartServerRepositoryRequest):
             return self._do_repository_request(body_bytes)
         finally:
             repository.unlock()
+            self._release_repository()
 
     def _expand_requested_revs(self, repo_graph, revision_ids, client_seen_revs,
                                include_missing, max_size=65536):
@@ -521,6 +666,8 @@ class SmartServerRepositoryLockWrite(SmartServerRepositoryRequest):
 
 class SmartServerRepositoryGetStream(SmartServerRepositoryRequest):
 
+    uses_repository_cache = True
+
     def do_repository_request(self, repository, to_network_name):
         """Get a stream for inserting into a to_format repository.
 
@@ -537,6 +684,7 @@ class SmartServerRepositoryGetStream(SmartServerRepositoryRequest):
         """
         self._to_format = network_format_registry.get(to_network_name)
         if self._should_fake_unknown():
+            self._release_repository()
             return FailedSmartServerResponse(
                 ('UnknownMethod', 'Repository.get_stream'))
         return None # Signal that we want a body.
@@ -580,6 +728,7 @@ class SmartServerRepositoryGetStream(SmartServerRepositoryRequest):
                 discard_excess=True)
             if error is not None:
                 repository.unlock()
+                self._release_repository()
                 return error
             source = repository._get_source(self._to_format)
             stream = source.get_stream(search_result)
@@ -588,6 +737,7 @@ class SmartServerRepositoryGetStream(SmartServerRepositoryRequest):
             try:
                 # On non-error, unlocking is done by the body stream handler.
                 repository.unlock()
+                self._release_repository()
             finally:
                 raise exc_info[0], exc_info[1], exc_info[2]
         return SuccessfulSmartServerResponse(('ok',),
@@ -602,9 +752,11 @@ class SmartServerRepositoryGetStream(SmartServerRepositoryRequest):
             # This shouldn't be able to happen, but as we don't buffer
             # everything it can in theory happen.
             repository.unlock()
+            self._release_repository()
             yield FailedSmartServerResponse(('NoSuchRevision', e.revision_id))
         else:
             repository.unlock()
+            self._release_repository()
 
 
 class SmartServerRepositoryGetStream_1_19(SmartServerRepositoryGetStream):
@@ -19,7 +19,9 @@
 from __future__ import absolute_import
 
 import errno
+import os
 import os.path
+import signal
 import socket
 import sys
 import time
@@ -36,6 +38,7 @@ from bzrlib.lazy_import import lazy_import
 lazy_import(globals(), """
 from bzrlib.smart import (
     medium,
+    repository as _mod_smart_repository,
     signals,
     )
 from bzrlib.transport import (
@@ -68,7 +71,7 @@ class SmartTCPServer(object):
     _timer = time.time
 
     def __init__(self, backing_transport, root_client_path='/',
-                 client_timeout=None):
+                 client_timeout=None, max_connections=None):
         """Construct a new server.
 
         To actually start it running, call either start_background_thread or
@@ -79,10 +82,16 @@ class SmartTCPServer(object):
             of backing_transport.
         :param client_timeout: See SmartServerSocketStreamMedium's timeout
             parameter.
+        :param max_connections: The maximum number of connections served at
+            the same time, None or a value below 1 means no limit. Further
+            clients wait in the listen queue.
         """
         self.backing_transport = backing_transport
         self.root_client_path = root_client_path
         self._client_timeout = client_timeout
+        if max_connections is not None and max_connections < 1:
+            max_connections = None
+        self._max_connections = max_connections
         self._active_connections = []
         # This is set to indicate we want to wait for clients to finish before
         # we disconnect.
@@ -204,27 +213,7 @@ class SmartTCPServer(object):
         self._started.set()
         try:
             try:
-                while not self._should_terminate:
-                    try:
-                        conn, client_addr = self._server_socket.accept()
-                    except self._socket_timeout:
-                        # just check if we're asked to stop
-                        pass
-                    except self._socket_error, e:
-                        # if the socket is closed by stop_background_thread
-                        # we might get a EBADF here, or if we get a signal we
-                        # can get EINTR, any other socket errors should get
-                        # logged.
-                        if e.args[0] not in (errno.EBADF, errno.EINTR):
-                            trace.warning(gettext("listening socket error: %s")
-                                          % (e,))
-                    else:
-                        if self._should_terminate:
-                            conn.close()
-                            break
-                        self.serve_conn(conn, thread_name_suffix)
-                    # Cleanout any threads that have finished processing.
-                    self._poll_active_connections()
+                self._accept_connections(thread_name_suffix)
             except KeyboardInterrupt:
                 # dont log when CTRL-C'd.
                 raise
@@ -245,6 +234,37 @@ class SmartTCPServer(object):
             self._wait_for_clients_to_disconnect()
         self._fully_stopped.set()
 
+    def _accept_connections(self, thread_name_suffix):
+        """Accept and serve connections until asked to terminate."""
+        while not self._should_terminate:
+            if (self._max_connections is not None and
+                len(self._active_connections) >= self._max_connections):
+                # Leave new clients in the listen queue until one of the
+                # current ones is done.
+                self._poll_active_connections(
+                    self._ACCEPT_TIMEOUT / len(self._active_connections))
+                continue
+            try:
+                conn, client_addr = self._server_socket.accept()
+            except self._socket_timeout:
+                # just check if we're asked to stop
+                pass
+            except self._socket_error, e:
+                # if the socket is closed by stop_background_thread
+                # we might get a EBADF here, or if we get a signal we
+                # can get EINTR, any other socket errors should get
+                # logged.
+                if e.args[0] not in (errno.EBADF, errno.EINTR):
+                    trace.warning(gettext("listening socket error: %s")
+                                  % (e,))
+            else:
+                if self._should_terminate:
+                    conn.close()
+                    break
+                self.serve_conn(conn, thread_name_suffix)
+            # Cleanout any threads that have finished processing.
+            self._poll_active_connections()
+
     def get_url(self):
         """Return the url of the server"""
         return "bzr://%s:%s/" % (self._sockname[0], self._sockname[1])
@@ -353,6 +373,220 @@ class SmartServerHooks(Hooks):
 SmartTCPServer.hooks = SmartServerHooks()
 
 
+class SmartPreforkTCPServer(SmartTCPServer):
+    """A SmartTCPServer serving connections from a pool of processes.
+
+    The listening socket is created before the worker processes are forked,
+    and each worker accepts and serves connections on it the way
+    SmartTCPServer does. This spreads the work of concurrent clients over
+    several CPUs. The parent process only watches over its workers and
+    replaces the ones that die.
+
+    Sending SIGHUP to the parent stops the server gracefully: the workers
+    finish serving their current clients before exiting. Sending SIGUSR1
+    restarts the workers gracefully: new workers start accepting connections
+    right away while the old ones finish serving their current clients.
+    """
+
+    _WORKER_POLL_TIMEOUT = 0.5
+
+    def __init__(self, backing_transport, root_client_path='/',
+                 client_timeout=None, max_connections=None, workers=2):
+        """Construct a new server.
+
+        :param workers: The number of worker processes.
+        :param max_connections: The maximum number of connections each
+            worker serves at the same time.
+
+        See SmartTCPServer for the other parameters.
+        """
+        super(SmartPreforkTCPServer, self).__init__(backing_transport,
+            root_client_path=root_client_path, client_timeout=client_timeout,
+            max_connections=max_connections)
+        self._worker_count = workers
+        # The pids of the workers accepting connections
+        self._workers = set()
+        # The pids of the workers that have been asked to stop gracefully
+        self._retiring_workers = set()
+        self._is_worker = False
+        self._restart_requested = False
+
+    def start_server(self, host, port):
+        super(SmartPreforkTCPServer, self).start_server(host, port)
+        # All the workers accept connections from this socket.
+        self._server_socket.listen(socket.SOMAXCONN)
+
+    def restart_workers(self):
+        """Gracefully replace all the workers by new ones."""
+        self._restart_requested = True
+
+    def _on_restart_signal(self, signal_number, interrupted_frame):
+        self.restart_workers()
+
+    def _install_restart_handler(self):
+        if getattr(signal, 'SIGUSR1', None) is None:
+            return None
+        try:
+            return signal.signal(signal.SIGUSR1, self._on_restart_signal)
+        except ValueError:
+            # Signal handlers can only be installed from the main thread.
+            trace.mutter('not handling SIGUSR1 outside of the main thread')
+            return None
+
+    def _restore_restart_handler(self, old_handler):
+        if old_handler is not None:
+            signal.signal(signal.SIGUSR1, old_handler)
+
+    def _stop_gracefully(self):
+        if self._is_worker:
+            super(SmartPreforkTCPServer, self)._stop_gracefully()
+            return
+        trace.note(gettext('Requested to stop gracefully'))
+        self._should_terminate = True
+        self._gracefully_stopping = True
+        self._retire_workers()
+
+    def _signal_workers(self, signal_number, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal_number)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def _retire_workers(self):
+        """Ask all the accepting workers to stop gracefully."""
+        self._signal_workers(signal.SIGHUP, self._workers)
+        self._retiring_workers.update(self._workers)
+        self._workers.clear()
+
+    def _reap_workers(self):
+        """Forget about the workers that have exited."""
+        for pid in list(self._workers) + list(self._retiring_workers):
+            try:
+                finished, status = os.waitpid(pid, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                finished, status = pid, 0
+            if not finished:
+                continue
+            if pid in self._workers:
+                self._workers.remove(pid)
+                if not self._should_terminate:
+                    trace.warning(
+                        gettext('worker %d exited unexpectedly (status %d)')
+                        % (pid, status))
+            else:
+                self._retiring_workers.discard(pid)
+
+    def _spawn_worker(self, thread_name_suffix):
+        """Fork a new worker process.
+
+        :return: The pid of the new worker, in the parent process. The worker
+            process exits once it stops serving.
+        """
+        trace._flush_trace()
+        pid = os.fork()
+        if pid:
+            self._workers.add(pid)
+            return pid
+        exit_code = 0
+        try:
+            try:
+                self._serve_as_worker(thread_name_suffix)
+            except KeyboardInterrupt:
+                pass
+            except:
+                trace.report_exception(sys.exc_info(), sys.stderr)
+                exit_code = 1
+        finally:
+            trace._flush_trace()
+            trace._flush_stdout_stderr()
+            os._exit(exit_code)
+
+    def _serve_as_worker(self, thread_name_suffix):
+        self._is_worker = True
+        self._workers = set()
+        self._retiring_workers = set()
+        if getattr(signal, 'SIGUSR1', None) is not None:
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        stop_gracefully = self._stop_gracefully
+        signals.register_on_hangup(id(self), stop_gracefully)
+        try:
+            self._accept_connections(thread_name_suffix)
+        finally:
+            try:
+                self._server_socket.close()
+            except self._socket_error:
+                pass
+        if self._gracefully_stopping:
+            self._wait_for_clients_to_disconnect()
+
+    def _manage_workers(self, thread_name_suffix):
+        """Keep the pool of workers full until asked to terminate."""
+        while not self._should_terminate:
+            if self._restart_requested:
+                self._restart_requested = False
+                trace.note(gettext('Restarting %d worker(s)')
+                           % (len(self._workers),))
+                self._retire_workers()
+            while len(self._workers) < self._worker_count:
+                self._spawn_worker(thread_name_suffix)
+            time.sleep(self._WORKER_POLL_TIMEOUT)
+            self._reap_workers()
+
+    def _wait_for_workers_to_exit(self):
+        self._reap_workers()
+        t_next_log = self._timer() + self._LOG_WAITING_TIMEOUT
+        while self._workers or self._retiring_workers:
+            now = self._timer()
+            if now >= t_next_log:
+                trace.note(gettext('Still waiting for %d worker(s) to finish')
+                           % (len(self._workers)
+                              + len(self._retiring_workers),))
+                t_next_log = now + self._LOG_WAITING_TIMEOUT
+            time.sleep(self._WORKER_POLL_TIMEOUT)
+            self._reap_workers()
+
+    def serve(self, thread_name_suffix=''):
+        # See SmartTCPServer.serve for why we keep a reference to the bound
+        # method.
+        stop_gracefully = self._stop_gracefully
+        signals.register_on_hangup(id(self), stop_gracefully)
+        old_restart_handler = self._install_restart_handler()
+        self._should_terminate = False
+        self.run_server_started_hooks()
+        self._started.set()
+        try:
+            try:
+                self._manage_workers(thread_name_suffix)
+            except KeyboardInterrupt:
+                # dont log when CTRL-C'd.
+                raise
+            except Exception, e:
+                trace.report_exception(sys.exc_info(), sys.stderr)
+                raise
+        finally:
+            try:
+                # The workers hold their own copy of the socket.
+                self._server_socket.close()
+            except self._socket_error:
+                # ignore errors on close
+                pass
+            if not self._gracefully_stopping:
+                self._signal_workers(signal.SIGTERM,
+                    list(self._workers) + list(self._retiring_workers))
+            self._wait_for_workers_to_exit()
+            self._stopped.set()
+            self._restore_restart_handler(old_restart_handler)
+            signals.unregister_on_hangup(id(self))
+            self.run_server_stopped_hooks()
+        self._fully_stopped.set()
+
+
 def _local_path_for_transport(transport):
     """Return a local path for transport, if reasonably possible.
     
@@ -446,8 +680,19 @@ class BzrServerFactory(object):
                 host = medium.BZR_DEFAULT_INTERFACE
             if port is None:
                 port = medium.BZR_DEFAULT_PORT
-            smart_server = SmartTCPServer(self.transport,
-                                          client_timeout=timeout)
+            c = config.GlobalStack()
+            workers = c.get('serve.workers')
+            max_connections = c.get('serve.max_connections')
+            if workers:
+                if getattr(os, 'fork', None) is None:
+                    raise errors.BzrCommandError(gettext(
+                        'serve.workers is not supported on this platform.'))
+                smart_server = SmartPreforkTCPServer(self.transport,
+                    client_timeout=timeout, max_connections=max_connections,
+                    workers=workers)
+            else:
+                smart_server = SmartTCPServer(self.transport,
+                    client_timeout=timeout, max_connections=max_connections)
             smart_server.start_server(host, port)
             trace.note(gettext('listening on port: %s') % smart_server.port)
         self.smart_server = smart_server
@@ -471,9 +716,20 @@ class BzrServerFactory(object):
             signals.restore_sighup_handler(orig)
         self.cleanups.append(restore_signals)
 
+    def _make_repository_cache(self):
+        size = config.GlobalStack().get('serve.repository_cache_size')
+        if not size:
+            return
+        old_cache = _mod_smart_repository.set_repository_cache(
+            _mod_smart_repository.RepositoryCache(size))
+        def restore_repository_cache():
+            _mod_smart_repository.set_repository_cache(old_cache)
+        self.cleanups.append(restore_repository_cache)
+
     def set_up(self, transport, host, port, inet, timeout):
         self._make_backing_transport(transport)
         self._make_smart_server(host, port, inet, timeout)
+        self._make_repository_cache()
         self._change_globals()
 
     def tear_down(self):
@@ -3968,6 +3968,7 @@ def _test_suite_testmod_names():
         'bzrlib.tests.test__walkdirs_win32',
         'bzrlib.tests.test_ancestry',
         'bzrlib.tests.test_annotate',
+        'bzrlib.tests.test_annotation_cache',
         'bzrlib.tests.test_api',
         'bzrlib.tests.test_atomicfile',
         'bzrlib.tests.test_bad_files',
@@ -3980,6 +3981,7 @@ def _test_suite_testmod_names():
         'bzrlib.tests.test_bzrdir',
         'bzrlib.tests.test__chunks_to_lines',
         'bzrlib.tests.test_cache_utf8',
+        'bzrlib.tests.test_check',
         'bzrlib.tests.test_chk_map',
         'bzrlib.tests.test_chk_serializer',
         'bzrlib.tests.test_chunk_writer',
@@ -4017,6 +4019,7 @@ def _test_suite_testmod_names():
         'bzrlib.tests.test_foreign',
         'bzrlib.tests.test_generate_docs',
         'bzrlib.tests.test_generate_ids',
+        'bzrlib.tests.test_generation_index',
         'bzrlib.tests.test_globbing',
         'bzrlib.tests.test_gpg',
         'bzrlib.tests.test_graph',
@@ -4044,6 +4047,7 @@ def _test_suite_testmod_names():
         'bzrlib.tests.test_lockable_files',
         'bzrlib.tests.test_lockdir',
         'bzrlib.tests.test_log',
+        'bzrlib.tests.test_log_index',
         'bzrlib.tests.test_lru_cache',
         'bzrlib.tests.test_lsprof',
         'bzrlib.tests.test_mail_client',
@@ -4078,6 +4082,7 @@ def _test_suite_testmod_names():
         'bzrlib.tests.test_repository',
         'bzrlib.tests.test_revert',
         'bzrlib.tests.test_revision',
+        'bzrlib.tests.test_revno_cache',
         'bzrlib.tests.test_revisionspec',
         'bzrlib.tests.test_revisiontree',
         'bzrlib.tests.test_rio',
@@ -4119,6 +4124,7 @@ def _test_suite_testmod_names():
         'bzrlib.tests.test_transport',
         'bzrlib.tests.test_transport_log',
         'bzrlib.tests.test_tree',
+        'bzrlib.tests.test_tree_watch',
         'bzrlib.tests.test_treebuilder',
         'bzrlib.tests.test_treeshape',
         'bzrlib.tests.test_tsort',
@@ -21,6 +21,7 @@ from itertools import izip
 import os
 
 from bzrlib import (
+    branch,
     branchbuilder,
     errors,
     log,
@@ -996,6 +997,33 @@ class TestLogMultiple(TestLogWithLogCatcher):
         os.chdir("dir1")
         self.assertLogRevnos(['dir2', 'file5'], ['5', '3'])
 
+    def test_log_directory_with_renamed_parent(self):
+        self.prepare_tree()
+        self.run_bzr('mv dir1 dir3')
+        self.run_bzr(['commit', '-m', 'rename dir1'])
+        self.assertLogRevnos(['dir3/dir2'], ['7', '3'])
+        self.assertLogRevnos(['dir3/dir2/file3'], ['3'])
+
+
+class TestLogFileWithIndex(TestLogFile):
+
+    def prepare_tree(self, complex=False):
+        super(TestLogFileWithIndex, self).prepare_tree(complex)
+        branch.Branch.open('.').get_config_stack().set('log.file_index', True)
+
+    def test_index_written(self):
+        self.prepare_tree()
+        self.assertLogRevnos(['-n0', 'file2'], ['4', '3.1.1', '2'])
+        repo = branch.Branch.open('.').repository
+        self.assertTrue(repo.control_transport.has('log-index'))
+
+
+class TestLogMultipleWithIndex(TestLogMultiple):
+
+    def prepare_tree(self):
+        super(TestLogMultipleWithIndex, self).prepare_tree()
+        branch.Branch.open('.').get_config_stack().set('log.file_index', True)
+
 
 class MainlineGhostTests(TestLogWithLogCatcher):
 
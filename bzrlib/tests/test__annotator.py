@@ -18,6 +18,7 @@
 
 from bzrlib import (
     annotate,
+    annotation_cache,
     errors,
     knit,
     revision,
@@ -373,3 +374,48 @@ class TestAnnotator(tests.TestCaseWithMemoryTransport):
         self.assertAnnotateEqual([(self.fb_key,),
                                   (self.fb_key,),
                                  ], self.fb_key)
+
+    def make_cached_annotator(self):
+        self.cache = annotation_cache.AnnotationCache(
+            self.get_transport('annotation-cache'))
+        return self.module.Annotator(self.vf, cache=self.cache)
+
+    def test_cache_stores_annotated_text(self):
+        self.make_merge_text()
+        ann = self.make_cached_annotator()
+        annotations, lines = ann.annotate(self.fd_key)
+        self.assertEqual(annotations, self.cache.get(self.fd_key))
+        # Only the requested text is stored
+        self.assertIs(None, self.cache.get(self.fb_key))
+
+    def test_cache_stops_ancestry_walk(self):
+        self.make_merge_and_restored_text()
+        self.make_cached_annotator().annotate(self.fc_key)
+        ann = self.make_cached_annotator()
+        keys, ann_keys = ann._get_needed_keys(self.fd_key)
+        # The text of C is still needed to diff D against it, but not its
+        # ancestry
+        self.assertEqual([self.fa_key, self.fc_key, self.fd_key],
+                         sorted(keys))
+        self.assertEqual((), ann._parent_map[self.fc_key])
+
+    def test_cache_gives_same_annotations(self):
+        self.make_merge_and_restored_text()
+        self.make_cached_annotator().annotate(self.fc_key)
+        self.ann = self.make_cached_annotator()
+        self.assertAnnotateEqual([(self.fa_key,), (self.fa_key, self.fc_key)],
+                                 self.fd_key)
+        # fc is a simple dominator of fa, even if the ancestry of fc was not
+        # walked
+        self.ann = self.make_cached_annotator()
+        self.assertEqual([(self.fa_key, 'simple\n'),
+                          (self.fc_key, 'content\n'),
+                         ], self.ann.annotate_flat(self.fd_key))
+
+    def test_cache_not_used_for_special_text(self):
+        self.make_merge_text()
+        ann = self.make_cached_annotator()
+        spec_key = ('f-id', revision.CURRENT_REVISION)
+        ann.add_special_text(spec_key, [self.fd_key], 'simple\n')
+        ann.annotate(spec_key)
+        self.assertIs(None, self.cache.get(spec_key))
@@ -0,0 +1,109 @@
+# Copyright (C) 2017 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the persistent annotation cache of repositories."""
+
+from bzrlib import (
+    annotation_cache,
+    tests,
+    )
+
+
+class TestAnnotationCache(tests.TestCaseWithMemoryTransport):
+
+    fa_key = ('f-id', 'a-id')
+    fb_key = ('f-id', 'b-id')
+
+    def make_cache(self):
+        return annotation_cache.AnnotationCache(
+            self.get_transport('annotation-cache'))
+
+    def test_missing(self):
+        cache = self.make_cache()
+        self.assertIs(None, cache.get(self.fa_key))
+        self.assertFalse(self.get_transport().has('annotation-cache'))
+
+    def test_put_get_roundtrip(self):
+        cache = self.make_cache()
+        annotations = [(self.fa_key,), (self.fa_key, self.fb_key),
+                       (self.fa_key, self.fb_key), (self.fb_key,)]
+        cache.put(self.fb_key, annotations)
+        loaded = cache.get(self.fb_key)
+        self.assertEqual(annotations, loaded)
+        self.assertIs(loaded[1], loaded[2])
+        self.assertIs(None, cache.get(self.fa_key))
+
+    def test_corrupt_entry_ignored(self):
+        cache = self.make_cache()
+        cache.put(self.fa_key, [(self.fa_key,)])
+        cache._transport.put_bytes(cache._path_for_key(self.fa_key),
+                                   'Bazaar annotation cache v1\ngarbage')
+        self.assertIs(None, cache.get(self.fa_key))
+
+    def test_entry_for_other_key_ignored(self):
+        cache = self.make_cache()
+        cache.put(self.fa_key, [(self.fa_key,)])
+        path = cache._path_for_key(self.fb_key)
+        cache._ensure_directory(path[:2])
+        cache._transport.put_bytes(path,
+            cache._transport.get_bytes(cache._path_for_key(self.fa_key)))
+        self.assertIs(None, cache.get(self.fb_key))
+
+
+class TestRepositoryAnnotationCache(tests.TestCaseWithTransport):
+
+    def make_annotated_tree(self):
+        tree = self.make_branch_and_tree('tree', format='2a')
+        self.build_tree_contents([('tree/file', 'one\ntwo\n')])
+        tree.add(['file'], ['f-id'])
+        tree.commit('one', rev_id='rev-1')
+        self.build_tree_contents([('tree/file', 'one\n2\nthree\n')])
+        tree.commit('two', rev_id='rev-2')
+        return tree
+
+    def annotate(self, tree, revision_id):
+        repo = tree.branch.repository
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        return repo.revision_tree(revision_id).annotate_iter('f-id')
+
+    def test_not_used_by_default(self):
+        tree = self.make_annotated_tree()
+        self.annotate(tree, 'rev-2')
+        self.assertIs(None, tree.branch.repository.texts._annotation_cache)
+        self.assertFalse(tree.branch.repository._transport.has(
+            'annotation-cache'))
+
+    def test_annotations_stored(self):
+        tree = self.make_annotated_tree()
+        tree.branch.repository._pack_collection.config_stack.set(
+            'repository.annotation_cache', True)
+        repo = tree.branch.repository.bzrdir.open_repository()
+        cache = repo.texts._annotation_cache
+        self.assertIsInstance(cache, annotation_cache.AnnotationCache)
+        expected = [('rev-1', 'one\n'), ('rev-2', '2\n'), ('rev-2', 'three\n')]
+        repo.lock_read()
+        try:
+            self.assertEqual(expected,
+                repo.revision_tree('rev-2').annotate_iter('f-id'))
+            self.assertEqual([(('f-id', 'rev-1'),), (('f-id', 'rev-2'),),
+                              (('f-id', 'rev-2'),)],
+                             cache.get(('f-id', 'rev-2')))
+            # Served from the cache
+            self.assertEqual(expected,
+                repo.revision_tree('rev-2').annotate_iter('f-id'))
+        finally:
+            repo.unlock()
@@ -17,6 +17,7 @@
 
 """Tests for btree indices."""
 
+import mmap
 import pprint
 import zlib
 
@@ -36,6 +37,7 @@ from bzrlib.tests import (
 from bzrlib.tests import (
     features,
     )
+from bzrlib.transport import memory
 
 
 load_tests = scenarios.load_tests_apply_scenarios
@@ -1201,6 +1203,63 @@ class TestBTreeIndex(BTreeTestCase):
         self.assertEqual(500, len(entries))
 
 
+class TestMMapBTreeIndex(BTreeTestCase):
+
+    def make_index(self, nodes, ref_lists=0, key_elements=1, t=None):
+        builder = btree_index.BTreeBuilder(reference_lists=ref_lists,
+            key_elements=key_elements)
+        for key, value, references in nodes:
+            builder.add_node(key, value, references)
+        if t is None:
+            t = self.get_transport()
+        size = t.put_file('index', builder.finish())
+        return btree_index.MMapBTreeGraphIndex(t, 'index', size)
+
+    def test_maps_local_file(self):
+        nodes = self.make_nodes(400, 2, 2)
+        index = self.make_index(nodes, ref_lists=2, key_elements=2)
+        self.assertEqual(800, index.key_count())
+        self.assertEqual(2, len(index._row_lengths))
+        self.assertEqual(sorted([(index,) + node for node in nodes]),
+                         sorted(index.iter_entries([n[0] for n in nodes])))
+        self.assertIsInstance(index._file, mmap.mmap)
+        self.assertTrue(len(index._leaf_node_cache) > 0)
+        for node in index._leaf_node_cache.as_dict().itervalues():
+            self.assertIsInstance(node, btree_index._LazyLeafNode)
+        self.assertEqual(sorted([(index,) + node for node in nodes]),
+                         list(index.iter_all_entries()))
+
+    def test_no_prefetch(self):
+        nodes = self.make_nodes(400, 1, 0)
+        index = self.make_index(nodes)
+        self.assertEqual(1, len(list(index.iter_entries([nodes[0][0]]))))
+        self.assertEqual(1, len(index._leaf_node_cache))
+
+    def test_missing_keys(self):
+        nodes = self.make_nodes(400, 1, 0)
+        index = self.make_index(nodes)
+        self.assertEqual([], list(index.iter_entries([('missing',),
+                                                      ('0' * 39,)])))
+
+    def test_find_ancestors(self):
+        nodes = self.make_nodes(400, 1, 1)
+        index = self.make_index(nodes, ref_lists=1)
+        parent_map = {}
+        missing_keys = set()
+        search_keys = index._find_ancestors([nodes[-1][0]], 0, parent_map,
+                                            missing_keys)
+        self.assertEqual(nodes[-1][2][0], parent_map[nodes[-1][0]])
+        self.assertEqual(set(), missing_keys.intersection(parent_map))
+        self.assertEqual(set(), search_keys.intersection(parent_map))
+
+    def test_non_local_transport(self):
+        nodes = self.make_nodes(400, 1, 0)
+        index = self.make_index(nodes, t=memory.MemoryTransport())
+        self.assertEqual(400, len(list(index.iter_entries(
+            [n[0] for n in nodes]))))
+        self.assertIs(None, index._file)
+
+
 class TestBTreeNodes(BTreeTestCase):
 
     scenarios = btreeparser_scenarios()
@@ -1247,6 +1306,45 @@ class TestBTreeNodes(BTreeTestCase):
             ('11', '44'): ('value:4', ((), (('11', 'ref00'),)))
             }, dict(node.all_items()))
 
+    def test_LazyLeafNode_2_2(self):
+        node_bytes = ("type=leaf\n"
+            "00\x0000\x00\t00\x00ref00\x00value:0\n"
+            "00\x0011\x0000\x00ref00\t00\x00ref00\r01\x00ref01\x00value:1\n"
+            "11\x0033\x0011\x00ref22\t11\x00ref22\r11\x00ref22\x00value:3\n"
+            "11\x0044\x00\t11\x00ref00\x00value:4\n"
+            ""
+            )
+        node = btree_index._LazyLeafNode(node_bytes, 2, 2)
+        self.assertEqual(4, len(node))
+        self.assertEqual(('00', '00'), node.min_key)
+        self.assertEqual(('11', '44'), node.max_key)
+        self.assertEqual([('00', '00'), ('00', '11'), ('11', '33'),
+                          ('11', '44')], node.all_keys())
+        self.assertEqual([
+            (('00', '00'), ('value:0', ((), (('00', 'ref00'),)))),
+            (('00', '11'), ('value:1',
+                ((('00', 'ref00'),), (('00', 'ref00'), ('01', 'ref01'))))),
+            (('11', '33'), ('value:3',
+                ((('11', 'ref22'),), (('11', 'ref22'), ('11', 'ref22'))))),
+            (('11', '44'), ('value:4', ((), (('11', 'ref00'),)))),
+            ], node.all_items())
+        self.assertEqual(('value:1',
+                ((('00', 'ref00'),), (('00', 'ref00'), ('01', 'ref01')))),
+            node[('00', '11')])
+        self.assertTrue(('11', '33') in node)
+        # Keys sorting before, between and after the present ones
+        for key in [('0', '00'), ('00', '0'), ('00', '000'), ('00', '22'),
+                    ('11', '3'), ('11', '55'), ('22', '00')]:
+            self.assertFalse(key in node)
+            self.assertRaises(KeyError, node.__getitem__, key)
+
+    def test_LazyLeafNode_empty(self):
+        node = btree_index._LazyLeafNode("type=leaf\n", 1, 0)
+        self.assertEqual(0, len(node))
+        self.assertIs(None, node.min_key)
+        self.assertFalse(('00',) in node)
+        self.assertEqual([], node.all_items())
+
     def test_InternalNode_1(self):
         node_bytes = ("type=internal\n"
             "offset=1\n"
@@ -1327,6 +1425,111 @@ class TestCompiledBtree(tests.TestCase):
         self.requireFeature(compiled_btreeparser_feature)
 
 
+class TestBloomFilter(tests.TestCase):
+
+    def test_contains_added_keys(self):
+        bloom = btree_index.BloomFilter.for_key_count(100)
+        keys = [('key-%d' % i,) for i in range(100)]
+        for key in keys:
+            bloom.add(key)
+        for key in keys:
+            self.assertTrue(key in bloom)
+        false_positives = [i for i in range(1000)
+                           if ('missing-%d' % i,) in bloom]
+        self.assertTrue(len(false_positives) < 50)
+
+    def test_sized_by_key_count(self):
+        bloom = btree_index.BloomFilter.for_key_count(1000)
+        self.assertEqual(10000, bloom.num_bits)
+        self.assertEqual(7, bloom.num_hashes)
+        self.assertEqual(64, btree_index.BloomFilter.for_key_count(0).num_bits)
+
+    def test_roundtrip(self):
+        bloom = btree_index.BloomFilter.for_key_count(10)
+        bloom.add(('a', 'b'))
+        bytes = bloom.to_bytes()
+        self.assertStartsWith(bytes, "B+Tree Graph Index Bloom Filter 1\n"
+                              "hashes=7\nbits=104\n")
+        loaded = btree_index.BloomFilter.from_bytes(bytes)
+        self.assertEqual(bytes, loaded.to_bytes())
+        self.assertTrue(('a', 'b') in loaded)
+
+    def test_from_bytes_rejects_bad_data(self):
+        self.assertRaises(errors.BadIndexFormatSignature,
+                          btree_index.BloomFilter.from_bytes, 'garbage')
+        self.assertRaises(errors.BadIndexOptions,
+            btree_index.BloomFilter.from_bytes,
+            "B+Tree Graph Index Bloom Filter 1\nhashes=7\nbits=80\nshort")
+
+
+class TestBloomFilterIndex(BTreeTestCase):
+
+    def make_index_with_bloom(self, nodes, ref_lists=0):
+        builder = btree_index.BTreeBuilder(reference_lists=ref_lists)
+        for node in nodes:
+            builder.add_node(*node)
+        builder.set_bloom_filter()
+        stream = builder.finish()
+        t = transport.get_transport_from_url('trace+' + self.get_url(''))
+        size = t.put_file('index', stream)
+        t.put_bytes('index.bloom', builder.bloom_filter.to_bytes())
+        index = btree_index.BTreeGraphIndex(t, 'index', size)
+        index.set_bloom_filter_name('index.bloom')
+        del t._activity[:]
+        return t, index
+
+    def test_builder_without_bloom_filter(self):
+        builder = btree_index.BTreeBuilder()
+        builder.add_node(('key',), 'value')
+        builder.finish()
+        self.assertIs(None, builder.bloom_filter)
+
+    def test_builder_adds_all_keys(self):
+        nodes = self.make_nodes(300, 1, 0)
+        builder = btree_index.BTreeBuilder(spill_at=100)
+        for node in nodes:
+            builder.add_node(*node)
+        builder.set_bloom_filter()
+        builder.finish()
+        for key, _, _ in nodes:
+            self.assertTrue(key in builder.bloom_filter)
+
+    def test_iter_entries_skips_rejected_keys(self):
+        nodes = self.make_nodes(300, 1, 0)
+        t, index = self.make_index_with_bloom(nodes)
+        missing = [('missing-%d' % i,) for i in range(10)]
+        missing = [key for key in missing
+                   if key not in index._get_bloom_filter()]
+        del t._activity[:]
+        self.assertEqual([], list(index.iter_entries(missing)))
+        self.assertEqual([], t._activity)
+        self.assertEqual([(index,) + nodes[0][:2]],
+                         list(index.iter_entries([nodes[0][0]] + missing)))
+
+    def test_find_ancestors_marks_rejected_keys_missing(self):
+        nodes = self.make_nodes(300, 1, 1)
+        t, index = self.make_index_with_bloom(nodes, ref_lists=1)
+        key = ('missing',)
+        if key in index._get_bloom_filter():
+            key = ('missing-too',)
+        del t._activity[:]
+        parent_map = {}
+        missing_keys = set()
+        self.assertEqual(set(), index._find_ancestors([key], 0, parent_map,
+                                                      missing_keys))
+        self.assertEqual({}, parent_map)
+        self.assertEqual(set([key]), missing_keys)
+        self.assertEqual([], t._activity)
+
+    def test_missing_bloom_filter(self):
+        nodes = self.make_nodes(300, 1, 0)
+        t, index = self.make_index_with_bloom(nodes)
+        t.delete('index.bloom')
+        self.assertEqual([(index,) + nodes[0][:2]],
+                         list(index.iter_entries([nodes[0][0]])))
+        self.assertIs(None, index._get_bloom_filter())
+
+
 class TestMultiBisectRight(tests.TestCase):
 
     def assertMultiBisectRight(self, offsets, search_keys, fixed_keys):
@@ -0,0 +1,150 @@
+# Copyright (C) 2017 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the repository checker."""
+
+from bzrlib import (
+    check,
+    config,
+    osutils,
+    tests,
+    vf_repository,
+    )
+
+
+class TestPendingKeys(tests.TestCase):
+
+    def make_items(self):
+        return [
+            (('inventories', 'rev-1'), ('inventory', 'inv-sha', 'rev-1')),
+            (('texts', 'a-id', 'rev-1'), ('text', 'a-sha', 'rev-1')),
+            (('texts', 'b-id', 'rev-1'), ('text', None, 'rev-1')),
+            (('texts', 'c-id', 'rev-2'), ('text', 'c-sha', 'rev-2')),
+            ]
+
+    def check_pending_keys(self, pending):
+        items = self.make_items()
+        for key, item_data in items:
+            pending[key] = item_data
+        self.assertEqual(4, len(pending))
+        for key, item_data in items:
+            self.assertEqual(item_data, pending.get(key))
+            self.assertEqual(item_data, pending[key])
+        self.assertIs(None, pending.get(('texts', 'd-id', 'rev-1')))
+        self.assertRaises(KeyError, pending.__getitem__,
+                          ('texts', 'd-id', 'rev-1'))
+        self.assertEqual(sorted(key for key, item_data in items),
+                         sorted(pending))
+        self.assertEqual({('inventories', 'rev-1'):
+                          ('inventory', 'inv-sha', 'rev-1')},
+                         pending.other_items())
+        self.assertEqual(sorted((key[1:], item_data)
+                                for key, item_data in items[1:]),
+                         sorted(pending.iter_texts()))
+        batches = list(pending.iter_text_batches(2))
+        self.assertEqual([2, 1], map(len, batches))
+
+    def test_in_memory(self):
+        self.check_pending_keys(check._PendingKeys())
+
+    def test_spilled(self):
+        pending = check._PendingKeys(spill_at=2)
+        self.check_pending_keys(pending)
+        self.assertNotEqual([], pending._texts._backing_indices)
+
+    def test_spilled_bad_key(self):
+        pending = check._PendingKeys(spill_at=2)
+        pending[('texts', 'bad id', 'rev-1')] = ('text', 'sha', 'rev-1')
+        self.assertEqual(('text', 'sha', 'rev-1'),
+                         pending.get(('texts', 'bad id', 'rev-1')))
+        self.assertEqual([(('bad id', 'rev-1'), ('text', 'sha', 'rev-1'))],
+                         list(pending.iter_texts()))
+
+
+class TestCheckTexts(tests.TestCaseWithTransport):
+
+    def make_repository_with_texts(self, format='2a'):
+        tree = self.make_branch_and_tree('.', format=format)
+        self.build_tree_contents([('a', 'a text\n'), ('b', 'b text\n'),
+                                  ('c', 'c text\n')])
+        tree.add(['a', 'b', 'c'], ['a-id', 'b-id', 'c-id'])
+        tree.commit('one', rev_id='rev-1')
+        repo = tree.branch.repository
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        return repo
+
+    def check_texts(self, workers):
+        self.overrideAttr(vf_repository.VersionedFileRepository,
+                          '_check_batch_size', 2)
+        config.GlobalStack().set('check.workers', workers)
+        repo = self.make_repository_with_texts()
+        checker = check.VersionedFileCheck(repo)
+        pending = checker._new_pending_keys()
+        pending[('texts', 'a-id', 'rev-1')] = (
+            'text', osutils.sha_string('a text\n'), 'rev-1')
+        pending[('texts', 'b-id', 'rev-1')] = ('text', 'wrong', 'rev-1')
+        pending[('texts', 'c-id', 'rev-1')] = ('text', None, 'rev-1')
+        pending[('texts', 'd-id', 'rev-1')] = ('text', 'd-sha', 'rev-1')
+        repo._check_texts(checker, pending)
+        self.assertEqual([
+            "Missing texts {('d-id', 'rev-1')}",
+            "sha1 mismatch: ('b-id', 'rev-1') has sha1 %s expected wrong"
+            " referenced by rev-1" % osutils.sha_string('b text\n'),
+            "sha1 mismatch: ('c-id', 'rev-1') has sha1 %s expected None"
+            " referenced by rev-1" % osutils.sha_string('c text\n'),
+            ], sorted(checker._report_items))
+
+    def test_check_texts(self):
+        self.check_texts(1)
+
+    def test_check_texts_in_workers(self):
+        self.check_texts(2)
+
+    def test_hash_texts_failure(self):
+        repo = self.make_repository_with_texts()
+        self.overrideAttr(vf_repository, '_check_repository', None)
+        vf_repository._init_check_worker(repo)
+        self.assertEqual({('a-id', 'rev-1'): osutils.sha_string('a text\n')},
+            vf_repository._hash_texts([('a-id', 'rev-1'), ('d-id', 'rev-1')]))
+        # Errors are reported by the parent process
+        vf_repository._init_check_worker(None)
+        self.assertIs(None, vf_repository._hash_texts([('a-id', 'rev-1')]))
+
+    def check_repository(self, format):
+        repo = self.make_repository_with_texts(format)
+        default = repo.check(['rev-1'])
+        config.GlobalStack().set('check.workers', 2)
+        config.GlobalStack().set('check.memory_budget', 1024)
+        self.overrideAttr(vf_repository.VersionedFileRepository,
+                          '_check_batch_size', 2)
+        self.overrideAttr(vf_repository._VersionedFileChecker,
+                          '_batch_size', 2)
+        result = repo.check(['rev-1'])
+        self.assertEqual(2, result._spill_at)
+        self.assertEqual([], result._report_items)
+        self.assertEqual(default.checked_rev_cnt, result.checked_rev_cnt)
+        self.assertEqual(default.checked_weaves, result.checked_weaves)
+        self.assertEqual(default.inconsistent_parents,
+                         result.inconsistent_parents)
+        self.assertEqual(default.unreferenced_versions,
+                         result.unreferenced_versions)
+
+    def test_check_2a(self):
+        self.check_repository('2a')
+
+    def test_check_pack(self):
+        self.check_repository('pack-0.92')
@@ -16,12 +16,15 @@
 
 """Tests for maps built on a CHK versionedfiles facility."""
 
+import threading
+
 from bzrlib import (
     chk_map,
     errors,
     groupcompress,
     osutils,
     tests,
+    versionedfile,
     )
 from bzrlib.chk_map import (
     CHKMap,
@@ -334,6 +337,77 @@ class TestTestCaseWithExampleMaps(TestCaseWithExampleMaps):
             c_map._dump_tree())
 
 
+class TestPageCache(TestCaseWithStore):
+
+    def test_counters(self):
+        page_cache = chk_map.PageCache(max_size=100)
+        self.assertRaises(KeyError, page_cache.__getitem__, ('a',))
+        page_cache[('a',)] = 'x' * 40
+        self.assertEqual('x' * 40, page_cache[('a',)])
+        page_cache[('b',)] = 'y' * 40
+        page_cache[('c',)] = 'z' * 40
+        self.assertRaises(KeyError, page_cache.__getitem__, ('a',))
+        self.assertEqual((1, 2, 1), (page_cache.hits, page_cache.misses,
+                                     page_cache.evictions))
+        page_cache.clear()
+        self.assertEqual(1, page_cache.evictions)
+
+    def get_leaf_bytes(self, store):
+        c_map = CHKMap(store, None)
+        c_map.map(('a',), 'content')
+        key = c_map._save()
+        return key, chk_map._get_cache(store)[key]
+
+    def test_get_node(self):
+        store = self.get_chk_bytes()
+        key, bytes = self.get_leaf_bytes(store)
+        page_cache = chk_map.PageCache()
+        page_cache[key] = bytes
+        node = page_cache.get_node(key, chk_map._search_key_plain)
+        self.assertEqual({('a',): 'content'}, node._items)
+        self.assertIsNot(node,
+                         page_cache.get_node(key, chk_map._search_key_plain))
+        self.assertEqual({}, page_cache._nodes)
+
+    def test_get_node_cached(self):
+        store = self.get_chk_bytes()
+        key, bytes = self.get_leaf_bytes(store)
+        page_cache = chk_map.PageCache(cache_nodes=True)
+        page_cache[key] = bytes
+        node = page_cache.get_node(key, chk_map._search_key_plain)
+        node.map(store, ('b',), 'other')
+        self.assertEqual([key], page_cache._nodes.keys())
+        node = page_cache.get_node(key, chk_map._search_key_plain)
+        self.assertEqual({('a',): 'content'}, node._items)
+        self.assertEqual(key, node.key())
+        page_cache.clear()
+        self.assertEqual({}, page_cache._nodes)
+
+    def test_store_cache(self):
+        chk_map.clear_cache()
+        store = self.get_chk_bytes()
+        chk_map.set_page_cache(store, 1024 * 1024, cache_nodes=True)
+        page_cache = chk_map._get_cache(store)
+        self.assertIsNot(chk_map._get_cache(), page_cache)
+        key, bytes = self.get_leaf_bytes(store)
+        self.assertEqual([key], page_cache.keys())
+        self.assertRaises(KeyError, chk_map._get_cache().__getitem__, key)
+        hits = page_cache.hits
+        c_map = CHKMap(store, key)
+        self.assertEqual([(('a',), 'content')], list(c_map.iteritems()))
+        self.assertEqual(hits + 1, page_cache.hits)
+
+    def test_store_cache_per_thread(self):
+        store = self.get_chk_bytes()
+        chk_map.set_page_cache(store, 1024 * 1024)
+        caches = []
+        thread = threading.Thread(
+            target=lambda: caches.append(chk_map._get_cache(store)))
+        thread.start()
+        thread.join()
+        self.assertIsNot(chk_map._get_cache(store), caches[0])
+
+
 class TestMap(TestCaseWithStore):
 
     def assertHasABMap(self, chk_bytes):
@@ -2479,6 +2553,8 @@ class TestCHKMapDifference(TestCaseWithExampleMaps):
 
 class TestIterInterestingNodes(TestCaseWithExampleMaps):
 
+    prefetch = 0
+
     def get_map_key(self, a_dict, maximum_size=10):
         c_map = self.get_map(a_dict, maximum_size=maximum_size)
         return c_map.key()
@@ -2496,7 +2572,8 @@ class TestIterInterestingNodes(TestCaseWithExampleMaps):
         store = self.get_chk_bytes()
         store._search_key_func = chk_map._search_key_plain
         iter_nodes = chk_map.iter_interesting_nodes(store, interesting_keys,
-                                                    old_keys)
+                                                    old_keys,
+                                                    prefetch=self.prefetch)
         record_keys = []
         all_items = []
         for record, new_items in iter_nodes:
@@ -2826,3 +2903,91 @@ class TestIterInterestingNodes(TestCaseWithExampleMaps):
             [right, left, l_a_key, r_c_key],
             [(('abb',), 'changed left'), (('cbb',), 'changed right')],
             [left, right], [basis])
+
+
+    def test_missing_page(self):
+        store = self.get_chk_bytes()
+        store._search_key_func = chk_map._search_key_plain
+        c_map = self.make_two_deep_map()
+        c_map._ensure_root()
+        missing = sorted(c_map._root_node.refs())[0]
+        orig_get_record_stream = store.get_record_stream
+        def get_record_stream(keys, ordering, include_delta_closure):
+            for record in orig_get_record_stream(keys, ordering,
+                                                 include_delta_closure):
+                if record.key == missing:
+                    record = versionedfile.AbsentContentFactory(missing)
+                yield record
+        store.get_record_stream = get_record_stream
+        self.assertRaises(errors.NoSuchRevision, list,
+            chk_map.iter_interesting_nodes(store, [c_map.key()], [],
+                                           prefetch=self.prefetch))
+
+    def test_pages_read_once(self):
+        store = self.get_chk_bytes()
+        c_map = self.make_two_deep_map()
+        key1 = c_map.key()
+        c_map.map(('aaa',), 'new aaa content')
+        key2 = c_map._save()
+        c_map.map(('ccc',), 'new ccc content')
+        key3 = c_map._save()
+        requested = []
+        orig_get_record_stream = store.get_record_stream
+        def get_record_stream(keys, ordering, include_delta_closure):
+            requested.extend(keys)
+            return orig_get_record_stream(keys, ordering,
+                                          include_delta_closure)
+        store.get_record_stream = get_record_stream
+        diff = chk_map.CHKMapDifference(store, [key2, key3], [key1],
+            chk_map._search_key_plain, prefetch=self.prefetch)
+        records = [record.key for record, items in diff.process()
+                   if record is not None]
+        self.assertEqual(len(set(requested)), len(requested))
+        self.assertEqual(len(requested), diff.pages_read)
+        self.assertEqual(len(set(records)), len(records))
+        self.assertEqual(len(records), diff.new_pages)
+
+
+class TestIterInterestingNodesPrefetching(TestIterInterestingNodes):
+
+    prefetch = 2
+
+    def setUp(self):
+        super(TestIterInterestingNodesPrefetching, self).setUp()
+        # Small batches make the next level requested before the current
+        # one is fully read.
+        self.overrideAttr(chk_map, '_PREFETCH_BATCH_SIZE', 2)
+
+    def test_records_consumed_while_reading(self):
+        store = self.get_chk_bytes()
+        store._search_key_func = chk_map._search_key_plain
+        c_map = self.make_two_deep_map()
+        c_map._ensure_root()
+        main_thread = threading.currentThread()
+        store_threads = []
+        consumed = threading.Event()
+        waited = []
+        orig_get_record_stream = store.get_record_stream
+        def get_record_stream(keys, ordering, include_delta_closure):
+            thread = threading.currentThread()
+            if thread is not main_thread and thread in store_threads:
+                # Only read the next pages once a new page is used
+                waited.append(consumed.wait(10))
+            store_threads.append(thread)
+            for record in orig_get_record_stream(keys, ordering,
+                                                 include_delta_closure):
+                yield record
+        store.get_record_stream = get_record_stream
+        records = []
+        for record, items in chk_map.iter_interesting_nodes(store,
+                [c_map.key()], [], prefetch=self.prefetch):
+            if record is None:
+                continue
+            # The records don't share anything with the store
+            self.assertEqual('fulltext', record.storage_kind)
+            records.append(record.get_bytes_as('fulltext'))
+            consumed.set()
+        self.assertNotEqual([], waited)
+        self.assertTrue(all(waited))
+        # Without old pages to filter out, every page is read by the thread
+        self.assertFalse(main_thread in store_threads)
@@ -20,6 +20,7 @@ import os
 import tempfile
 
 from bzrlib import (
+    config,
     controldir,
     dirstate,
     errors,
@@ -1400,6 +1401,90 @@ class TestDirStateHashUpdates(TestCaseWithDirState):
                          state._dirblock_state)
         self.assertEqual(0, len(state._known_hash_changes))
 
+    def make_journaled_state(self):
+        config.GlobalStack().set('dirstate.journal', True)
+        tree = self.make_branch_and_tree('.')
+        self.build_tree(['c', 'd'])
+        tree.lock_write()
+        tree.add(['c', 'd'], ['c-id', 'd-id'])
+        tree.commit('add c and d')
+        path = tree.current_dirstate()._filename
+        tree.unlock()
+        return self.open_journaled_state(path)
+
+    def open_journaled_state(self, path):
+        state = InstrumentedDirState.on_file(path)
+        state.lock_write()
+        state._read_dirblocks_if_needed()
+        state.adjust_time(+20) # Allow things to be cached
+        return state
+
+    def test_journal_appends_hash_changes(self):
+        state = self.make_journaled_state()
+        content = self._read_state_content(state)
+        self.do_update_entry(state, 'c')
+        state.save()
+        self.assertEqual(dirstate.DirState.IN_MEMORY_UNMODIFIED,
+                         state._dirblock_state)
+        self.assertEqual(content, self._read_state_content(state))
+        self.assertPathExists(state._journal_filename)
+        details = state._get_entry(0, path_utf8='c')[1][0]
+        self.assertEqual('f', details[0])
+        self.assertNotEqual(dirstate.DirState.NULLSTAT, details[4])
+        state.unlock()
+        state = dirstate.DirState.on_file(state._filename)
+        state.lock_read()
+        self.addCleanup(state.unlock)
+        self.assertEqual(details, state._get_entry(0, path_utf8='c')[1][0])
+
+    def test_journal_rewritten_past_limit(self):
+        self.overrideAttr(dirstate.DirState, 'MAX_JOURNAL_FRACTION', 0)
+        state = self.make_journaled_state()
+        self.addCleanup(state.unlock)
+        content = self._read_state_content(state)
+        self.do_update_entry(state, 'c')
+        state.save()
+        self.assertEqual(content, self._read_state_content(state))
+        self.do_update_entry(state, 'd')
+        state.save()
+        self.assertNotEqual(content, self._read_state_content(state))
+        self.assertPathDoesNotExist(state._journal_filename)
+
+    def test_journal_incomplete_chunk(self):
+        # The dirstate of the test is smaller than the journal
+        self.overrideAttr(dirstate.DirState, 'MAX_JOURNAL_FRACTION', 10)
+        state = self.make_journaled_state()
+        self.do_update_entry(state, 'c')
+        state.save()
+        details = state._get_entry(0, path_utf8='c')[1][0]
+        state.unlock()
+        # An interrupted save
+        with open(state._journal_filename, 'ab') as f:
+            f.write('100 42\nc\0')
+        state = self.open_journaled_state(state._filename)
+        self.addCleanup(state.unlock)
+        self.assertEqual(details, state._get_entry(0, path_utf8='c')[1][0])
+        self.do_update_entry(state, 'd')
+        state.save()
+        with open(state._journal_filename, 'rb') as f:
+            journal = f.read()
+        self.assertFalse('100 42\n' in journal)
+        self.assertTrue('\0d\0d-id\0' in journal)
+
+    def test_journal_for_other_content(self):
+        state = self.make_journaled_state()
+        details = state._get_entry(0, path_utf8='c')[1][0]
+        self.do_update_entry(state, 'c')
+        state.save()
+        state.unlock()
+        with open(state._journal_filename, 'rb') as f:
+            journal = f.read()
+        with open(state._journal_filename, 'wb') as f:
+            f.write(journal.replace('crc32: ', 'crc32: 1', 1))
+        state = self.open_journaled_state(state._filename)
+        self.addCleanup(state.unlock)
+        self.assertEqual(details, state._get_entry(0, path_utf8='c')[1][0])
+
 
 class TestGetLines(TestCaseWithDirState):
 
@@ -2097,6 +2182,13 @@ class TestBisect(TestCaseWithDirState):
              ['b/d/e', 'b/d/e2'],
             ], state, ['', 'b', 'b/d'])
 
+    def test_bisect_dirblocks_unsorted_paths(self):
+        tree, state, expected = self.create_basic_dirstate()
+        # 'b-c' sorts before 'b/d' as a string, but after it in the file
+        self.assertBisectDirBlocks(expected,
+            [['b/c', 'b/d'], ['b/d/e'], None],
+            state, ['b', 'b/d', 'b-c'])
+
     def test_bisect_dirblocks_missing(self):
         tree, state, expected = self.create_basic_dirstate()
         self.assertBisectDirBlocks(expected, [['b/d/e'], None],
@@ -2148,6 +2240,67 @@ class TestBisect(TestCaseWithDirState):
                                    state, ['b'])
 
 
+class TestLazyRead(TestCaseWithDirState):
+    """Test reading only the dirblocks needed for some paths."""
+
+    def create_lazy_dirstate(self, create=None):
+        config.GlobalStack().set('dirstate.lazy_read', True)
+        if create is None:
+            create = self.create_basic_dirstate
+        tree, state, expected = create()
+        full = dirstate.DirState.on_file('dirstate')
+        full.lock_read()
+        try:
+            full._read_dirblocks_if_needed()
+            full_dirblocks = full._dirblocks
+        finally:
+            full.unlock()
+        return state, full_dirblocks
+
+    def test_read_file_path(self):
+        state, full_dirblocks = self.create_lazy_dirstate()
+        state._read_dirblocks_for_paths(set(['b/c']))
+        self.assertEqual(set(['', 'b']), state._loaded_dirnames)
+        self.assertEqual(['', '', 'b'], [d for d, _ in state._dirblocks])
+        self.assertEqual(full_dirblocks[1], state._dirblocks[1])
+        self.assertEqual(('b', 'c', 'c-id'), state._get_entry(0,
+            path_utf8='b/c')[0])
+        # Nothing else was needed
+        self.assertEqual(set(['', 'b']), state._loaded_dirnames)
+
+    def test_read_directory_path(self):
+        state, full_dirblocks = self.create_lazy_dirstate()
+        state._read_dirblocks_for_paths(set(['b']))
+        self.assertEqual(set(['', 'b', 'b/d']), state._loaded_dirnames)
+        self.assertEqual(['', '', 'b', 'b/d'],
+                         [d for d, _ in state._dirblocks])
+
+    def test_read_remaining_dirblocks(self):
+        state, full_dirblocks = self.create_lazy_dirstate()
+        state._read_dirblocks_for_paths(set(['b/d/e']))
+        e_block = state._dirblocks[-1][1]
+        state._read_dirblocks_if_needed()
+        self.assertIs(None, state._loaded_dirnames)
+        self.assertIs(None, state._state_map)
+        self.assertEqual(full_dirblocks, state._dirblocks)
+        # The entries already read are kept
+        self.assertIs(e_block, state._dirblocks[-1][1])
+
+    def test_read_renamed_path(self):
+        state, full_dirblocks = self.create_lazy_dirstate(
+            self.create_renamed_dirstate)
+        state._read_dirblocks_for_paths(set(['b']))
+        self.assertIs(None, state._loaded_dirnames)
+        self.assertEqual(full_dirblocks, state._dirblocks)
+
+    def test_read_without_option(self):
+        state, full_dirblocks = self.create_lazy_dirstate()
+        config.GlobalStack().set('dirstate.lazy_read', False)
+        state._read_dirblocks_for_paths(set(['b/c']))
+        self.assertIs(None, state._loaded_dirnames)
+        self.assertEqual(full_dirblocks, state._dirblocks)
+
+
 class TestDirstateValidation(TestCaseWithDirState):
 
     def test_validate_correct_dirstate(self):
@@ -2437,6 +2590,45 @@ class TestSHA1Provider(tests.TestCaseInTempDir):
         self.assertEqual(len(text), statvalue.st_size)
         self.assertEqual(expected_sha, sha1)
 
+    def make_prefetching_provider(self):
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(2)
+        self.addCleanup(pool.join)
+        self.addCleanup(pool.terminate)
+        provider = dirstate.DefaultSHA1Provider()
+        return dirstate._PrefetchingSHA1Provider(provider, provider.sha1, pool)
+
+    def test_prefetching_provider(self):
+        self.build_tree_contents([('foo', 'foo text'), ('bar', 'bar text')])
+        p = self.make_prefetching_provider()
+        p.prefetch(['foo', 'bar'])
+        statvalue, sha1 = p.stat_and_sha1('foo')
+        self.assertEqual(osutils.sha_string('foo text'), sha1)
+        self.assertEqual(len('foo text'), statvalue.st_size)
+        self.assertEqual(osutils.sha_string('bar text'), p.sha1('bar'))
+        self.assertEqual({}, p._pending)
+
+    def test_prefetching_provider_not_prefetched(self):
+        self.build_tree_contents([('foo', 'foo text')])
+        p = self.make_prefetching_provider()
+        self.assertEqual(osutils.sha_string('foo text'), p.sha1('foo'))
+        self.assertEqual(osutils.sha_string('foo text'),
+                         p.stat_and_sha1('foo')[1])
+
+    def test_prefetching_provider_missing_file(self):
+        p = self.make_prefetching_provider()
+        p.prefetch(['missing'])
+        # The error is raised by the wrapped provider
+        self.assertRaises(IOError, p.stat_and_sha1, 'missing')
+
+    def test_prefetching_provider_discard(self):
+        self.build_tree_contents([('foo', 'foo text')])
+        p = self.make_prefetching_provider()
+        p.prefetch(['foo'])
+        p.discard()
+        self.assertEqual({}, p._pending)
+        self.assertEqual(osutils.sha_string('foo text'), p.sha1('foo'))
+
 
 class _Repo(object):
     """A minimal api to get InventoryRevisionTree to work."""
@@ -17,18 +17,27 @@
 """Tests for bzrlib.export."""
 
 from cStringIO import StringIO
+import gzip
+from multiprocessing.pool import ThreadPool
 import os
 import tarfile
 import time
 import zipfile
 
 from bzrlib import (
+    config,
     errors,
     export,
     tests,
     )
-from bzrlib.export import get_root_name
-from bzrlib.export.tar_exporter import export_tarball_generator
+from bzrlib.export import (
+    _export_iter_entries_and_chunks,
+    get_root_name,
+    )
+from bzrlib.export.tar_exporter import (
+    _ParallelGzipFile,
+    export_tarball_generator,
+    )
 from bzrlib.tests import features
 
 
@@ -261,6 +270,81 @@ class TarExporterTests(tests.TestCaseWithTransport):
         self.addCleanup(ball2.close)
         self.assertEqual(["bar/a"], ball2.getnames())
 
+    def test_tgz_compress_workers(self):
+        wt = self.make_branch_and_tree('.')
+        self.build_tree_contents([('a', 'a text\n' * 1000), ('b/',),
+                                  ('b/c', 'c text\n')])
+        wt.add(['a', 'b', 'b/c'])
+        wt.commit("1")
+        config.GlobalStack().set('export.compress_workers', 3)
+        export.export(wt, 'target.tar.gz', format="tgz")
+        tf = tarfile.open('target.tar.gz')
+        self.addCleanup(tf.close)
+        self.assertEqual(["target/a", "target/b", "target/b/c"],
+                         tf.getnames())
+        self.assertEqual('a text\n' * 1000, tf.extractfile('target/a').read())
+        self.assertEqual('c text\n', tf.extractfile('target/b/c').read())
+
+
+class ParallelGzipFileTests(tests.TestCase):
+
+    def make_gzip_file(self, fileobj, block_size):
+        pool = ThreadPool(2)
+        self.addCleanup(pool.join)
+        self.addCleanup(pool.terminate)
+        return _ParallelGzipFile('foo.gz', fileobj, 42, pool, 2,
+                                 block_size=block_size)
+
+    def test_blocks(self):
+        out = StringIO()
+        gz = self.make_gzip_file(out, 10)
+        text = ''.join(['line %d\n' % i for i in range(100)])
+        gz.write(text[:15])
+        gz.write(text[15:])
+        gz.close()
+        self.assertEqual(text,
+                         gzip.GzipFile(fileobj=StringIO(out.getvalue())).read())
+
+    def test_header(self):
+        out = StringIO()
+        gz = self.make_gzip_file(out, 10)
+        gz.write('text')
+        gz.close()
+        expected = StringIO()
+        ref = gzip.GzipFile('foo.gz', 'w', fileobj=expected, mtime=42)
+        ref.write('text')
+        ref.close()
+        # The header and the trailer are the ones gzip writes
+        self.assertEqual(expected.getvalue()[:14], out.getvalue()[:14])
+        self.assertEqual(expected.getvalue()[-8:], out.getvalue()[-8:])
+
+    def test_empty(self):
+        out = StringIO()
+        self.make_gzip_file(out, 10).close()
+        self.assertEqual('',
+                         gzip.GzipFile(fileobj=StringIO(out.getvalue())).read())
+
+
+class ExportIterEntriesTests(tests.TestCaseWithTransport):
+
+    def test_iter_entries_and_chunks(self):
+        wt = self.make_branch_and_tree('.')
+        self.build_tree_contents([('a', 'a text'), ('b/',),
+                                  ('b/c', 'c text'), ('d', 'd text')])
+        wt.add(['a', 'b', 'b/c', 'd'])
+        wt.commit("1")
+        tree = wt.basis_tree()
+        tree.lock_read()
+        self.addCleanup(tree.unlock)
+        result = [(final_path, path, entry.kind,
+                   chunks and ''.join(chunks))
+                  for final_path, path, entry, chunks in
+                  _export_iter_entries_and_chunks(tree, None, batch_files=2)]
+        self.assertEqual([('a', 'a', 'file', 'a text'),
+                          ('b', 'b', 'directory', None),
+                          ('d', 'd', 'file', 'd text'),
+                          ('b/c', 'b/c', 'file', 'c text')], result)
+
 
 class ZipExporterTests(tests.TestCaseWithTransport):
 
@@ -0,0 +1,196 @@
+# Copyright (C) 2017 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the index of the generation numbers of revisions."""
+
+from bzrlib import (
+    config,
+    generation_index,
+    graph as _mod_graph,
+    tests,
+    )
+from bzrlib.revision import NULL_REVISION
+
+
+#   A
+#   |\
+#   B C
+#   |/|
+#   D E
+#   |
+#   F   G (ghost parent X)
+ancestry = {'A': (NULL_REVISION,), 'B': ('A',), 'C': ('A',),
+            'D': ('B', 'C'), 'E': ('C',), 'F': ('D',), 'G': ('X',)}
+
+
+class TestGenerationIndex(tests.TestCaseWithMemoryTransport):
+
+    def make_index(self):
+        return generation_index.GenerationIndex(self.get_transport())
+
+    def make_provider(self):
+        return _mod_graph.DictParentsProvider(ancestry)
+
+    def test_records(self):
+        index = self.make_index()
+        index.update(self.make_provider(), ['F'])
+        index.update(self.make_provider(), ['E', 'G'])
+        generations = index.get_generations('ABCDEFG')
+        self.assertEqual(dict(A=1, B=2, C=2, D=3, E=3, F=4),
+                         dict((r, g) for r, (g, c) in generations.items()))
+        # The left-hand ancestry of F is a chain, C and E are on another
+        chains = dict((r, c) for r, (g, c) in generations.items())
+        self.assertEqual(set([chains['A']]),
+                         set([chains['B'], chains['D'], chains['F']]))
+        self.assertEqual(chains['C'], chains['E'])
+        self.assertNotEqual(chains['A'], chains['C'])
+        self.assertEqual(set(['G']), index.ghosted)
+
+    def test_load(self):
+        self.make_index().update(self.make_provider(), ['D'])
+        index = self.make_index()
+        index.load()
+        self.assertEqual(set('ABCD'), set(index.revisions))
+        # Only the missing revisions are added, extending the chains
+        index.update(self.make_provider(), ['E', 'F'])
+        loaded = self.make_index()
+        loaded.load()
+        self.assertEqual(index.revisions, loaded.revisions)
+        self.assertEqual(loaded.revisions['D'][1], loaded.revisions['F'][1])
+        self.assertEqual(loaded.revisions['C'][1], loaded.revisions['E'][1])
+
+    def test_load_new_records(self):
+        index = self.make_index()
+        index.load()
+        self.make_index().update(self.make_provider(), ['B'])
+        index.load()
+        self.assertEqual(set('AB'), set(index.revisions))
+        self.make_index().update(self.make_provider(), ['C'])
+        index.load()
+        self.assertEqual(set('ABC'), set(index.revisions))
+
+    def test_absent_revisions_not_recorded(self):
+        index = self.make_index()
+        index.update(self.make_provider(), ['A', 'ghost'])
+        self.assertEqual(set(['A']), set(index.revisions))
+        self.assertEqual(set(), index.ghosted)
+
+    def test_corrupt_records_ignored(self):
+        transport = self.get_transport()
+        transport.put_bytes('generation-index', 'Bazaar generation index v1\n'
+                            'A\x001\x00\x00\n'
+                            'B\x00x\x00A\x00\n'
+                            'G\x00-\x00\x00\n'
+                            'C\x002\x00A')
+        index = self.make_index()
+        index.load()
+        # C was still being written
+        self.assertEqual({'A': (1, 0)}, index.revisions)
+        self.assertEqual(set(['G']), index.ghosted)
+        index.update(self.make_provider(), ['C'])
+        loaded = self.make_index()
+        loaded.load()
+        self.assertEqual(set(['A', 'C']), set(loaded.revisions))
+        self.assertEqual((2, 0), loaded.revisions['C'])
+
+    def test_interleaved_updates(self):
+        # Two writers which don't see each other's records before appending
+        # theirs, as happens if they don't hold the repository lock
+        index = self.make_index()
+        index.update(self.make_provider(), ['A'])
+        other = self.make_index()
+        other.load()
+        other.load = lambda: None
+        index.update(self.make_provider(), ['B'])
+        other.update(self.make_provider(), ['E'])
+        loaded = self.make_index()
+        loaded.load()
+        self.assertEqual(set('ABCE'), set(loaded.revisions))
+        # B and C both have A as left-hand parent, only B continues its chain
+        self.assertEqual(loaded.revisions['A'][1], loaded.revisions['B'][1])
+        self.assertNotEqual(loaded.revisions['B'][1],
+                            loaded.revisions['C'][1])
+        self.assertEqual(loaded.revisions['C'][1], loaded.revisions['E'][1])
+        graph = _mod_graph.Graph(self.make_provider(),
+                                 generation_index=loaded)
+        self.assertFalse(graph.is_ancestor('B', 'E'))
+        self.assertTrue(graph.is_ancestor('A', 'E'))
+
+    def test_duplicate_records_ignored(self):
+        transport = self.get_transport()
+        transport.put_bytes('generation-index', 'Bazaar generation index v1\n'
+                            'A\x001\x00\x00\n'
+                            'B\x002\x00A\x00\n'
+                            'B\x002\x00A\x00\n'
+                            'C\x002\x00A\x00\n')
+        index = self.make_index()
+        index.load()
+        self.assertEqual(index.revisions['A'][1], index.revisions['B'][1])
+        self.assertNotEqual(index.revisions['B'][1], index.revisions['C'][1])
+
+    def test_unknown_format_ignored(self):
+        self.get_transport().put_bytes('generation-index',
+                                       'Bazaar generation index v2\n'
+                                       'A\x001\x00\x00\n')
+        index = self.make_index()
+        index.load()
+        self.assertEqual({}, index.revisions)
+
+
+class TestRepositoryGenerationIndex(tests.TestCaseWithTransport):
+
+    def test_commit_updates_index(self):
+        config.GlobalStack().set('repository.generation_index', True)
+        tree = self.make_branch_and_tree('.')
+        tree.commit('one', rev_id='rev-1')
+        other = tree.bzrdir.sprout('other').open_workingtree()
+        tree.commit('two', rev_id='rev-2')
+        other.commit('three', rev_id='rev-3')
+        tree.merge_from_branch(other.branch)
+        tree.commit('four', rev_id='rev-4')
+        repo = tree.branch.repository
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        index = generation_index.index_for_repository(repo)
+        self.assertEqual({'rev-1': (1, 0), 'rev-2': (2, 0), 'rev-3': (2, 1),
+                          'rev-4': (3, 0)}, index.revisions)
+        graph = repo.get_graph()
+        self.assertIsNot(None, graph._generation_index)
+        self.assertTrue(graph.is_ancestor('rev-3', 'rev-4'))
+        self.assertFalse(graph.is_ancestor('rev-2', 'rev-3'))
+        self.assertEqual(set(['rev-4']), graph.heads(['rev-1', 'rev-3',
+                                                      'rev-4']))
+
+    def test_update_holds_physical_lock(self):
+        config.GlobalStack().set('repository.generation_index', True)
+        tree = self.make_branch_and_tree('.')
+        repo = tree.branch.repository
+        lock_status = []
+        original_update = generation_index.GenerationIndex.update
+        def update(index, parents_provider, revision_ids):
+            lock_status.append(repo.get_physical_lock_status())
+            return original_update(index, parents_provider, revision_ids)
+        self.overrideAttr(generation_index.GenerationIndex, 'update', update)
+        tree.commit('one')
+        self.assertEqual([True], lock_status)
+        self.assertFalse(repo.get_physical_lock_status())
+
+    def test_no_index_without_option(self):
+        tree = self.make_branch_and_tree('.')
+        tree.commit('one')
+        repo = tree.branch.repository
+        self.assertFalse(repo.control_transport.has('generation-index'))
+        self.assertIs(None, repo.get_graph()._generation_index)
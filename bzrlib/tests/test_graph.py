@@ -16,6 +16,7 @@
 
 from bzrlib import (
     errors,
+    generation_index,
     graph as _mod_graph,
     tests,
     )
@@ -1248,6 +1249,52 @@ class TestGraph(TestCaseWithMemoryTransport):
             state)
 
 
+class TestGraphWithGenerationIndex(TestGraph):
+    """Run the graph tests with the generations of the ancestry known."""
+
+    def make_graph(self, ancestors):
+        parents_provider = _mod_graph.DictParentsProvider(ancestors)
+        index = generation_index.GenerationIndex(self.get_transport())
+        index.update(parents_provider, ancestors)
+        return _mod_graph.Graph(parents_provider, generation_index=index)
+
+    def make_counting_graph(self, ancestors):
+        graph = self.make_graph(ancestors)
+        provider = InstrumentedParentsProvider(graph._parents_provider)
+        return (_mod_graph.Graph(provider,
+                                 generation_index=graph._generation_index),
+                provider)
+
+    def test_is_ancestor_same_chain(self):
+        graph, provider = self.make_counting_graph(ancestry_1)
+        self.assertTrue(graph.is_ancestor('rev1', 'rev4'))
+        self.assertFalse(graph.is_ancestor('rev4', 'rev1'))
+        # rev2b has the same generation as rev2a
+        self.assertFalse(graph.is_ancestor('rev2b', 'rev2a'))
+        self.assertEqual([], provider.calls)
+        # rev2b is not on the chain of rev3, this needs a search
+        self.assertFalse(graph.is_ancestor('rev2b', 'rev3'))
+        self.assertEqual(['rev3'], provider.calls)
+
+    def test_heads_pruned_by_generation(self):
+        graph, provider = self.make_counting_graph(ancestry_1)
+        self.assertEqual(set(['rev3', 'rev2b']),
+                         graph.heads(['rev3', 'rev2b', 'rev1']))
+        # rev1 is on the chain of rev3, and the search from rev3 stops at
+        # the generation of rev2b
+        self.assertEqual(['rev3'], provider.calls)
+
+    def test_heads_with_ghosts(self):
+        graph, provider = self.make_counting_graph(with_ghost)
+        index = graph._generation_index
+        # d and c have the ghost g in their ancestry
+        self.assertEqual(set(['c', 'd']), index.ghosted)
+        self.assertEqual(set(['a']), graph.heads(['a', 'e']))
+        self.assertEqual([], provider.calls)
+        self.assertEqual(set(['c']), graph.heads(['c', 'e']))
+        self.assertEqual(set(['e', 'g']), graph.heads(['e', 'g']))
+
+
 class TestFindUniqueAncestors(TestGraphBase):
 
     def assertFindUniqueAncestors(self, graph, expected, node, common):
@@ -16,6 +16,7 @@
 
 """Tests for group compression."""
 
+import multiprocessing
 import zlib
 
 from bzrlib import (
@@ -788,6 +789,106 @@ class TestGroupCompressVersionedFiles(TestCaseWithGroupCompressVersionedFiles):
         self.assertEqual(0, len(vf._group_cache))
 
 
+class _InlineResult(object):
+
+    def __init__(self, value):
+        self._value = value
+
+    def get(self):
+        return self._value
+
+    def wait(self):
+        pass
+
+
+class _InlinePool(object):
+    """A stand-in for multiprocessing.Pool running tasks as they come."""
+
+    def __init__(self):
+        self.tasks = 0
+
+    def apply_async(self, func, args):
+        self.tasks += 1
+        return _InlineResult(func(*args))
+
+
+class TestExtractWorkers(TestCaseWithGroupCompressVersionedFiles):
+
+    def test_get_record_stream(self):
+        vf = self.make_test_vf(True, dir='source')
+        expected = {}
+        for group in range(3):
+            vf.insert_record_stream([
+                versionedfile.FulltextContentFactory(
+                    ('%d-%d' % (group, i),), (), None,
+                    'text %d %d\n' % (group, i) + 'common\n' * 10)
+                for i in range(5)])
+        vf.writer.end()
+        expected = dict((record.key, record.get_bytes_as('fulltext'))
+                        for record in vf.get_record_stream(vf.keys(),
+                            'unordered', True))
+        vf.set_extract_workers(2)
+        for ordering in ['unordered', 'topological', 'groupcompress']:
+            stream = vf.get_record_stream(vf.keys(), ordering, True)
+            self.assertEqual(expected, dict(
+                (record.key, record.get_bytes_as('fulltext'))
+                for record in stream))
+        self.assertEqual(2, vf.without_fallbacks()._extract_workers)
+
+
+class TestInsertRecordStreamInPool(TestCaseWithGroupCompressVersionedFiles):
+
+    def file_texts_stream(self):
+        for file_id in ['f1', 'f2', 'f3']:
+            parents = ()
+            for revision_id in ['a', 'b', 'c', 'd']:
+                key = (file_id, revision_id)
+                yield versionedfile.FulltextContentFactory(key, parents, None,
+                    'content of %s\nat revision %s\n' % key + 'common\n' * 20)
+                parents = (key,)
+
+    def insert_in_pool(self, dir, pool, max_pending=2, chunk_size=200):
+        vf = self.make_test_vf(True, keylength=2, dir=dir)
+        keys = list(vf._insert_record_stream_in_pool(self.file_texts_stream(),
+            pool, max_pending, chunk_size=chunk_size))
+        vf.writer.end()
+        return vf, keys
+
+    def block_bytes(self, vf, keys):
+        return [record._manager._block.to_bytes() for record in
+                vf.get_record_stream(keys, 'unordered', False)
+                if record.storage_kind == 'groupcompress-block']
+
+    def test_texts_are_inserted(self):
+        pool = _InlinePool()
+        vf, keys = self.insert_in_pool('target', pool)
+        expected = dict((record.key, record.get_bytes_as('fulltext'))
+                        for record in self.file_texts_stream())
+        self.assertEqual(sorted(expected), sorted(keys))
+        self.assertEqual(expected, dict(
+            (record.key, record.get_bytes_as('fulltext')) for record in
+            vf.get_record_stream(keys, 'unordered', True)))
+        self.assertEqual({('f1', 'b'): (('f1', 'a'),)},
+                         vf.get_parent_map([('f1', 'b')]))
+        # One chunk per file, as each is larger than chunk_size
+        self.assertEqual(3, pool.tasks)
+
+    def test_files_share_chunks_below_chunk_size(self):
+        pool = _InlinePool()
+        self.insert_in_pool('target', pool, chunk_size=2**20)
+        self.assertEqual(1, pool.tasks)
+
+    def test_independent_of_pool(self):
+        vf, keys = self.insert_in_pool('inline', _InlinePool(), max_pending=1)
+        expected = self.block_bytes(vf, keys)
+        self.assertEqual(3, len(expected))
+        pool = multiprocessing.Pool(2)
+        self.addCleanup(pool.join)
+        self.addCleanup(pool.terminate)
+        vf, keys = self.insert_in_pool('pool', pool, max_pending=4)
+        self.assertEqual(expected, self.block_bytes(vf, keys))
+
+
 class TestGroupCompressConfig(tests.TestCaseWithTransport):
 
     def make_test_vf(self):
@@ -936,6 +1037,57 @@ class Test_BatchingBlockFetcher(TestCaseWithGroupCompressVersionedFiles):
         self.assertEqual('groupcompress-block', factories[0].storage_kind)
 
 
+    def make_block(self, texts):
+        compressor = groupcompress.GroupCompressor()
+        offsets = {}
+        for key, text in texts:
+            _, start, end, _ = compressor.compress(key, text, None)
+            offsets[key] = (start, end)
+        return compressor.flush(), offsets
+
+    def make_extracting_batcher(self, extract_ahead_bytes):
+        block1, offsets1 = self.make_block([(('key1',), 'text one\n')])
+        block2, offsets2 = self.make_block([(('key2',), 'text two\n'),
+                                            (('key3',), 'text three\n')])
+        read_memo1 = ('fake index', 100, 50)
+        read_memo2 = ('fake index', 150, 40)
+        gcvf = StubGCVF(canned_get_blocks=[(read_memo1, block1),
+                                           (read_memo2, block2)])
+        locations = {
+            ('key1',): (read_memo1 + offsets1[('key1',)], None, (), None),
+            ('key2',): (read_memo2 + offsets2[('key2',)], None, (), None),
+            ('key3',): (read_memo2 + offsets2[('key3',)], None, (), None)}
+        pool = _InlinePool()
+        batcher = groupcompress._BatchingBlockFetcher(gcvf, locations,
+            extract_pool=pool, extract_ahead_bytes=extract_ahead_bytes)
+        for key in [('key1',), ('key2',), ('key3',)]:
+            batcher.add_key(key)
+        return batcher, pool
+
+    def test_yield_factories_extracts_ahead(self):
+        batcher, pool = self.make_extracting_batcher(2**20)
+        # The first block is being extracted, but is within the budget
+        self.assertEqual([], list(batcher.yield_factories()))
+        self.assertEqual(1, pool.tasks)
+        factories = list(batcher.yield_factories(full_flush=True))
+        self.assertEqual(2, pool.tasks)
+        self.assertEqual([('key1',), ('key2',), ('key3',)],
+                         [f.key for f in factories])
+
+    def test_yield_factories_extracted_texts(self):
+        batcher, pool = self.make_extracting_batcher(2**20)
+        texts = []
+        for factory in batcher.yield_factories(full_flush=True):
+            # Already extracted
+            texts.append(factory._bytes)
+        self.assertEqual(['text one\n', 'text two\n', 'text three\n'], texts)
+
+    def test_yield_factories_extract_budget(self):
+        batcher, pool = self.make_extracting_batcher(0)
+        factories = list(batcher.yield_factories())
+        self.assertEqual([('key1',)], [f.key for f in factories])
+
+
 class TestLazyGroupCompress(tests.TestCaseWithTransport):
 
     _texts = {
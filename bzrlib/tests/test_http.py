@@ -525,6 +525,116 @@ class TestHTTPConnections(http_utils.TestCaseWithWebserver):
             socket.setdefaulttimeout(default_timeout)
 
 
+class FakePooledConnection(object):
+
+    def __init__(self, pool_key, idle=True):
+        self.pool_key = pool_key
+        self.sock = object()
+        self.idle = idle
+        self.closed = False
+
+    def is_idle(self):
+        return self.idle
+
+    def close(self):
+        self.sock = None
+        self.closed = True
+
+
+class TestConnectionPool(tests.TestCase):
+
+    key = ('http', 'example.com', 80, None, None)
+
+    def test_disabled(self):
+        pool = _urllib2_wrappers.ConnectionPool(0, 30)
+        connection = FakePooledConnection(self.key)
+        pool.release(connection)
+        self.assertTrue(connection.closed)
+        self.assertIs(None, pool.get(self.key))
+
+    def test_reuse(self):
+        pool = _urllib2_wrappers.ConnectionPool(2, 30)
+        connection = FakePooledConnection(self.key)
+        pool.release(connection)
+        self.assertFalse(connection.closed)
+        self.assertIs(None, pool.get(('https',) + self.key[1:]))
+        self.assertIs(connection, pool.get(self.key))
+        self.assertIs(None, pool.get(self.key))
+
+    def test_max_per_host(self):
+        pool = _urllib2_wrappers.ConnectionPool(2, 30)
+        connections = [FakePooledConnection(self.key) for i in range(3)]
+        for connection in connections:
+            pool.release(connection)
+        # The oldest one is closed, the most recent is reused first
+        self.assertEqual([True, False, False],
+                         [c.closed for c in connections])
+        self.assertIs(connections[2], pool.get(self.key))
+        self.assertIs(connections[1], pool.get(self.key))
+
+    def test_idle_timeout(self):
+        pool = _urllib2_wrappers.ConnectionPool(2, -1)
+        connection = FakePooledConnection(self.key)
+        pool.release(connection)
+        self.assertIs(None, pool.get(self.key))
+        self.assertTrue(connection.closed)
+
+    def test_busy_connection_closed(self):
+        pool = _urllib2_wrappers.ConnectionPool(2, 30)
+        connection = FakePooledConnection(self.key, idle=False)
+        pool.release(connection)
+        self.assertTrue(connection.closed)
+        self.assertIs(None, pool.get(self.key))
+
+    def test_track(self):
+        class Owner(object):
+            pass
+        pool = _urllib2_wrappers.ConnectionPool(2, 30)
+        owner = Owner()
+        connection = FakePooledConnection(self.key)
+        pool.track(owner, connection)
+        self.assertIs(None, pool.get(self.key))
+        del owner
+        self.assertIs(connection, pool.get(self.key))
+
+    def test_untrack(self):
+        class Owner(object):
+            pass
+        pool = _urllib2_wrappers.ConnectionPool(2, 30)
+        owner = Owner()
+        connection = FakePooledConnection(self.key)
+        pool.track(owner, connection)
+        self.assertEqual([connection], pool.untrack(owner))
+        del owner
+        self.assertIs(None, pool.get(self.key))
+
+
+class TestConnectionPoolReuse(http_utils.TestCaseWithWebserver):
+    """Connections are shared between unrelated urllib transports."""
+
+    _protocol_version = 'HTTP/1.1'
+    _url_protocol = 'http+urllib'
+
+    def setUp(self):
+        super(TestConnectionPoolReuse, self).setUp()
+        self.pool = _urllib2_wrappers.ConnectionPool(2, 30)
+        self.overrideAttr(_urllib2_wrappers, 'connection_pool', self.pool)
+        self.addCleanup(self.pool.clear)
+        self.build_tree_contents([('a', 'contents of a\n')])
+
+    def test_disconnect_releases_connection(self):
+        t = self.get_readonly_transport()
+        self.assertEqual('contents of a\n', t.get_bytes('a'))
+        connection = t._get_connection()
+        t.disconnect()
+        other = transport.get_transport_from_url(t.base)
+        self.assertEqual('contents of a\n', other.get_bytes('a'))
+        self.assertIs(connection, other._get_connection())
+        # The disconnected transport gets a new one
+        self.assertEqual('contents of a\n', t.get_bytes('a'))
+        self.assertIsNot(connection, t._get_connection())
+
+
 class TestHttpTransportRegistration(tests.TestCase):
     """Test registrations of various http implementations"""
 
@@ -869,6 +979,24 @@ class TestRangeRequestServer(TestSpecificRequestHandler):
         # The server should have issued 3 requests
         self.assertEqual(3, server.GET_request_nb)
 
+    def test_readv_pipelined(self):
+        server = self.get_readonly_server()
+        t = self.get_readonly_transport()
+        # Spread the offsets over requests in flight at the same time
+        t._readv_window = 4
+        t._max_readv_combine = 1
+        l = list(t.readv('a', ((0, 1), (1, 1), (3, 2), (9, 1))))
+        self.assertEqual([(0, '0'), (1, '1'), (3, '34'), (9, '9')], l)
+        # The server should have issued 4 requests
+        self.assertEqual(4, server.GET_request_nb)
+
+    def test_readv_pipelined_out_of_order(self):
+        t = self.get_readonly_transport()
+        t._readv_window = 4
+        t._max_readv_combine = 1
+        l = list(t.readv('a', ((1, 1), (9, 1), (0, 1), (3, 2))))
+        self.assertEqual([(1, '1'), (9, '9'), (0, '0'), (3, '34')], l)
+
     def test_complete_readv_leave_pipe_clean(self):
         server = self.get_readonly_server()
         t = self.get_readonly_transport()
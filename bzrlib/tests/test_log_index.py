@@ -0,0 +1,128 @@
+# Copyright (C) 2017 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the index of the file ids touched by revisions."""
+
+import zlib
+
+from bzrlib import (
+    log_index,
+    tests,
+    )
+
+
+class TestLogIndex(tests.TestCaseWithMemoryTransport):
+
+    def make_repository_with_history(self):
+        builder = self.make_branch_builder('branch')
+        builder.start_series()
+        self.addCleanup(builder.finish_series)
+        builder.build_snapshot('A', None,
+            [('add', ('', 'root-id', 'directory', None)),
+             ('add', ('dir', 'dir-id', 'directory', None)),
+             ('add', ('dir/sub', 'sub-id', 'directory', None)),
+             ('add', ('dir/sub/file', 'file-id', 'file', 'content\n')),
+             ('add', ('other', 'other-id', 'file', 'content\n'))])
+        builder.build_snapshot('B', ['A'],
+            [('modify', ('file-id', 'new content\n'))])
+        builder.build_snapshot('C', ['A'],
+            [('modify', ('other-id', 'new content\n'))])
+        builder.build_snapshot('D', ['B', 'C'], [])
+        builder.build_snapshot('E', ['D'],
+            [('rename', ('dir', 'renamed'))])
+        repo = builder.get_branch().repository
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        return repo
+
+    def make_index(self):
+        return log_index.LogIndex(self.get_transport())
+
+    def test_records(self):
+        repo = self.make_repository_with_history()
+        index = self.make_index()
+        index.update(repo, ['A', 'B', 'C', 'D', 'E'])
+        self.assertEqual(set(['A', 'B', 'C', 'D', 'E']), index.revisions)
+        self.assertEqual(set(['A', 'B']),
+                         index.revisions_touching(['file-id']))
+        self.assertEqual(set(['A', 'B']), index.revisions_touching(['sub-id']))
+        self.assertEqual(set(['A', 'B', 'E']),
+                         index.revisions_touching(['dir-id']))
+        # D only differs from B by the merged changes of C
+        self.assertEqual(set(['A', 'C', 'D']),
+                         index.revisions_touching(['other-id']))
+        self.assertEqual(set(['A', 'B', 'E']),
+            index.revisions_touching(['sub-id'],
+                                     include_moved_directories=True))
+
+    def test_load(self):
+        repo = self.make_repository_with_history()
+        self.make_index().update(repo, ['B', 'C'])
+        index = self.make_index()
+        index.load()
+        self.assertEqual(set(['B', 'C']), index.revisions)
+        self.assertEqual(set(['B']), index.revisions_touching(['file-id']))
+        # Only the missing revisions are added
+        index.update(repo, ['A', 'B', 'C'])
+        index = self.make_index()
+        index.load()
+        self.assertEqual(set(['A', 'B', 'C']), index.revisions)
+
+    def test_absent_revisions_not_recorded(self):
+        repo = self.make_repository_with_history()
+        index = self.make_index()
+        index.update(repo, ['A', 'ghost'])
+        self.assertEqual(set(['A']), index.revisions)
+
+    def make_record(self, record):
+        return '%d %d %s\n' % (len(record), zlib.crc32(record), record)
+
+    def test_corrupt_records_ignored(self):
+        transport = self.get_transport()
+        transport.put_bytes('log-index', 'Bazaar log index v1\n'
+                            + self.make_record('A\x000\x00file-id')
+                            + self.make_record('B')
+                            + 'A\x000\x00file-id\n'
+                            + self.make_record('C\x001\x00dir-id')[:-1])
+        index = self.make_index()
+        index.load()
+        # C was still being written
+        self.assertEqual(set(['A']), index.revisions)
+
+    def test_interleaved_records_ignored(self):
+        transport = self.get_transport()
+        a_record = self.make_record('A\x000\x00file-id\x00other-id')
+        b_record = self.make_record('B\x000\x00file-id')
+        # A record torn by another process appending at the same time
+        transport.put_bytes('log-index', 'Bazaar log index v1\n'
+                            + a_record[:20] + b_record + a_record[20:])
+        index = self.make_index()
+        index.load()
+        self.assertEqual(set(), index.revisions)
+        repo = self.make_repository_with_history()
+        index.update(repo, ['A', 'B'])
+        index = self.make_index()
+        index.load()
+        self.assertEqual(set(['A', 'B']), index.revisions)
+        self.assertEqual(set(['A', 'B']),
+                         index.revisions_touching(['file-id']))
+
+    def test_unknown_format_ignored(self):
+        self.get_transport().put_bytes('log-index', 'Bazaar log index v2\n'
+                                       'A\x000\x00file-id\n')
+        index = self.make_index()
+        index.load()
+        self.assertEqual(set(), index.revisions)
@@ -3011,6 +3011,82 @@ class TestConfigurableFileMerger(tests.TestCaseWithTransport):
         self.assertEqual([], self.calls)
 
 
+class TestParallelTextMerge(tests.TestCaseWithTransport):
+
+    def setUp(self):
+        super(TestParallelTextMerge, self).setUp()
+        self.merged = []
+        orig = _mod_merge._ParallelTextMerger.get
+        def get(text_merger, file_id):
+            result = orig(text_merger, file_id)
+            if result is not None:
+                self.merged.append(file_id)
+            return result
+        self.overrideAttr(_mod_merge._ParallelTextMerger, 'get', get)
+
+    def make_trees(self):
+        """Make two copies of a tree, and a branch to merge into them.
+
+        Both sides change f0 to f5, at their beginning and end, f0 is
+        conflicted and bin is a binary file changed in both.
+        """
+        base_lines = ['line %d\n' % i for i in range(10)]
+        tree = self.make_branch_and_tree('this')
+        files = ['f%d' % i for i in range(6)]
+        self.build_tree_contents([('this/' + f, ''.join(base_lines))
+                                  for f in files + ['unchanged']]
+                                 + [('this/bin', 'a\0b\n')])
+        tree.add(files + ['unchanged', 'bin'],
+                 [f + '-id' for f in files + ['unchanged', 'bin']])
+        tree.commit('base')
+        other = tree.bzrdir.sprout('other').open_workingtree()
+        self.build_tree_contents([('other/' + f,
+                                   ''.join(base_lines[:-1] + ['other\n']))
+                                  for f in files] + [('other/bin', 'c\0\n')])
+        self.build_tree_contents([('other/f0', 'other\n')])
+        other.commit('other')
+        self.build_tree_contents([('this/' + f,
+                                   ''.join(['this\n'] + base_lines[1:]))
+                                  for f in files] + [('this/bin', 'd\0\n')])
+        tree.commit('this')
+        copy = tree.bzrdir.sprout('copy').open_workingtree()
+        return tree, copy, other
+
+    def merge(self, tree, other, workers):
+        tree.get_config_stack().set('merge.workers', workers)
+        conflicts = tree.merge_from_branch(other.branch)
+        t = tree.bzrdir.root_transport
+        return conflicts, [(f, t.get_bytes(f)) for f in sorted(t.list_dir('.'))
+                           if not f.startswith('.')]
+
+    def test_merge_with_workers(self):
+        tree, copy, other = self.make_trees()
+        expected = self.merge(copy, other, 1)
+        self.assertEqual([], self.merged)
+        self.assertEqual(expected, self.merge(tree, other, 3))
+        self.assertEqual(2, expected[0])
+        # Binary texts are rejected by the workers
+        self.assertEqual(['bin-id'] + ['f%d-id' % i for i in range(6)],
+                         sorted(self.merged))
+        self.assertEqual(['this\n', 'line 1\n'],
+                         tree.get_file_lines(tree.path2id('f1'))[:2])
+
+    def test_merge_hook_with_workers(self):
+        class F1Merger(_mod_merge.PerFileMerger):
+            def file_matches(self, params):
+                return self.get_filename(params, self.merger.this_tree) == 'f1'
+            def merge_matching(self, params):
+                return 'success', ['hooked\n']
+        _mod_merge.Merger.hooks.install_named_hook('merge_file_content',
+            F1Merger, 'test factory')
+        tree, copy, other = self.make_trees()
+        expected = self.merge(copy, other, 1)
+        self.assertEqual(expected, self.merge(tree, other, 3))
+        self.assertEqual('hooked\n', tree.get_file_text(tree.path2id('f1')))
+        self.assertEqual(['bin-id', 'f0-id', 'f2-id', 'f3-id', 'f4-id',
+                          'f5-id'], sorted(self.merged))
+
+
 class TestMergeIntoBase(tests.TestCaseWithTransport):
 
     def setup_simple_branch(self, relpath, shape=None, root_id=None):
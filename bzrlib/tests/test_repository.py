@@ -31,6 +31,7 @@ from bzrlib.errors import (
     )
 from bzrlib import (
     btree_index,
+    chk_map,
     symbol_versioning,
     tests,
     transport,
@@ -45,6 +46,7 @@ from bzrlib.tests import (
     )
 from bzrlib import (
     bzrdir,
+    config,
     controldir,
     errors,
     inventory,
@@ -479,6 +481,50 @@ class TestRepositoryConverter(TestCaseWithTransport):
         repo = repo_dir.open_repository()
         self.assertTrue(isinstance(target_format, repo._format.__class__))
 
+    def make_interrupted_conversion(self):
+        tree = self.make_branch_and_tree('.', format='pack-0.92')
+        revs = [tree.commit('one'), tree.commit('two'), tree.commit('three')]
+        repo_dir = tree.bzrdir
+        repo_dir.transport.move('repository', 'repository.backup')
+        backup_transport = repo_dir.transport.clone('repository.backup')
+        source = tree.branch.repository._format.open(repo_dir, _found=True,
+            _override_transport=backup_transport)
+        converted = groupcompress_repo.RepositoryFormat2a().initialize(
+            repo_dir)
+        # Only the first revision was copied
+        converted.fetch(source, revision_id=revs[0])
+        return repo_dir, revs
+
+    def test_resume(self):
+        repo_dir, revs = self.make_interrupted_conversion()
+        converter = repository.CopyConverter(
+            groupcompress_repo.RepositoryFormat2a())
+        pb = bzrlib.ui.ui_factory.nested_progress_bar()
+        try:
+            converter.resume(repo_dir, pb)
+        finally:
+            pb.finished()
+        self.assertFalse(repo_dir.transport.has('repository.backup'))
+        repo = repo_dir.open_repository()
+        self.assertIsInstance(repo._format,
+                              groupcompress_repo.RepositoryFormat2a)
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        self.assertEqual(set(revs), set(repo.get_parent_map(revs)))
+        repo.check([revs[-1]]).report_results(verbose=False)
+
+    def test_upgrade_resumes(self):
+        repo_dir, revs = self.make_interrupted_conversion()
+        format = controldir.format_registry.make_bzrdir('2a')
+        self.assertTrue(repo_dir.needs_format_conversion(format))
+        upgrade.upgrade('.', format)
+        repo_dir = bzrdir.BzrDir.open('.')
+        self.assertFalse(repo_dir.needs_format_conversion(format))
+        repo = repo_dir.open_repository()
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        self.assertEqual(set(revs), set(repo.get_parent_map(revs)))
+
 
 class TestRepositoryFormatKnit3(TestCaseWithTransport):
 
@@ -550,6 +596,91 @@ class Test2a(tests.TestCaseWithMemoryTransport):
         index = repo.chk_bytes._index._graph_index._indices[0]
         self.assertEqual(btree_index._gcchk_factory, index._leaf_factory)
 
+    def test_mmap_indices(self):
+        mt = self.make_branch_and_memory_tree('test', format='2a')
+        mt.lock_write()
+        self.addCleanup(mt.unlock)
+        mt.add([''], ['root-id'])
+        mt.commit('first')
+        repo = mt.branch.repository.bzrdir.open_repository()
+        repo._pack_collection.config_stack.set('repository.mmap_indices',
+                                               True)
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        index = repo.revisions._index._graph_index._indices[0]
+        self.assertIsInstance(index, btree_index.MMapBTreeGraphIndex)
+        index = repo.chk_bytes._index._graph_index._indices[0]
+        self.assertIsInstance(index, btree_index.MMapBTreeGraphIndex)
+        self.assertEqual(btree_index._gcchk_factory, index._leaf_factory)
+        self.assertEqual(['first'], [rev.message for rev in
+            repo.get_revisions(repo.all_revision_ids())])
+
+    def test_bloom_filters(self):
+        mt = self.make_branch_and_memory_tree('test', format='2a')
+        repo = mt.branch.repository
+        repo._pack_collection.config_stack.set('repository.bloom_filters',
+                                               True)
+        mt.lock_write()
+        self.addCleanup(mt.unlock)
+        mt.add([''], ['root-id'])
+        mt.commit('first', rev_id='first')
+        mt.commit('second', rev_id='second')
+        index_transport = repo._pack_collection._index_transport
+        blooms = [name for name in index_transport.list_dir('.')
+                  if name.endswith('.bloom')]
+        self.assertEqual(10, len(blooms))
+        repo.pack()
+        blooms = [name for name in index_transport.list_dir('.')
+                  if name.endswith('.bloom')]
+        self.assertEqual(5, len(blooms))
+        repo = repo.bzrdir.open_repository()
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        self.assertEqual({'second': ('first',)},
+            repo.get_parent_map(['second', 'missing']))
+        for index in repo.revisions._index._graph_index._indices:
+            self.assertIsNot(None, index._get_bloom_filter())
+
+    def test_bloom_filters_obsoleted_without_option(self):
+        mt = self.make_branch_and_memory_tree('test', format='2a')
+        repo = mt.branch.repository
+        config_stack = repo._pack_collection.config_stack
+        config_stack.set('repository.bloom_filters', True)
+        mt.lock_write()
+        self.addCleanup(mt.unlock)
+        mt.add([''], ['root-id'])
+        mt.commit('first', rev_id='first')
+        mt.commit('second', rev_id='second')
+        config_stack.set('repository.bloom_filters', False)
+        repo.pack()
+        index_transport = repo._pack_collection._index_transport
+        self.assertEqual([], [name for name in index_transport.list_dir('.')
+                              if name.endswith('.bloom')])
+
+    def test_pack_with_workers(self):
+        builder = self.make_branch_builder('source', format='2a')
+        builder.start_series()
+        builder.build_snapshot('1', None, [
+            ('add', ('', 'root-id', 'directory', '')),
+            ('add', ('file', 'file-id', 'file', 'content\n')),
+            ('add', ('other', 'other-id', 'file', 'other\n'))])
+        builder.build_snapshot('2', ['1'], [
+            ('modify', ('file-id', 'content-2\n'))])
+        builder.finish_series()
+        repo = builder.get_branch().repository
+        repo._pack_collection.config_stack.set('pack.workers', 2)
+        repo.lock_write()
+        self.addCleanup(repo.unlock)
+        repo.pack()
+        self.assertEqual(1, len(repo._pack_collection.packs))
+        self.assertEqual({('file-id', '1'): 'content\n',
+                          ('file-id', '2'): 'content-2\n',
+                          ('other-id', '1'): 'other\n'},
+            dict((record.key, record.get_bytes_as('fulltext'))
+                 for record in repo.texts.get_record_stream(
+                    [('file-id', '1'), ('file-id', '2'), ('other-id', '1')],
+                    'unordered', True)))
+
     def test_fetch_combines_groups(self):
         builder = self.make_branch_builder('source', format='2a')
         builder.start_series()
@@ -620,6 +751,18 @@ class Test2a(tests.TestCaseWithMemoryTransport):
         repo = self.make_repository('repo', format='2a')
         self.assertTrue(repo._format.pack_compresses)
 
+    def test_chk_page_cache_per_repository(self):
+        repo = self.make_repository('repo', format='2a')
+        self.assertIs(chk_map._get_cache(), chk_map._get_cache(repo.chk_bytes))
+        config_stack = repo._pack_collection.config_stack
+        config_stack.set('repository.chk_cache_size', '1MB')
+        config_stack.set('repository.chk_cache_nodes', True)
+        repo = repo.bzrdir.open_repository()
+        page_cache = chk_map._get_cache(repo.chk_bytes)
+        self.assertIsNot(chk_map._get_cache(), page_cache)
+        self.assertEqual(1000000, page_cache._max_size)
+        self.assertTrue(page_cache.cache_nodes)
+
     def test_inventories_use_chk_map_with_parent_base_dict(self):
         tree = self.make_branch_and_memory_tree('repo', format="2a")
         tree.lock_write()
@@ -1693,6 +1836,79 @@ class TestCrossFormatPacks(TestCaseWithTransport):
         self.run_fetch('2a', '2a', False)
 
 
+class TestInterDifferingSerializerWorkers(TestCaseWithTransport):
+
+    def make_source(self):
+        tree = self.make_branch_and_tree('source', format='pack-0.92')
+        self.build_tree(['source/dir/'])
+        tree.add(['dir'])
+        revs = []
+        for i in range(7):
+            self.build_tree_contents([('source/dir/file%d' % (i % 3),
+                                       'content %d\n' % i)])
+            if i < 3:
+                tree.add(['dir/file%d' % i])
+            revs.append(tree.commit('commit %d' % i))
+        tree.branch.repository.lock_read()
+        self.addCleanup(tree.branch.repository.unlock)
+        return tree.branch.repository, revs
+
+    def fetch(self, source, path, workers):
+        self.overrideAttr(vf_repository.InterDifferingSerializer,
+                          '_batch_size', 2)
+        config.GlobalStack().set('repository.convert_workers', workers)
+        target = self.make_repository(path, format='2a')
+        target.lock_write()
+        self.addCleanup(target.unlock)
+        inter = repository.InterRepository.get(source, target)
+        self.assertIsInstance(inter, vf_repository.InterDifferingSerializer)
+        inter.fetch()
+        return target
+
+    def test_fetch_in_workers(self):
+        source, revs = self.make_source()
+        serial = self.fetch(source, 'serial', 0)
+        parallel = self.fetch(source, 'parallel', 2)
+        self.assertEqual(serial.get_parent_map(revs),
+                         parallel.get_parent_map(revs))
+        for rev in revs:
+            self.assertEqual(serial.get_inventory(rev),
+                             parallel.get_inventory(rev))
+        text_keys = serial.texts.keys()
+        self.assertEqual(text_keys, parallel.texts.keys())
+        self.assertEqual(serial.texts.get_sha1s(text_keys),
+                         parallel.texts.get_sha1s(text_keys))
+        self.assertEqual(serial.texts.get_parent_map(text_keys),
+                         parallel.texts.get_parent_map(text_keys))
+
+    def test_get_convert_workers(self):
+        source, revs = self.make_source()
+        target = self.make_repository('target', format='2a')
+        inter = repository.InterRepository.get(source, target)
+        config.GlobalStack().set('repository.convert_workers', 3)
+        self.assertEqual(3, inter._get_convert_workers(revs, 2))
+        # A single batch is converted directly
+        self.assertEqual(0, inter._get_convert_workers(revs, 100))
+
+    def test_convert_batch_failure(self):
+        source, revs = self.make_source()
+        target = self.make_repository('target', format='2a')
+        inter = repository.InterRepository.get(source, target)
+        inter._converting_to_rich_root = True
+        inter._revision_id_to_root_id = {}
+        self.overrideAttr(vf_repository, '_convert_inter', None)
+        vf_repository._init_convert_worker(inter)
+        parent_map, analysis, text_blocks = vf_repository._convert_batch(
+            revs[1:3], revs[0], target.texts._get_compressor_settings())
+        self.assertEqual(revs[2], analysis[0])
+        self.assertEqual([revs[1], revs[2]],
+                         [delta[2] for delta in analysis[1]])
+        self.assertEqual(1, len(text_blocks))
+        # Errors are reported by the parent process
+        self.assertIs(None, vf_repository._convert_batch(['missing'], revs[0],
+                                                          None))
+
+
 class Test_LazyListJoin(tests.TestCase):
 
     def test__repr__(self):
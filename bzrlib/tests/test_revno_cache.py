@@ -0,0 +1,121 @@
+# Copyright (C) 2017 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the persistent revno cache of branches."""
+
+from bzrlib import (
+    revno_cache,
+    tests,
+    )
+
+
+class TestRevnoCache(tests.TestCaseWithMemoryTransport):
+
+    def make_branch_with_merges(self):
+        # A
+        # |\
+        # B C
+        # |/|
+        # D E
+        # |/
+        # F
+        builder = self.make_branch_builder('branch')
+        builder.start_series()
+        self.addCleanup(builder.finish_series)
+        builder.build_snapshot('A', None,
+            [('add', ('', 'root-id', 'directory', None))])
+        builder.build_snapshot('B', ['A'], [])
+        builder.build_snapshot('C', ['A'], [])
+        builder.build_snapshot('D', ['B', 'C'], [])
+        builder.build_snapshot('E', ['C'], [])
+        builder.build_snapshot('F', ['D', 'E'], [])
+        return builder.get_branch()
+
+    def full_merge_sort(self, branch, tip):
+        known_graph = branch.repository.get_known_graph_ancestry([tip])
+        return [(node.key, node.merge_depth, node.revno, node.end_of_merge)
+                for node in known_graph.merge_sort(tip)]
+
+    def as_tuples(self, nodes):
+        return [(node.key, node.merge_depth, node.revno, node.end_of_merge)
+                for node in nodes]
+
+    def test_not_used_by_default(self):
+        branch = self.make_branch_with_merges()
+        self.assertEqual((1, 1, 2), branch.revision_id_to_dotted_revno('E'))
+        self.assertFalse(branch._transport.has('revno-cache'))
+
+    def test_written_when_enabled(self):
+        branch = self.make_branch_with_merges()
+        branch.get_config_stack().set('branch.revno_cache', True)
+        self.assertEqual({'A': (1,), 'B': (2,), 'C': (1, 1, 1), 'D': (3,),
+                          'E': (1, 1, 2), 'F': (4,)},
+                         branch.get_revision_id_to_revno_map())
+        tip, nodes = revno_cache.RevnoCache(branch._transport).load()
+        self.assertEqual('F', tip)
+        self.assertEqual(self.full_merge_sort(branch, 'F'),
+                         self.as_tuples(nodes))
+
+    def test_save_load_roundtrip(self):
+        branch = self.make_branch_with_merges()
+        cache = revno_cache.RevnoCache(branch._transport)
+        self.assertIs(None, cache.load())
+        nodes = cache.merge_sort(branch.repository, 4, 'F')
+        tip, loaded = cache.load()
+        self.assertEqual('F', tip)
+        self.assertEqual(self.as_tuples(nodes), self.as_tuples(loaded))
+
+    def test_corrupt_cache_ignored(self):
+        branch = self.make_branch_with_merges()
+        branch._transport.put_bytes('revno-cache',
+                                    'Bazaar revno cache v1\ngarbage')
+        cache = revno_cache.RevnoCache(branch._transport)
+        self.assertIs(None, cache.load())
+        nodes = cache.merge_sort(branch.repository, 4, 'F')
+        self.assertEqual(self.full_merge_sort(branch, 'F'),
+                         self.as_tuples(nodes))
+
+    def test_extend_from_lefthand_ancestor(self):
+        branch = self.make_branch_with_merges()
+        repo = branch.repository
+        for base_revno, base_tip in [(1, 'A'), (2, 'B'), (3, 'D')]:
+            base_nodes = repo.get_known_graph_ancestry(
+                [base_tip]).merge_sort(base_tip)
+            nodes = revno_cache.extend_merge_sorted(repo, 4, 'F', base_nodes)
+            self.assertEqual(self.full_merge_sort(branch, 'F'),
+                             self.as_tuples(nodes))
+
+    def test_extend_from_non_lefthand_ancestor(self):
+        branch = self.make_branch_with_merges()
+        repo = branch.repository
+        base_nodes = repo.get_known_graph_ancestry(['E']).merge_sort('E')
+        self.assertIs(None,
+            revno_cache.extend_merge_sorted(repo, 4, 'F', base_nodes))
+
+    def test_cache_follows_new_tip(self):
+        branch = self.make_branch_with_merges()
+        branch.get_config_stack().set('branch.revno_cache', True)
+        branch.set_last_revision_info(2, 'B')
+        self.assertEqual({'A': (1,), 'B': (2,)},
+                         branch.get_revision_id_to_revno_map())
+        self.assertEqual('B',
+            revno_cache.RevnoCache(branch._transport).load()[0])
+        branch.set_last_revision_info(4, 'F')
+        self.assertEqual((1, 1, 2), branch.revision_id_to_dotted_revno('E'))
+        tip, nodes = revno_cache.RevnoCache(branch._transport).load()
+        self.assertEqual('F', tip)
+        self.assertEqual(self.full_merge_sort(branch, 'F'),
+                         self.as_tuples(nodes))
@@ -409,8 +409,10 @@ class ReadvFile(object):
 
     def __init__(self, data):
         self._data = data
+        self.readv_calls = []
 
     def readv(self, requests):
+        self.readv_calls.append(requests)
         for start, length in requests:
             yield self._data[start:start+length]
 
@@ -466,6 +468,20 @@ class Test_SFTPReadvHelper(tests.TestCase):
                                   data, [(0, 1), (10, 1), (4, 3), (1, 3)])
 
 
+    def test_request_and_yield_offsets_window(self):
+        self.requireFeature(features.paramiko)
+        data = 'abcdefghijklmnopqrstuvwxyz' * 5000
+        offsets = [(0, 40000), (70000, 60000), (50000, 10000)]
+        helper = _mod_sftp._SFTPReadvHelper(offsets, 'artificial_test',
+            _null_report_activity, window=2)
+        data_f = ReadvFile(data)
+        result = list(helper.request_and_yield_offsets(data_f))
+        self.assertEqual([(start, data[start:start + length])
+                          for start, length in offsets], result)
+        # The 5 requests are issued 2 at a time
+        self.assertEqual([2, 2, 1], map(len, data_f.readv_calls))
+
+
 class TestUsesAuthConfig(TestCaseWithSFTPServer):
     """Test that AuthenticationConfig can supply default usernames."""
 
@@ -1669,6 +1669,86 @@ class TestSmartServerRepositoryGetParentMap(tests.TestCaseWithMemoryTransport):
             request.do_body('\n\n0\n'))
 
 
+class TestRepositoryCache(tests.TestCaseWithMemoryTransport):
+
+    def make_cache(self, max_size=2):
+        cache = smart_repo.RepositoryCache(max_size)
+        old_cache = smart_repo.set_repository_cache(cache)
+        self.addCleanup(smart_repo.set_repository_cache, old_cache)
+        return cache
+
+    def test_get_after_release_reuses_repository(self):
+        cache = self.make_cache()
+        self.make_repository('repo')
+        t = self.get_transport('repo')
+        repo = cache.get(t)
+        cache.release(repo)
+        self.assertIs(repo, cache.get(t))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+    def test_repository_in_use_is_not_shared(self):
+        cache = self.make_cache()
+        self.make_repository('repo')
+        t = self.get_transport('repo')
+        repo = cache.get(t)
+        self.assertIsNot(repo, cache.get(t))
+
+    def test_locked_repository_is_not_reused(self):
+        cache = self.make_cache()
+        self.make_repository('repo')
+        t = self.get_transport('repo')
+        repo = cache.get(t)
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        cache.release(repo)
+        self.assertIsNot(repo, cache.get(t))
+
+    def test_pack_names_change_invalidates(self):
+        cache = self.make_cache()
+        tree = self.make_branch_and_memory_tree('.')
+        t = self.get_transport()
+        repo = cache.get(t)
+        cache.release(repo)
+        tree.lock_write()
+        tree.add('')
+        tree.commit('first')
+        tree.unlock()
+        self.assertIsNot(repo, cache.get(t))
+        self.assertEqual(1, cache.invalidations)
+
+    def test_size_is_bounded(self):
+        cache = self.make_cache(max_size=1)
+        self.make_repository('one')
+        self.make_repository('two')
+        repo_one = cache.get(self.get_transport('one'))
+        repo_two = cache.get(self.get_transport('two'))
+        cache.release(repo_one)
+        cache.release(repo_two)
+        self.assertIsNot(repo_one, cache.get(self.get_transport('one')))
+        self.assertIs(repo_two, cache.get(self.get_transport('two')))
+
+    def test_non_pack_repository_not_cached(self):
+        cache = self.make_cache()
+        self.make_repository('repo', format='knit')
+        t = self.get_transport('repo')
+        repo = cache.get(t)
+        cache.release(repo)
+        self.assertIsNot(repo, cache.get(t))
+
+    def test_get_parent_map_uses_cache(self):
+        cache = self.make_cache()
+        backing = self.get_transport()
+        tree = self.make_branch_and_memory_tree('.')
+        for i in range(2):
+            request = smart_repo.SmartServerRepositoryGetParentMap(backing)
+            self.assertEqual(None, request.execute('', 'missing-id'))
+            self.assertEqual(
+                smart_req.SuccessfulSmartServerResponse(('ok', ),
+                                                        bz2.compress('')),
+                request.do_body('\n\n0\n'))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+
 class TestSmartServerRepositoryGetRevisionGraph(
     tests.TestCaseWithMemoryTransport):
 
@@ -1864,6 +1944,22 @@ class TestSmartServerRepositoryGetStream(GetStreamTestBase):
         self.assertStartsWith(stream_bytes, 'Bazaar pack format 1')
 
 
+    def test_uses_repository_cache(self):
+        cache = smart_repo.RepositoryCache(2)
+        old_cache = smart_repo.set_repository_cache(cache)
+        self.addCleanup(smart_repo.set_repository_cache, old_cache)
+        backing = self.get_transport()
+        repo, r1, r2 = self.make_two_commit_repo()
+        for i in range(2):
+            request = smart_repo.SmartServerRepositoryGetStream_1_19(backing)
+            request.execute('', repo._format.network_name())
+            response = request.do_body('everything')
+            self.assertEqual(('ok',), response.args)
+            stream_bytes = ''.join(response.body_stream)
+            self.assertStartsWith(stream_bytes, 'Bazaar pack format 1')
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+
 class TestSmartServerRequestHasRevision(tests.TestCaseWithMemoryTransport):
 
     def test_missing_revision(self):
@@ -21,6 +21,7 @@ from cStringIO import StringIO
 import doctest
 import errno
 import os
+import signal
 import socket
 import subprocess
 import sys
@@ -1260,32 +1261,8 @@ class TestGetProtocolFactoryForBytes(tests.TestCase):
         self.assertEqual('anything\n', remainder)
 
 
-class TestSmartTCPServer(tests.TestCase):
-
-    def make_server(self):
-        """Create a SmartTCPServer that we can exercise.
-
-        Note: we don't use SmartTCPServer_for_testing because the testing
-        version overrides lots of functionality like 'serve', and we want to
-        test the raw service.
-
-        This will start the server in another thread, and wait for it to
-        indicate it has finished starting up.
-
-        :return: (server, server_thread)
-        """
-        t = _mod_transport.get_transport_from_url('memory:///')
-        server = _mod_server.SmartTCPServer(t, client_timeout=4.0)
-        server._ACCEPT_TIMEOUT = 0.1
-        # We don't use 'localhost' because that might be an IPv6 address.
-        server.start_server('127.0.0.1', 0)
-        server_thread = threading.Thread(target=server.serve,
-                                         args=(self.id(),))
-        server_thread.start()
-        # Ensure this gets called at some point
-        self.addCleanup(server._stop_gracefully)
-        server._started.wait()
-        return server, server_thread
+class TCPServerTestCase(tests.TestCase):
+    """Helpers to talk to a SmartTCPServer from raw client sockets."""
 
     def ensure_client_disconnected(self, client_sock):
         """Ensure that a socket is closed, discarding all errors."""
@@ -1331,6 +1308,34 @@ class TestSmartTCPServer(tests.TestCase):
         server._fully_stopped.wait()
         server_thread.join()
 
+
+class TestSmartTCPServer(TCPServerTestCase):
+
+    def make_server(self):
+        """Create a SmartTCPServer that we can exercise.
+
+        Note: we don't use SmartTCPServer_for_testing because the testing
+        version overrides lots of functionality like 'serve', and we want to
+        test the raw service.
+
+        This will start the server in another thread, and wait for it to
+        indicate it has finished starting up.
+
+        :return: (server, server_thread)
+        """
+        t = _mod_transport.get_transport_from_url('memory:///')
+        server = _mod_server.SmartTCPServer(t, client_timeout=4.0)
+        server._ACCEPT_TIMEOUT = 0.1
+        # We don't use 'localhost' because that might be an IPv6 address.
+        server.start_server('127.0.0.1', 0)
+        server_thread = threading.Thread(target=server.serve,
+                                         args=(self.id(),))
+        server_thread.start()
+        # Ensure this gets called at some point
+        self.addCleanup(server._stop_gracefully)
+        server._started.wait()
+        return server, server_thread
+
     def test_get_error_unexpected(self):
         """Error reported by server with no specific representation"""
         self.overrideEnv('BZR_NO_SMART_VFS', None)
@@ -1477,6 +1482,126 @@ class TestSmartTCPServer(tests.TestCase):
         self.connect_to_server_and_hangup(server)
         server_thread.join()
 
+    def test_max_connections_defers_accept(self):
+        t = _mod_transport.get_transport_from_url('memory:///')
+        server = _mod_server.SmartTCPServer(t, client_timeout=4.0,
+                                            max_connections=1)
+        server._ACCEPT_TIMEOUT = 0.1
+        server.start_server('127.0.0.1', 0)
+        server_thread = threading.Thread(target=server.serve,
+                                         args=(self.id(),))
+        server_thread.start()
+        self.addCleanup(server._stop_gracefully)
+        server._started.wait()
+        client_sock1 = self.connect_to_server(server)
+        self.say_hello(client_sock1)
+        # The second client is left in the listen queue
+        client_sock2 = self.connect_to_server(server)
+        client_sock2.send('hello\n')
+        client_sock2.settimeout(0.3)
+        self.assertRaises(socket.timeout, client_sock2.recv, 5)
+        self.assertEqual(1, len(server._active_connections))
+        # Until the first one is done.
+        client_sock1.close()
+        client_sock2.settimeout(None)
+        self.assertEqual('ok\x012\n', client_sock2.recv(5))
+        client_sock2.close()
+        self.shutdown_server_cleanly(server, server_thread)
+
+    def test_max_connections_zero_is_unlimited(self):
+        t = _mod_transport.get_transport_from_url('memory:///')
+        server = _mod_server.SmartTCPServer(t, client_timeout=4.0,
+                                            max_connections=0)
+        server._ACCEPT_TIMEOUT = 0.1
+        server.start_server('127.0.0.1', 0)
+        server_thread = threading.Thread(target=server.serve,
+                                         args=(self.id(),))
+        server_thread.start()
+        self.addCleanup(server._stop_gracefully)
+        server._started.wait()
+        client_sock1 = self.connect_to_server(server)
+        self.say_hello(client_sock1)
+        client_sock2 = self.connect_to_server(server)
+        self.say_hello(client_sock2)
+        self.assertEqual(2, len(server._active_connections))
+        client_sock1.close()
+        client_sock2.close()
+        self.shutdown_server_cleanly(server, server_thread)
+
+
+class TestSmartPreforkTCPServer(TCPServerTestCase):
+
+    def setUp(self):
+        super(TestSmartPreforkTCPServer, self).setUp()
+        if getattr(os, 'fork', None) is None:
+            raise tests.TestNotApplicable('os.fork is not available')
+
+    def make_prefork_server(self, workers=2):
+        t = _mod_transport.get_transport_from_url('memory:///')
+        server = _mod_server.SmartPreforkTCPServer(t, client_timeout=4.0,
+                                                   workers=workers)
+        server._ACCEPT_TIMEOUT = 0.1
+        server._WORKER_POLL_TIMEOUT = 0.05
+        server.start_server('127.0.0.1', 0)
+        server.start_background_thread('-' + self.id())
+        self.addCleanup(self.stop_prefork_server, server)
+        return server
+
+    def stop_prefork_server(self, server):
+        if not server._fully_stopped.isSet():
+            server.stop_background_thread()
+            server._fully_stopped.wait()
+
+    def wait_for_workers(self, server, count, excluded=()):
+        for attempt in range(100):
+            workers = set(server._workers)
+            if len(workers) == count and not workers.intersection(excluded):
+                return workers
+            time.sleep(0.05)
+        self.fail('workers not started: %r' % (server._workers,))
+
+    def test_workers_serve_connections(self):
+        server = self.make_prefork_server()
+        self.wait_for_workers(server, 2)
+        for i in range(4):
+            client_sock = self.connect_to_server(server)
+            self.say_hello(client_sock)
+            client_sock.close()
+        # Connections are served by the workers, not the parent process.
+        self.assertEqual([], server._active_connections)
+
+    def test_stop_terminates_workers(self):
+        server = self.make_prefork_server()
+        workers = self.wait_for_workers(server, 2)
+        self.stop_prefork_server(server)
+        self.assertEqual(set(), server._workers)
+        self.assertEqual(set(), server._retiring_workers)
+        for pid in workers:
+            self.assertRaises(OSError, os.waitpid, pid, os.WNOHANG)
+
+    def test_restart_workers(self):
+        server = self.make_prefork_server()
+        old_workers = self.wait_for_workers(server, 2)
+        client_sock = self.connect_to_server(server)
+        self.say_hello(client_sock)
+        server.restart_workers()
+        new_workers = self.wait_for_workers(server, 2, old_workers)
+        self.assertEqual(set(), old_workers.intersection(new_workers))
+        # The old worker hangs up once its client is between requests.
+        client_sock.send('hello\n')
+        self.assertEqual('', client_sock.recv(5))
+        client_sock.close()
+        client_sock = self.connect_to_server(server)
+        self.say_hello(client_sock)
+
+    def test_dead_worker_is_replaced(self):
+        server = self.make_prefork_server(workers=1)
+        old_workers = self.wait_for_workers(server, 1)
+        os.kill(list(old_workers)[0], signal.SIGKILL)
+        self.wait_for_workers(server, 1, old_workers)
+        client_sock = self.connect_to_server(server)
+        self.say_hello(client_sock)
+
 
 class SmartTCPTests(tests.TestCase):
     """Tests for connection/end to end behaviour using the TCP server.
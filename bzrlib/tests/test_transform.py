@@ -18,10 +18,12 @@ import errno
 import os
 from StringIO import StringIO
 import sys
+import threading
 import time
 
 from bzrlib import (
     bencode,
+    config,
     errors,
     filters,
     generate_ids,
@@ -2272,6 +2274,74 @@ class TestBuildTree(tests.TestCaseWithTransport):
         self.assertEqual(entry1_state, entry1[1][0])
         self.assertEqual(entry2_state, entry2[1][0])
 
+    def test_build_tree_write_workers(self):
+        source = self.make_branch_and_tree('source')
+        paths = ['dir/'] + ['file%d' % i for i in range(10)] + [
+            'dir/file%d' % i for i in range(10)]
+        self.build_tree(['source/' + path for path in paths])
+        source.add([path.rstrip('/') for path in paths])
+        os.chmod('source/file1', 0755)
+        source.commit('new files')
+        config.GlobalStack().set('transform.write_workers', 3)
+        written = []
+        orig = transform.DiskTreeTransform._write_limbo_file
+        def write_limbo_file(tt, name, chunks):
+            written.append(threading.current_thread().name)
+            return orig(tt, name, chunks)
+        self.overrideAttr(transform.DiskTreeTransform, '_write_limbo_file',
+                          write_limbo_file)
+        target = self.make_branch_and_tree('target')
+        target.lock_write()
+        self.addCleanup(target.unlock)
+        state = target.current_dirstate()
+        state._cutoff_time = time.time() + 60
+        revision_tree = source.basis_tree()
+        revision_tree.lock_read()
+        self.addCleanup(revision_tree.unlock)
+        build_tree(revision_tree, target)
+        self.assertEqual(20, len(written))
+        self.assertFalse(threading.current_thread().name in written)
+        self.assertEqual([], list(target.iter_changes(revision_tree)))
+        for path in paths[1:]:
+            self.assertFileEqual(
+                'contents of source/%s\n' % path, 'target/' + path)
+            # The observed sha1s have been recorded
+            entry = state._get_entry(0, path_utf8=path)
+            self.assertEqual(osutils.sha_file_by_name('target/' + path),
+                             entry[1][0][1])
+        self.assertTrue(target.is_executable(target.path2id('file1')))
+
+    def test_limbo_file_writer_bounds_pending_bytes(self):
+        tree = self.make_branch_and_tree('tree')
+        tt = TreeTransform(tree)
+        self.addCleanup(tt.finalize)
+        writer = transform._LimboFileWriter(tt, 2, max_pending_bytes=10)
+        self.addCleanup(writer.close)
+        trans_ids = []
+        for name in ['a', 'b', 'c']:
+            trans_id = tt.create_path(name, tt.root)
+            writer.create_file(['conte', 'nt'], trans_id)
+            trans_ids.append(trans_id)
+            # A file is waited for once the contents exceed the budget
+            self.assertEqual(1, len(writer._pending))
+            self.assertEqual(7, writer._pending_bytes)
+        writer.finish()
+        self.assertEqual(0, writer._pending_bytes)
+        for trans_id in trans_ids:
+            self.assertFileEqual('content', tt._limbo_name(trans_id))
+
+    def test_build_tree_write_workers_accelerator(self):
+        source = self.create_ab_tree()
+        config.GlobalStack().set('transform.write_workers', 2)
+        target = self.make_branch_and_tree('target')
+        revision_tree = source.basis_tree()
+        revision_tree.lock_read()
+        self.addCleanup(revision_tree.unlock)
+        build_tree(revision_tree, target, source)
+        target.lock_read()
+        self.addCleanup(target.unlock)
+        self.assertEqual([], list(target.iter_changes(revision_tree)))
+
 
 class TestCommitTransform(tests.TestCaseWithTransport):
 
@@ -230,6 +230,37 @@ class TestCoalesceOffsets(tests.TestCase):
                    max_size=1*1024*1024*1024)
 
 
+class TestReadvTuner(tests.TestCase):
+
+    def test_no_measurements(self):
+        tuner = transport._ReadvTuner()
+        self.assertEqual(128, tuner.fudge_factor(128, 65536))
+        # Without throughput, the latency is not enough
+        tuner.record(0.1, 0, 0)
+        self.assertEqual(128, tuner.fudge_factor(128, 65536))
+
+    def test_bytes_per_round_trip(self):
+        tuner = transport._ReadvTuner()
+        # 10kB in 0.1s during a 0.05s round trip
+        tuner.record(0.05, 10000, 0.1)
+        self.assertEqual(5000, tuner.fudge_factor(128, 65536))
+
+    def test_bounds(self):
+        tuner = transport._ReadvTuner()
+        tuner.record(0.001, 1000, 1)
+        self.assertEqual(128, tuner.fudge_factor(128, 65536))
+        tuner = transport._ReadvTuner()
+        tuner.record(1, 1000000, 1)
+        self.assertEqual(65536, tuner.fudge_factor(128, 65536))
+
+    def test_running_average(self):
+        tuner = transport._ReadvTuner()
+        tuner.record(0.1, 1000, 1)
+        tuner.record(0.5, 1000, 1)
+        self.assertAlmostEqual(0.2, tuner.latency)
+        self.assertAlmostEqual(1000, tuner.throughput)
+
+
 class TestMemoryServer(tests.TestCase):
 
     def test_create_server(self):
@@ -0,0 +1,327 @@
+# Copyright (C) 2017 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for watching working trees."""
+
+import threading
+import time
+
+from bzrlib import (
+    tests,
+    tree_watch,
+    )
+from bzrlib.tests import features
+
+
+class _InotifyFeature(features.Feature):
+
+    def _probe(self):
+        try:
+            tree_watch.Inotify().close()
+        except tree_watch.WatcherUnavailable:
+            return False
+        return True
+
+    def feature_name(self):
+        return 'inotify'
+
+InotifyFeature = _InotifyFeature()
+
+
+class FakeInotify(object):
+
+    def __init__(self):
+        self.watches = {}
+        self.events = []
+        self._next_wd = 1
+
+    def add_watch(self, path):
+        wd = self._next_wd
+        self._next_wd += 1
+        self.watches[wd] = path
+        return wd
+
+    def rm_watch(self, wd):
+        del self.watches[wd]
+
+    def read_events(self):
+        events = self.events
+        self.events = []
+        return events
+
+    def close(self):
+        pass
+
+
+class TestDirtyPaths(tests.TestCase):
+
+    def test_since(self):
+        dirty = tree_watch.DirtyPaths()
+        dirty.add('a')
+        token = dirty.token
+        dirty.add('b')
+        dirty.add('c')
+        self.assertEqual(['a', 'b', 'c'], sorted(dirty.since(dirty.epoch, 0)))
+        self.assertEqual(['b', 'c'], sorted(dirty.since(dirty.epoch, token)))
+        self.assertEqual([], dirty.since(dirty.epoch, dirty.token))
+
+    def test_since_other_epoch(self):
+        dirty = tree_watch.DirtyPaths()
+        dirty.add('a')
+        self.assertIs(None, dirty.since('other', 0))
+
+    def test_too_many_paths(self):
+        dirty = tree_watch.DirtyPaths(max_paths=2)
+        epoch = dirty.epoch
+        dirty.add('a')
+        dirty.add('b')
+        self.assertEqual(epoch, dirty.epoch)
+        dirty.add('c')
+        self.assertNotEqual(epoch, dirty.epoch)
+        self.assertEqual([], dirty.since(dirty.epoch, 0))
+
+
+class TestTreeWatcher(tests.TestCaseInTempDir):
+
+    def make_watcher(self):
+        self.build_tree(['tree/', 'tree/.bzr/', 'tree/dir/', 'tree/dir/sub/',
+                         'tree/file'])
+        inotify = FakeInotify()
+        watcher = tree_watch.TreeWatcher(u'tree', inotify)
+        watcher.start()
+        return watcher, inotify
+
+    def wd_for(self, watcher, relpath):
+        for wd, path in watcher._wd_paths.iteritems():
+            if path == relpath:
+                return wd
+        self.fail('%s is not watched' % (relpath,))
+
+    def dirty_paths(self, watcher):
+        return sorted(watcher.dirty.since(watcher.dirty.epoch, 0))
+
+    def test_start_skips_control_dir(self):
+        watcher, inotify = self.make_watcher()
+        self.assertEqual(['', 'dir', 'dir/sub'],
+                         sorted(watcher._wd_paths.values()))
+        self.assertEqual(['tree', 'tree/dir', 'tree/dir/sub'],
+                         sorted(inotify.watches.values()))
+
+    def test_file_events(self):
+        watcher, inotify = self.make_watcher()
+        watcher.process_events([
+            (self.wd_for(watcher, ''), tree_watch.IN_MODIFY, 0, 'file'),
+            (self.wd_for(watcher, 'dir/sub'), tree_watch.IN_CREATE, 0, 'new'),
+            (self.wd_for(watcher, ''), tree_watch.IN_CREATE, 0, '.bzr'),
+            ])
+        self.assertEqual(['dir/sub/new', 'file'], self.dirty_paths(watcher))
+
+    def test_directory_metadata_ignored(self):
+        watcher, inotify = self.make_watcher()
+        watcher.process_events([
+            (self.wd_for(watcher, ''), tree_watch.IN_ATTRIB
+             | tree_watch.IN_ISDIR, 0, 'dir'),
+            (self.wd_for(watcher, 'dir'), tree_watch.IN_ATTRIB, 0, ''),
+            ])
+        self.assertEqual([], self.dirty_paths(watcher))
+
+    def test_new_directory_watched(self):
+        watcher, inotify = self.make_watcher()
+        self.build_tree(['tree/dir/new/', 'tree/dir/new/inner/'])
+        watcher.process_events([(self.wd_for(watcher, 'dir'),
+            tree_watch.IN_CREATE | tree_watch.IN_ISDIR, 0, 'new')])
+        self.assertEqual(['dir/new'], self.dirty_paths(watcher))
+        self.assertEqual(['', 'dir', 'dir/new', 'dir/new/inner', 'dir/sub'],
+                         sorted(watcher._wd_paths.values()))
+
+    def test_directory_moved_away(self):
+        watcher, inotify = self.make_watcher()
+        watcher.process_events([(self.wd_for(watcher, ''),
+            tree_watch.IN_MOVED_FROM | tree_watch.IN_ISDIR, 1, 'dir')])
+        self.assertEqual(['dir'], self.dirty_paths(watcher))
+        self.assertEqual([''], watcher._wd_paths.values())
+        self.assertEqual(['tree'], inotify.watches.values())
+
+    def test_overflow_restarts_journal(self):
+        watcher, inotify = self.make_watcher()
+        epoch = watcher.dirty.epoch
+        watcher.process_events([
+            (self.wd_for(watcher, ''), tree_watch.IN_MODIFY, 0, 'file'),
+            (-1, tree_watch.IN_Q_OVERFLOW, 0, '')])
+        self.assertNotEqual(epoch, watcher.dirty.epoch)
+        self.assertEqual([], self.dirty_paths(watcher))
+
+    def test_handle_request(self):
+        watcher, inotify = self.make_watcher()
+        epoch = watcher.dirty.epoch
+        self.assertEqual((epoch, 0, []),
+                         watcher.handle_request(('dirty', '', 0)))
+        inotify.events.append(
+            (self.wd_for(watcher, ''), tree_watch.IN_MODIFY, 0, 'file'))
+        self.assertEqual((epoch, 1, ['file']),
+                         watcher.handle_request(('dirty', epoch, 0)))
+        self.assertEqual((epoch, 1, []),
+                         watcher.handle_request(('dirty', epoch, 1)))
+
+    def test_incomplete_watcher_never_trusted(self):
+        watcher, inotify = self.make_watcher()
+        watcher.complete = False
+        epoch, token, paths = watcher.handle_request(('dirty', '', 0))
+        self.assertNotEqual(
+            epoch, watcher.handle_request(('dirty', epoch, token))[0])
+
+
+class TestWatchedChanges(tests.TestCaseWithTransport):
+
+    def setUp(self):
+        super(TestWatchedChanges, self).setUp()
+        self.epoch = 'epoch'
+        self.token = 0
+        self.dirty = []
+        self.queries = []
+        self.overrideAttr(tree_watch, '_query_watcher', self.query_watcher)
+        self.tree = self.make_branch_and_tree('tree')
+        self.build_tree(['tree/a', 'tree/b', 'tree/dir/', 'tree/dir/c',
+                         'tree/unknown'])
+        self.tree.add(['a', 'b', 'dir', 'dir/c'])
+        self.tree.commit('one')
+        self.tree._transport.put_bytes(tree_watch.WATCHER_FILENAME,
+                                       'socket\n')
+
+    def query_watcher(self, socket_path, epoch, token):
+        self.queries.append((epoch, token))
+        self.token += 1
+        return self.epoch, self.token, self.dirty
+
+    def changed_paths(self, want_unversioned=True):
+        self.tree.lock_read()
+        try:
+            changes = list(self.tree.iter_changes(self.tree.basis_tree(),
+                want_unversioned=want_unversioned))
+        finally:
+            self.tree.unlock()
+        return sorted(change[1] for change in changes)
+
+    def unwatched_changed_paths(self):
+        self.tree._transport.delete(tree_watch.WATCHER_FILENAME)
+        try:
+            return self.changed_paths()
+        finally:
+            self.tree._transport.put_bytes(tree_watch.WATCHER_FILENAME,
+                                           'socket\n')
+
+    def test_not_watched(self):
+        self.tree._transport.delete(tree_watch.WATCHER_FILENAME)
+        self.build_tree_contents([('tree/a', 'modified\n')])
+        self.assertEqual([(None, u'unknown'), (u'a', u'a')],
+                         self.changed_paths())
+        self.assertEqual([], self.queries)
+
+    def test_full_comparison_saves_baseline(self):
+        self.build_tree_contents([('tree/a', 'modified\n')])
+        self.assertEqual([(None, u'unknown'), (u'a', u'a')],
+                         self.changed_paths())
+        self.assertEqual([('', 0)], self.queries)
+        self.assertEqual(('epoch', 1, (self.tree.last_revision(),),
+                          ('a', 'unknown')),
+                         tree_watch.load_baseline(self.tree._transport))
+
+    def test_restricted_to_dirty_paths(self):
+        self.build_tree_contents([('tree/a', 'modified\n')])
+        self.changed_paths()
+        # Not reported by the watcher, so not seen.
+        self.build_tree_contents([('tree/b', 'modified\n'),
+                                  ('tree/dir/c', 'modified\n')])
+        self.assertEqual([(None, u'unknown'), (u'a', u'a')],
+                         self.changed_paths())
+        self.dirty = ['dir/c']
+        self.assertEqual([(None, u'unknown'), (u'a', u'a'),
+                          (u'dir/c', u'dir/c')],
+                         self.changed_paths())
+        self.assertEqual([('', 0), ('epoch', 1), ('epoch', 2)], self.queries)
+
+    def test_reverted_path_dropped_from_baseline(self):
+        self.build_tree_contents([('tree/a', 'modified\n')])
+        self.changed_paths()
+        self.build_tree_contents([('tree/a', 'contents of tree/a\n')])
+        self.dirty = ['a']
+        self.assertEqual([(None, u'unknown')], self.changed_paths())
+        self.assertEqual(('unknown',),
+                         tree_watch.load_baseline(self.tree._transport)[3])
+
+    def test_unversioned_reported_once(self):
+        self.changed_paths()
+        self.build_tree(['tree/new/', 'tree/new/sub/', 'tree/new/sub/file',
+                         'tree/dir/other'])
+        self.dirty = ['new/sub/file', 'dir/other', '.bzr/foo']
+        self.assertEqual([(None, u'dir/other'), (None, u'new'),
+                          (None, u'unknown')],
+                         self.changed_paths())
+        self.assertEqual([(None, u'dir/other'), (None, u'new'),
+                          (None, u'unknown')],
+                         self.changed_paths())
+
+    def test_versioning_changes_seen(self):
+        self.changed_paths()
+        self.tree.add(['unknown'])
+        self.tree.remove(['b'], keep_files=True)
+        self.assertEqual(self.unwatched_changed_paths(),
+                         self.changed_paths())
+
+    def test_new_parents_compare_whole_tree(self):
+        self.changed_paths()
+        self.tree.commit('two')
+        self.build_tree_contents([('tree/b', 'modified\n')])
+        self.assertEqual([(None, u'unknown'), (u'b', u'b')],
+                         self.changed_paths())
+        self.assertEqual([('', 0), ('epoch', 1), ('', 0)], self.queries)
+
+    def test_new_epoch_compares_whole_tree(self):
+        self.changed_paths()
+        self.build_tree_contents([('tree/b', 'modified\n')])
+        self.epoch = 'restarted'
+        self.assertEqual([(None, u'unknown'), (u'b', u'b')],
+                         self.changed_paths())
+
+    def test_baseline_not_saved_without_unversioned(self):
+        self.changed_paths(want_unversioned=False)
+        self.assertIs(None, tree_watch.load_baseline(self.tree._transport))
+
+
+class TestWatchTree(tests.TestCaseWithTransport):
+
+    _test_needs_features = [InotifyFeature]
+
+    def test_status_sees_modifications(self):
+        tree = self.make_branch_and_tree('tree')
+        self.build_tree(['tree/a', 'tree/dir/', 'tree/dir/b'])
+        tree.add(['a', 'dir', 'dir/b'])
+        tree.commit('one')
+        watcher = tree_watch.TreeWatcher(tree.basedir)
+        thread = threading.Thread(target=tree_watch.watch_tree,
+                                  args=(tree, watcher))
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(watcher.stop)
+        while not tree._transport.has(tree_watch.WATCHER_FILENAME):
+            time.sleep(0.01)
+        self.assertEqual('', self.run_bzr('status --short tree')[0])
+        self.build_tree_contents([('tree/dir/b', 'modified\n')])
+        self.build_tree(['tree/dir/new/', 'tree/dir/new/file'])
+        self.assertEqual(' M  dir/b\n?   dir/new/\n',
+                         self.run_bzr('status --short tree')[0])
+        self.assertEqual(('dir/b', 'dir/new'), tree_watch.load_baseline(
+            tree._transport)[3])
@@ -20,7 +20,13 @@
 import pprint
 
 from bzrlib.tests import TestCase
-from bzrlib.tsort import topo_sort, TopoSorter, MergeSorter, merge_sort
+from bzrlib.tsort import (
+    extend_merge_sort,
+    merge_sort,
+    MergeSorter,
+    topo_sort,
+    TopoSorter,
+    )
 from bzrlib.errors import GraphCycleError
 from bzrlib.revision import NULL_REVISION
 
@@ -693,3 +699,78 @@ class MergeSortTests(TestCase):
              ],
             True
             )
+
+
+class ExtendMergeSortTests(TestCase):
+
+    def assertExtendsMergeSort(self, graph, base_tip, branch_tip):
+        """Check extending the sort of base_tip matches sorting branch_tip."""
+        expected = merge_sort(graph, branch_tip, generate_revno=True)
+        base_sorted = merge_sort(graph, base_tip, generate_revno=True)
+        base_nodes = set(node for _, node, _, _, _ in base_sorted)
+        left_parents = set(graph[node][0] for node in base_nodes
+                           if graph[node])
+        base_revnos = {}
+        revno_to_branch_count = {}
+        for _, node, _, revno, _ in base_sorted:
+            base_revnos[node] = (revno, node not in left_parents)
+            if len(revno) == 3:
+                revno_to_branch_count[revno[0]] = max(
+                    revno[1], revno_to_branch_count.get(revno[0], 0))
+            elif revno == (1,):
+                revno_to_branch_count.setdefault(0, 0)
+        new_graph = dict((node, parents) for node, parents in graph.items()
+                         if node not in base_nodes)
+        new_sorted = extend_merge_sort(new_graph, branch_tip, base_tip,
+                                       base_revnos, revno_to_branch_count)
+        self.assertEqual(
+            [item[1:] for item in expected],
+            [item[1:] for item in new_sorted + base_sorted])
+
+    def test_extend_mainline(self):
+        graph = {'A': [], 'B': ['A'], 'C': ['B']}
+        self.assertExtendsMergeSort(graph, 'A', 'C')
+        self.assertExtendsMergeSort(graph, 'B', 'C')
+
+    def test_extend_with_merges(self):
+        # A
+        # |\
+        # B C
+        # |/|\
+        # D E F
+        # |/ /
+        # G /
+        # |/
+        # H
+        graph = {'A': [],
+                 'B': ['A'],
+                 'C': ['A'],
+                 'D': ['B', 'C'],
+                 'E': ['C'],
+                 'F': ['C'],
+                 'G': ['D', 'E'],
+                 'H': ['G', 'F'],
+                 }
+        self.assertExtendsMergeSort(graph, 'B', 'H')
+        self.assertExtendsMergeSort(graph, 'D', 'H')
+        self.assertExtendsMergeSort(graph, 'G', 'H')
+
+    def test_extend_continuing_merged_branch(self):
+        # C continues the branch B that was merged into D, the merged branch
+        # tip is not a left-hand parent in the base ancestry.
+        graph = {'A': [],
+                 'B': ['A'],
+                 'D': ['A', 'B'],
+                 'C': ['B'],
+                 'E': ['D', 'C'],
+                 }
+        self.assertExtendsMergeSort(graph, 'D', 'E')
+
+    def test_extend_with_ghost_and_new_root(self):
+        graph = {'A': [],
+                 'B': ['A'],
+                 'R': ['ghost'],
+                 'S': [],
+                 'C': ['B', 'R', 'S'],
+                 }
+        self.assertExtendsMergeSort(graph, 'B', 'C')
@@ -18,10 +18,12 @@
 """Tests for WorkingTreeFormat4"""
 
 import os
+import threading
 import time
 
 from bzrlib import (
     bzrdir,
+    config,
     dirstate,
     errors,
     inventory,
@@ -656,6 +658,87 @@ class TestWorkingTreeFormat4(TestCaseWithTransport):
         self.assertEqual([], changes)
         self.assertEqual(['', 'versioned', 'versioned2'], returned)
 
+    def test_iter_changes_sha1_workers(self):
+        tree = self.make_branch_and_tree('.', format='dirstate')
+        tree._iter_changes = dirstate.ProcessEntryPython
+        self.build_tree_contents([('a', 'a text\n'), ('dir/',),
+                                  ('dir/b', 'b text\n'),
+                                  ('dir/c', 'c text\n')])
+        tree.add(['a', 'dir', 'dir/b', 'dir/c'], ['a-id', 'dir-id', 'b-id',
+                                                  'c-id'])
+        tree.commit('one', rev_id='rev-1')
+        self.build_tree_contents([('dir/b', 'new b text\n')])
+        tree.get_config_stack().set('dirstate.sha1_workers', 4)
+        hashed = []
+        orig = dirstate.DefaultSHA1Provider.stat_and_sha1
+        def stat_and_sha1(provider, abspath):
+            hashed.append((osutils.basename(abspath),
+                           isinstance(threading.current_thread(),
+                                      threading._MainThread)))
+            return orig(provider, abspath)
+        self.overrideAttr(dirstate.DefaultSHA1Provider, 'stat_and_sha1',
+                          stat_and_sha1)
+        tree.lock_read()
+        self.addCleanup(tree.unlock)
+        basis = tree.basis_tree()
+        basis.lock_read()
+        self.addCleanup(basis.unlock)
+        state = tree.current_dirstate()
+        provider = state._sha1_provider
+        changes = [c[0] for c in tree.iter_changes(basis)]
+        self.assertEqual(['b-id'], changes)
+        # The files whose stat is not recorded have been hashed in threads
+        self.assertEqual([('a', False), ('b', False), ('c', False)],
+                         sorted(hashed))
+        self.assertIs(provider, state._sha1_provider)
+        self.assertEqual(provider.sha1, state._sha1_file)
+
+    def test_iter_changes_sha1_workers_use_python(self):
+        tree = self.make_branch_and_tree('.', format='dirstate')
+        self.build_tree_contents([('a', 'a text\n')])
+        tree.add(['a'], ['a-id'])
+        tree.commit('one', rev_id='rev-1')
+        self.build_tree_contents([('a', 'new a text\n')])
+        class UnthreadedProcessEntry(dirstate.ProcessEntryPython):
+            def __init__(self, *args):
+                raise AssertionError('sha1 workers not used')
+        tree._iter_changes = UnthreadedProcessEntry
+        tree.get_config_stack().set('dirstate.sha1_workers', 2)
+        tree.lock_read()
+        self.addCleanup(tree.unlock)
+        basis = tree.basis_tree()
+        basis.lock_read()
+        self.addCleanup(basis.unlock)
+        changes = [c[0] for c in tree.iter_changes(basis)]
+        self.assertEqual(['a-id'], changes)
+
+    def test_iter_changes_lazy_read(self):
+        tree = self.make_branch_and_tree('.', format='dirstate')
+        self.build_tree_contents([('a', 'a text\n'), ('dir/',),
+                                  ('dir/b', 'b text\n'), ('dir/sub/',),
+                                  ('dir/sub/c', 'c text\n'), ('other/',),
+                                  ('other/d', 'd text\n')])
+        tree.add(['a', 'dir', 'dir/b', 'dir/sub', 'dir/sub/c', 'other',
+                  'other/d'], ['a-id', 'dir-id', 'b-id', 'sub-id', 'c-id',
+                               'other-id', 'd-id'])
+        tree.commit('one', rev_id='rev-1')
+        self.build_tree_contents([('dir/sub/c', 'new c text\n'),
+                                  ('other/d', 'new d text\n')])
+        config.GlobalStack().set('dirstate.lazy_read', True)
+        tree.lock_read()
+        self.addCleanup(tree.unlock)
+        basis = tree.basis_tree()
+        basis.lock_read()
+        self.addCleanup(basis.unlock)
+        state = tree.current_dirstate()
+        changes = [c[0] for c in tree.iter_changes(basis,
+                                                   specific_files=['dir'])]
+        self.assertEqual(['c-id'], changes)
+        self.assertEqual(set(['', 'dir', 'dir/sub']), state._loaded_dirnames)
+        changes = [c[0] for c in tree.iter_changes(basis)]
+        self.assertEqual(['c-id', 'd-id'], sorted(changes))
+        self.assertIs(None, state._loaded_dirnames)
+
     def test_iter_changes_unversioned_error(self):
         """ Check if a PathsNotVersionedError is correctly raised and the
             paths list contains all unversioned entries only.
@@ -30,6 +30,8 @@ from bzrlib import (
     tree,
     )
 lazy_import.lazy_import(globals(), """
+import collections
+
 from bzrlib import (
     annotate,
     bencode,
@@ -69,6 +71,9 @@ from bzrlib.symbol_versioning import (
 
 
 ROOT_PARENT = "root-parent"
+# The most bytes of file contents kept in memory by a _LimboFileWriter while
+# they wait to be written.
+LIMBO_WRITE_AHEAD_BYTES = 2**24
 
 def unique_add(map, key, value):
     if key in map:
@@ -1326,6 +1331,19 @@ class DiskTreeTransform(TreeTransformBase):
         if sha1 is not None:
             self._observed_sha1s[trans_id] = (sha1, osutils.lstat(name))
 
+    def _write_limbo_file(self, name, chunks):
+        """Write the contents of a new file in limbo.
+
+        This may be called from several threads once the creation mtime is
+        set.
+        """
+        f = open(name, 'wb')
+        try:
+            f.writelines(chunks)
+        finally:
+            f.close()
+        self._set_mtime(name)
+
     def _read_file_chunks(self, trans_id):
         cur_file = open(self._limbo_name(trans_id), 'rb')
         try:
@@ -2663,8 +2681,93 @@ def _build_tree(tree, wt, accelerator_tree, hardlink, delta_from_tree):
     return result
 
 
+class _LimboFileWriter(object):
+    """Create the new files of a transform in a pool of threads.
+
+    The contents of the files are read by the calling thread, in the order
+    they are given, while the threads of the pool write them in limbo. The
+    files are only moved into the tree when the transform is applied, which
+    stays serial.
+    """
+
+    def __init__(self, tt, workers, max_pending_bytes=LIMBO_WRITE_AHEAD_BYTES):
+        """Create a _LimboFileWriter.
+
+        :param tt: The DiskTreeTransform the files are created for.
+        :param workers: The number of threads writing files.
+        :param max_pending_bytes: The most bytes of file contents waiting to
+            be written, one file is always allowed.
+        """
+        from multiprocessing.pool import ThreadPool
+        self._tt = tt
+        self._pool = ThreadPool(workers)
+        # The contents of the files waiting to be written are kept in memory
+        self._max_pending = workers * 4
+        self._max_pending_bytes = max_pending_bytes
+        self._pending = collections.deque()
+        self._pending_bytes = 0
+        if tt._creation_mtime is None:
+            tt._creation_mtime = time.time()
+
+    def create_file(self, contents, trans_id, sha1=None):
+        """Schedule creation of a new file, see TreeTransform.create_file."""
+        # The contents may only be valid until the next one is read
+        chunks = list(contents)
+        size = sum(map(len, chunks))
+        name = self._tt._limbo_name(trans_id)
+        unique_add(self._tt._new_contents, trans_id, 'file')
+        result = self._pool.apply_async(self._tt._write_limbo_file,
+                                        (name, chunks))
+        self._pending.append((trans_id, name, sha1, size, result))
+        self._pending_bytes += size
+        while (len(self._pending) > self._max_pending
+               or (len(self._pending) > 1
+                   and self._pending_bytes > self._max_pending_bytes)):
+            self._finish_one()
+
+    def _finish_one(self):
+        trans_id, name, sha1, size, result = self._pending.popleft()
+        self._pending_bytes -= size
+        result.get()
+        self._tt._set_mode(trans_id, None, S_ISREG)
+        if sha1 is not None:
+            self._tt._observed_sha1s[trans_id] = (sha1, osutils.lstat(name))
+
+    def finish(self):
+        """Wait for all the files to be written."""
+        while self._pending:
+            self._finish_one()
+
+    def close(self):
+        """Stop the threads, waiting for the files being written."""
+        self._pool.terminate()
+        self._pool.join()
+
+
 def _create_files(tt, tree, desired_files, pb, offset, accelerator_tree,
                   hardlink):
+    wt = tt._tree
+    workers = wt.get_config_stack().get('transform.write_workers')
+    if workers is None or workers <= 1 or len(desired_files) < 2:
+        _create_files_with(tt, tt, tree, desired_files, pb, offset,
+                           accelerator_tree, hardlink)
+        return
+    writer = _LimboFileWriter(tt, workers)
+    try:
+        _create_files_with(tt, writer, tree, desired_files, pb, offset,
+                           accelerator_tree, hardlink)
+        writer.finish()
+    finally:
+        writer.close()
+
+
+def _create_files_with(tt, creator, tree, desired_files, pb, offset,
+                       accelerator_tree, hardlink):
+    """Create the files of a tree being built.
+
+    :param creator: The object whose create_file method creates the files,
+        the transform itself or a _LimboFileWriter.
+    """
     total = len(desired_files) + offset
     wt = tt._tree
     if accelerator_tree is None:
@@ -2696,7 +2799,7 @@ def _create_files(tt, tree, desired_files, pb, offset, accelerator_tree,
                     contents = filtered_output_bytes(contents, filters,
                         ContentFilterContext(tree_path, tree))
                 try:
-                    tt.create_file(contents, trans_id, sha1=text_sha1)
+                    creator.create_file(contents, trans_id, sha1=text_sha1)
                 finally:
                     try:
                         contents.close()
@@ -2711,7 +2814,7 @@ def _create_files(tt, tree, desired_files, pb, offset, accelerator_tree,
             filters = wt._content_filter_stack(tree_path)
             contents = filtered_output_bytes(contents, filters,
                 ContentFilterContext(tree_path, tree))
-        tt.create_file(contents, trans_id, sha1=text_sha1)
+        creator.create_file(contents, trans_id, sha1=text_sha1)
         pb.update(gettext('Adding file contents'), count + offset, total)
 
 
@@ -195,6 +195,54 @@ class _CoalescedOffset(object):
             self.start, self.length, self.ranges)
 
 
+class _ReadvTuner(object):
+    """Tune the coalescing of readv offsets from measured round trips.
+
+    Reading the bytes between two requested ranges is cheaper than another
+    round trip as long as they arrive faster than the round trip takes. The
+    suggested fudge factor for _coalesce_offsets is therefore the number of
+    bytes the link delivers during one round trip.
+    """
+
+    # The weight of a new measurement in the running averages
+    _smoothing = 0.25
+
+    def __init__(self):
+        self.latency = None
+        self.throughput = None
+
+    def _average(self, average, value):
+        if average is None:
+            return value
+        return average + self._smoothing * (value - average)
+
+    def record(self, latency, size, duration):
+        """Record the timing of a request.
+
+        :param latency: The seconds elapsed between sending the request and
+            receiving the start of the response.
+        :param size: The number of bytes received after the start of the
+            response.
+        :param duration: The seconds spent receiving them.
+        """
+        self.latency = self._average(self.latency, latency)
+        if size > 0 and duration > 0:
+            self.throughput = self._average(self.throughput,
+                                            size / float(duration))
+
+    def fudge_factor(self, min_fudge, max_fudge):
+        """The fudge factor to give to _coalesce_offsets.
+
+        :param min_fudge: The value used until there are measurements, and
+            the lowest one returned.
+        :param max_fudge: The highest value returned.
+        """
+        if self.latency is None or self.throughput is None:
+            return min_fudge
+        fudge = int(self.latency * self.throughput)
+        return max(min_fudge, min(fudge, max_fudge))
+
+
 class LateReadError(object):
     """A helper for transports which pretends to be a readable file.
 
@@ -21,13 +21,18 @@ There are separate implementation modules for each http client implementation.
 
 from __future__ import absolute_import
 
+import collections
+import itertools
 import os
+import Queue
 import re
 import urlparse
 import sys
+import time
 import weakref
 
 from bzrlib import (
+    config,
     debug,
     errors,
     transport,
@@ -72,8 +77,13 @@ class HttpTransportBase(ConnectedTransport):
         # propagated to clones.
         if _from_transport is not None:
             self._range_hint = _from_transport._range_hint
+            self._readv_window = _from_transport._readv_window
+            self._readv_tuner = _from_transport._readv_tuner
         else:
             self._range_hint = 'multi'
+            # Read from the configuration on first use
+            self._readv_window = None
+            self._readv_tuner = transport._ReadvTuner()
 
     def has(self, relpath):
         raise NotImplementedError("has() is abstract on %r" % self)
@@ -127,6 +137,16 @@ class HttpTransportBase(ConnectedTransport):
             self._medium = SmartClientHTTPMedium(self)
         return self._medium
 
+    def _clone_with_new_connection(self):
+        """Return a clone of this transport that does not share its connection.
+
+        The credentials are kept so that the user is not asked for them again.
+        """
+        t = self.clone()
+        t._shared_connection = transport._SharedConnection(
+            credentials=self._get_credentials())
+        return t
+
     def _degrade_range_hint(self, relpath, ranges, exc_info):
         if self._range_hint == 'multi':
             self._range_hint = 'single'
@@ -151,6 +171,9 @@ class HttpTransportBase(ConnectedTransport):
     # header and issue a '400: Bad request' error when too much ranges are
     # specified.
     _bytes_to_read_before_seek = 128
+    # When readv requests are pipelined, the value above is raised up to this
+    # one depending on the measured latency and throughput.
+    _max_bytes_to_read_before_seek = 64 * 1024
     # No limit on the offset number that get combined into one, we are trying
     # to avoid downloading the whole file.
     _max_readv_combine = 0
@@ -178,10 +201,12 @@ class HttpTransportBase(ConnectedTransport):
 
             # Coalesce the offsets to minimize the GET requests issued
             sorted_offsets = sorted(offsets)
+            fudge_factor = self._readv_tuner.fudge_factor(
+                self._bytes_to_read_before_seek,
+                self._max_bytes_to_read_before_seek)
             coalesced = self._coalesce_offsets(
                 sorted_offsets, limit=self._max_readv_combine,
-                fudge_factor=self._bytes_to_read_before_seek,
-                max_size=self._get_max_size)
+                fudge_factor=fudge_factor, max_size=self._get_max_size)
 
             # Turn it into a list, we will iterate it several times
             coalesced = list(coalesced)
@@ -244,54 +269,135 @@ class HttpTransportBase(ConnectedTransport):
                 retried_offset = cur_offset_and_size
                 try_again = True
 
+    def _get_readv_window(self):
+        if self._readv_window is None:
+            self._readv_window = config.GlobalStack().get('http.readv_window')
+        return self._readv_window
+
     def _coalesce_readv(self, relpath, coalesced):
         """Issue several GET requests to satisfy the coalesced offsets"""
-
-        def get_and_yield(relpath, coalesced):
-            if coalesced:
-                # Note that the _get below may raise
-                # errors.InvalidHttpRange. It's the caller's responsibility to
-                # decide how to retry since it may provide different coalesced
-                # offsets.
-                code, rfile = self._get(relpath, coalesced)
-                for coal in coalesced:
-                    yield coal, rfile
-
+        window = self._get_readv_window()
+        requests = self._split_coalesced_offsets(coalesced, window)
+        if window > 1 and self._range_hint is not None:
+            requests = list(requests)
+            if len(requests) > 1:
+                for c, rfile in self._pipelined_get(relpath, requests,
+                                                    window):
+                    yield c, rfile
+                return
+        for ranges in requests:
+            # Note that the _get below may raise
+            # errors.InvalidHttpRange. It's the caller's responsibility to
+            # decide how to retry since it may provide different coalesced
+            # offsets.
+            code, rfile = self._get(relpath, ranges)
+            for coal in ranges:
+                yield coal, rfile
+
+    def _split_coalesced_offsets(self, coalesced, window=1):
+        """Split the coalesced offsets between GET requests.
+
+        :param window: The number of requests that will be in flight at
+            once. The offsets are spread over at least that many requests.
+        :return: An iterator over the lists of offsets to request.
+        """
+        if not coalesced:
+            return
         if self._range_hint is None:
             # Download whole file
-            for c, rfile in get_and_yield(relpath, coalesced):
-                yield c, rfile
+            yield coalesced
+            return
+        total = len(coalesced)
+        if self._range_hint == 'multi':
+            max_ranges = self._max_get_ranges
+        elif self._range_hint == 'single':
+            max_ranges = total
         else:
-            total = len(coalesced)
-            if self._range_hint == 'multi':
-                max_ranges = self._max_get_ranges
-            elif self._range_hint == 'single':
-                max_ranges = total
+            raise AssertionError("Unknown _range_hint %r"
+                                 % (self._range_hint,))
+        if window > 1:
+            max_ranges = min(max_ranges, max(1, (total + window - 1) // window))
+        # TODO: Some web servers may ignore the range requests and return
+        # the whole file, we may want to detect that and avoid further
+        # requests.
+        # Hint: test_readv_multiple_get_requests will fail once we do that
+        cumul = 0
+        ranges = []
+        for coal in coalesced:
+            if ((self._get_max_size > 0
+                 and cumul + coal.length > self._get_max_size)
+                or len(ranges) >= max_ranges):
+                # Get that much
+                yield ranges
+                # Restart with the current offset
+                ranges = [coal]
+                cumul = coal.length
             else:
-                raise AssertionError("Unknown _range_hint %r"
-                                     % (self._range_hint,))
-            # TODO: Some web servers may ignore the range requests and return
-            # the whole file, we may want to detect that and avoid further
-            # requests.
-            # Hint: test_readv_multiple_get_requests will fail once we do that
-            cumul = 0
-            ranges = []
-            for coal in coalesced:
-                if ((self._get_max_size > 0
-                     and cumul + coal.length > self._get_max_size)
-                    or len(ranges) >= max_ranges):
-                    # Get that much and yield
-                    for c, rfile in get_and_yield(relpath, ranges):
-                        yield c, rfile
-                    # Restart with the current offset
-                    ranges = [coal]
-                    cumul = coal.length
-                else:
-                    ranges.append(coal)
-                    cumul += coal.length
-            # Get the rest and yield
-            for c, rfile in get_and_yield(relpath, ranges):
-                yield c, rfile
+                ranges.append(coal)
+                cumul += coal.length
+        # Get the rest
+        if ranges:
+            yield ranges
+
+    def _get_and_read(self, relpath, ranges):
+        """Issue a GET request for ranges and read the response.
+
+        :return: A list of (coalesced offset, file) for ranges.
+        """
+        start = time.time()
+        code, rfile = self._get(relpath, ranges)
+        response_start = time.time()
+        files = []
+        size = 0
+        for coal in ranges:
+            rfile.seek(coal.start, os.SEEK_SET)
+            data = rfile.read(coal.length)
+            size += len(data)
+            files.append((coal, _ReadAheadFile(coal.start, data)))
+        self._readv_tuner.record(response_start - start, size,
+                                 time.time() - response_start)
+        return files
+
+    def _pipelined_get(self, relpath, requests, window):
+        """Issue several GET requests at once, yielding in order.
+
+        Each request is issued on a connection of its own, by a worker thread
+        that reads the whole response so that the next request can be issued
+        right away. At most window responses are in flight or waiting to be
+        consumed.
+
+        :param requests: The lists of coalesced offsets to request.
+        :param window: The number of requests in flight at once.
+        """
+        # This transport connection is left alone, the caller may use it
+        # while the readv is in progress.
+        clones = [self._clone_with_new_connection() for i in range(window)]
+        idle = Queue.Queue()
+        for t in clones:
+            idle.put(t)
+        def get_and_read(ranges):
+            t = idle.get()
+            try:
+                return t._get_and_read(relpath, ranges)
+            finally:
+                idle.put(t)
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(window)
+        try:
+            requests = iter(requests)
+            pending = collections.deque()
+            for ranges in itertools.islice(requests, window):
+                pending.append(pool.apply_async(get_and_read, (ranges,)))
+            while pending:
+                files = pending.popleft().get()
+                for ranges in itertools.islice(requests, 1):
+                    pending.append(pool.apply_async(get_and_read, (ranges,)))
+                for c, rfile in files:
+                    yield c, rfile
+        finally:
+            pool.terminate()
+            for t in clones:
+                t.disconnect()
 
     def recommended_page_size(self):
         """See Transport.recommended_page_size().
@@ -527,6 +633,31 @@ class HttpTransportBase(ConnectedTransport):
 
 # TODO: May be better located in smart/medium.py with the other
 # SmartMedium classes
+class _ReadAheadFile(object):
+    """The content of a coalesced offset read ahead of its use by readv.
+
+    Offsets are relative to the start of the file the content comes from.
+    """
+
+    def __init__(self, start, data):
+        self._start = start
+        self._data = data
+        self._pos = 0
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence != os.SEEK_SET:
+            raise AssertionError('only absolute seeks are supported')
+        self._pos = offset - self._start
+
+    def read(self, size=-1):
+        if size < 0:
+            data = self._data[self._pos:]
+        else:
+            data = self._data[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+
 class SmartClientHTTPMedium(medium.SmartClientMedium):
 
     def __init__(self, http_transport):
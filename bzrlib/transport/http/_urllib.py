@@ -27,6 +27,7 @@ from bzrlib.transport.http._urllib2_wrappers import (
     Opener,
     Request,
     )
+from bzrlib.transport.http import _urllib2_wrappers
 
 
 class HttpTransport_urllib(http.HttpTransportBase):
@@ -60,6 +61,10 @@ class HttpTransport_urllib(http.HttpTransportBase):
             # Clean the httplib.HTTPConnection pipeline in case the previous
             # request couldn't do it
             connection.cleanup_pipe()
+        elif self._get_credentials() is not None:
+            # A new connection for known credentials, see
+            # HttpTransportBase._clone_with_new_connection
+            (auth, proxy_auth) = [dict(d) for d in self._get_credentials()]
         else:
             # First request, initialize credentials.
             # scheme and realm will be set by the _urllib2_wrappers.AuthHandler
@@ -78,6 +83,9 @@ class HttpTransport_urllib(http.HttpTransportBase):
             # First connection or reconnection
             self._set_connection(request.connection,
                                  (request.auth, request.proxy_auth))
+            pool = _urllib2_wrappers.connection_pool
+            if pool.enabled():
+                pool.track(self._get_shared_connection(), request.connection)
         else:
             # http may change the credentials while keeping the
             # connection opened
@@ -99,7 +107,16 @@ class HttpTransport_urllib(http.HttpTransportBase):
     def disconnect(self):
         connection = self._get_connection()
         if connection is not None:
-            connection.close()
+            pool = _urllib2_wrappers.connection_pool
+            if pool.enabled():
+                # Let another transport reuse the connection, this one will
+                # get a new one if needed.
+                shared = self._get_shared_connection()
+                pool.untrack(shared)
+                shared.connection = None
+                pool.release(connection)
+            else:
+                connection.close()
 
     def _get(self, relpath, offsets, tail_amount=0):
         """See HttpTransport._get"""
@@ -59,7 +59,9 @@ import urlparse
 import re
 import ssl
 import sys
+import threading
 import time
+import weakref
 
 from bzrlib import __version__ as bzrlib_version
 from bzrlib import (
@@ -390,6 +392,16 @@ class AbstractHTTPConnection:
         """Wrap the socket before anybody use it."""
         self.sock = _ReportingSocket(sock, self._report_activity)
 
+    def set_report_activity(self, report_activity):
+        """Report the activity of the connection to a new transport."""
+        self._report_activity = report_activity
+        if self.sock is not None:
+            self.sock._report_activity = report_activity
+
+    def is_idle(self):
+        """Can a request be sent without reading the previous response ?"""
+        return self._response is None or self._response.isclosed()
+
 
 class HTTPConnection(AbstractHTTPConnection, httplib.HTTPConnection):
 
@@ -471,6 +483,187 @@ class HTTPSConnection(AbstractHTTPConnection, httplib.HTTPSConnection):
         self._wrap_socket_for_reporting(ssl_sock)
 
 
+class ConnectionPool(object):
+    """Idle HTTP connections kept for reuse by the whole process.
+
+    Connections belong to the transports using them and only enter the pool
+    when released: when their transport is disconnected or garbage
+    collected, or when the response of a redirected request is. The
+    ConnectionHandler then reuses the most recently released connection to
+    the same scheme, host and port instead of opening a new one, saving the
+    TCP and TLS handshakes.
+
+    Getting a connection never blocks: the pool keeps a limited number of
+    idle connections per host and closes the ones idle for too long.
+    """
+
+    def __init__(self, max_per_host=None, idle_timeout=None):
+        """Create a ConnectionPool.
+
+        :param max_per_host: The number of idle connections kept per host, 0
+            disables the pool. Read from the http.max_idle_connections option
+            when None.
+        :param idle_timeout: The number of seconds after which an idle
+            connection is closed. Read from the http.idle_timeout option
+            when None.
+        """
+        self._max_per_host = max_per_host
+        self._idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # key -> [(release time, connection)], the most recent last
+        self._idle = {}
+        # id(owner) -> (weakref to owner, [connections])
+        self._owners = {}
+
+    def enabled(self):
+        if self._max_per_host is None or self._idle_timeout is None:
+            config_stack = config.GlobalStack()
+            if self._max_per_host is None:
+                self._max_per_host = config_stack.get(
+                    'http.max_idle_connections')
+            if self._idle_timeout is None:
+                self._idle_timeout = config_stack.get('http.idle_timeout')
+        return self._max_per_host > 0
+
+    def _pop_expired(self, now):
+        """Remove the connections idle for too long from the pool.
+
+        The lock must be held.
+
+        :return: The connections to close.
+        """
+        expired = []
+        deadline = now - self._idle_timeout
+        for key, idle in self._idle.items():
+            while idle and idle[0][0] < deadline:
+                expired.append(idle.pop(0)[1])
+            if not idle:
+                del self._idle[key]
+        return expired
+
+    def get(self, key):
+        """Take an idle connection out of the pool.
+
+        :param key: The pool_key of the connection.
+        :return: A connection or None if there is no idle one for key.
+        """
+        if not self.enabled():
+            return None
+        connection = None
+        self._lock.acquire()
+        try:
+            expired = self._pop_expired(time.time())
+            idle = self._idle.get(key)
+            if idle:
+                connection = idle.pop()[1]
+                if not idle:
+                    del self._idle[key]
+        finally:
+            self._lock.release()
+        for c in expired:
+            c.close()
+        return connection
+
+    def release(self, connection):
+        """Give back a connection its owner will not use anymore.
+
+        The connection is closed instead if it can't be used for a new request
+        without reading the rest of a response, or if enough connections to
+        its host are already idle.
+        """
+        key = getattr(connection, 'pool_key', None)
+        if (key is None or not self.enabled()
+            or connection.sock is None or not connection.is_idle()):
+            connection.close()
+            return
+        now = time.time()
+        self._lock.acquire()
+        try:
+            to_close = self._pop_expired(now)
+            idle = self._idle.setdefault(key, [])
+            idle.append((now, connection))
+            if len(idle) > self._max_per_host:
+                to_close.append(idle.pop(0)[1])
+        finally:
+            self._lock.release()
+        for c in to_close:
+            c.close()
+
+    def track(self, owner, connection):
+        """Release a connection when its owner is garbage collected.
+
+        :param owner: The object using the connection.
+        :param connection: A connection created by the ConnectionHandler.
+        """
+        key = id(owner)
+        def owner_collected(ref):
+            self._lock.acquire()
+            try:
+                entry = self._owners.get(key)
+                if entry is not None and entry[0] is ref:
+                    del self._owners[key]
+                else:
+                    entry = None
+            finally:
+                self._lock.release()
+            if entry is not None:
+                for c in entry[1]:
+                    self.release(c)
+        self._lock.acquire()
+        try:
+            entry = self._owners.get(key)
+            if entry is None or entry[0]() is not owner:
+                entry = (weakref.ref(owner, owner_collected), [])
+                self._owners[key] = entry
+            entry[1].append(connection)
+        finally:
+            self._lock.release()
+
+    def untrack(self, owner):
+        """Stop tracking the connections of owner.
+
+        :return: The connections that were tracked for owner.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._owners.get(id(owner))
+            if entry is None or entry[0]() is not owner:
+                return []
+            del self._owners[id(owner)]
+            return entry[1]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Close all the idle connections."""
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = {}
+        finally:
+            self._lock.release()
+        for connections in idle.itervalues():
+            for released, c in connections:
+                c.close()
+
+
+connection_pool = ConnectionPool()
+
+
+class _WeakReportActivity(object):
+    """Report the activity of a connection without keeping its transport alive.
+    """
+
+    def __init__(self, report_activity):
+        self._obj = weakref.ref(report_activity.im_self)
+        self._func = report_activity.im_func
+
+    def __call__(self, size, direction):
+        obj = self._obj()
+        if obj is not None:
+            self._func(obj, size, direction)
+
+
 class Request(urllib2.Request):
     """A custom Request object.
 
@@ -585,18 +778,29 @@ class ConnectionHandler(urllib2.BaseHandler):
             # handled in the higher levels
             raise errors.InvalidURL(request.get_full_url(), 'no host given.')
 
+        report_activity = self._report_activity
+        if (connection_pool.enabled()
+            and getattr(report_activity, 'im_self', None) is not None):
+            # The connection may outlive the transport when pooled
+            report_activity = _WeakReportActivity(report_activity)
         # We create a connection (but it will not connect until the first
         # request is made)
         try:
             connection = http_connection_class(
                 host, proxied_host=request.proxied_host,
-                report_activity=self._report_activity,
+                report_activity=report_activity,
                 ca_certs=self.ca_certs)
         except httplib.InvalidURL, exception:
             # There is only one occurrence of InvalidURL in httplib
             raise errors.InvalidURL(request.get_full_url(),
                                     extra='nonnumeric port')
-
+        connection.pool_key = (request.get_type(), connection.host,
+                               connection.port, request.proxied_host,
+                               self.ca_certs)
+        pooled = connection_pool.get(connection.pool_key)
+        if pooled is not None:
+            pooled.set_report_activity(report_activity)
+            return pooled
         return connection
 
     def capture_connection(self, request, http_connection_class):
@@ -998,7 +1202,12 @@ class HTTPRedirectHandler(urllib2.HTTPRedirectHandler):
         # We have all we need already in the response
         req.connection.cleanup_pipe()
 
-        return self.parent.open(redirected_req)
+        response = self.parent.open(redirected_req)
+        if connection_pool.enabled():
+            # The connection is not the one of the transport, release it with
+            # the response.
+            connection_pool.track(response, redirected_req.connection)
+        return response
 
     http_error_301 = http_error_303 = http_error_307 = http_error_302
 
@@ -53,6 +53,7 @@ from bzrlib.trace import mutter, warning
 from bzrlib.transport import (
     FileFileStream,
     _file_streams,
+    _ReadvTuner,
     ssh,
     ConnectedTransport,
     )
@@ -127,7 +128,8 @@ class _SFTPReadvHelper(object):
     # See _get_requests for an explanation.
     _max_request_size = 32768
 
-    def __init__(self, original_offsets, relpath, _report_activity):
+    def __init__(self, original_offsets, relpath, _report_activity,
+                 fudge_factor=0, window=0, tuner=None):
         """Create a new readv helper.
 
         :param original_offsets: The original requests given by the caller of
@@ -135,10 +137,17 @@ class _SFTPReadvHelper(object):
         :param relpath: The name of the file (if known)
         :param _report_activity: A Transport._report_activity bound method,
             to be called as data arrives.
+        :param fudge_factor: The fudge factor used to coalesce the offsets.
+        :param window: The number of requests to keep in flight, 0 sends them
+            all at once.
+        :param tuner: A _ReadvTuner recording the timing of the requests.
         """
         self.original_offsets = list(original_offsets)
         self.relpath = relpath
         self._report_activity = _report_activity
+        self._fudge_factor = fudge_factor
+        self._window = window
+        self._tuner = tuner
 
     def _get_requests(self):
         """Break up the offsets into individual requests over sftp.
@@ -151,14 +160,14 @@ class _SFTPReadvHelper(object):
         Newer versions of paramiko would do the chunking for us, but we want to
         start processing results right away, so we do it ourselves.
         """
-        # TODO: Because we issue async requests, we don't 'fudge' any extra
-        #       data.  I'm not 100% sure that is the best choice.
+        # Because we issue async requests, extra data is only 'fudged' when
+        # the transport measured that it arrives faster than a round trip.
 
         # The first thing we do, is to collapse the individual requests as much
         # as possible, so we don't issues requests <32kB
         sorted_offsets = sorted(self.original_offsets)
         coalesced = list(ConnectedTransport._coalesce_offsets(sorted_offsets,
-                                                        limit=0, fudge_factor=0))
+            limit=0, fudge_factor=self._fudge_factor))
         requests = []
         for c_offset in coalesced:
             start = c_offset.start
@@ -176,6 +185,60 @@ class _SFTPReadvHelper(object):
                 len(requests))
         return requests
 
+    def _windowed_readv(self, fp, requests):
+        """Yield the data of requests, keeping at most window in flight.
+
+        paramiko sends all the requests given to readv() at once. The next
+        window is requested when half of the current one has been consumed,
+        so that the link stays busy.
+        """
+        window = self._window
+        half = max(1, window // 2)
+        start = 0
+        head = []
+        current = fp.readv(requests[:window])
+        while current is not None:
+            start += window
+            following = None
+            count = 0
+            for data in itertools.chain(head, current):
+                yield data
+                count += 1
+                if (following is None and count >= half
+                    and start < len(requests)):
+                    following = fp.readv(requests[start:start + window])
+                    # Getting the first chunk of the following window makes
+                    # paramiko buffer what is left of the current one.
+                    head = [following.next()]
+            current = following
+
+    def _iter_readv(self, fp, requests):
+        """Yield the data of requests, recording their timing."""
+        if self._window > 0 and len(requests) > self._window:
+            data_stream = self._windowed_readv(fp, requests)
+        else:
+            data_stream = iter(fp.readv(requests))
+        latency = None
+        size = 0
+        waited = 0.0
+        try:
+            while True:
+                start = time.time()
+                try:
+                    data = data_stream.next()
+                except StopIteration:
+                    return
+                elapsed = time.time() - start
+                if latency is None:
+                    latency = elapsed
+                else:
+                    size += len(data)
+                    waited += elapsed
+                yield data
+        finally:
+            if self._tuner is not None and latency is not None:
+                self._tuner.record(latency, size, waited)
+
     def request_and_yield_offsets(self, fp):
         """Request the data from the remote machine, yielding the results.
 
@@ -200,7 +263,7 @@ class _SFTPReadvHelper(object):
         # Create an 'unlimited' data stream, so we stop based on requests,
         # rather than just because the data stream ended. This lets us detect
         # short readv.
-        data_stream = itertools.chain(fp.readv(requests),
+        data_stream = itertools.chain(self._iter_readv(fp, requests),
                                       itertools.repeat(None))
         for (start, length), data in itertools.izip(requests, data_stream):
             if data is None:
@@ -331,6 +394,20 @@ class SFTPTransport(ConnectedTransport):
     # size for paramiko <= 1.6.1. paramiko 1.6.2 will probably chop
     # up the request itself, rather than us having to worry about it
     _max_request_size = 32768
+    # The fudge factor used when coalescing async requests is raised up to
+    # this value depending on the measured latency and throughput.
+    _max_bytes_to_read_before_seek = 65536
+
+    def __init__(self, base, _from_transport=None):
+        super(SFTPTransport, self).__init__(base,
+                                            _from_transport=_from_transport)
+        if _from_transport is not None:
+            self._readv_window = _from_transport._readv_window
+            self._readv_tuner = _from_transport._readv_tuner
+        else:
+            # Read from the configuration on first use
+            self._readv_window = None
+            self._readv_tuner = _ReadvTuner()
 
     def _remote_path(self, relpath):
         """Return the path to be passed along the sftp protocol for relpath.
@@ -463,7 +540,13 @@ class SFTPTransport(ConnectedTransport):
         does not support ranges > 64K, so it caps the request size, and
         just reads until it gets all the stuff it wants.
         """
-        helper = _SFTPReadvHelper(offsets, relpath, self._report_activity)
+        if self._readv_window is None:
+            self._readv_window = config.GlobalStack().get('sftp.readv_window')
+        fudge_factor = self._readv_tuner.fudge_factor(0,
+            self._max_bytes_to_read_before_seek)
+        helper = _SFTPReadvHelper(offsets, relpath, self._report_activity,
+            fudge_factor=fudge_factor, window=self._readv_window,
+            tuner=self._readv_tuner)
         return helper.request_and_yield_offsets(fp)
 
     def put_file(self, relpath, f, mode=None):
@@ -0,0 +1,559 @@
+# Copyright (C) 2017 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Watch a working tree for modifications to speed up iter_changes.
+
+Comparing a dirstate working tree with its basis requires a lstat of every
+file in the tree. A watcher is a local process (started by ``bzr watch-tree``)
+using inotify to record the paths modified in the tree. Its unix socket is
+advertised in the ``watcher`` file of the working tree control directory.
+
+After iter_changes has compared the whole tree with its basis, the paths
+that were reported changed are saved as a baseline, along with the position
+reached in the watcher journal before the comparison started. The next
+comparison only needs to look at the paths of the baseline, the paths
+modified since, and the paths whose versioning differs between the tree and
+its basis. Whenever the continuity with the baseline can't be proven (the
+watcher restarted, the parents of the tree changed, ...), the whole tree is
+compared again.
+"""
+
+from __future__ import absolute_import
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import socket
+import stat
+import struct
+import tempfile
+
+from bzrlib import (
+    bencode,
+    errors,
+    osutils,
+    trace,
+    )
+
+
+WATCHER_FILENAME = 'watcher'
+BASELINE_FILENAME = 'watch-baseline'
+
+_FORMAT_STRING = 'Bazaar tree watch baseline v1\n'
+
+# How long a client waits for the watcher to answer.
+_QUERY_TIMEOUT = 5.0
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO
+               | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+               | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+_event_header = struct.Struct('iIII')
+
+
+class WatcherUnavailable(errors.BzrError):
+
+    _fmt = 'Cannot watch working trees: %(reason)s'
+
+    def __init__(self, reason):
+        errors.BzrError.__init__(self, reason=reason)
+
+
+class Inotify(object):
+    """A minimal inotify binding.
+
+    Events are returned as (watch_descriptor, mask, cookie, name) tuples.
+    """
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise WatcherUnavailable('no C library found')
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+            init = libc.inotify_init1
+        except AttributeError:
+            raise WatcherUnavailable('inotify is not supported')
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self._fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise WatcherUnavailable(os.strerror(ctypes.get_errno()))
+
+    def fileno(self):
+        return self._fd
+
+    def add_watch(self, path, mask=_WATCH_MASK):
+        """Watch a directory.
+
+        :return: The watch descriptor for path.
+        :raise OSError: If the directory can't be watched.
+        """
+        wd = self._add_watch(self._fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self._fd, wd)
+
+    def read_events(self):
+        """Return all the queued events, without blocking."""
+        events = []
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return events
+                raise
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, name_len = _event_header.unpack_from(
+                    data, pos)
+                pos += _event_header.size
+                name = data[pos:pos + name_len].split('\0', 1)[0]
+                pos += name_len
+                events.append((wd, mask, cookie, name))
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class DirtyPaths(object):
+    """The paths modified in a tree, numbered in modification order.
+
+    The journal is identified by an epoch: when it has to be restarted (lost
+    events, too many paths), a new epoch is used and clients have to compare
+    the whole tree again.
+    """
+
+    def __init__(self, max_paths=100000):
+        self.max_paths = max_paths
+        self.reset()
+
+    def reset(self):
+        self.epoch = osutils.rand_chars(16)
+        self.token = 0
+        self._paths = {}
+
+    def add(self, path):
+        self.token += 1
+        self._paths[path] = self.token
+        if len(self._paths) > self.max_paths:
+            trace.mutter('too many modified paths, restarting the journal')
+            self.reset()
+
+    def since(self, epoch, token):
+        """Return the paths modified after token in epoch.
+
+        :return: A list of paths or None if epoch is not the current one.
+        """
+        if epoch != self.epoch:
+            return None
+        return [path for path, path_token in self._paths.iteritems()
+                if path_token > token]
+
+
+def _is_control_path(relpath):
+    return '.bzr' in relpath.split('/')
+
+
+class TreeWatcher(object):
+    """Record the modifications made in a directory tree.
+
+    Paths are utf8 encoded and relative to the tree root, control
+    directories are not watched.
+    """
+
+    def __init__(self, basedir, inotify=None, dirty=None):
+        if isinstance(basedir, unicode):
+            basedir = basedir.encode(osutils._fs_enc)
+        self.basedir = basedir
+        if inotify is None:
+            inotify = Inotify()
+        self._inotify = inotify
+        if dirty is None:
+            dirty = DirtyPaths()
+        self.dirty = dirty
+        self._wd_paths = {}
+        # False when some directories could not be watched: modifications
+        # may be missed so no journal can be trusted.
+        self.complete = True
+        self._stopped = False
+
+    def start(self):
+        self._watch_tree('')
+
+    def _watch_tree(self, relpath):
+        if relpath:
+            top = osutils.pathjoin(self.basedir, relpath)
+        else:
+            top = self.basedir
+        for dirpath, dirnames, filenames in os.walk(top):
+            dir_relpath = dirpath[len(self.basedir):].lstrip('/')
+            try:
+                wd = self._inotify.add_watch(dirpath)
+            except OSError, e:
+                if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                    # Removed meanwhile, its parent gets an event.
+                    continue
+                trace.warning('unable to watch %s: %s', dirpath, e)
+                self.complete = False
+                continue
+            self._wd_paths[wd] = dir_relpath
+            dirnames[:] = [name for name in dirnames if name != '.bzr']
+
+    def _unwatch_tree(self, relpath):
+        prefix = relpath + '/'
+        for wd, path in self._wd_paths.items():
+            if path == relpath or path.startswith(prefix):
+                self._inotify.rm_watch(wd)
+                del self._wd_paths[wd]
+
+    def process_events(self, events):
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                trace.mutter('inotify queue overflow, restarting the journal')
+                self.dirty.reset()
+                continue
+            if mask & IN_IGNORED:
+                self._wd_paths.pop(wd, None)
+                continue
+            dir_relpath = self._wd_paths.get(wd)
+            if dir_relpath is None:
+                continue
+            if not name:
+                # Events about the watched directory itself are also
+                # reported to the watch of its parent, except for the root.
+                if dir_relpath == '' and mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    self.dirty.reset()
+                continue
+            relpath = osutils.pathjoin(dir_relpath, name)
+            if _is_control_path(relpath):
+                continue
+            if mask & IN_ISDIR:
+                if mask & (IN_MODIFY | IN_ATTRIB):
+                    # Directory metadata is not versioned.
+                    continue
+                if mask & IN_MOVED_FROM:
+                    self._unwatch_tree(relpath)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files created before the watch is in place are covered
+                    # by the directory itself being dirty.
+                    self._watch_tree(relpath)
+            self.dirty.add(relpath)
+
+    def handle_request(self, request):
+        """Answer a client request.
+
+        :param request: A ('dirty', epoch, token) tuple.
+        :return: An (epoch, token, paths) tuple where paths are the paths
+            modified since the requested token, token the current one.
+        """
+        if request[0] != 'dirty':
+            raise ValueError('unknown request %r' % (request[0],))
+        epoch, token = request[1:]
+        self.process_events(self._inotify.read_events())
+        if not self.complete:
+            # Never let a client trust the journal.
+            self.dirty.reset()
+        paths = self.dirty.since(epoch, token)
+        if paths is None:
+            paths = []
+        return (self.dirty.epoch, self.dirty.token, paths)
+
+    def _handle_connection(self, conn):
+        try:
+            conn.settimeout(_QUERY_TIMEOUT)
+            chunks = []
+            while True:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            response = self.handle_request(
+                bencode.bdecode_as_tuple(''.join(chunks)))
+            conn.sendall(bencode.bencode(response))
+        except (socket.error, ValueError, TypeError), e:
+            trace.mutter('bad watcher request: %s', e)
+        conn.close()
+
+    def serve(self, listener):
+        """Record modifications and answer clients until stopped.
+
+        :param listener: A listening socket.
+        """
+        while not self._stopped:
+            readable = select.select([self._inotify, listener], [], [],
+                                     0.5)[0]
+            if self._inotify in readable:
+                self.process_events(self._inotify.read_events())
+            if listener in readable:
+                self._handle_connection(listener.accept()[0])
+
+    def stop(self):
+        self._stopped = True
+
+    def close(self):
+        self._inotify.close()
+
+
+def watch_tree(tree, watcher=None):
+    """Watch a working tree until interrupted.
+
+    :param tree: A working tree.
+    :param watcher: The TreeWatcher to use, one watching tree is created if
+        None.
+    """
+    if watcher is None:
+        watcher = TreeWatcher(tree.basedir)
+    socket_dir = tempfile.mkdtemp(prefix='bzr-watch-')
+    socket_path = osutils.pathjoin(socket_dir, 'socket')
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        listener.bind(socket_path)
+        listener.listen(5)
+        watcher.start()
+        tree._transport.put_bytes(WATCHER_FILENAME, socket_path + '\n',
+                                  mode=tree.bzrdir._get_file_mode())
+        try:
+            watcher.serve(listener)
+        finally:
+            try:
+                if tree._transport.get_bytes(WATCHER_FILENAME).rstrip(
+                    '\n') == socket_path:
+                    tree._transport.delete(WATCHER_FILENAME)
+            except errors.NoSuchFile:
+                pass
+    finally:
+        listener.close()
+        watcher.close()
+        osutils.rmtree(socket_dir)
+
+
+def _query_watcher(socket_path, epoch, token):
+    """Ask a watcher for the paths modified since token.
+
+    :return: An (epoch, token, paths) tuple.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(_QUERY_TIMEOUT)
+        sock.connect(socket_path)
+        sock.sendall(bencode.bencode(('dirty', epoch, token)))
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        sock.close()
+    return bencode.bdecode_as_tuple(''.join(chunks))
+
+
+def load_baseline(transport):
+    """Read the baseline saved by a previous comparison.
+
+    :return: An (epoch, token, parent_ids, paths) tuple or None.
+    """
+    try:
+        bytes = transport.get_bytes(BASELINE_FILENAME)
+    except errors.NoSuchFile:
+        return None
+    if not bytes.startswith(_FORMAT_STRING):
+        return None
+    try:
+        epoch, token, parent_ids, paths = bencode.bdecode_as_tuple(
+            bytes[len(_FORMAT_STRING):])
+    except (ValueError, TypeError), e:
+        trace.mutter('ignoring corrupt watch baseline in %s: %s',
+                     transport.base, e)
+        return None
+    return epoch, token, parent_ids, paths
+
+
+def save_baseline(transport, epoch, token, parent_ids, paths, file_mode=None):
+    bytes = _FORMAT_STRING + bencode.bencode(
+        (epoch, token, tuple(parent_ids), sorted(paths)))
+    try:
+        transport.put_bytes(BASELINE_FILENAME, bytes, mode=file_mode)
+    except (errors.TransportNotPossible, errors.PathError), e:
+        trace.mutter('unable to write watch baseline in %s: %s',
+                     transport.base, e)
+
+
+class WatchedChanges(object):
+    """Restrict the comparison of a dirstate tree with its basis.
+
+    :ivar paths: The utf8 paths to look at, or None if the whole tree has to
+        be compared.
+    """
+
+    def __init__(self, tree, parent_ids, epoch, token, paths):
+        self._tree = tree
+        self._parent_ids = parent_ids
+        self._epoch = epoch
+        self._token = token
+        self.paths = paths
+        self._unversioned = []
+
+    @classmethod
+    def for_tree(cls, tree):
+        """Get the changes recorded by the watcher of tree.
+
+        :return: A WatchedChanges or None if tree is not watched.
+        """
+        try:
+            socket_path = tree._transport.get_bytes(WATCHER_FILENAME)
+        except errors.NoSuchFile:
+            return None
+        parent_ids = tree.get_parent_ids()
+        baseline = load_baseline(tree._transport)
+        if baseline is None or baseline[2] != tuple(parent_ids):
+            baseline = ('', 0, (), ())
+        base_epoch, base_token, _, base_paths = baseline
+        try:
+            epoch, token, dirty = _query_watcher(socket_path.rstrip('\n'),
+                                                 base_epoch, base_token)
+        except (socket.error, ValueError, TypeError), e:
+            trace.mutter('unable to query tree watcher: %s', e)
+            return None
+        if epoch == base_epoch:
+            paths = set(base_paths)
+            paths.update(dirty)
+        else:
+            paths = None
+        return cls(tree, parent_ids, epoch, token, paths)
+
+    def _versioned_entries(self, state, path, indices):
+        return [entry for entry in state._entries_for_path(path)
+                if [index for index in indices
+                    if entry[1][index][0] not in 'ar']]
+
+    def specific_files(self, state, source_index):
+        """Return the versioned paths to compare.
+
+        Paths outside of versioned directories are not handled by
+        iter_changes like a full comparison does: the unversioned paths with
+        a versioned parent are kept aside and reported by iter_changes.
+
+        :param state: The locked dirstate of the tree.
+        :param source_index: The index of the basis in state.
+        :return: A set of utf8 paths.
+        """
+        if self.paths is None:
+            return set([''])
+        candidates = set(path for path in self.paths
+                         if not _is_control_path(path))
+        # Versioning changes are not seen by the watcher.
+        for block in state._dirblocks:
+            for entry in block[1]:
+                if entry[1][0][0] != entry[1][source_index][0]:
+                    candidates.add(
+                        osutils.pathjoin(entry[0][0], entry[0][1]))
+        versioned = set()
+        unversioned = set()
+        for path in candidates:
+            if self._versioned_entries(state, path, (0, source_index)):
+                versioned.add(path)
+            # Only the unversioned path closest to the root is reported.
+            parts = path.split('/')
+            for index in range(1, len(parts) + 1):
+                prefix = '/'.join(parts[:index])
+                entries = self._versioned_entries(state, prefix, (0,))
+                if not entries:
+                    unversioned.add(prefix)
+                    break
+                if entries[0][1][0][0] != 'd':
+                    # Inside a tree reference or below a file.
+                    break
+        versioned = osutils.minimum_path_selection(versioned)
+        if '' in versioned:
+            unversioned = ()
+        self._unversioned = sorted(path for path in unversioned
+            if not [parent for parent in osutils.parent_directories(path)
+                    if parent in versioned])
+        return versioned
+
+    def _iter_unversioned(self):
+        for path in self._unversioned:
+            path = path.decode('utf8')
+            try:
+                st = os.lstat(self._tree.abspath(path))
+            except OSError, e:
+                if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise
+            kind = osutils.file_kind_from_stat_mode(st.st_mode)
+            if (kind == 'directory'
+                and self._tree._directory_is_tree_reference(path)):
+                kind = 'tree-reference'
+            executable = bool(stat.S_ISREG(st.st_mode)
+                              and stat.S_IEXEC & st.st_mode)
+            yield (None, (None, path), True, (False, False), (None, None),
+                   (None, osutils.basename(path)), (None, kind),
+                   (None, executable))
+
+    def iter_changes(self, changes, want_unversioned):
+        """Report changes, saving a new baseline once they are all seen.
+
+        :param changes: The iter_changes results for specific_files.
+        :param want_unversioned: Whether unversioned paths are reported,
+            a baseline is only saved if they are.
+        """
+        changed = set()
+        for change in changes:
+            for path in change[1]:
+                if path is not None:
+                    changed.add(path.encode('utf8'))
+            yield change
+        if not want_unversioned:
+            return
+        for change in self._iter_unversioned():
+            changed.add(change[1][1].encode('utf8'))
+            yield change
+        save_baseline(self._tree._transport, self._epoch, self._token,
+                      self._parent_ids, changed,
+                      self._tree.bzrdir._get_file_mode())
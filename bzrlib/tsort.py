@@ -185,6 +185,46 @@ def merge_sort(graph, branch_tip, mainline_revisions=None, generate_revno=False)
         generate_revno).sorted()
 
 
+def extend_merge_sort(graph, branch_tip, base_tip, base_revnos,
+                      revno_to_branch_count):
+    """Merge sort the nodes added on top of a previously sorted tip.
+
+    Because the merge sort walks the left-hand subtree of a node before its
+    merged parents, a tip whose left-hand ancestry contains base_tip numbers
+    the ancestry of base_tip exactly as sorting base_tip alone did. Only the
+    nodes that are not ancestors of base_tip need to be sorted, given the
+    state the previous sort finished with.
+
+    :param graph: sequence of pairs of node->parents_list for the nodes
+        reachable from branch_tip but not from base_tip.
+    :param branch_tip: the new tip. base_tip must be one of its left-hand
+        ancestors.
+    :param base_tip: the tip of the previous merge sort.
+    :param base_revnos: a dict mapping previously sorted nodes to
+        (revno_sequence, first_child) pairs. It must contain base_tip and
+        every previously sorted node that is a parent of a node in graph.
+        first_child is True if no previously sorted node has the node as its
+        left-hand parent.
+    :param revno_to_branch_count: a dict mapping each revno to the number of
+        branches the previous sort started from it, 0 being the root
+        sequence.
+    :return: The merge_sort output with generate_revno=True for the new nodes
+        only.
+    """
+    sorter = MergeSorter(graph, None, generate_revno=True)
+    for node_name, (revno, first_child) in base_revnos.iteritems():
+        sorter._revnos[node_name] = [revno, first_child]
+        sorter._completed_node_names.add(node_name)
+    sorter._revno_to_branch_count.update(revno_to_branch_count)
+    # Scheduling base_tip first gives the oldest new node the right
+    # end_of_merge value; it is dropped from the output below.
+    sorter._scheduled_nodes.append((base_tip, 0, base_revnos[base_tip][0]))
+    sorter._push_node(branch_tip, 0, sorter._graph.pop(branch_tip))
+    result = sorter.sorted()
+    result.pop()
+    return result
+
+
 class MergeSorter(object):
 
     __slots__ = ['_node_name_stack',
@@ -18,10 +18,13 @@
 
 from __future__ import absolute_import
 
+import sys
 
 from bzrlib.lazy_import import lazy_import
 lazy_import(globals(), """
+import collections
 import itertools
+import multiprocessing
 
 from bzrlib import (
     check,
@@ -31,6 +34,7 @@ from bzrlib import (
     fifo_cache,
     gpg,
     graph,
+    groupcompress,
     inventory_delta,
     lru_cache,
     osutils,
@@ -1085,17 +1089,18 @@ class VersionedFileRepository(Repository):
     def _do_check_inventories(self, checker, bar):
         """Helper for _check_inventories."""
         revno = 0
-        keys = {'chk_bytes':set(), 'inventories':set(), 'texts':set()}
+        keys = {'chk_bytes':set(), 'inventories':set()}
         kinds = ['chk_bytes', 'texts']
         count = len(checker.pending_keys)
         bar.update(gettext("inventories"), 0, 2)
         current_keys = checker.pending_keys
-        checker.pending_keys = {}
+        checker.pending_keys = checker._new_pending_keys()
         # Accumulate current checks.
         for key in current_keys:
             if key[0] != 'inventories' and key[0] not in kinds:
                 checker._report_items.append('unknown key type %r' % (key,))
-            keys[key[0]].add(key[1:])
+            elif key[0] != 'texts':
+                keys[key[0]].add(key[1:])
         if keys['inventories']:
             # NB: output order *should* be roughly sorted - topo or
             # inverse topo depending on repository - either way decent
@@ -1115,29 +1120,99 @@ class VersionedFileRepository(Repository):
         else:
             return
         bar.update(gettext("texts"), 1)
-        while (checker.pending_keys or keys['chk_bytes']
-            or keys['texts']):
+        # Texts referenced by the revisions themselves are checked with the
+        # ones referenced by the inventories.
+        pending_texts = [current_keys]
+        while checker.pending_keys or keys['chk_bytes']:
             # Something to check.
             current_keys = checker.pending_keys
-            checker.pending_keys = {}
+            checker.pending_keys = checker._new_pending_keys()
+            pending_texts.append(current_keys)
             # Accumulate current checks.
-            for key in current_keys:
+            for key, item_data in current_keys.other_items().iteritems():
                 if key[0] not in kinds:
                     checker._report_items.append('unknown key type %r' % (key,))
-                keys[key[0]].add(key[1:])
-            # Check the outermost kind only - inventories || chk_bytes || texts
-            for kind in kinds:
-                if keys[kind]:
-                    last_object = None
-                    for record in getattr(self, kind).check(keys=keys[kind]):
-                        if record.storage_kind == 'absent':
-                            checker._report_items.append(
-                                'Missing %s {%s}' % (kind, record.key,))
-                        else:
-                            last_object = self._check_record(kind, record,
-                                checker, last_object, current_keys[(kind,) + record.key])
-                    keys[kind] = set()
-                    break
+                else:
+                    keys[key[0]].add(key[1:])
+            # Check the outermost kind only - chk_bytes || texts, the texts
+            # being checked in batches by _check_texts.
+            if keys['chk_bytes']:
+                last_object = None
+                for record in self.chk_bytes.check(keys=keys['chk_bytes']):
+                    if record.storage_kind == 'absent':
+                        checker._report_items.append(
+                            'Missing %s {%s}' % ('chk_bytes', record.key,))
+                    else:
+                        last_object = self._check_record('chk_bytes', record,
+                            checker, last_object,
+                            current_keys[('chk_bytes',) + record.key])
+                keys['chk_bytes'] = set()
+        for current_keys in pending_texts:
+            self._check_texts(checker, current_keys)
+
+    # The number of texts verified at once
+    _check_batch_size = 1000
+
+    def _check_texts(self, checker, pending_keys):
+        """Check the texts referenced by some pending keys.
+
+        When checker.workers is greater than 1, the texts are extracted and
+        hashed in that many processes.
+        """
+        batches = pending_keys.iter_text_batches(self._check_batch_size)
+        workers = checker.workers
+        if workers > 1 and sys.platform != 'win32':
+            self._check_texts_in_pool(checker, batches, workers)
+            return
+        for batch in batches:
+            self._check_text_batch(checker, batch)
+
+    def _check_text_batch(self, checker, batch):
+        item_data = dict(batch)
+        for record in self.texts.check(keys=item_data.keys()):
+            if record.storage_kind == 'absent':
+                checker._report_items.append(
+                    'Missing %s {%s}' % ('texts', record.key,))
+            else:
+                self._check_text(record, checker, item_data[record.key])
+
+    def _check_texts_in_pool(self, checker, batches, workers):
+        """Check batches of texts, hashing them in worker processes.
+
+        The workers inherit this repository and return the sha1s of the texts
+        of a batch, at most 2 * workers batches being pending at once.
+        """
+        mutter('checking texts with %d workers', workers)
+        pending = collections.deque()
+        def check_batch():
+            batch, result = pending.popleft()
+            sha1s = result.get()
+            if sha1s is None:
+                # The worker failed, report the error from here
+                self._check_text_batch(checker, batch)
+                return
+            for key, item_data in batch:
+                sha1 = sha1s.get(key)
+                if sha1 is None:
+                    checker._report_items.append(
+                        'Missing %s {%s}' % ('texts', key,))
+                elif item_data and sha1 != item_data[1]:
+                    checker._report_items.append(
+                        'sha1 mismatch: %s has sha1 %s expected %s referenced'
+                        ' by %s' % (key, sha1, item_data[1], item_data[2]))
+        pool = multiprocessing.Pool(workers, _init_check_worker, (self,))
+        try:
+            for batch in batches:
+                pending.append((batch, pool.apply_async(_hash_texts,
+                    ([key for key, item_data in batch],))))
+                while len(pending) > 2 * workers:
+                    check_batch()
+            while pending:
+                check_batch()
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
 
     def _check_record(self, kind, record, checker, last_object, item_data):
         """Check a single text from this repository."""
@@ -2526,6 +2601,9 @@ class _VersionedFileChecker(object):
             if local_progress:
                 local_progress.finished()
 
+    # The number of text keys whose stored parents are read at once
+    _batch_size = 10000
+
     def _check_file_version_parents(self, texts, progress_bar):
         """See check_file_version_parents."""
         wrong_parents = {}
@@ -2534,12 +2612,24 @@ class _VersionedFileChecker(object):
         # text keys is now grouped by file_id
         n_versions = len(self.text_index)
         progress_bar.update(gettext('loading text store'), 0, n_versions)
-        parent_map = self.repository.texts.get_parent_map(self.text_index)
         # On unlistable transports this could well be empty/error...
         text_keys = self.repository.texts.keys()
-        unused_keys = frozenset(text_keys) - set(self.text_index)
+        unused_keys = frozenset([key for key in text_keys
+                                 if key not in self.text_index])
+        del text_keys
+        batch = []
         for num, key in enumerate(self.text_index.iterkeys()):
-            progress_bar.update(gettext('checking text graph'), num, n_versions)
+            batch.append(key)
+            if len(batch) >= self._batch_size or num == n_versions - 1:
+                progress_bar.update(gettext('checking text graph'), num,
+                                    n_versions)
+                self._check_parents_of(batch, wrong_parents)
+                batch = []
+        return wrong_parents, unused_keys
+
+    def _check_parents_of(self, text_keys, wrong_parents):
+        parent_map = self.repository.texts.get_parent_map(text_keys)
+        for key in text_keys:
             correct_parents = self.calculate_file_version_parents(key)
             try:
                 knit_parents = parent_map[key]
@@ -2548,7 +2638,6 @@ class _VersionedFileChecker(object):
                 knit_parents = None
             if correct_parents != knit_parents:
                 wrong_parents[key] = (knit_parents, correct_parents)
-        return wrong_parents, unused_keys
 
 
 class InterVersionedFileRepository(InterRepository):
@@ -2737,6 +2826,9 @@ class InterVersionedFileRepository(InterRepository):
 
 class InterDifferingSerializer(InterVersionedFileRepository):
 
+    # The number of revisions copied in each write group
+    _batch_size = 100
+
     @classmethod
     def _get_repo_format_to_test(self):
         return None
@@ -2857,6 +2949,31 @@ class InterDifferingSerializer(InterVersionedFileRepository):
         :return: The revision_id of the last converted tree. The RevisionTree
             for it will be in cache
         """
+        parent_map = self.source.get_parent_map(revision_ids)
+        self._fetch_parent_invs_for_stacking(parent_map, cache)
+        self.source._safe_to_return_from_cache = True
+        (basis_id, pending_deltas, pending_revisions, root_keys_to_create,
+         text_keys, root_ids) = self._analyse_batch(revision_ids, parent_map,
+                                                    basis_id, cache)
+        self.source._safe_to_return_from_cache = False
+        return self._insert_batch(parent_map, pending_deltas,
+            pending_revisions, root_keys_to_create, text_keys, root_ids,
+            basis_id, cache)
+
+    def _analyse_batch(self, revision_ids, parent_map, basis_id, cache):
+        """Find the inventory deltas and texts needed to copy a few revisions.
+
+        This only reads from the source repository.
+
+        :param revision_ids: The revisions to copy
+        :param parent_map: The parents of revision_ids in the source.
+        :param basis_id: The revision_id of a tree that must be in cache, used
+            as a basis for delta when no other base is available
+        :param cache: A cache of RevisionTrees that we can use.
+        :return: A (basis_id, pending_deltas, pending_revisions,
+            root_keys_to_create, text_keys, root_ids) tuple, root_ids mapping
+            the revisions to their root ids when converting to rich roots.
+        """
         # Walk though all revisions; get inventory deltas, copy referenced
         # texts that delta references, insert the delta, revision and
         # signature.
@@ -2864,9 +2981,7 @@ class InterDifferingSerializer(InterVersionedFileRepository):
         text_keys = set()
         pending_deltas = []
         pending_revisions = []
-        parent_map = self.source.get_parent_map(revision_ids)
-        self._fetch_parent_invs_for_stacking(parent_map, cache)
-        self.source._safe_to_return_from_cache = True
+        root_ids = {}
         for tree in self.source.revision_trees(revision_ids):
             # Find a inventory delta for this revision.
             # Find text entries that need to be copied, too.
@@ -2884,8 +2999,7 @@ class InterDifferingSerializer(InterVersionedFileRepository):
             pending_deltas.append((basis_id, delta,
                 current_revision_id, revision.parent_ids))
             if self._converting_to_rich_root:
-                self._revision_id_to_root_id[current_revision_id] = \
-                    tree.get_root_id()
+                root_ids[current_revision_id] = tree.get_root_id()
             # Determine which texts are in present in this revision but not in
             # any of the available parents.
             texts_possibly_new_in_tree = set()
@@ -2920,7 +3034,20 @@ class InterDifferingSerializer(InterVersionedFileRepository):
             pending_revisions.append(revision)
             cache[current_revision_id] = tree
             basis_id = current_revision_id
-        self.source._safe_to_return_from_cache = False
+        return (basis_id, pending_deltas, pending_revisions,
+                root_keys_to_create, text_keys, root_ids)
+
+    def _insert_batch(self, parent_map, pending_deltas, pending_revisions,
+                      root_keys_to_create, text_keys, root_ids, basis_id,
+                      cache, text_blocks=None):
+        """Insert the data found by _analyse_batch into the target.
+
+        :param text_blocks: If not None, the texts of text_keys already
+            compressed by groupcompress._compress_texts.
+        :return: The revision_id of the last converted tree.
+        """
+        if self._converting_to_rich_root:
+            self._revision_id_to_root_id.update(root_ids)
         # Copy file texts
         from_texts = self.source.texts
         to_texts = self.target.texts
@@ -2929,9 +3056,12 @@ class InterDifferingSerializer(InterVersionedFileRepository):
                 root_keys_to_create, self._revision_id_to_root_id, parent_map,
                 self.source)
             to_texts.insert_record_stream(root_stream)
-        to_texts.insert_record_stream(from_texts.get_record_stream(
-            text_keys, self.target._format._fetch_order,
-            not self.target._format._fetch_uses_deltas))
+        if text_blocks is not None:
+            to_texts._add_compressed_blocks(text_blocks)
+        else:
+            to_texts.insert_record_stream(from_texts.get_record_stream(
+                text_keys, self.target._format._fetch_order,
+                not self.target._format._fetch_uses_deltas))
         # insert inventory deltas
         for delta in pending_deltas:
             self.target.add_inventory_by_delta(*delta)
@@ -2979,26 +3109,98 @@ class InterDifferingSerializer(InterVersionedFileRepository):
     def _fetch_all_revisions(self, revision_ids, pb):
         """Fetch everything for the list of revisions.
 
+        Every batch of revisions is committed in its own write group, so an
+        interrupted fetch only has to copy the revisions still missing when
+        it is started again.
+
         :param revision_ids: The list of revisions to fetch. Must be in
             topological order.
         :param pb: A ProgressTask
         :return: None
         """
         basis_id, basis_tree = self._get_basis(revision_ids[0])
-        batch_size = 100
+        batch_size = self._batch_size
         cache = lru_cache.LRUCache(100)
         cache[basis_id] = basis_tree
         del basis_tree # We don't want to hang on to it here
         hints = []
-        a_graph = None
+        workers = self._get_convert_workers(revision_ids, batch_size)
+        if workers > 1:
+            self._fetch_batches_in_pool(revision_ids, batch_size, basis_id,
+                                        cache, hints, workers, pb)
+        else:
+            for offset in range(0, len(revision_ids), batch_size):
+                self.target.start_write_group()
+                try:
+                    pb.update(gettext('Transferring revisions'), offset,
+                              len(revision_ids))
+                    batch = revision_ids[offset:offset+batch_size]
+                    basis_id = self._fetch_batch(batch, basis_id, cache)
+                except:
+                    self.source._safe_to_return_from_cache = False
+                    self.target.abort_write_group()
+                    raise
+                else:
+                    hint = self.target.commit_write_group()
+                    if hint:
+                        hints.extend(hint)
+        if hints and self.target._format.pack_compresses:
+            self.target.pack(hint=hints)
+        pb.update(gettext('Transferring revisions'), len(revision_ids),
+                  len(revision_ids))
 
-        for offset in range(0, len(revision_ids), batch_size):
+    def _get_convert_workers(self, revision_ids, batch_size):
+        """Return the number of processes to prepare batches in."""
+        if len(revision_ids) <= batch_size:
+            return 0
+        if self.target._fallback_repositories:
+            # Parent inventories are copied depending on the previous batches
+            return 0
+        if sys.platform == 'win32':
+            # The workers inherit the source repository by forking
+            return 0
+        return _mod_config.LocationStack(self.target.user_url).get(
+            'repository.convert_workers')
+
+    def _fetch_batches_in_pool(self, revision_ids, batch_size, basis_id,
+                               cache, hints, workers, pb):
+        """Fetch batches of revisions prepared in worker processes.
+
+        The workers compute the inventory deltas of the batches, read their
+        texts and, when the target uses groupcompress, compress them. The
+        batches are inserted in order, each in its own write group, while
+        at most 2 * workers further batches are prepared.
+        """
+        to_texts = self.target.texts
+        if (getattr(to_texts, '_add_compressed_blocks', None) is not None
+            and not self.target._format._fetch_uses_deltas):
+            compressor_settings = to_texts._get_compressor_settings()
+        else:
+            compressor_settings = None
+        mutter('converting %d revisions with %d workers', len(revision_ids),
+               workers)
+        pending = collections.deque()
+        def insert_batch():
+            offset, batch, batch_basis_id, result = pending.popleft()
+            pb.update(gettext('Transferring revisions'), offset,
+                      len(revision_ids))
+            prepared = result.get()
+            if batch_basis_id not in cache:
+                cache[batch_basis_id] = self.source.revision_tree(
+                    batch_basis_id)
             self.target.start_write_group()
             try:
-                pb.update(gettext('Transferring revisions'), offset,
-                          len(revision_ids))
-                batch = revision_ids[offset:offset+batch_size]
-                basis_id = self._fetch_batch(batch, basis_id, cache)
+                if prepared is None:
+                    # The worker failed, report the error from here
+                    self._fetch_batch(batch, batch_basis_id, cache)
+                else:
+                    parent_map, analysis, text_blocks = prepared
+                    (last_id, pending_deltas, pending_revisions,
+                     root_keys_to_create, text_keys, root_ids) = analysis
+                    self._fetch_parent_invs_for_stacking(parent_map, cache)
+                    self._insert_batch(parent_map, pending_deltas,
+                        pending_revisions, root_keys_to_create, text_keys,
+                        root_ids, last_id, cache, text_blocks=text_blocks)
             except:
                 self.source._safe_to_return_from_cache = False
                 self.target.abort_write_group()
@@ -3007,10 +3209,22 @@ class InterDifferingSerializer(InterVersionedFileRepository):
                 hint = self.target.commit_write_group()
                 if hint:
                     hints.extend(hint)
-        if hints and self.target._format.pack_compresses:
-            self.target.pack(hint=hints)
-        pb.update(gettext('Transferring revisions'), len(revision_ids),
-                  len(revision_ids))
+        pool = multiprocessing.Pool(workers, _init_convert_worker, (self,))
+        try:
+            for offset in range(0, len(revision_ids), batch_size):
+                batch = revision_ids[offset:offset+batch_size]
+                pending.append((offset, batch, basis_id,
+                    pool.apply_async(_convert_batch,
+                        (batch, basis_id, compressor_settings))))
+                basis_id = batch[-1]
+                while len(pending) > 2 * workers:
+                    insert_batch()
+            while pending:
+                insert_batch()
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
 
     @needs_write_lock
     def fetch(self, revision_id=None, find_ghosts=False,
@@ -3082,6 +3296,90 @@ class InterDifferingSerializer(InterVersionedFileRepository):
         return basis_id, basis_tree
 
 
+# The InterDifferingSerializer the workers of a conversion pool read from,
+# inherited from the process which created the pool.
+_convert_inter = None
+
+
+def _init_convert_worker(inter):
+    global _convert_inter
+    _convert_inter = inter
+
+
+def _convert_batch(revision_ids, basis_id, compressor_settings):
+    """Prepare the conversion of a few revisions in a worker process.
+
+    :param revision_ids: The revisions to convert, in topological order.
+    :param basis_id: The revision used as a basis for the inventory deltas
+        of the revisions without parents.
+    :param compressor_settings: The settings to compress the new texts with
+        groupcompress, or None to leave the texts in the source.
+    :return: A (parent_map, analysis, text_blocks) tuple, analysis being the
+        result of InterDifferingSerializer._analyse_batch, or None if
+        preparing the batch failed.
+    """
+    inter = _convert_inter
+    source = inter.source
+    try:
+        cache = lru_cache.LRUCache(100)
+        cache[basis_id] = source.revision_tree(basis_id)
+        parent_map = source.get_parent_map(revision_ids)
+        source._safe_to_return_from_cache = True
+        analysis = inter._analyse_batch(revision_ids, parent_map, basis_id,
+                                        cache)
+        source._safe_to_return_from_cache = False
+        text_blocks = None
+        if compressor_settings is not None:
+            texts = []
+            for record in source.texts.get_record_stream(analysis[4],
+                    inter.target._format._fetch_order, True):
+                if record.storage_kind == 'absent':
+                    raise errors.RevisionNotPresent(record.key, source.texts)
+                texts.append((record.key, record.parents, record.sha1,
+                              record.get_bytes_as('fulltext')))
+            text_blocks = groupcompress._compress_texts(texts,
+                                                        compressor_settings)
+    except Exception, e:
+        # Errors are not always picklable, the batch is converted again by
+        # the parent process which reports them.
+        mutter('unable to prepare the conversion of %s: %s',
+               revision_ids[0], e)
+        return None
+    return parent_map, analysis, text_blocks
+
+
+# The repository the workers of a check pool read from, inherited from the
+# process which created the pool.
+_check_repository = None
+
+
+def _init_check_worker(repository):
+    global _check_repository
+    _check_repository = repository
+
+
+def _hash_texts(keys):
+    """Extract and hash texts in a worker process.
+
+    :param keys: The keys of the texts.
+    :return: A dict mapping the keys of the texts present to their sha1, or
+        None if the texts could not be read.
+    """
+    sha1s = {}
+    try:
+        for record in _check_repository.texts.check(keys=keys):
+            if record.storage_kind == 'absent':
+                continue
+            sha1s[record.key] = osutils.sha_strings(
+                record.get_bytes_as('chunked'))
+    except Exception, e:
+        # Errors are not always picklable, the batch is checked again by the
+        # parent process which reports them.
+        mutter('unable to hash texts in a worker: %s', e)
+        return None
+    return sha1s
+
+
 class InterSameDataRepository(InterVersionedFileRepository):
     """Code for converting between repositories that represent the same data.
 
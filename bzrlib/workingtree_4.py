@@ -49,6 +49,7 @@ from bzrlib import (
     revisiontree,
     trace,
     transform,
+    tree_watch,
     views,
     )
 """)
@@ -2219,7 +2220,15 @@ class InterDirStateTree(InterTree):
 
         # -- get the state object and prepare it.
         state = self.target.current_dirstate()
-        state._read_dirblocks_if_needed()
+        state._read_dirblocks_for_paths(specific_files)
+        watched = None
+        if (specific_files == set(['']) and source_index == 1
+            and not include_unchanged):
+            # Only look at the paths a watcher reports modified.
+            watched = tree_watch.WatchedChanges.for_tree(self.target)
+            if watched is not None:
+                specific_files = watched.specific_files(state, source_index)
+                require_versioned = False
         if require_versioned:
             # -- check all supplied paths are versioned in a search tree. --
             not_versioned = []
@@ -2248,9 +2257,18 @@ class InterDirStateTree(InterTree):
         search_specific_files = osutils.minimum_path_selection(specific_files)
 
         use_filesystem_for_exec = (sys.platform != 'win32')
-        iter_changes = self.target._iter_changes(include_unchanged,
+        process_entry = self.target._iter_changes
+        if (process_entry is not dirstate.ProcessEntryPython
+            and self.target.get_config_stack().get(
+                'dirstate.sha1_workers') > 1):
+            # Only the python implementation hashes files in threads
+            process_entry = dirstate.ProcessEntryPython
+        iter_changes = process_entry(include_unchanged,
             use_filesystem_for_exec, search_specific_files, state,
             source_index, target_index, want_unversioned, self.target)
+        if watched is not None:
+            return watched.iter_changes(iter_changes.iter_changes(),
+                                        want_unversioned)
         return iter_changes.iter_changes()
 
     @staticmethod
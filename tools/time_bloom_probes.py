@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""Count the btree probes of get_parent_map with and without bloom filters.
+
+A repository with many packs is built in a temporary directory, with
+autopacking disabled and the repository.bloom_filters option set so that
+each pack gets its filters. A probe is a descent into one btree index.
+get_parent_map is then run for present and missing revisions, reading the
+repository with and without the filters.
+"""
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from bzrlib import (
+    btree_index,
+    bzrdir,
+    config,
+    controldir,
+    trace,
+    urlutils,
+    )
+from bzrlib.repofmt import pack_repo
+
+p = optparse.OptionParser()
+p.add_option('--packs', default=40, type=int,
+             help='Number of packs to create')
+p.add_option('--queries', default=200, type=int,
+             help='Number of present and of missing revisions to look up')
+opts, args = p.parse_args(sys.argv[1:])
+
+trace.enable_default_logging()
+base = tempfile.mkdtemp(prefix='bzr-bloom-')
+# The option is set in locations.conf, keep it away from the user's one.
+os.environ['BZR_HOME'] = base
+
+probes = [0]
+_orig_walk = btree_index.BTreeGraphIndex._walk_through_internal_nodes
+def _counting_walk(self, keys):
+    probes[0] += 1
+    return _orig_walk(self, keys)
+btree_index.BTreeGraphIndex._walk_through_internal_nodes = _counting_walk
+# Keep every pack, this is what happens between autopacks.
+pack_repo.RepositoryPackCollection._max_pack_count = (
+    lambda self, total_revisions: opts.packs + 1)
+
+
+def set_bloom_filters(path, value):
+    location_config = config.LocationStack(urlutils.local_path_to_url(path))
+    location_config.set('repository.bloom_filters', value)
+
+
+def build_tree(path):
+    os.mkdir(path)
+    set_bloom_filters(path, True)
+    tree = bzrdir.BzrDir.create_standalone_workingtree(path,
+        format=controldir.format_registry.make_bzrdir('2a'))
+    revision_ids = []
+    tree.lock_write()
+    try:
+        # Each commit writes a pack of its own
+        for num in xrange(opts.packs):
+            revision_ids.append(tree.commit('commit %d' % (num,),
+                committer='bloom <bloom@example.com>'))
+    finally:
+        tree.unlock()
+    return tree, revision_ids
+
+
+def time_lookups(tree, use_bloom_filters, keys):
+    set_bloom_filters(tree.basedir, use_bloom_filters)
+    repo = tree.bzrdir.open_repository()
+    repo.lock_read()
+    try:
+        probes[0] = 0
+        start = time.time()
+        for key in keys:
+            repo.revisions.get_parent_map([key])
+        end = time.time()
+        return probes[0], end - start, len(repo._pack_collection.packs)
+    finally:
+        repo.unlock()
+
+
+try:
+    tree, revision_ids = build_tree(os.path.join(base, 'tree'))
+    present = [(rev_id,) for rev_id in revision_ids[-opts.queries:]]
+    missing = [('missing-%d' % i,) for i in xrange(opts.queries)]
+    for label, keys in [('present', present), ('missing', missing)]:
+        for use_bloom_filters in (False, True):
+            count, duration, pack_count = time_lookups(tree,
+                use_bloom_filters, keys)
+            print '%-8s bloom=%-5s packs=%d lookups=%d probes=%d (%.3fs)' % (
+                label, use_bloom_filters, pack_count, len(keys), count,
+                duration)
+finally:
+    shutil.rmtree(base)